@@ -0,0 +1,180 @@
+"""Benchmark of the artist leaderboards of database.py against the queries they replaced,
+as the number of sales per artist grows.
+
+The replaced queries joined every album purchase of an artist to every one of their
+track purchases, then counted them back down with COUNT(DISTINCT), so their cost grew
+with the square of an artist's sales. get_popular_artists now counts each kind of
+purchase per artist before combining them, and get_sales reads the hourly artist
+rollup, so their cost grows in line with the sales, or less. For each number of sales
+per artist, the bench_leaderboard schema is rebuilt from schema/schema.sql with that
+many album and track purchases for every artist, all in the last hour, and rolled up
+by the migration that creates the rollups. Each query's median wall time is printed,
+with the exponent of its growth from the previous size: about 1 is linear, about 2
+quadratic. Connects with the same environment variables as the dashboard, and only
+drops and recreates the bench_leaderboard schema.
+
+Run with: python3 benchmark_leaderboard.py --sales-per-artist 100 300 1000 3000
+"""
+
+import argparse
+import math
+from pathlib import Path
+import statistics
+import time
+
+from dotenv import load_dotenv
+from psycopg import Connection
+
+from benchmark_partitions import SCHEMA_PATH, get_connection, use_schema
+import database
+
+BENCH_SCHEMA = "bench_leaderboard"
+ROLLUP_MIGRATION_PATH = (Path(__file__).parent.parent / "schema" / "migrations"
+                         / "008_hourly_sales_rollups.sql")
+TIMEFRAME = "1 day"
+
+LEGACY_POPULAR_ARTISTS = """
+    SELECT A.artist_id, A.name, COUNT(DISTINCT AP.album_purchase_id) AS album_sales, COUNT(DISTINCT TP.track_purchase_id) AS track_sales, COUNT(DISTINCT AP.album_purchase_id) + COUNT(DISTINCT TP.track_purchase_id) AS total_sales, A.url as artist_url
+    FROM
+        artist AS A
+    LEFT JOIN
+        album AS AB ON A.artist_id = AB.artist_id
+    LEFT JOIN
+        album_purchase AS AP ON AB.album_id = AP.album_id
+    LEFT JOIN
+        track AS T ON A.artist_id = T.artist_id
+    LEFT JOIN
+        track_purchase AS TP ON T.track_id = TP.track_id
+    WHERE
+        CURRENT_TIMESTAMP < AP.timestamp + INTERVAL '{timeframe}'
+    GROUP BY
+        A.artist_id, A.name
+    ORDER BY
+        total_sales DESC
+    LIMIT 5
+"""
+LEGACY_SALES = """
+    SELECT A.name, COUNT(DISTINCT AP.album_purchase_id) AS album_sales, COUNT(DISTINCT TP.track_purchase_id) AS track_sales
+    FROM artist as A
+    LEFT JOIN album AS AB
+    ON AB.artist_id = A.artist_id
+    LEFT JOIN album_purchase AS AP
+    ON AP.album_id = AB.album_id
+    LEFT JOIN track as T
+    ON T.artist_id = A.artist_id
+    LEFT JOIN track_purchase as TP
+    ON TP.track_id = T.track_id
+    GROUP BY A.name
+"""
+SEED_SALES = [
+    """
+    INSERT INTO artist(name, url)
+    SELECT 'Artist ' || i, 'https://artist' || i || '.bandcamp.com'
+    FROM generate_series(1, %(artists)s) AS i
+    """,
+    """
+    INSERT INTO album(title, artist_id, url)
+    SELECT 'Album ' || i, 1 + i %% %(artists)s, 'https://bandcamp.com/album/a' || i
+    FROM generate_series(1, 2 * %(artists)s) AS i
+    """,
+    """
+    INSERT INTO track(title, album_id, artist_id, url)
+    SELECT 'Track ' || i, 1 + i %% (2 * %(artists)s), 1 + (i %% (2 * %(artists)s)) %% %(artists)s,
+           'https://bandcamp.com/track/t' || i
+    FROM generate_series(1, 4 * %(artists)s) AS i
+    """,
+    "INSERT INTO country(name) VALUES ('Country 1')",
+    """
+    INSERT INTO album_purchase(album_id, timestamp, amount_usd, country_id, purchase_key)
+    SELECT 1 + i %% (2 * %(artists)s), LOCALTIMESTAMP - INTERVAL '1 second' * (i %% 3600),
+           5, 1, encode(sha256(('a' || i)::BYTEA), 'hex')
+    FROM generate_series(1, %(sales)s * %(artists)s) AS i
+    """,
+    """
+    INSERT INTO track_purchase(track_id, timestamp, amount_usd, country_id, purchase_key)
+    SELECT 1 + i %% (4 * %(artists)s), LOCALTIMESTAMP - INTERVAL '1 second' * (i %% 3600),
+           1, 1, encode(sha256(('t' || i)::BYTEA), 'hex')
+    FROM generate_series(1, %(sales)s * %(artists)s) AS i
+    """,
+]
+
+
+def build_schema(conn: Connection, schema: str, artists: int, sales: int) -> None:
+    """Creates a schema of its own from schema.sql, with sales album and sales
+    track purchases for each of artists artists, rolled up."""
+    conn.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+    conn.execute(f"CREATE SCHEMA {schema}")
+    use_schema(conn, schema)
+    conn.execute(SCHEMA_PATH.read_text(encoding="utf-8"))
+    for statement in SEED_SALES:
+        conn.execute(statement, {"artists": artists, "sales": sales})
+    conn.execute(ROLLUP_MIGRATION_PATH.read_text(encoding="utf-8"))
+    conn.execute("ANALYZE")
+
+
+def get_queries() -> dict:
+    """Returns each leaderboard's query before and after, as functions of a connection."""
+    return {
+        "popular_artists": (
+            lambda conn: conn.execute(
+                LEGACY_POPULAR_ARTISTS.format(timeframe=TIMEFRAME)).fetchall(),
+            lambda conn: database.get_popular_artists.__wrapped__(conn, TIMEFRAME)),
+        "sales": (
+            lambda conn: conn.execute(LEGACY_SALES).fetchall(),
+            database.get_sales.__wrapped__),
+    }
+
+
+def time_query(conn: Connection, query, repeats: int) -> float:
+    """Returns the median wall time of a query over repeats runs."""
+    wall_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        query(conn)
+        wall_times.append(time.perf_counter() - start)
+    return statistics.median(wall_times)
+
+
+def get_growth(wall_time: float, previous_wall_time: float, sales: int,
+               previous_sales: int) -> str:
+    """Returns the exponent of a query's growth between two sizes, as text."""
+    if previous_wall_time is None:
+        return "-"
+    return f"{math.log(wall_time / previous_wall_time) / math.log(sales / previous_sales):.2f}"
+
+
+def run_benchmark(sizes: list[int], artists: int, repeats: int) -> None:
+    """Times both leaderboards before and after at every number of sales per
+    artist, and prints how each grows"""
+    conn = get_connection()
+    queries = get_queries()
+    previous = {}
+    try:
+        print(f"{'query':>16}{'sales/artist':>14}{'before (s)':>12}{'growth':>8}"
+              f"{'after (s)':>11}{'growth':>8}")
+        for sales in sizes:
+            build_schema(conn, BENCH_SCHEMA, artists, sales)
+            for name, (before_query, after_query) in queries.items():
+                before = time_query(conn, before_query, repeats)
+                after = time_query(conn, after_query, repeats)
+                previous_sales, previous_before, previous_after = previous.get(
+                    name, (None, None, None))
+                print(f"{name:>16}{sales:>14}{before:>12.3f}"
+                      f"{get_growth(before, previous_before, sales, previous_sales):>8}"
+                      f"{after:>11.3f}"
+                      f"{get_growth(after, previous_after, sales, previous_sales):>8}")
+                previous[name] = (sales, before, after)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sales-per-artist", type=int, nargs="+", default=[100, 300, 1000, 3000],
+                        help="numbers of album and of track purchases per artist to time")
+    parser.add_argument("--artists", type=int, default=10, help="number of artists")
+    parser.add_argument("--repeats", type=int, default=3, help="runs of each query to time")
+    args = parser.parse_args()
+
+    load_dotenv()
+    run_benchmark(args.sales_per_artist, args.artists, args.repeats)
@@ -0,0 +1,243 @@
+"""Benchmark of the dashboard's timeframe queries on purchase tables partitioned by
+month against the same purchases in single heap tables.
+
+Builds two copies of the schema from schema/schema.sql in schemas of their own: in
+bench_heap the purchase tables are replaced by the heap tables they were before
+partitioning, with no index on timestamp, and in bench_partitioned they are kept
+partitioned by month, with a partition for every month of the generated purchases
+and a BRIN index on timestamp. The same synthetic purchases, spread evenly over
+the months and inserted in time order as the pipeline inserts them, are loaded into
+both. Each timeframe query of database.py is then run for every timeframe the
+dashboard offers against each copy, and the median wall time reported.
+Connects with the same environment variables as the dashboard. Only the bench_
+schemas are dropped and recreated, but loading 50 million purchases takes a while
+and the disk space of both copies.
+
+Run with: python3 benchmark_partitions.py --size 50000000 --months 24
+"""
+
+import argparse
+from os import environ as ENV
+from pathlib import Path
+import statistics
+import time
+
+from dotenv import load_dotenv
+from psycopg import connect, Connection
+from psycopg.rows import dict_row
+
+import database
+
+SCHEMA_PATH = Path(__file__).parent.parent / "schema" / "schema.sql"
+VARIANTS = ["bench_heap", "bench_partitioned"]
+TIMEFRAMES = ["1 day", "1 week", "1 month", "1 year"]
+QUERIES = {
+    "popular_tracks": database.get_popular_tracks,
+    "popular_albums": database.get_popular_albums,
+    "popular_artists": database.get_popular_artists,
+    "sales_by_tag": database.get_sales_by_tag,
+}
+ARTISTS = 20000
+ALBUMS = 50000
+TRACKS = 250000
+TAGS = 300
+COUNTRIES = 50
+ALBUM_PURCHASE_SHARE = 0.35
+
+HEAP_PURCHASE_TABLES = """
+    DROP TABLE album_purchase, track_purchase;
+    CREATE TABLE album_purchase (
+        album_purchase_id INT PRIMARY KEY,
+        album_id INT NOT NULL,
+        timestamp TIMESTAMP(0) NOT NULL,
+        amount_usd DECIMAL(6,2) NOT NULL,
+        country_id SMALLINT NOT NULL,
+        purchase_key CHAR(64) UNIQUE NOT NULL
+    );
+    CREATE TABLE track_purchase (
+        track_purchase_id INT PRIMARY KEY,
+        track_id INT NOT NULL,
+        timestamp TIMESTAMP(0) NOT NULL,
+        amount_usd DECIMAL(6,2) NOT NULL,
+        country_id SMALLINT NOT NULL,
+        purchase_key CHAR(64) UNIQUE NOT NULL
+    );
+"""
+DROP_PURCHASE_FOREIGN_KEYS = """
+    ALTER TABLE album_purchase DROP CONSTRAINT album_purchase_album_id_fkey,
+                               DROP CONSTRAINT album_purchase_country_id_fkey;
+    ALTER TABLE track_purchase DROP CONSTRAINT track_purchase_track_id_fkey,
+                               DROP CONSTRAINT track_purchase_country_id_fkey;
+"""
+SEED_DIMENSIONS = [
+    """
+    INSERT INTO artist(name, url)
+    SELECT 'Artist ' || i, 'https://artist' || i || '.bandcamp.com'
+    FROM generate_series(1, %(artists)s) AS i
+    """,
+    """
+    INSERT INTO album(title, artist_id, url)
+    SELECT 'Album ' || i, 1 + i %% %(artists)s, 'https://bandcamp.com/album/a' || i
+    FROM generate_series(1, %(albums)s) AS i
+    """,
+    """
+    INSERT INTO track(title, album_id, artist_id, url)
+    SELECT 'Track ' || i, 1 + i %% %(albums)s, 1 + (i %% %(albums)s) %% %(artists)s,
+           'https://bandcamp.com/track/t' || i
+    FROM generate_series(1, %(tracks)s) AS i
+    """,
+    """
+    INSERT INTO tag(name) SELECT 'genre' || i FROM generate_series(1, %(tags)s) AS i
+    """,
+    """
+    INSERT INTO country(name) SELECT 'Country ' || i FROM generate_series(1, %(countries)s) AS i
+    """,
+    """
+    INSERT INTO album_tag_assignment(album_id, tag_id)
+    SELECT DISTINCT album_id, 1 + (album_id * 7 + n * 31) %% %(tags)s
+    FROM generate_series(1, %(albums)s) AS album_id, generate_series(1, 4) AS n
+    """,
+    """
+    INSERT INTO track_tag_assignment(track_id, tag_id)
+    SELECT DISTINCT track_id, 1 + (track_id * 7 + n * 31) %% %(tags)s
+    FROM generate_series(1, %(tracks)s) AS track_id, generate_series(1, 4) AS n
+    """,
+]
+SEED_PURCHASES = [
+    """
+    SELECT setseed(0.5)
+    """,
+    """
+    INSERT INTO album_purchase
+    SELECT i, 1 + floor(%(albums)s * power(random(), 3))::INT,
+           LOCALTIMESTAMP - %(months)s * INTERVAL '1 month' * (1 - i::FLOAT / %(album_rows)s),
+           round((1 + random() * 29)::NUMERIC, 2), 1 + floor(%(countries)s * random())::INT,
+           encode(sha256(('a' || i)::BYTEA), 'hex')
+    FROM generate_series(1, %(album_rows)s) AS i
+    """,
+    """
+    INSERT INTO track_purchase
+    SELECT i, 1 + floor(%(tracks)s * power(random(), 3))::INT,
+           LOCALTIMESTAMP - %(months)s * INTERVAL '1 month' * (1 - i::FLOAT / %(track_rows)s),
+           round((1 + random() * 29)::NUMERIC, 2), 1 + floor(%(countries)s * random())::INT,
+           encode(sha256(('t' || i)::BYTEA), 'hex')
+    FROM generate_series(1, %(track_rows)s) AS i
+    """,
+]
+CREATE_MONTHLY_PARTITIONS = """
+    DO $$
+    DECLARE
+        partition_month DATE :=
+            date_trunc('month', LOCALTIMESTAMP - INTERVAL '{months} months');
+    BEGIN
+        WHILE partition_month <= LOCALTIMESTAMP LOOP
+            EXECUTE format('CREATE TABLE %I PARTITION OF album_purchase '
+                           'FOR VALUES FROM (%L) TO (%L)',
+                           'album_purchase' || to_char(partition_month, '_YYYY_MM'),
+                           partition_month, partition_month + INTERVAL '1 month');
+            EXECUTE format('CREATE TABLE %I PARTITION OF track_purchase '
+                           'FOR VALUES FROM (%L) TO (%L)',
+                           'track_purchase' || to_char(partition_month, '_YYYY_MM'),
+                           partition_month, partition_month + INTERVAL '1 month');
+            partition_month := partition_month + INTERVAL '1 month';
+        END LOOP;
+    END $$;
+"""
+COPY_TABLES = ["artist", "album", "track", "tag", "country", "album_tag_assignment",
+               "track_tag_assignment", "album_purchase", "track_purchase"]
+
+
+def get_connection() -> Connection:
+    """Returns a connection to the database in autocommit mode, as the dashboard makes it."""
+    return connect(port=ENV["DB_PORT"], dbname=ENV["DB_NAME"], host=ENV["DB_ENDPOINT"],
+                   user=ENV["DB_USER"], password=ENV["DB_PASSWORD"],
+                   row_factory=dict_row, autocommit=True)
+
+
+def use_schema(conn: Connection, schema: str) -> None:
+    """Points every following query at the tables of one benchmark schema."""
+    conn.execute(f"SET search_path TO {schema}")
+
+
+def build_schemas(conn: Connection, size: int, months: int) -> None:
+    """Creates both benchmark schemas and loads the same purchases into each,
+    printing how long each took to load."""
+    for schema in VARIANTS:
+        conn.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        conn.execute(f"CREATE SCHEMA {schema}")
+        use_schema(conn, schema)
+        conn.execute(SCHEMA_PATH.read_text(encoding="utf-8"))
+
+    use_schema(conn, "bench_heap")
+    conn.execute(HEAP_PURCHASE_TABLES)
+    album_rows = int(size * ALBUM_PURCHASE_SHARE)
+    start = time.perf_counter()
+    params = {"artists": ARTISTS, "albums": ALBUMS, "tracks": TRACKS, "tags": TAGS,
+              "countries": COUNTRIES, "months": months,
+              "album_rows": album_rows, "track_rows": size - album_rows}
+    for statement in SEED_DIMENSIONS + SEED_PURCHASES:
+        conn.execute(statement, params)
+    print(f"Loaded {size} purchases into bench_heap in {time.perf_counter() - start:.0f}s")
+
+    use_schema(conn, "bench_partitioned")
+    conn.execute(DROP_PURCHASE_FOREIGN_KEYS)
+    conn.execute(CREATE_MONTHLY_PARTITIONS.format(months=months))
+    start = time.perf_counter()
+    for table in COPY_TABLES:
+        conn.execute(f"INSERT INTO {table} OVERRIDING SYSTEM VALUE "
+                     f"SELECT * FROM bench_heap.{table} ORDER BY 1")
+    print(f"Copied them into bench_partitioned in {time.perf_counter() - start:.0f}s")
+
+    for schema in VARIANTS:
+        for table in COPY_TABLES:
+            conn.execute(f"VACUUM ANALYZE {schema}.{table}")
+
+
+def time_query(conn: Connection, query, timeframe: str, repeats: int) -> float:
+    """Returns the median wall time of a dashboard query over repeats runs,
+    calling it past the dashboard's cache."""
+    wall_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        query.__wrapped__(conn, timeframe)
+        wall_times.append(time.perf_counter() - start)
+    return statistics.median(wall_times)
+
+
+def run_benchmark(size: int, months: int, queries: list[str], repeats: int,
+                  reuse: bool) -> None:
+    """Runs every chosen query at every timeframe against both schemas and prints a comparison"""
+    conn = get_connection()
+    try:
+        if not reuse:
+            build_schemas(conn, size, months)
+        print(f"{'query':>16}{'timeframe':>11}{'heap (s)':>10}{'partitioned (s)':>17}"
+              f"{'speedup':>9}")
+        for name in queries:
+            for timeframe in TIMEFRAMES:
+                wall_times = {}
+                for schema in VARIANTS:
+                    use_schema(conn, schema)
+                    wall_times[schema] = time_query(conn, QUERIES[name], timeframe, repeats)
+                heap, partitioned = wall_times["bench_heap"], wall_times["bench_partitioned"]
+                print(f"{name:>16}{timeframe:>11}{heap:>10.2f}{partitioned:>17.2f}"
+                      f"{heap / partitioned:>8.1f}x")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=50_000_000,
+                        help="number of purchases to generate")
+    parser.add_argument("--months", type=int, default=24,
+                        help="number of months the purchases are spread over")
+    parser.add_argument("--queries", nargs="+", choices=list(QUERIES), default=list(QUERIES),
+                        help="dashboard queries to time")
+    parser.add_argument("--repeats", type=int, default=3, help="runs of each query to time")
+    parser.add_argument("--reuse", action="store_true",
+                        help="time the queries against the schemas of a previous run")
+    args = parser.parse_args()
+
+    load_dotenv()
+    run_benchmark(args.size, args.months, args.queries, args.repeats, args.reuse)
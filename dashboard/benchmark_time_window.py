@@ -0,0 +1,147 @@
+"""Benchmark of the dashboard's timeframe queries with the window bound to a prepared
+statement against the filters they were first written with.
+
+Captures the text of each timeframe query of database.py, then times two forms of
+it with EXPLAIN ANALYZE for every timeframe the dashboard offers. Before, the
+window is interpolated into the query and wraps the column,
+`CURRENT_TIMESTAMP < timestamp + INTERVAL '1 day'`, so the query is planned on
+every call and no partition can be skipped. After, the query is prepared once with
+the window as its parameter and `timestamp >= now() - $1::interval`, and executed
+as the dashboard's connection executes it. The median planning and execution
+times of each are reported. Runs against the schemas built by
+benchmark_partitions.py, building them first unless --reuse is given.
+
+Run with: python3 benchmark_time_window.py --reuse --schema bench_partitioned
+"""
+
+import argparse
+import re
+import statistics
+
+from dotenv import load_dotenv
+from psycopg import Connection
+
+from benchmark_partitions import QUERIES, TIMEFRAMES, build_schemas, get_connection, use_schema
+
+WINDOW_FILTER_PATTERN = re.compile(r"(\w+)\.timestamp >= now\(\) - %\(window\)s::interval")
+# Prepared statements switch to a generic plan after five custom ones.
+GENERIC_PLAN_EXECUTIONS = 5
+
+
+class CapturingCursor:
+    """A cursor that records the query it is given instead of running it."""
+
+    def __init__(self, queries: list):
+        self.queries = queries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, query: str, params=None, prepare=None) -> None:  # pylint: disable=unused-argument
+        """Records the query."""
+        self.queries.append(re.sub(r"[\s;]+$", "", query))
+
+    def fetchall(self) -> list:
+        """Returns no rows."""
+        return []
+
+
+class CapturingConnection:
+    """A connection whose cursors record the queries they are given."""
+
+    def __init__(self):
+        self.queries = []
+
+    def cursor(self) -> CapturingCursor:
+        """Returns a capturing cursor."""
+        return CapturingCursor(self.queries)
+
+
+def get_query_text(name: str) -> str:
+    """Returns the text of a dashboard query, with its window parameter."""
+    conn = CapturingConnection()
+    QUERIES[name].__wrapped__(conn, TIMEFRAMES[0])
+    return conn.queries[0]
+
+
+def get_before_query(query: str, timeframe: str) -> str:
+    """Returns a query with the window interpolated into a filter wrapping the column."""
+    return WINDOW_FILTER_PATTERN.sub(
+        rf"CURRENT_TIMESTAMP < \1.timestamp + INTERVAL '{timeframe}'", query)
+
+
+def explain(conn: Connection, query: str) -> tuple[float, float]:
+    """Returns the planning and execution time of a query in milliseconds."""
+    plan = conn.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {query}").fetchone()
+    plan = (plan["QUERY PLAN"] if isinstance(plan, dict) else plan[0])[0]
+    return plan["Planning Time"], plan["Execution Time"]
+
+
+def time_before(conn: Connection, query: str, timeframe: str,
+                repeats: int) -> tuple[float, float]:
+    """Returns the median planning and execution time of a query with its
+    window interpolated, planned afresh on every run."""
+    times = [explain(conn, get_before_query(query, timeframe)) for _ in range(repeats)]
+    return (statistics.median(planning for planning, _ in times),
+            statistics.median(execution for _, execution in times))
+
+
+def time_after(conn: Connection, query: str, timeframe: str,
+               repeats: int) -> tuple[float, float]:
+    """Returns the median planning and execution time of a query prepared
+    with its window as a parameter, once its plan is cached."""
+    conn.execute(f"PREPARE window_query(TEXT) AS {query.replace('%(window)s', '$1')}")
+    try:
+        execute = f"EXECUTE window_query('{timeframe}')"
+        for _ in range(GENERIC_PLAN_EXECUTIONS):
+            conn.execute(execute)
+        times = [explain(conn, execute) for _ in range(repeats)]
+    finally:
+        conn.execute("DEALLOCATE window_query")
+    return (statistics.median(planning for planning, _ in times),
+            statistics.median(execution for _, execution in times))
+
+
+def run_benchmark(schema: str, queries: list[str], repeats: int, reuse: bool,
+                  size: int, months: int) -> None:
+    """Times every chosen query at every timeframe before and after, and prints a comparison"""
+    conn = get_connection()
+    try:
+        if not reuse:
+            build_schemas(conn, size, months)
+        use_schema(conn, schema)
+        print(f"{'query':>16}{'timeframe':>11}{'before plan':>13}{'before exec':>13}"
+              f"{'after plan':>12}{'after exec':>12}{'speedup':>9}")
+        for name in queries:
+            query = get_query_text(name)
+            for timeframe in TIMEFRAMES:
+                before = time_before(conn, query, timeframe, repeats)
+                after = time_after(conn, query, timeframe, repeats)
+                print(f"{name:>16}{timeframe:>11}{before[0]:>11.2f}ms{before[1]:>11.2f}ms"
+                      f"{after[0]:>10.2f}ms{after[1]:>10.2f}ms"
+                      f"{sum(before) / sum(after):>8.1f}x")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--schema", default="bench_partitioned",
+                        choices=["bench_heap", "bench_partitioned"],
+                        help="benchmark schema to time the queries against")
+    parser.add_argument("--queries", nargs="+", choices=list(QUERIES), default=list(QUERIES),
+                        help="dashboard queries to time")
+    parser.add_argument("--repeats", type=int, default=5, help="runs of each query to time")
+    parser.add_argument("--reuse", action="store_true",
+                        help="time the queries against the schemas of a previous run")
+    parser.add_argument("--size", type=int, default=50_000_000,
+                        help="number of purchases to generate when building the schemas")
+    parser.add_argument("--months", type=int, default=24,
+                        help="number of months the purchases are spread over")
+    args = parser.parse_args()
+
+    load_dotenv()
+    run_benchmark(args.schema, args.queries, args.repeats, args.reuse, args.size, args.months)
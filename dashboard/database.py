@@ -7,6 +7,8 @@ from psycopg.rows import dict_row
 import streamlit as st
 import pandas as pd
 
+from time_window import execute_in_window, window_filter
+
 
 @st.cache_resource
 def get_connection() -> Connection:
@@ -48,14 +50,14 @@ def get_popular_tracks(_conn: Connection, timeframe: str) -> pd.DataFrame:
         USING(track_id)
         JOIN artist as A
         USING(artist_id)
-        WHERE CURRENT_TIMESTAMP < TP.timestamp + INTERVAL '{timeframe}'
+        WHERE {window_filter("TP.timestamp")}
         GROUP BY T.title, A.name, T.url
         ORDER BY copies_sold DESC
         LIMIT 5
         ;
         """
     with _conn.cursor() as cur:
-        cur.execute(query)
+        execute_in_window(cur, query, timeframe)
         data = cur.fetchall()
     return pd.DataFrame(data)
 
@@ -72,7 +74,7 @@ def get_popular_albums(_conn: Connection, timeframe: str) -> pd.DataFrame:
         USING(album_id)
         JOIN artist as AT
         USING(artist_id)
-        WHERE CURRENT_TIMESTAMP < AP.timestamp + INTERVAL '{timeframe}'
+        WHERE {window_filter("AP.timestamp")}
         GROUP BY AB.title, AT.name, AB.url
         ORDER BY copies_sold DESC
         LIMIT 5
@@ -80,7 +82,7 @@ def get_popular_albums(_conn: Connection, timeframe: str) -> pd.DataFrame:
         """
 
     with _conn.cursor() as cur:
-        cur.execute(query)
+        execute_in_window(cur, query, timeframe)
         data = cur.fetchall()
 
     return pd.DataFrame(data)
@@ -88,33 +90,41 @@ def get_popular_albums(_conn: Connection, timeframe: str) -> pd.DataFrame:
 
 @st.cache_data(ttl="1hr")
 def get_popular_artists(_conn: Connection, timeframe) -> pd.DataFrame:
-    """Returns the 5 artists with the most sales in the database."""
+    """Returns the 5 artists with the most sales in the database. Album and
+    track purchases are counted per artist separately before being combined,
+    so neither multiplies the other, and artists with only track sales count.
+    Only the top 5 are joined to their artists."""
 
     print("Collating most popular artists...")
     query = f"""
-            SELECT A.artist_id, A.name, COUNT(DISTINCT AP.album_purchase_id) AS album_sales, COUNT(DISTINCT TP.track_purchase_id) AS track_sales, COUNT(DISTINCT AP.album_purchase_id) + COUNT(DISTINCT TP.track_purchase_id) AS total_sales, A.url as artist_url
-            FROM
-                artist AS A
-            LEFT JOIN
-                album AS AB ON A.artist_id = AB.artist_id
-            LEFT JOIN
-                album_purchase AS AP ON AB.album_id = AP.album_id
-            LEFT JOIN
-                track AS T ON A.artist_id = T.artist_id
-            LEFT JOIN
-                track_purchase AS TP ON T.track_id = TP.track_id
-            WHERE
-                CURRENT_TIMESTAMP < AP.timestamp + INTERVAL '{timeframe}'
-            GROUP BY
-                A.artist_id, A.name
+            SELECT A.artist_id, A.name, S.album_sales, S.track_sales, S.total_sales, A.url as artist_url
+            FROM (
+                SELECT artist_id, CAST(SUM(album_sales) AS BIGINT) AS album_sales, CAST(SUM(track_sales) AS BIGINT) AS track_sales, CAST(SUM(album_sales + track_sales) AS BIGINT) AS total_sales
+                FROM (
+                    SELECT AB.artist_id, COUNT(*) AS album_sales, 0 AS track_sales
+                    FROM album_purchase AS AP
+                    JOIN album AS AB USING(album_id)
+                    WHERE {window_filter("AP.timestamp")}
+                    GROUP BY AB.artist_id
+                    UNION ALL
+                    SELECT T.artist_id, 0, COUNT(*)
+                    FROM track_purchase AS TP
+                    JOIN track AS T USING(track_id)
+                    WHERE {window_filter("TP.timestamp")}
+                    GROUP BY T.artist_id
+                ) AS artist_sales
+                GROUP BY artist_id
+                ORDER BY total_sales DESC
+                LIMIT 5
+            ) AS S
+            JOIN
+                artist AS A USING(artist_id)
             ORDER BY
-                total_sales DESC
-            LIMIT 5;
-        ;
+                S.total_sales DESC;
         """
 
     with _conn.cursor() as cur:
-        cur.execute(query)
+        execute_in_window(cur, query, timeframe)
         data = cur.fetchall()
 
     return pd.DataFrame(data)
@@ -151,7 +161,7 @@ def get_sales_by_tag(_conn: Connection, timeframe: str) -> pd.DataFrame:
         FROM album_tag_assignment ata
         INNER JOIN album_purchase ap
         ON ata.album_id = ap.album_id
-        WHERE CURRENT_TIMESTAMP < AP.timestamp + INTERVAL '{timeframe}'
+        WHERE {window_filter("AP.timestamp")}
         GROUP BY ata.tag_id)
         album_table ON album_table.tag_id = t.tag_id
     INNER JOIN (
@@ -159,7 +169,7 @@ def get_sales_by_tag(_conn: Connection, timeframe: str) -> pd.DataFrame:
         FROM track_tag_assignment tta
         INNER JOIN track_purchase tp
         ON tta.track_id = tp.track_id
-        WHERE CURRENT_TIMESTAMP < TP.timestamp + INTERVAL '{timeframe}'
+        WHERE {window_filter("TP.timestamp")}
         GROUP BY tta.tag_id)
         track_table ON track_table.tag_id = t.tag_id
     GROUP BY t.tag_id
@@ -169,7 +179,7 @@ def get_sales_by_tag(_conn: Connection, timeframe: str) -> pd.DataFrame:
     """
 
     with _conn.cursor() as cur:
-        cur.execute(query)
+        execute_in_window(cur, query, timeframe)
         data = cur.fetchall()
 
     return pd.DataFrame(data)
@@ -195,23 +205,16 @@ def get_all_tags(_conn: Connection) -> list:
 
 @st.cache_data(ttl="1hr")
 def get_sales_by_country(_conn: Connection) -> list[dict]:
-    """Returns the sales for each country."""
+    """Returns the sales for each country, from the hourly country rollup."""
 
     print("Counting sales by country...")
     query = """
-        SELECT C.name as name, CAST(SUM(album_table.album_total + track_table.track_total) AS FLOAT) AS total_sales
+        SELECT C.name as name, CAST(SUM(CHS.album_sales + CHS.track_sales) AS FLOAT) AS total_sales
         FROM country C
-        INNER JOIN (
-            SELECT AP.country_id, COUNT(DISTINCT AP.album_purchase_id) album_total
-            FROM album_purchase AP
-            GROUP BY AP.country_id
-        ) album_table ON album_table.country_id = C.country_id
-        INNER JOIN  (
-            SELECT TP.country_id, COUNT(DISTINCT TP.track_purchase_id) track_total
-            FROM track_purchase TP
-            GROUP BY TP.country_id
-        ) track_table ON track_table.country_id = C.country_id
+        INNER JOIN country_hourly_sales CHS
+        USING(country_id)
         GROUP BY C.name
+        HAVING SUM(CHS.album_sales) > 0 AND SUM(CHS.track_sales) > 0
         ORDER BY total_sales DESC
         ;
         """
@@ -243,18 +246,17 @@ def get_all_album_titles(_conn: Connection):
 
 @st.cache_data(ttl="1hr")
 def get_track_sales_by_artist(_conn: Connection, artist: str):
-    """Returns all track info for a given artist."""
+    """Returns the track sales of each hour for a given artist, from the hourly artist rollup."""
 
     print(f"Counting track sales for artist {artist}...")
     query = """
-            SELECT DATE_TRUNC('hour', TP.timestamp) AS hour, COUNT(DISTINCT TP.track_purchase_id) as sales
+            SELECT AHS.hour, SUM(AHS.track_sales) as sales
             FROM artist AS A
-            INNER JOIN track as T
+            INNER JOIN artist_hourly_sales as AHS
             USING(artist_id)
-            INNER JOIN track_purchase as TP
-            USING(track_id)
             WHERE A.name = %s
-            GROUP BY hour
+            GROUP BY AHS.hour
+            HAVING SUM(AHS.track_sales) > 0
             ;
         """
 
@@ -267,18 +269,17 @@ def get_track_sales_by_artist(_conn: Connection, artist: str):
 
 @st.cache_data(ttl="1hr")
 def get_album_sales_by_artist(_conn: Connection, artist: str):
-    """Returns all album info for a given artist."""
+    """Returns the album sales of each hour for a given artist, from the hourly artist rollup."""
 
     print(f"Counting album sales for artist {artist}...")
     query = """
-            SELECT DATE_TRUNC('hour', AP.timestamp) AS hour, COUNT(DISTINCT AP.album_purchase_id) as sales
+            SELECT AHS.hour, SUM(AHS.album_sales) as sales
             FROM artist AS A
-            INNER JOIN album as AB
+            INNER JOIN artist_hourly_sales as AHS
             USING(artist_id)
-            INNER JOIN album_purchase as AP
-            USING(album_id)
             WHERE A.name = %s
-            GROUP BY hour
+            GROUP BY AHS.hour
+            HAVING SUM(AHS.album_sales) > 0
             ;
         """
 
@@ -291,19 +292,13 @@ def get_album_sales_by_artist(_conn: Connection, artist: str):
 
 @st.cache_data(ttl="1hr")
 def get_sales(_conn: Connection) -> pd.DataFrame:
-    """Returns all sales data."""
+    """Returns all sales data, from the hourly artist rollup."""
 
     query = """
-        SELECT A.name, COUNT(DISTINCT AP.album_purchase_id) AS album_sales, COUNT(DISTINCT TP.track_purchase_id) AS track_sales
+        SELECT A.name, CAST(COALESCE(SUM(AHS.album_sales), 0) AS BIGINT) AS album_sales, CAST(COALESCE(SUM(AHS.track_sales), 0) AS BIGINT) AS track_sales
         FROM artist as A
-        LEFT JOIN album AS AB
-        ON AB.artist_id = A.artist_id
-        LEFT JOIN album_purchase AS AP
-        ON AP.album_id = AB.album_id
-        LEFT JOIN track as T
-        ON T.artist_id = A.artist_id
-        LEFT JOIN track_purchase as TP
-        ON TP.track_id = T.track_id
+        LEFT JOIN artist_hourly_sales AS AHS
+        ON AHS.artist_id = A.artist_id
         GROUP BY A.name;"""
     with _conn.cursor() as cur:
         cur.execute(query)
@@ -337,18 +332,15 @@ def get_sales_for_chosen_artists(sales_data: pd.DataFrame, artist_names: list[st
 
 @st.cache_data(ttl="1hr")
 def get_track_sales_by_tag(_conn: Connection, tag_name: str) -> pd.DataFrame:
-    """Returns all sales for a given tag."""
+    """Returns the track sales of each hour for a given tag, from the hourly tag rollup."""
 
     print(f"Counting tag sales for tag {tag_name}...")
     query = """
-        SELECT DATE_TRUNC('hour', TP.timestamp) AS hour, COUNT(DISTINCT TP.track_purchase_id) as sales
+        SELECT THS.hour, THS.track_sales as sales
         FROM tag AS T
-        INNER JOIN track_tag_assignment as TTA
+        INNER JOIN tag_hourly_sales as THS
         USING(tag_id)
-        INNER JOIN track_purchase as TP
-        USING(track_id)
-        WHERE T.name = %s 
-        GROUP BY hour
+        WHERE T.name = %s AND THS.track_sales > 0
         ;
         """
 
@@ -361,18 +353,15 @@ def get_track_sales_by_tag(_conn: Connection, tag_name: str) -> pd.DataFrame:
 
 @st.cache_data(ttl="1hr")
 def get_album_sales_by_tag(_conn: Connection, tag_name: str) -> pd.DataFrame:
-    """Returns all sales for a given tag."""
+    """Returns the album sales of each hour for a given tag, from the hourly tag rollup."""
 
     print(f"Counting tag sales for tag {tag_name}...")
     query = """
-        SELECT DATE_TRUNC('hour', AP.timestamp) AS hour, COUNT(DISTINCT AP.album_purchase_id) as sales
+        SELECT THS.hour, THS.album_sales as sales
         FROM tag AS T
-        INNER JOIN album_tag_assignment as ATA
+        INNER JOIN tag_hourly_sales as THS
         USING (tag_id)
-        INNER JOIN album_purchase as AP
-        USING (album_id)
-        WHERE T.name = %s
-        GROUP BY hour
+        WHERE T.name = %s AND THS.album_sales > 0
         ;
         """
 
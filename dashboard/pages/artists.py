@@ -18,6 +18,7 @@ from charts import (
     get_most_popular_artists_chart,
     get_sales_line_graph
 )
+from time_window import TIME_WINDOWS
 
 
 def show_artists():
@@ -28,8 +29,8 @@ def show_artists():
     conn = get_connection()
     conn = check_connection(conn)
 
-    timeframe = st.radio(label="Filter by sale timeframe", options=[
-        '1 day', '1 week', '1 month', "1 year"], horizontal=True)
+    timeframe = st.radio(label="Filter by sale timeframe", options=list(TIME_WINDOWS),
+                         horizontal=True)
 
     pop_artists = get_popular_artists(conn, timeframe)
     st.header("Top artists")
@@ -4,6 +4,7 @@
 import streamlit as st
 import database
 import charts
+from time_window import TIME_WINDOWS
 
 
 def show_home():
@@ -31,8 +32,8 @@ def show_home():
         st.write(
             """Here you'll find insights into Bandcamp sales and
             you can also subscribe to receive email notifications!""")
-    timeframe = st.radio(label="Filter by sale timeframe", options=[
-        '1 day', '1 week', '1 month', "1 year"], horizontal=True)
+    timeframe = st.radio(label="Filter by sale timeframe", options=list(TIME_WINDOWS),
+                         horizontal=True)
     st.header("Top tracks")
 
     st.write("Click on the bar to be taken to the relevant page on Bandcamp")
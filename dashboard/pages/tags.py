@@ -12,6 +12,7 @@ from database import (
 )
 
 from charts import get_sales_line_graph, get_most_popular_tags_chart
+from time_window import TIME_WINDOWS
 
 
 def show_tags():
@@ -23,7 +24,7 @@ def show_tags():
     all_tags = get_all_tags(conn)
     timeframe = st.radio(
         label="Filter by sale timeframe",
-        options=["1 day", "1 week", "1 month", "1 year"],
+        options=list(TIME_WINDOWS),
         horizontal=True,
     )
     tags = get_sales_by_tag(conn, timeframe)
@@ -0,0 +1,31 @@
+"""Time window filters for the dashboard's queries.
+
+A window is bound as a parameter and compared against the bare timestamp
+column, `timestamp >= now() - %(window)s::interval`, so Postgres can skip the
+purchase partitions outside it and use their BRIN indexes. The query text is
+the same for every window, so each query is prepared on the server once per
+connection and its plan reused, rather than planned again on every call."""
+
+from psycopg import Cursor
+
+TIME_WINDOWS = ("1 day", "1 week", "1 month", "1 year")
+
+
+def window_filter(column: str) -> str:
+    """Returns a filter keeping the rows whose column falls in the window
+    bound to the window parameter."""
+    return f"{column} >= now() - %(window)s::interval"
+
+
+def validate_window(window: str) -> str:
+    """Returns the window if the dashboard offers it, else raises a ValueError."""
+    if window not in TIME_WINDOWS:
+        raise ValueError(f"Unsupported time window {window!r}, "
+                         f"expected one of {', '.join(TIME_WINDOWS)}")
+    return window
+
+
+def execute_in_window(cur: Cursor, query: str, window: str, params: dict = None) -> None:
+    """Runs a query filtered with window_filter for a window, binding it
+    with any other parameters, as a prepared statement."""
+    cur.execute(query, {**(params or {}), "window": validate_window(window)}, prepare=True)
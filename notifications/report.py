@@ -8,6 +8,8 @@ from psycopg import connect, Connection
 from psycopg.rows import dict_row
 from boto3 import client
 
+from time_window import execute_in_window, window_filter
+
 
 TRENDING_THRESHOLD = 100
 FILTER_TOPICS_BY = "c11-bandcamp-"
@@ -66,20 +68,21 @@ JOIN {item_type} AS T ON TP.{item_type}_id = T.{item_type}_id
 JOIN artist AS A ON T.artist_id = A.artist_id
 JOIN {item_type}_tag_assignment AS TTA ON T.{item_type}_id = TTA.{item_type}_id
 JOIN tag AS TG ON TTA.tag_id = TG.tag_id
-WHERE TG.name = %s
-AND TP.timestamp >= NOW() - INTERVAL '{sales_timeframe}'
+WHERE TG.name = %(tag)s
+AND {window_filter('TP.timestamp')}
 GROUP BY
     T.{item_type}_id,
     T.title,
     A.name,
     T.url
-HAVING COUNT(DISTINCT TP.{item_type}_purchase_id) >= %s
+HAVING COUNT(DISTINCT TP.{item_type}_purchase_id) >= %(sales_limit)s
 ORDER BY copies_sold DESC
 '''
 
     try:
         with conn.cursor() as cur:
-            cur.execute(query, (tag, sales_limit))
+            execute_in_window(cur, query, sales_timeframe,
+                              {"tag": tag, "sales_limit": sales_limit})
             trending = cur.fetchall()
 
         if len(trending) >= 1:
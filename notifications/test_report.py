@@ -108,6 +108,31 @@ def test_add_tags_to_dictionary(tags_list, expected_tags_list):
     assert add_tags_to_dictionary(tags_list) == expected_tags_list
 
 
+def test_get_sales_data_of_tag():
+    '''Tests that the tag, limit and window are bound, with no window in the query text'''
+    mock_connection = MagicMock()
+    mock_cursor = mock_connection.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchall.return_value = [{"title": "Track1"}]
+
+    assert get_sales_data_of_tag(mock_connection, "track", "rock", 10, "1 day") == [
+        {"title": "Track1"}]
+
+    query, params = mock_cursor.execute.call_args.args
+    assert "TP.timestamp >= now() - %(window)s::interval" in query
+    assert "1 day" not in query
+    assert params == {"tag": "rock", "sales_limit": 10, "window": "1 day"}
+    assert mock_cursor.execute.call_args.kwargs == {"prepare": True}
+
+
+def test_get_sales_data_of_tag_unsupported_window():
+    '''Tests that an unsupported window is never run and returns no trending items'''
+    mock_connection = MagicMock()
+    mock_cursor = mock_connection.cursor.return_value.__enter__.return_value
+
+    assert get_sales_data_of_tag(mock_connection, "album", "rock", 10, "3 days") == []
+    mock_cursor.execute.assert_not_called()
+
+
 @patch('report.get_sales_data_of_tag')
 def test_get_trending_items(mock_get_sales):
     '''Test get trending items if key is inserted correctly'''
@@ -0,0 +1,38 @@
+'''Testing suite for time_window.py'''
+
+from unittest.mock import MagicMock
+import pytest
+from time_window import (
+    TIME_WINDOWS,
+    execute_in_window,
+    validate_window,
+    window_filter,
+)
+
+
+def test_window_filter():
+    '''Tests that the filter compares the bare column against a bound window'''
+    assert window_filter("TP.timestamp") == "TP.timestamp >= now() - %(window)s::interval"
+
+
+@pytest.mark.parametrize("window", TIME_WINDOWS)
+def test_validate_window(window):
+    '''Tests that every allowed window is accepted'''
+    assert validate_window(window) == window
+
+
+@pytest.mark.parametrize("window", ["2 hours", "8 hours'; DROP TABLE tag; --", "", None])
+def test_validate_window_rejects(window):
+    '''Tests that windows outside the allowed ones are rejected before reaching SQL'''
+    with pytest.raises(ValueError):
+        validate_window(window)
+
+
+def test_execute_in_window():
+    '''Tests that the window is bound with the other parameters and the query prepared'''
+    mock_cursor = MagicMock()
+
+    execute_in_window(mock_cursor, "SELECT 1", "8 hours", {"tag": "rock"})
+
+    mock_cursor.execute.assert_called_once_with(
+        "SELECT 1", {"tag": "rock", "window": "8 hours"}, prepare=True)
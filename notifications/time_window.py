@@ -0,0 +1,28 @@
+'''Time window filters for the notification queries.
+
+The window is bound as a parameter against the bare timestamp column, so the
+purchase partitions outside it are skipped, and the query text stays the same
+for every tag and window. Each query is prepared on the server the first time
+it runs, and every later tag checked on the connection reuses its plan.'''
+
+from psycopg import Cursor
+
+TIME_WINDOWS = ("4 hours", "8 hours", "1 day")
+
+
+def window_filter(column: str) -> str:
+    '''Returns a filter keeping the rows whose column falls in the bound window'''
+    return f"{column} >= now() - %(window)s::interval"
+
+
+def validate_window(window: str) -> str:
+    '''Returns the window if notifications allow it, else raises a ValueError'''
+    if window not in TIME_WINDOWS:
+        raise ValueError(f"Unsupported time window {window!r}, "
+                         f"expected one of {', '.join(TIME_WINDOWS)}")
+    return window
+
+
+def execute_in_window(cur: Cursor, query: str, window: str, params: dict = None) -> None:
+    '''Runs a query filtered with window_filter for a window as a prepared statement'''
+    cur.execute(query, {**(params or {}), "window": validate_window(window)}, prepare=True)
@@ -0,0 +1,273 @@
+'''Append-only archive of the raw salesfeed responses and item pages fetched by each
+run, so that runs can be reproduced, backfilled and benchmarked without bandcamp.
+
+Records are written as NDJSON to zstd compressed segment files, one zstd frame per
+record, so each can be read back on its own while a whole segment still decompresses
+with `zstd -d` into plain NDJSON. A sqlite index maps every record to its segment and
+offset, by url and by time. Segments older than ARCHIVE_RETENTION_DAYS are pruned when a
+run that archived anything closes the archive. Archiving is best effort: a record that
+cannot be written is logged and skipped, so a full disk never fails a run.'''
+
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+import json
+import logging
+from pathlib import Path
+import sqlite3
+import time
+from typing import Optional
+
+import zstandard
+
+from scrape_cache import normalize_url
+
+
+ARCHIVE_PATH = "/tmp/raw_archive"
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+COMPRESSION_LEVEL = 3
+ARCHIVE_RETENTION_DAYS = 30
+ARCHIVE_MISS_STATUS = 204
+FEED_LAG_SECONDS = 60 * 60
+
+
+class ArchivedResponse:
+    '''Response read from, or written to, the archive. Offers the parts of an
+    aiohttp response used by fetch_webpage'''
+
+    def __init__(self, status: int, body: bytes):
+        self.status = status
+        self.headers = {}
+        self.body = body
+
+    async def read(self) -> bytes:
+        '''Returns the raw body'''
+        return self.body
+
+    async def text(self) -> str:
+        '''Returns the body decoded as utf-8, as bandcamp serves it'''
+        return self.body.decode("utf-8", errors="replace")
+
+
+class FeedArchive:
+    '''Compressed, append-only store of feed responses and item pages, indexed
+    by url and by the time they were fetched'''
+
+    def __init__(self, path: str = ARCHIVE_PATH,
+                 segment_max_bytes: int = SEGMENT_MAX_BYTES,
+                 retention_days: int = ARCHIVE_RETENTION_DAYS):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_max_bytes = segment_max_bytes
+        self.retention_days = retention_days
+        self.records_written = 0
+        self.write_errors = 0
+        self._compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL)
+        self._decompressor = zstandard.ZstdDecompressor()
+        self._segment = None
+
+        self.index = sqlite3.connect(self.path / "index.sqlite3")
+        self.index.execute('''
+            CREATE TABLE IF NOT EXISTS archive_record (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                url TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                fetched_at REAL NOT NULL,
+                segment TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            )''')
+        self.index.execute('''
+            CREATE INDEX IF NOT EXISTS archive_record_url
+            ON archive_record(url, fetched_at)''')
+        self.index.execute('''
+            CREATE INDEX IF NOT EXISTS archive_record_fetched_at
+            ON archive_record(kind, fetched_at)''')
+
+    def _get_segment(self, fetched_at: float) -> Path:
+        '''Returns the segment to append to: the latest of the day, unless it is full'''
+        day = datetime.fromtimestamp(fetched_at, tz=timezone.utc).strftime("%Y-%m-%d")
+        if self._segment is not None and self._segment.name.startswith(day) \
+                and self._segment.stat().st_size < self.segment_max_bytes:
+            return self._segment
+
+        segments = sorted(self.path.glob(f"{day}-*.ndjson.zst"))
+        if segments and segments[-1].stat().st_size < self.segment_max_bytes:
+            self._segment = segments[-1]
+        else:
+            self._segment = self.path / f"{day}-{len(segments):04}.ndjson.zst"
+        return self._segment
+
+    def _write(self, record: dict) -> None:
+        '''Appends a record to the current segment as its own zstd frame and indexes it.
+        A record that cannot be written, for example on a full disk, is logged and skipped'''
+        frame = self._compressor.compress(
+            json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+        try:
+            segment = self._get_segment(record["fetched_at"])
+            with open(segment, "ab") as file:
+                offset = file.tell()
+                file.write(frame)
+
+            self.index.execute(
+                '''INSERT INTO archive_record
+                   (kind, url, status, fetched_at, segment, offset, length)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                (record["kind"], record["url"], record["status"], record["fetched_at"],
+                 segment.name, offset, len(frame)))
+        except (OSError, sqlite3.Error) as e:
+            self.write_errors += 1
+            logging.error("Could not archive %s: %s", record["url"], e)
+            return
+        self.records_written += 1
+
+    def write_feed(self, url: str, params: dict, body: dict, fetched_at: float = None) -> None:
+        '''Archives a salesfeed response'''
+        self._write({"kind": "feed", "url": url, "params": params, "status": 200,
+                     "fetched_at": fetched_at or time.time(), "body": body})
+
+    def write_page(self, url: str, status: int, body: bytes, fetched_at: float = None) -> None:
+        '''Archives a fetched item page, by its normalized url'''
+        self._write({"kind": "page", "url": normalize_url(url), "status": status,
+                     "fetched_at": fetched_at or time.time(),
+                     "body": body.decode("utf-8", errors="replace")})
+
+    def read_record(self, segment: str, offset: int, length: int) -> dict:
+        '''Reads a single record back from its segment'''
+        with open(self.path / segment, "rb") as file:
+            file.seek(offset)
+            frame = file.read(length)
+        return json.loads(self._decompressor.decompress(frame))
+
+    def get_page(self, url: str, before: float = None) -> dict:
+        '''Returns the latest archived record of an item page fetched before a
+        time, or None if it was never archived'''
+        row = self.index.execute(
+            '''SELECT segment, offset, length FROM archive_record
+               WHERE kind = 'page' AND url = ? AND fetched_at < ?
+               ORDER BY fetched_at DESC LIMIT 1''',
+            (normalize_url(url), before if before is not None else float("inf"))).fetchone()
+        return self.read_record(*row) if row is not None else None
+
+    def get_feed_records(self, start: float, end: float) -> list[dict]:
+        '''Returns the feed responses fetched between two times, oldest first'''
+        rows = self.index.execute(
+            '''SELECT segment, offset, length FROM archive_record
+               WHERE kind = 'feed' AND fetched_at >= ? AND fetched_at < ?
+               ORDER BY fetched_at, id''',
+            (start, end)).fetchall()
+        return [self.read_record(*row) for row in rows]
+
+    def get_feed_events(self, start: float, end: float) -> list[dict]:
+        '''Returns the sales events of every feed response fetched between two
+        times. Responses overlap, so as with paging through the feed, events are
+        only kept past the latest event seen so far'''
+        events = []
+        high_water_mark = float("-inf")
+        for record in self.get_feed_records(start, end):
+            feed_data = record["body"].get("feed_data", record["body"])
+            page_events = feed_data.get("events", [])
+            events.extend(event for event in page_events
+                          if event["utc_date"] > high_water_mark)
+            high_water_mark = max((event["utc_date"] for event in page_events),
+                                  default=high_water_mark)
+        return events
+
+    def recording(self, session) -> "RecordingSession":
+        '''Wraps a session so that every page it fetches is archived'''
+        return RecordingSession(session, self)
+
+    def prune(self, now: float = None) -> int:
+        '''Deletes the segments of days older than the retention period, and their
+        index entries, returning how many segments were deleted. Keeps everything
+        if retention_days is 0'''
+        if not self.retention_days:
+            return 0
+        cutoff = datetime.fromtimestamp(now or time.time(), tz=timezone.utc) \
+            - timedelta(days=self.retention_days)
+        cutoff_day = cutoff.strftime("%Y-%m-%d")
+
+        pruned = 0
+        for segment in sorted(self.path.glob("*.ndjson.zst")):
+            if segment.name[:10] >= cutoff_day:
+                continue
+            self.index.execute("DELETE FROM archive_record WHERE segment = ?",
+                               (segment.name,))
+            segment.unlink()
+            pruned += 1
+        if self._segment is not None and not self._segment.exists():
+            self._segment = None
+        return pruned
+
+    def close(self) -> None:
+        '''Prunes old segments if this run archived anything, then writes the index
+        to disk. Errors are logged rather than raised'''
+        logging.info("Archived %s records to %s, %s could not be written",
+                     self.records_written, self.path, self.write_errors)
+        try:
+            if self.records_written:
+                logging.info("Pruned %s archive segments", self.prune())
+            self.index.commit()
+        except (OSError, sqlite3.Error) as e:
+            logging.error("Could not finish writing the archive: %s", e)
+        finally:
+            self.index.close()
+
+
+def open_archive(path: Optional[str]) -> Optional[FeedArchive]:
+    '''Opens the archive at path for a run to record to, or returns None if
+    path is None or the archive cannot be opened, so a run goes on without it'''
+    if path is None:
+        return None
+    try:
+        return FeedArchive(path)
+    except (OSError, sqlite3.Error) as e:
+        logging.error("Could not open the archive at %s, not archiving: %s", path, e)
+        return None
+
+
+def get_day_range(day: str) -> tuple[float, float]:
+    '''Returns the start and end timestamps of a UTC day given as YYYY-MM-DD'''
+    start = datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    return start.timestamp(), (start + timedelta(days=1)).timestamp()
+
+
+class RecordingSession:
+    '''Session wrapper that archives the body of every page found or not found'''
+
+    def __init__(self, session, archive: FeedArchive):
+        self.session = session
+        self.archive = archive
+
+    @asynccontextmanager
+    async def get(self, url: str, **kwargs) -> AsyncIterator[ArchivedResponse]:
+        '''Fetches a page through the wrapped session, archiving its body'''
+        async with self.session.get(url, **kwargs) as response:
+            body = await response.read()
+            if response.status in (200, 404):
+                self.archive.write_page(url, response.status, body)
+            archived = ArchivedResponse(response.status, body)
+            archived.headers = response.headers
+            yield archived
+
+
+class ReplaySession:
+    '''Session stand-in that serves item pages from the archive, as they were
+    when last fetched before the end of the replayed period'''
+
+    def __init__(self, archive: FeedArchive, before: float = None):
+        self.archive = archive
+        self.before = before
+        self.misses = 0
+
+    @asynccontextmanager
+    async def get(self, url: str, **_kwargs) -> AsyncIterator[ArchivedResponse]:
+        '''Serves a page from the archive, or an empty response if it was never archived'''
+        record = self.archive.get_page(url, self.before)
+        if record is None:
+            self.misses += 1
+            logging.warning("Page is not in the archive: %s", url)
+            yield ArchivedResponse(ARCHIVE_MISS_STATUS, b"")
+        else:
+            yield ArchivedResponse(record["status"], record["body"].encode("utf-8"))
@@ -0,0 +1,318 @@
+"""Script for loading sales data with asynchronous psycopg 3 in pipeline mode.
+
+load.py waits for the reply to every statement before sending the next. Here
+the statements for a whole chunk of sales are sent in four pipelined rounds,
+without waiting on any reply within a round: countries, artists and tags
+first, then albums, which need artist ids, then tracks, which need album ids,
+and finally the tag assignments and purchases. A chunk takes the same few
+round trips whatever its size, and shares load.py's dimension caches."""
+
+from functools import partial
+import logging
+from os import environ as ENV
+from typing import Any, Dict, Hashable, List, Tuple
+
+from psycopg import AsyncConnection
+
+from bulk_load import REQUIRED_FIELDS, get_sale_kind
+import http_client
+from load import (
+    COMMIT_CHUNK_SIZE,
+    CREATE_PENDING_SALES_ROLLUP,
+    DEFER_SALE,
+    DIMENSION_CACHES,
+    FLUSH_SALES_ROLLUPS,
+    INSERT_ALBUM_PURCHASE,
+    INSERT_ALBUM_TAG_ASSIGNMENT,
+    INSERT_REJECTED_SALE,
+    INSERT_TRACK_PURCHASE,
+    INSERT_TRACK_TAG_ASSIGNMENT,
+    PENDING_PURCHASE_COUNTS,
+    UPSERT_ALBUM,
+    UPSERT_ARTIST,
+    UPSERT_COUNTRY,
+    UPSERT_TAG,
+    UPSERT_TRACK,
+    WARM_CACHE_QUERIES,
+    commit_dimension_caches,
+    commit_purchase_counts,
+    get_deferred_sale_params,
+    get_missing_fields,
+    get_purchase_key,
+    get_rejected_sale_params,
+    log_dimension_cache_stats,
+    log_purchase_stats,
+    release_dimension_cache_savepoints,
+    rollback_dimension_caches,
+    rollback_dimension_caches_to_savepoints,
+    rollback_purchase_counts,
+)
+
+# A lookup is the cache to use, the upsert returning an id on a cache miss,
+# and the parameters of that upsert for each key to look up.
+Lookup = Tuple[str, str, Dict[Hashable, Dict[str, Any]]]
+
+
+async def get_async_connection() -> AsyncConnection:
+    """Creates an asynchronous database session and returns its connection."""
+    return await AsyncConnection.connect(
+        host=ENV["DB_HOST"],
+        port=ENV["DB_PORT"],
+        user=ENV["DB_USER"],
+        password=ENV["DB_PASS"],
+        dbname=ENV["DB_NAME"],
+    )
+
+
+async def warm_dimension_caches_async(connection: AsyncConnection) -> None:
+    """Fills the caches of the small country and tag dimensions from the
+    database, as warm_dimension_caches does."""
+
+    for name, query in WARM_CACHE_QUERIES:
+        cache = DIMENSION_CACHES[name]
+        if cache.warmed:
+            continue
+        cursor = await connection.execute(query, (cache.max_entries,))
+        for key, value in await cursor.fetchall():
+            cache.put(key, value)
+        cache.commit()
+        cache.warmed = True
+        logging.info("Warmed the %s cache with %s entries", name, len(cache.entries))
+
+
+def get_loadable_sales(
+    sales_data: List[Dict[str, Any]]
+) -> Tuple[List[Tuple[str, Dict[str, Any]]], List[tuple]]:
+    """Returns each sale that can be loaded along with its kind, and the
+    parameters of DEFER_SALE for any missing a required field, which are
+    deferred to the retry queue as insert_sale does."""
+
+    loadable = []
+    deferred = []
+    for sale in sales_data:
+        kind = get_sale_kind(sale)
+        if kind is None:
+            continue
+        missing_fields = get_missing_fields(sale, REQUIRED_FIELDS[kind])
+        if missing_fields:
+            deferred.append(get_deferred_sale_params(sale, missing_fields))
+            continue
+        loadable.append((kind, sale))
+    return loadable, deferred
+
+
+async def defer_sales(connection: AsyncConnection, deferred: List[tuple]) -> None:
+    """Adds sales missing scraped fields to the retry queue in one pipelined round."""
+
+    if not deferred:
+        return
+    async with connection.pipeline():
+        for params in deferred:
+            await connection.execute(DEFER_SALE, params)
+    PENDING_PURCHASE_COUNTS["deferred"] += len(deferred)
+
+
+async def look_up_ids(connection: AsyncConnection,
+                      lookups: List[Lookup]) -> Dict[str, Dict[Hashable, int]]:
+    """Returns the id of every key of every lookup, by cache name. Keys that
+    are not cached are upserted in one pipelined round, and a key whose row
+    an overlapping run inserted unseen is upserted once more on its own, as
+    upsert_returning_id does."""
+
+    ids = {name: {} for name, _, _ in lookups}
+    misses = []
+    for name, query, params_by_key in lookups:
+        cache = DIMENSION_CACHES[name]
+        for key, params in params_by_key.items():
+            row_id = cache.get(key)
+            if row_id is None:
+                misses.append((name, query, key, params))
+            else:
+                ids[name][key] = row_id
+    if not misses:
+        return ids
+
+    async with connection.pipeline():
+        cursors = [await connection.execute(query, params) for _, query, _, params in misses]
+
+    for (name, query, key, params), cursor in zip(misses, cursors):
+        row = await cursor.fetchone()
+        if row is None:
+            row = await (await connection.execute(query, params)).fetchone()
+        ids[name][key] = row[0]
+        DIMENSION_CACHES[name].put(key, row[0])
+    return ids
+
+
+def get_sale_tags(kind: str, sale: Dict[str, Any]) -> List[str]:
+    """Returns the tags of a sale that are not empty."""
+    return [tag for tag in sale["album_tags" if kind == "album" else "track_tags"] if tag]
+
+
+async def insert_sales_in_pipeline(connection: AsyncConnection,
+                                   sales: List[Tuple[str, Dict[str, Any]]]) -> None:
+    """Inserts loadable sales in four pipelined rounds, one per level of the
+    dimensions they depend on, counting each purchase as inserted or as a
+    duplicate. Runs inside the caller's transaction."""
+
+    if not sales:
+        return
+
+    ids = await look_up_ids(connection, [
+        ("country", UPSERT_COUNTRY,
+         {sale["country"]: {"name": sale["country"]} for _, sale in sales}),
+        ("artist", UPSERT_ARTIST,
+         {(sale["artist_name"], sale["artist_url"]):
+          {"name": sale["artist_name"], "url": sale["artist_url"]} for _, sale in sales}),
+        ("tag", UPSERT_TAG,
+         {tag: {"name": tag} for kind, sale in sales for tag in get_sale_tags(kind, sale)}),
+    ])
+    artist_ids = [ids["artist"][(sale["artist_name"], sale["artist_url"])]
+                  for _, sale in sales]
+
+    albums = {}
+    for (kind, sale), artist_id in zip(sales, artist_ids):
+        if kind == "album":
+            albums.setdefault(sale["url"], {"title": sale["item_description"],
+                                            "artist_id": artist_id, "url": sale["url"]})
+        elif kind == "track":
+            albums.setdefault(sale["album_url"], {"title": sale["album_title"],
+                                                  "artist_id": artist_id,
+                                                  "url": sale["album_url"]})
+    ids.update(await look_up_ids(connection, [("album", UPSERT_ALBUM, albums)]))
+    album_ids = [ids["album"].get(sale["url"] if kind == "album" else sale.get("album_url"))
+                 for kind, sale in sales]
+
+    tracks = {}
+    for (kind, sale), artist_id, album_id in zip(sales, artist_ids, album_ids):
+        if kind != "album":
+            tracks.setdefault((sale["url"], album_id), {
+                "title": sale["item_description"], "album_id": album_id,
+                "artist_id": artist_id, "url": sale["url"]})
+    ids.update(await look_up_ids(connection, [("track", UPSERT_TRACK, tracks)]))
+
+    purchase_cursors = []
+    async with connection.pipeline():
+        for (kind, sale), album_id in zip(sales, album_ids):
+            if kind == "album":
+                item_id = album_id
+                assignment_cache = DIMENSION_CACHES["album_tag_assignment"]
+                assignment_query = INSERT_ALBUM_TAG_ASSIGNMENT
+                purchase_query = INSERT_ALBUM_PURCHASE
+            else:
+                item_id = ids["track"][(sale["url"], album_id)]
+                assignment_cache = DIMENSION_CACHES["track_tag_assignment"]
+                assignment_query = INSERT_TRACK_TAG_ASSIGNMENT
+                purchase_query = INSERT_TRACK_PURCHASE
+
+            for tag in get_sale_tags(kind, sale):
+                tag_id = ids["tag"][tag]
+                if assignment_cache.get((item_id, tag_id)) is None:
+                    await connection.execute(assignment_query, (tag_id, item_id))
+                    assignment_cache.put((item_id, tag_id), True)
+
+            purchase_cursors.append(await connection.execute(purchase_query, (
+                item_id, sale["utc_date"], sale["amount_paid_usd"],
+                ids["country"][sale["country"]], get_purchase_key(sale))))
+
+    for cursor in purchase_cursors:
+        PENDING_PURCHASE_COUNTS["inserted" if cursor.rowcount == 1 else "duplicates"] += 1
+
+
+async def insert_sales_in_savepoints(connection: AsyncConnection,
+                                     sales: List[Tuple[str, Dict[str, Any]]]) -> None:
+    """Inserts loadable sales one at a time, each in its own savepoint, so a
+    sale that fails is rolled back on its own and rejected, as
+    insert_sale_in_savepoint does."""
+
+    for kind, sale in sales:
+        pending_counts = dict(PENDING_PURCHASE_COUNTS)
+        await connection.execute("SAVEPOINT sale")
+        try:
+            await insert_sales_in_pipeline(connection, [(kind, sale)])
+        except Exception as e:
+            await connection.execute("ROLLBACK TO SAVEPOINT sale")
+            rollback_dimension_caches_to_savepoints()
+            PENDING_PURCHASE_COUNTS.update(pending_counts)
+            await connection.execute(INSERT_REJECTED_SALE, get_rejected_sale_params(sale, e))
+            continue
+        await connection.execute("RELEASE SAVEPOINT sale")
+        release_dimension_cache_savepoints()
+
+
+async def async_load_sales_batch(connection: AsyncConnection,
+                                 sales_data: List[Dict[str, Any]]) -> bool:
+    """Inserts a chunk of sales in one transaction on an open connection,
+    returning whether it was committed. The chunk is pipelined as a whole, and
+    only if that fails is it inserted again a sale at a time, so that the
+    sales that failed can be rejected without losing the rest. The hourly
+    sales rollups are updated with its purchases before it commits."""
+
+    sales, deferred = get_loadable_sales(sales_data)
+    try:
+        try:
+            await connection.execute(CREATE_PENDING_SALES_ROLLUP)
+            await insert_sales_in_pipeline(connection, sales)
+        except Exception as e:
+            logging.warning("Loading %s sales sale by sale after an error: %s", len(sales), e)
+            await connection.rollback()
+            rollback_dimension_caches()
+            rollback_purchase_counts()
+            await connection.execute(CREATE_PENDING_SALES_ROLLUP)
+            await insert_sales_in_savepoints(connection, sales)
+        await defer_sales(connection, deferred)
+        await connection.execute(FLUSH_SALES_ROLLUPS)
+        await connection.commit()
+        commit_dimension_caches()
+        commit_purchase_counts()
+        return True
+    except Exception as e:
+        logging.error("An error occurred, rolling back %s sales: %s",
+                      len(sales_data), e)
+        await connection.rollback()
+        rollback_dimension_caches()
+        rollback_purchase_counts()
+        return False
+
+
+async def load_sales_data_async(sales_data: List[Dict[str, Any]], warm_caches: bool = False,
+                                chunk_size: int = COMMIT_CHUNK_SIZE) -> bool:
+    """Loads sales data into the database, committing every chunk_size sales,
+    first warming the dimension caches if warm_caches is set. Returns whether
+    every chunk was committed."""
+
+    committed = False
+    connection = await get_async_connection()
+    try:
+        if warm_caches:
+            await warm_dimension_caches_async(connection)
+        committed = True
+        for start in range(0, len(sales_data), chunk_size):
+            committed &= await async_load_sales_batch(
+                connection, sales_data[start:start + chunk_size])
+    except Exception as e:
+        logging.error("An error occurred: %s", e)
+        committed = False
+    finally:
+        await connection.close()
+    log_dimension_cache_stats()
+    log_purchase_stats()
+    return committed
+
+
+def async_load_sales_data(sales_data: List[Dict[str, Any]], warm_caches: bool = False,
+                          chunk_size: int = COMMIT_CHUNK_SIZE) -> bool:
+    """Loads sales data into the database as load_sales_data does, running
+    the asynchronous loader on the shared event loop."""
+    return http_client.run(load_sales_data_async(sales_data, warm_caches, chunk_size))
+
+
+async def get_async_batch_loader(warm_caches: bool = False) -> Tuple[AsyncConnection, partial]:
+    """Opens a connection for loading micro-batches on the running event
+    loop, returning it and a coroutine function loading a batch on it."""
+
+    connection = await get_async_connection()
+    if warm_caches:
+        await warm_dimension_caches_async(connection)
+        await connection.commit()
+    return connection, partial(async_load_sales_batch, connection)
@@ -0,0 +1,142 @@
+'''Replays a day of sales to measure how many track sales are resolved without a fetch.
+
+Generates a synthetic catalogue of albums and a day of sales skewed towards popular
+releases, serves album and track pages for it from a local server, then runs the
+extract step once per pipeline interval (every 2 minutes, as scheduled) over the day.
+The day is replayed with the scrape cache alone and with album pages also recording
+their tracks, reporting the fraction of track sales filled in without fetching the
+track page.
+
+Run with: python3 benchmark_album_harvest.py --sales 5000 --releases 800 --seed 1
+'''
+
+import argparse
+import random
+import tempfile
+from pathlib import Path
+
+from aiohttp import web
+
+import http_client
+from extract import extract_list_of_items
+from scrape_cache import ScrapeCache
+
+
+DAY_SECONDS = 24 * 60 * 60
+RUN_INTERVAL_SECONDS = 2 * 60
+ALBUM_SALE_SHARE = 0.35
+POPULARITY_SKEW = 1.1
+
+
+class ScrapeCacheWithoutAlbumTracks(ScrapeCache):
+    '''Scrape cache that ignores album track lists, as before they were recorded'''
+
+    def set_album_tracks(self, album_url: str, track_urls: list[str], tags: list[str]) -> None:
+        '''Discards the track list of an album page'''
+
+
+def create_catalogue(releases: int, rng: random.Random) -> list[dict]:
+    '''Creates albums of 4 to 12 tracks, each with a couple of tags'''
+    return [{"artist": f"artist{index}", "tracks": rng.randint(4, 12),
+             "tags": [f"genre{rng.randint(1, 40)}", f"place{rng.randint(1, 40)}"]}
+            for index in range(releases)]
+
+
+def create_day_of_sales(catalogue: list[dict], sales: int, base_url: str,
+                        rng: random.Random) -> list[dict]:
+    '''Creates a day of album and track sale events, most of them for popular releases'''
+    weights = [1 / (rank + 1) ** POPULARITY_SKEW for rank in range(len(catalogue))]
+    events = []
+    for release in rng.choices(catalogue, weights=weights, k=sales):
+        artist_url = f"{base_url}/{release['artist']}"
+        if rng.random() < ALBUM_SALE_SHARE:
+            item = {"item_type": "a", "album_title": None,
+                    "url": f"{artist_url}/album/record"}
+        else:
+            item = {"item_type": "t", "album_title": "Record",
+                    "url": f"{artist_url}/track/t{rng.randint(1, release['tracks'])}"}
+        events.append({"event_type": "sale", "utc_date": rng.uniform(0, DAY_SECONDS),
+                       "items": [item]})
+    return sorted(events, key=lambda event: event["utc_date"])
+
+
+def create_catalogue_app(catalogue: list[dict], counter: dict) -> web.Application:
+    '''Creates a server for the album and track pages of the catalogue, counting
+    the requests for track pages'''
+    releases = {release["artist"]: release for release in catalogue}
+
+    def render_tags(release: dict) -> str:
+        links = "".join(f'<a class="tag">{tag}</a>' for tag in release["tags"])
+        return f'<div class="tralbumData tralbum-tags">{links}</div>'
+
+    async def serve_album(request: web.Request) -> web.Response:
+        release = releases[request.match_info["artist"]]
+        rows = "".join(f'<tr><td><div class="title"><a href="/track/t{number}">'
+                       f'Track {number}</a></div></td></tr>'
+                       for number in range(1, release["tracks"] + 1))
+        return web.Response(text=f'<table id="track_table">{rows}</table>'
+                            f'{render_tags(release)}', content_type="text/html")
+
+    async def serve_track(request: web.Request) -> web.Response:
+        counter["track_pages"] += 1
+        release = releases[request.match_info["artist"]]
+        return web.Response(text='<a id="buyAlbumLink" href="/album/record">Buy</a>'
+                            f'{render_tags(release)}', content_type="text/html")
+
+    app = web.Application()
+    app.router.add_get("/{artist}/album/{name}", serve_album)
+    app.router.add_get("/{artist}/track/{name}", serve_track)
+    return app
+
+
+def replay_day(events: list[dict], cache: ScrapeCache) -> None:
+    '''Runs the extract step over the day, once per pipeline interval'''
+    for run_start in range(0, DAY_SECONDS, RUN_INTERVAL_SECONDS):
+        run_events = [event for event in events
+                      if run_start <= event["utc_date"] < run_start + RUN_INTERVAL_SECONDS]
+        if run_events:
+            http_client.run(extract_list_of_items(run_events, cache=cache))
+
+
+def run_benchmark(sales: int, releases: int, seed: int) -> None:
+    '''Replays the same day with and without album track lists and prints a comparison'''
+    rng = random.Random(seed)
+    catalogue = create_catalogue(releases, rng)
+    counter = {"track_pages": 0}
+
+    runner = web.AppRunner(create_catalogue_app(catalogue, counter))
+    http_client.run(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    http_client.run(site.start())
+    port = site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+    events = create_day_of_sales(catalogue, sales, f"http://127.0.0.1:{port}", rng)
+    track_sales = sum(event["items"][0]["item_type"] == "t" for event in events)
+
+    print(f"Sales: {sales} ({track_sales} tracks), releases: {releases}, "
+          f"runs: {DAY_SECONDS // RUN_INTERVAL_SECONDS}")
+    print(f"{'lookup':<22}{'track page fetches':>20}{'resolved without fetch':>24}")
+    try:
+        for name, cache_class in (("scrape cache", ScrapeCacheWithoutAlbumTracks),
+                                  ("+ album track lists", ScrapeCache)):
+            counter["track_pages"] = 0
+            with tempfile.TemporaryDirectory() as directory:
+                cache = cache_class(Path(directory) / "cache.sqlite3")
+                replay_day([{**event, "items": [dict(event["items"][0])]}
+                            for event in events], cache)
+                cache.close()
+            resolved = 1 - counter["track_pages"] / track_sales
+            print(f"{name:<22}{counter['track_pages']:>20}{resolved * 100:>23.1f}%")
+    finally:
+        http_client.run(runner.cleanup())
+        http_client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sales", type=int, default=5000, help="number of sales in the day")
+    parser.add_argument("--releases", type=int, default=800,
+                        help="number of albums in the catalogue")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the generated day")
+    args = parser.parse_args()
+
+    run_benchmark(args.sales, args.releases, args.seed)
@@ -0,0 +1,139 @@
+'''Benchmark of the row by row loader against the pipelined async loader, through
+a proxy adding network latency in front of a local Postgres.
+
+The proxy listens on a local port and forwards every byte to the database, holding
+each chunk back for half the round trip time in each direction, so a local Postgres
+answers as if it were a network hop away. The same synthetic sales are then loaded
+with load_sales_batch and with async_load_sales_batch for each round trip time, into
+a freshly reset schema, committing every chunk of sales, and the wall time and sales
+loaded per second are reported. Connects with the DB_ environment variables, and the
+schema is dropped and recreated before each run, so never point it at a database in use.
+
+Run with: python3 benchmark_async_load.py --size 5000 --rtts 0 5 20
+'''
+
+import argparse
+import asyncio
+from os import environ as ENV
+import random
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from async_load import async_load_sales_batch, get_async_connection
+from benchmark_load import count_purchases, create_sales, get_chunked_loader, reset_schema
+import http_client
+from load import COMMIT_CHUNK_SIZE, clear_dimension_caches, get_connection
+
+PROXY_BUFFER_BYTES = 65536
+
+
+class LatencyProxy:
+    '''A TCP proxy on its own thread, delaying every chunk by half of rtt_ms
+    in each direction while keeping the order of the bytes'''
+
+    def __init__(self, target_host: str, target_port: int, rtt_ms: float):
+        self.target_host = target_host
+        self.target_port = target_port
+        self.delay = rtt_ms / 2000
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+        self.port = None
+
+    async def forward(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''Forwards one direction of a connection, each chunk after the delay'''
+        chunks = asyncio.Queue()
+
+        async def send() -> None:
+            while (item := await chunks.get()) is not None:
+                due, data = item
+                await asyncio.sleep(max(due - self.loop.time(), 0))
+                writer.write(data)
+                await writer.drain()
+            writer.close()
+
+        sender = asyncio.create_task(send())
+        try:
+            while data := await reader.read(PROXY_BUFFER_BYTES):
+                chunks.put_nowait((self.loop.time() + self.delay, data))
+        except ConnectionError:
+            pass
+        chunks.put_nowait(None)
+        await sender
+
+    async def handle(self, client_reader: asyncio.StreamReader,
+                     client_writer: asyncio.StreamWriter) -> None:
+        '''Connects a client to the database through the delaying forwarders'''
+        server_reader, server_writer = await asyncio.open_connection(
+            self.target_host, self.target_port)
+        await asyncio.gather(self.forward(client_reader, server_writer),
+                             self.forward(server_reader, client_writer),
+                             return_exceptions=True)
+
+    def start(self) -> int:
+        '''Starts the proxy, returning the port it listens on'''
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle, "127.0.0.1", 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        return self.port
+
+    def stop(self) -> None:
+        '''Stops the proxy'''
+        self.server.close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+async def load_in_chunks_async(sales: list[dict], chunk_size: int) -> None:
+    '''Loads sales with the async loader, committing every chunk_size sales'''
+    connection = await get_async_connection()
+    try:
+        for start in range(0, len(sales), chunk_size):
+            await async_load_sales_batch(connection, sales[start:start + chunk_size])
+    finally:
+        await connection.close()
+
+
+def run_benchmark(size: int, rtts: list[float], chunk_size: int, seed: int) -> None:
+    '''Loads the sales with both loaders at every round trip time and prints a comparison'''
+    sales = create_sales(size, random.Random(seed))
+    target_host, target_port = ENV["DB_HOST"], int(ENV["DB_PORT"])
+    print(f"{'rtt (ms)':>9}{'loader':>8}{'loaded':>10}{'wall (s)':>11}{'sales/s':>11}")
+
+    for rtt in rtts:
+        proxy = LatencyProxy(target_host, target_port, rtt)
+        ENV.update(DB_HOST="127.0.0.1", DB_PORT=str(proxy.start()))
+        try:
+            for name in ("row", "async"):
+                connection = get_connection()
+                reset_schema(connection)
+                clear_dimension_caches()
+                start = time.perf_counter()
+                if name == "row":
+                    get_chunked_loader(chunk_size)(connection, [dict(sale) for sale in sales])
+                else:
+                    http_client.run(load_in_chunks_async([dict(sale) for sale in sales],
+                                                         chunk_size))
+                wall_time = time.perf_counter() - start
+                loaded, _ = count_purchases(connection)
+                connection.close()
+                print(f"{rtt:>9g}{name:>8}{loaded:>10}{wall_time:>11.2f}"
+                      f"{size / wall_time:>11.0f}")
+        finally:
+            proxy.stop()
+            ENV.update(DB_HOST=target_host, DB_PORT=str(target_port))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=5000, help="number of sales to load")
+    parser.add_argument("--rtts", type=float, nargs="+", default=[0, 5, 20],
+                        help="round trip times to simulate, in milliseconds")
+    parser.add_argument("--chunk-size", type=int, default=COMMIT_CHUNK_SIZE,
+                        help="number of sales committed at a time")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the generated sales")
+    args = parser.parse_args()
+
+    load_dotenv()
+    run_benchmark(args.size, args.rtts, args.chunk_size, args.seed)
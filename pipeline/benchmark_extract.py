@@ -0,0 +1,129 @@
+'''Benchmark of get_sales_data against the local bandcamp simulator.
+
+Runs the extract step end to end, from the salesfeed to the last scraped page, for
+each scenario: a responsive server, one that throttles, one that fails requests and
+one serving large pages. Items per second, requests per second and retries are
+printed and appended, with the commit they were measured at, to a results file,
+so a change can be compared against earlier commits.
+
+Run with: python3 benchmark_extract.py --sales 500 --latency 0.05 --results results.jsonl
+'''
+
+import argparse
+from datetime import datetime, timezone
+import json
+from pathlib import Path
+import subprocess
+import time
+
+import http_client
+from extract import get_sales_data
+from simulator import BandcampSimulator
+
+
+RESULTS_PATH = "benchmark_extract_results.jsonl"
+SCENARIOS = {
+    "baseline": {},
+    "throttled": {"throttle_rate": 0.05},
+    "errors": {"error_rate": 0.02},
+    "large_pages": {"page_bytes": 250000},
+}
+
+
+def get_commit() -> str:
+    '''Returns the short hash of the checked out commit, or None outside a git repository'''
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                            text=True, check=False)
+    return result.stdout.strip() or None
+
+
+def run_scenario(scenario: str, sales: int, releases: int, latency: float,
+                 seed: int) -> dict:
+    '''Runs the extract step once against a fresh simulator and returns its measurements'''
+    simulator = BandcampSimulator(sales=sales, releases=releases, latency=latency,
+                                  seed=seed, **SCENARIOS[scenario])
+    api_url = http_client.run(simulator.start())
+    try:
+        start = time.perf_counter()
+        items, _ = get_sales_data(cache_path=None, archive_path=None, api_url=api_url)
+        wall_time = time.perf_counter() - start
+    finally:
+        http_client.run(simulator.stop())
+        http_client.close()
+
+    requests = simulator.stats["feed_requests"] + simulator.stats["page_requests"]
+    complete = sum(item.get("album_tags") is not None or item.get("track_tags") is not None
+                   for item in items)
+    return {
+        "scenario": scenario,
+        "commit": get_commit(),
+        "recorded_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "sales": sales,
+        "releases": releases,
+        "latency": latency,
+        "seed": seed,
+        "items": len(items),
+        "items_complete": complete,
+        "wall_time": round(wall_time, 3),
+        "items_per_second": round(len(items) / wall_time, 1),
+        "requests_per_second": round(requests / wall_time, 1),
+        "retries": simulator.retries,
+        **simulator.stats,
+    }
+
+
+def load_previous_results(results_path: Path) -> dict:
+    '''Returns the latest recorded result of each scenario and its settings'''
+    previous = {}
+    if results_path.exists():
+        for line in results_path.read_text(encoding="utf-8").splitlines():
+            result = json.loads(line)
+            previous[get_result_key(result)] = result
+    return previous
+
+
+def get_result_key(result: dict) -> tuple:
+    '''Returns what has to match for two results to be comparable'''
+    return (result["scenario"], result["sales"], result["releases"], result["latency"],
+            result["seed"])
+
+
+def run_benchmark(scenarios: list[str], sales: int, releases: int, latency: float,
+                  seed: int, results_path: Path) -> None:
+    '''Runs every scenario, prints them next to the last recorded run and records them'''
+    previous = load_previous_results(results_path)
+
+    print(f"Sales: {sales}, releases: {releases}, page latency: {latency * 1000:.0f}ms")
+    print(f"{'scenario':<13}{'items/s':>9}{'requests/s':>12}{'retries':>9}"
+          f"{'complete':>10}{'vs previous':>20}")
+    for scenario in scenarios:
+        result = run_scenario(scenario, sales, releases, latency, seed)
+        before = previous.get(get_result_key(result))
+        change = "" if before is None else (
+            f"{result['items_per_second'] / before['items_per_second'] - 1:+.1%}"
+            f" ({before['commit']})")
+        print(f"{scenario:<13}{result['items_per_second']:>9.1f}"
+              f"{result['requests_per_second']:>12.1f}{result['retries']:>9}"
+              f"{result['items_complete']:>10}{change:>20}")
+
+        with open(results_path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(result) + "\n")
+    print(f"Results appended to {results_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sales", type=int, default=500, help="number of sales in the feed")
+    parser.add_argument("--releases", type=int, default=200,
+                        help="number of albums in the simulated catalogue")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="seconds of latency added to every page request")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the simulated sales")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="scenario to run, can be repeated (defaults to all)")
+    parser.add_argument("--results", type=Path, default=Path(RESULTS_PATH),
+                        help="file the results are appended to")
+    args = parser.parse_args()
+
+    run_benchmark(args.scenario or list(SCENARIOS), args.sales, args.releases,
+                  args.latency, args.seed, args.results)
@@ -0,0 +1,68 @@
+'''Micro-benchmark of the HTML extractor backends on the saved fixture pages.
+
+For every backend and page this reports the CPU time per parse, the peak memory
+allocated by Python during a parse (tracemalloc) and the growth in peak RSS of a
+fresh process parsing the page, which also covers memory allocated by lxml in C.
+
+Run with: python3 benchmark_extractors.py --repeats 200
+'''
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from pathlib import Path
+import resource
+import time
+import tracemalloc
+
+from extract import PAGE_EXTRACTORS
+
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+def measure_backend(backend: str, page_path: str, repeats: int) -> dict:
+    '''Parses one page with one backend, in a fresh process, and measures the cost'''
+    extractor = PAGE_EXTRACTORS[backend]
+    html = Path(page_path).read_text(encoding="utf-8")
+
+    extractor(html)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.process_time()
+    for _ in range(repeats):
+        extractor(html)
+    cpu_ms = (time.process_time() - start) / repeats * 1000
+
+    tracemalloc.start()
+    extractor(html)
+    _, python_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    return {"cpu_ms": cpu_ms, "python_peak_kb": python_peak / 1024, "rss_growth_kb": rss_growth}
+
+
+def run_benchmark(repeats: int) -> None:
+    '''Measures every backend on every fixture page and prints a table'''
+    pages = sorted(FIXTURES.glob("*.html"))
+    context = multiprocessing.get_context("spawn")
+
+    print(f"{'page':<26}{'backend':<11}{'size (kb)':>10}{'cpu (ms)':>10}"
+          f"{'py peak (kb)':>14}{'rss growth (kb)':>17}")
+    for page in pages:
+        for backend in sorted(PAGE_EXTRACTORS):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(measure_backend, backend, str(page), repeats).result()
+            print(f"{page.name:<26}{backend:<11}{page.stat().st_size / 1024:>10.1f}"
+                  f"{result['cpu_ms']:>10.2f}{result['python_peak_kb']:>14.1f}"
+                  f"{result['rss_growth_kb']:>17}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=200,
+                        help="number of parses timed per page and backend")
+    args = parser.parse_args()
+
+    run_benchmark(args.repeats)
@@ -0,0 +1,131 @@
+'''Benchmark of the connection setup saved by reusing the shared http client across invocations.
+
+Serves a small JSON feed over HTTPS from a local server with a self-signed certificate,
+then simulates a number of Lambda invocations that each make a batch of requests. Per
+invocation sessions (the previous behaviour, a fresh ClientSession and connection pool every
+run) are compared with one pooled session kept open between invocations, reporting the
+connections opened, the measured TCP + TLS setup time and the wall time. Setup on
+localhost is only CPU; the estimate adds two round trips per new connection at --rtt.
+
+Run with: python3 benchmark_http_client.py --invocations 20 --requests 10 --rtt 0.03
+'''
+
+import argparse
+from pathlib import Path
+import ssl
+import subprocess
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+import http_client
+
+
+def create_certificate(directory: Path) -> tuple[Path, Path]:
+    '''Creates a self-signed certificate for 127.0.0.1 using openssl'''
+    cert, key = directory / "cert.pem", directory / "key.pem"
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+                    "-keyout", str(key), "-out", str(cert), "-days", "1",
+                    "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1"],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+def create_trace_config(setup_times: list) -> aiohttp.TraceConfig:
+    '''Creates a trace config recording how long each new connection took to set up'''
+    async def on_start(_session, context, _params):
+        context.connect_start = time.perf_counter()
+
+    async def on_end(_session, context, _params):
+        setup_times.append(time.perf_counter() - context.connect_start)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_start.append(on_start)
+    trace_config.on_connection_create_end.append(on_end)
+    return trace_config
+
+
+async def run_invocation(session: aiohttp.ClientSession, url: str, requests: int) -> None:
+    '''Makes one invocation's worth of feed requests'''
+    for _ in range(requests):
+        async with session.get(url) as response:
+            await response.json()
+
+
+async def run_cold_invocation(url: str, requests: int, ssl_context: ssl.SSLContext,
+                              setup_times: list) -> None:
+    '''Makes an invocation's requests on a session of its own, as before the shared client'''
+    async with http_client.create_session(ssl_context, [create_trace_config(setup_times)]) \
+            as session:
+        await run_invocation(session, url, requests)
+
+
+async def open_shared_session(ssl_context: ssl.SSLContext,
+                              setup_times: list) -> aiohttp.ClientSession:
+    '''Opens a session to be kept across invocations, as the shared client does'''
+    return http_client.create_session(ssl_context, [create_trace_config(setup_times)])
+
+
+def run_benchmark(invocations: int, requests: int, rtt: float) -> None:
+    '''Runs the invocations with both strategies and prints a comparison'''
+    async def serve_feed(_request: web.Request) -> web.Response:
+        return web.json_response({"feed_data": {"events": []}})
+
+    with tempfile.TemporaryDirectory() as directory:
+        cert, key = create_certificate(Path(directory))
+        server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        server_context.load_cert_chain(cert, key)
+        client_context = ssl.create_default_context(cafile=str(cert))
+
+        app = web.Application()
+        app.router.add_get("/feed", serve_feed)
+        runner = web.AppRunner(app)
+        http_client.run(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0, ssl_context=server_context)
+        http_client.run(site.start())
+        port = site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+        url = f"https://127.0.0.1:{port}/feed"
+
+        results = {}
+        cold_setup_times = []
+        start = time.perf_counter()
+        for _ in range(invocations):
+            http_client.run(run_cold_invocation(url, requests, client_context,
+                                                cold_setup_times))
+        results["per invocation"] = (cold_setup_times, time.perf_counter() - start)
+
+        shared_setup_times = []
+        shared_session = http_client.run(
+            open_shared_session(client_context, shared_setup_times))
+        start = time.perf_counter()
+        for _ in range(invocations):
+            http_client.run(run_invocation(shared_session, url, requests))
+        results["shared"] = (shared_setup_times, time.perf_counter() - start)
+
+        http_client.run(shared_session.close())
+        http_client.run(runner.cleanup())
+        http_client.close()
+
+    print(f"Invocations: {invocations}, requests per invocation: {requests}, "
+          f"assumed rtt: {rtt * 1000:.0f}ms")
+    print(f"{'session':<16}{'connections':>13}{'setup (ms)':>12}{'wall (ms)':>11}"
+          f"{'est. setup at rtt (ms)':>24}")
+    for name, (setup_times, wall) in results.items():
+        estimated = sum(setup_times) + len(setup_times) * 2 * rtt
+        print(f"{name:<16}{len(setup_times):>13}{sum(setup_times) * 1000:>12.1f}"
+              f"{wall * 1000:>11.1f}{estimated * 1000:>24.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--invocations", type=int, default=20,
+                        help="number of warm invocations simulated")
+    parser.add_argument("--requests", type=int, default=10,
+                        help="number of requests made by each invocation")
+    parser.add_argument("--rtt", type=float, default=0.03,
+                        help="round trip time to bandcamp used for the estimate, in seconds")
+    args = parser.parse_args()
+
+    run_benchmark(args.invocations, args.requests, args.rtt)
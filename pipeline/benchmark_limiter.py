@@ -0,0 +1,117 @@
+'''Benchmark of the adaptive limiter against a local server that throttles at a set rate.
+
+The server answers 429 with a Retry-After once more than --rate requests arrive in a
+second. The same batch of pages is scraped with the old fixed limits (3 requests at a
+time, a 0.1s sleep before each, 2 ** attempt backoff) and with the AdaptiveLimiter,
+reporting throughput, the 429 rate and the final concurrency.
+
+Run with: python3 benchmark_limiter.py --pages 300 --rate 40 --latency 0.05
+'''
+
+import argparse
+import asyncio
+import time
+
+import aiohttp
+from aiohttp import web
+
+from extract import fetch_webpage
+from limiter import AdaptiveLimiter
+
+
+FIXED_CONCURRENCY = 3
+FIXED_DELAY_SECONDS = 0.1
+
+
+def create_rate_limited_app(rate: int, latency: float, counter: dict) -> web.Application:
+    '''Creates a server that throttles once more than rate requests arrive in a second'''
+    window = {"start": time.monotonic(), "count": 0}
+
+    async def serve_page(_request: web.Request) -> web.Response:
+        now = time.monotonic()
+        if now - window["start"] >= 1:
+            window["start"], window["count"] = now, 0
+        window["count"] += 1
+        counter["requests"] += 1
+
+        if window["count"] > rate:
+            counter["throttled"] += 1
+            retry_after = max(1 - (now - window["start"]), 0)
+            return web.Response(status=429, headers={"Retry-After": f"{retry_after:.2f}"})
+
+        await asyncio.sleep(latency)
+        return web.Response(text="<html><a class='tag'>tag</a></html>",
+                            content_type="text/html")
+
+    app = web.Application()
+    app.router.add_get("/{name}", serve_page)
+    return app
+
+
+async def scrape_with_fixed_limits(session: aiohttp.ClientSession, urls: list[str]) -> None:
+    '''Scrapes with the fixed semaphore and sleep used before the adaptive limiter'''
+    semaphore = asyncio.Semaphore(FIXED_CONCURRENCY)
+
+    async def fetch(url):
+        async with semaphore:
+            await asyncio.sleep(FIXED_DELAY_SECONDS)
+            return await fetch_webpage(session, url, 30)
+
+    return await asyncio.gather(*[fetch(url) for url in urls])
+
+
+async def scrape_with_adaptive_limiter(session: aiohttp.ClientSession, urls: list[str],
+                                       limiter: AdaptiveLimiter) -> None:
+    '''Scrapes with the adaptive limiter in charge of concurrency and backoff'''
+    async def fetch(url):
+        async with limiter:
+            return await fetch_webpage(session, url, 30, limiter=limiter)
+
+    return await asyncio.gather(*[fetch(url) for url in urls])
+
+
+async def run_benchmark(pages: int, rate: int, latency: float) -> None:
+    '''Scrapes the same pages with both strategies and prints a comparison'''
+    counter = {"requests": 0, "throttled": 0}
+    runner = web.AppRunner(create_rate_limited_app(rate, latency, counter))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+    urls = [f"http://127.0.0.1:{port}/{i}" for i in range(pages)]
+
+    print(f"Pages: {pages}, server rate limit: {rate}/s, latency: {latency * 1000:.0f}ms")
+    print(f"{'strategy':<12}{'pages/s':>10}{'failed':>8}{'429 rate':>10}{'concurrency':>13}")
+    try:
+        async with aiohttp.ClientSession() as session:
+            for name in ("fixed", "adaptive"):
+                counter["requests"], counter["throttled"] = 0, 0
+                limiter = AdaptiveLimiter()
+                await asyncio.sleep(1)
+
+                start = time.perf_counter()
+                if name == "fixed":
+                    results = await scrape_with_fixed_limits(session, urls)
+                else:
+                    results = await scrape_with_adaptive_limiter(session, urls, limiter)
+                elapsed = time.perf_counter() - start
+
+                failed = sum(result is None for result in results)
+                throttle_rate = counter["throttled"] / counter["requests"]
+                concurrency = FIXED_CONCURRENCY if name == "fixed" else limiter.concurrency
+                print(f"{name:<12}{pages / elapsed:>10.1f}{failed:>8}"
+                      f"{throttle_rate * 100:>9.1f}%{concurrency:>13}")
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=300, help="number of pages to scrape")
+    parser.add_argument("--rate", type=int, default=40,
+                        help="requests per second the server allows before throttling")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="seconds of latency added to every successful request")
+    args = parser.parse_args()
+
+    asyncio.run(run_benchmark(args.pages, args.rate, args.latency))
@@ -0,0 +1,131 @@
+'''Benchmark of the row by row loader against the bulk loader on a local Postgres.
+
+Generates synthetic transformed sales over a catalogue of artists, albums, tracks and
+tags, then loads the same sales with load_sales_batch, committing every chunk of each
+chunk size, and with bulk_load_sales_batch, each into a freshly reset schema, reporting
+the wall time and sales loaded per second. A share of the sales can be made to overflow
+amount_usd, to measure the cost of rejecting them in their savepoints.
+Connects with the DB_ environment variables, and the schema is dropped and recreated
+from schema/schema.sql before each run, so never point it at a database in use.
+
+Run with: python3 benchmark_load.py --sizes 10000 100000 1000000 --row-limit 100000
+          python3 benchmark_load.py --sizes 100000 --chunk-sizes 1 50 500 5000 100000
+'''
+
+import argparse
+from pathlib import Path
+import random
+import time
+
+from dotenv import load_dotenv
+
+from bulk_load import bulk_load_sales_batch
+from load import COMMIT_CHUNK_SIZE, get_connection, load_sales_batch
+
+
+SCHEMA_PATH = Path(__file__).parent.parent / "schema" / "schema.sql"
+COUNTRIES = ["United Kingdom", "United States", "Germany", "Japan", "France", "Canada"]
+ALBUM_SALE_SHARE = 0.35
+SINGLE_SALE_SHARE = 0.1
+
+
+def create_sales(size: int, rng: random.Random, reject_share: float = 0) -> list[dict]:
+    '''Creates transformed sales, with one release for every twenty sales, and
+    reject_share of them with an amount too large to load'''
+    releases = max(size // 20, 1)
+    sales = []
+    for _ in range(size):
+        release = rng.randint(1, releases)
+        artist_url = f"https://artist{release % (releases // 2 + 1)}.bandcamp.com"
+        tags = [f"genre{rng.randint(1, 300)}" for _ in range(4)] + [rng.choice(COUNTRIES)]
+        sale = {
+            "utc_date": f"2024-06-{rng.randint(1, 30):02} "
+                        f"{rng.randint(0, 23):02}:{rng.randint(0, 59):02}:00",
+            "artist_name": f"Artist {release}",
+            "artist_url": artist_url,
+            "amount_paid_usd": round(rng.uniform(1, 30), 2)
+                               if rng.random() >= reject_share else 10_000_000,
+            "country": rng.choice(COUNTRIES),
+        }
+        roll = rng.random()
+        if roll < ALBUM_SALE_SHARE:
+            sale.update(item_type="a", item_description=f"Album {release}",
+                        url=f"{artist_url}/album/a{release}", album_tags=tags)
+        elif roll < ALBUM_SALE_SHARE + SINGLE_SALE_SHARE:
+            sale.update(item_type="s", item_description=f"Single {release}",
+                        url=f"{artist_url}/track/s{release}", track_tags=tags)
+        else:
+            track = rng.randint(1, 10)
+            sale.update(item_type="t", item_description=f"Track {track}",
+                        url=f"{artist_url}/track/a{release}t{track}",
+                        album_title=f"Album {release}",
+                        album_url=f"{artist_url}/album/a{release}", track_tags=tags)
+        sales.append(sale)
+    return sales
+
+
+def reset_schema(connection) -> None:
+    '''Drops and recreates every table'''
+    with connection.cursor() as cursor:
+        cursor.execute(SCHEMA_PATH.read_text(encoding="utf-8"))
+    connection.commit()
+
+
+def count_purchases(connection) -> tuple[int, int]:
+    '''Returns the number of purchases and of rejected sales in the database'''
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT (SELECT COUNT(*) FROM album_purchase)"
+                       " + (SELECT COUNT(*) FROM track_purchase),"
+                       " (SELECT COUNT(*) FROM rejected_sale)")
+        return cursor.fetchone()
+
+
+def get_chunked_loader(chunk_size: int):
+    '''Returns a loader committing every chunk_size sales, as load_sales_data does'''
+    def load_in_chunks(connection, sales: list[dict]) -> None:
+        for start in range(0, len(sales), chunk_size):
+            load_sales_batch(connection, sales[start:start + chunk_size])
+    return load_in_chunks
+
+
+def run_benchmark(sizes: list[int], row_limit: int, chunk_sizes: list[int],
+                  reject_share: float, seed: int) -> None:
+    '''Loads every size with each loader and prints a comparison'''
+    connection = get_connection()
+    loaders = [(f"row/{chunk_size}", get_chunked_loader(chunk_size))
+               for chunk_size in chunk_sizes] + [("bulk", bulk_load_sales_batch)]
+    print(f"{'sales':>9}{'loader':>12}{'loaded':>10}{'rejected':>10}"
+          f"{'wall (s)':>11}{'sales/s':>11}")
+    try:
+        for size in sizes:
+            sales = create_sales(size, random.Random(seed), reject_share)
+            for name, load_batch in loaders:
+                if name != "bulk" and size > row_limit:
+                    print(f"{size:>9}{name:>12}{'skipped':>10}")
+                    continue
+                reset_schema(connection)
+                start = time.perf_counter()
+                load_batch(connection, [dict(sale) for sale in sales])
+                wall_time = time.perf_counter() - start
+                loaded, rejected = count_purchases(connection)
+                print(f"{size:>9}{name:>12}{loaded:>10}{rejected:>10}"
+                      f"{wall_time:>11.2f}{size / wall_time:>11.0f}")
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="numbers of sales to load")
+    parser.add_argument("--row-limit", type=int, default=100000,
+                        help="largest number of sales to load row by row")
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[COMMIT_CHUNK_SIZE],
+                        help="numbers of sales the row loader commits at a time")
+    parser.add_argument("--reject-share", type=float, default=0,
+                        help="share of sales made to fail and be rejected")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the generated sales")
+    args = parser.parse_args()
+
+    load_dotenv()
+    run_benchmark(args.sizes, args.row_limit, args.chunk_sizes, args.reject_share, args.seed)
@@ -0,0 +1,115 @@
+'''Benchmark comparing two fetches per track page against a single fetch and parse.
+
+Serves the fixture pages from a local server with a simulated network latency, then
+scrapes a batch of track sales the old way (scrape_tags, a delay, then scrape_album_url)
+and the new way (one scrape_page), reporting the number of fetches and the wall time.
+
+Run with: python3 benchmark_page_fetch.py --sales 60 --latency 0.05
+'''
+
+import argparse
+import asyncio
+from pathlib import Path
+import time
+
+import aiohttp
+from aiohttp import web
+
+from extract import (
+    get_stem_url,
+    scrape_album_url,
+    scrape_page,
+    scrape_tags,
+)
+
+
+FIXTURES = Path(__file__).parent / "fixtures"
+TRACK_FIXTURES = ["track_with_album.html", "track_without_tags.html"]
+DELAY_BETWEEN_REQUESTS = 0.1
+MAX_CONCURRENT_REQUESTS = 3
+
+
+def create_fixture_app(latency: float, counter: dict) -> web.Application:
+    '''Creates a web app serving every fixture page, counting each request'''
+    app = web.Application()
+    pages = {path.name: path.read_text(encoding="utf-8")
+             for path in FIXTURES.glob("*.html")}
+
+    async def serve_page(request: web.Request) -> web.Response:
+        counter["requests"] += 1
+        await asyncio.sleep(latency)
+        return web.Response(text=pages[request.match_info["name"]],
+                            content_type="text/html")
+
+    app.router.add_get("/{slug}/{name}", serve_page)
+    return app
+
+
+async def scrape_with_two_fetches(session: aiohttp.ClientSession, url: str) -> tuple:
+    '''Scrapes a track the way it was done before, fetching and parsing it twice'''
+    tags = await scrape_tags(session, url, 10)
+    await asyncio.sleep(DELAY_BETWEEN_REQUESTS)
+    album_href = await scrape_album_url(session, url, 10)
+    return tags, get_stem_url(url) + album_href if album_href else None
+
+
+async def scrape_with_one_fetch(session: aiohttp.ClientSession, url: str) -> tuple:
+    '''Scrapes a track with a single fetch and parse'''
+    page = await scrape_page(session, url, 10)
+    album_href = page["album_href"]
+    return page["tags"], get_stem_url(url) + album_href if album_href else None
+
+
+async def run_scrape(counter: dict, base_url: str, urls: list[str], scrape) -> dict:
+    '''Scrapes every url with the given strategy, under the usual concurrency limit'''
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    counter["requests"] = 0
+
+    async def scrape_one(session, url):
+        async with semaphore:
+            await asyncio.sleep(DELAY_BETWEEN_REQUESTS)
+            return await scrape(session, base_url + url)
+
+    start = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        results = await asyncio.gather(*[scrape_one(session, url) for url in urls])
+    wall_time = time.perf_counter() - start
+
+    return {"fetches": counter["requests"], "wall_time": wall_time, "results": results}
+
+
+async def run_benchmark(sales: int, latency: float) -> None:
+    '''Runs both strategies against the local fixture server and prints a comparison'''
+    counter = {"requests": 0}
+    app = create_fixture_app(latency, counter)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+    base_url = f"http://127.0.0.1:{port}"
+
+    urls = [f"/track/{TRACK_FIXTURES[i % len(TRACK_FIXTURES)]}" for i in range(sales)]
+    try:
+        before = await run_scrape(counter, base_url, urls, scrape_with_two_fetches)
+        after = await run_scrape(counter, base_url, urls, scrape_with_one_fetch)
+    finally:
+        await runner.cleanup()
+
+    assert before["results"] == after["results"], "Strategies scraped different fields"
+
+    print(f"Track sales scraped: {sales}, simulated latency: {latency * 1000:.0f}ms")
+    print(f"{'strategy':<16}{'fetches':>10}{'wall time (s)':>16}")
+    print(f"{'two fetches':<16}{before['fetches']:>10}{before['wall_time']:>16.3f}")
+    print(f"{'one fetch':<16}{after['fetches']:>10}{after['wall_time']:>16.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sales", type=int, default=60,
+                        help="number of track sales to scrape")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="seconds of latency added to every page request")
+    args = parser.parse_args()
+
+    asyncio.run(run_benchmark(args.sales, args.latency))
@@ -0,0 +1,120 @@
+'''Benchmark of end-to-end scrape throughput with pages parsed on and off the event loop.
+
+Starts a local stub server in its own process, serving the fixture pages, then scrapes
+a batch of pages with parsing done on the event loop and in process pools of 1, 2, 4
+and 8 workers, reporting the pages scraped per second for each.
+
+Run with: python3 benchmark_parse_pool.py --pages 400 --concurrency 16 --backend soup
+'''
+
+import argparse
+import asyncio
+import multiprocessing
+from os import environ as ENV
+from pathlib import Path
+import socket
+import time
+
+import aiohttp
+from aiohttp import web
+
+from extract import get_parse_executor, scrape_page
+
+
+FIXTURES = Path(__file__).parent / "fixtures"
+WORKER_COUNTS = [0, 1, 2, 4, 8]
+
+
+def serve_fixtures(port: int, latency: float) -> None:
+    '''Serves every fixture page on a local port, with a simulated latency'''
+    pages = {path.name: path.read_bytes() for path in FIXTURES.glob("*.html")}
+
+    async def serve_page(request: web.Request) -> web.Response:
+        await asyncio.sleep(latency)
+        return web.Response(body=pages[request.match_info["name"]],
+                            content_type="text/html", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/{slug}/{name}", serve_page)
+    web.run_app(app, host="127.0.0.1", port=port, print=None)
+
+
+def get_free_port() -> int:
+    '''Finds a free local port for the stub server'''
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def scrape_pages(urls: list[str], concurrency: int, workers: int) -> float:
+    '''Scrapes every url and returns the pages scraped per second'''
+    semaphore = asyncio.Semaphore(concurrency)
+    executor = get_parse_executor(workers)
+
+    async def scrape_one(session, url):
+        async with semaphore:
+            return await scrape_page(session, url, 30, executor)
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            await scrape_one(session, urls[0])
+            start = time.perf_counter()
+            pages = await asyncio.gather(*[scrape_one(session, url) for url in urls])
+            elapsed = time.perf_counter() - start
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    assert all(page is not None for page in pages), "Some pages failed to scrape"
+    return len(urls) / elapsed
+
+
+async def wait_for_server(base_url: str) -> None:
+    '''Waits until the stub server accepts requests'''
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            try:
+                async with session.get(f"{base_url}/album/album.html"):
+                    return
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError("Stub server did not start")
+
+
+def run_benchmark(pages: int, concurrency: int, latency: float) -> None:
+    '''Runs the scrape with every worker count and prints the throughput'''
+    port = get_free_port()
+    server = multiprocessing.Process(target=serve_fixtures, args=(port, latency), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{port}"
+
+    fixture_names = sorted(path.name for path in FIXTURES.glob("*.html"))
+    urls = [f"{base_url}/item/{fixture_names[i % len(fixture_names)]}" for i in range(pages)]
+
+    try:
+        asyncio.run(wait_for_server(base_url))
+        print(f"Pages: {pages}, concurrency: {concurrency}, latency: {latency * 1000:.0f}ms, "
+              f"backend: {ENV.get('HTML_EXTRACTOR', 'default')}")
+        print(f"{'parse workers':<16}{'pages/s':>10}")
+        for workers in WORKER_COUNTS:
+            throughput = asyncio.run(scrape_pages(urls, concurrency, workers))
+            label = "event loop" if workers == 0 else str(workers)
+            print(f"{label:<16}{throughput:>10.1f}")
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=400, help="number of pages to scrape")
+    parser.add_argument("--concurrency", type=int, default=16,
+                        help="number of requests in flight at once")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="seconds of latency added to every page request")
+    parser.add_argument("--backend", default=None,
+                        help="HTML extractor backend to parse with")
+    args = parser.parse_args()
+
+    if args.backend:
+        ENV["HTML_EXTRACTOR"] = args.backend
+    run_benchmark(args.pages, args.concurrency, args.latency)
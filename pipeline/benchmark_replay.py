@@ -0,0 +1,110 @@
+'''Measures how fast a day of archived sales replays through extract and transform.
+
+Generates a synthetic catalogue and day of sales, archives the feed responses a live
+run would have fetched every 2 minutes along with every album and track page, then
+replays the whole day from the archive with no network, reporting the archive size,
+compression ratio and replay throughput.
+
+Run with: python3 benchmark_replay.py --sales 5000 --releases 800 --seed 1
+'''
+
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import zstandard
+
+from archive import FeedArchive, get_day_range
+from benchmark_album_harvest import create_catalogue, create_day_of_sales
+from extract import replay_sales_data
+from transform import transform_sales_data
+
+
+DAY = "2024-06-30"
+BASE_URL = "https://bench.bandcamp.com"
+RUN_INTERVAL_SECONDS = 2 * 60
+
+
+def render_tags(release: dict) -> str:
+    '''Renders the tag block of an item page'''
+    links = "".join(f'<a class="tag">{tag}</a>' for tag in release["tags"])
+    return f'<div class="tralbumData tralbum-tags">{links}</div>'
+
+
+def archive_catalogue(archive: FeedArchive, catalogue: list[dict], fetched_at: float) -> None:
+    '''Archives the album page and every track page of each release'''
+    for release in catalogue:
+        artist_url = f"{BASE_URL}/{release['artist']}"
+        rows = "".join(f'<tr><td><div class="title"><a href="/track/t{number}">'
+                       f'Track {number}</a></div></td></tr>'
+                       for number in range(1, release["tracks"] + 1))
+        archive.write_page(f"{artist_url}/album/record", 200,
+                           f'<table id="track_table">{rows}</table>{render_tags(release)}'
+                           .encode(), fetched_at=fetched_at)
+        for number in range(1, release["tracks"] + 1):
+            archive.write_page(f"{artist_url}/track/t{number}", 200,
+                               f'<a id="buyAlbumLink" href="{artist_url}/album/record">Buy</a>'
+                               f'{render_tags(release)}'.encode(), fetched_at=fetched_at)
+
+
+def archive_feed(archive: FeedArchive, events: list[dict], day_start: float) -> None:
+    '''Archives the feed response each scheduled run would have fetched'''
+    for run_start in range(0, 24 * 60 * 60, RUN_INTERVAL_SECONDS):
+        run_events = [event for event in events
+                      if run_start <= event["utc_date"] - day_start
+                      < run_start + RUN_INTERVAL_SECONDS]
+        archive.write_feed("https://bandcamp.com/api/salesfeed/1/get_initial", None,
+                           {"feed_data": {"events": run_events}},
+                           fetched_at=day_start + run_start + RUN_INTERVAL_SECONDS)
+
+
+def get_decompressed_size(segment: Path) -> int:
+    '''Returns the size of a segment once decompressed to plain NDJSON'''
+    with open(segment, "rb") as file:
+        reader = zstandard.ZstdDecompressor().stream_reader(file, read_across_frames=True)
+        return len(reader.read())
+
+
+def run_benchmark(sales: int, releases: int, seed: int) -> None:
+    '''Archives a synthetic day, replays it and prints the results'''
+    rng = random.Random(seed)
+    day_start, _ = get_day_range(DAY)
+    catalogue = create_catalogue(releases, rng)
+    events = create_day_of_sales(catalogue, sales, BASE_URL, rng)
+    for event in events:
+        event["utc_date"] += day_start
+        event["items"][0].update(utc_date=event["utc_date"], artist_name="Artist",
+                                 item_description="Release", amount_paid_usd=1.0,
+                                 country="United Kingdom")
+
+    with tempfile.TemporaryDirectory() as directory:
+        archive = FeedArchive(Path(directory) / "archive", retention_days=0)
+        archive_catalogue(archive, catalogue, day_start)
+        archive_feed(archive, events, day_start)
+        archive.close()
+        segments = list(archive.path.glob("*.ndjson.zst"))
+        archived_bytes = sum(segment.stat().st_size for segment in segments)
+        raw_bytes = sum(get_decompressed_size(segment) for segment in segments)
+
+        start = time.perf_counter()
+        cleaned_sales = transform_sales_data(replay_sales_data(DAY, archive.path))
+        replay_seconds = time.perf_counter() - start
+
+    print(f"Sales: {sales}, releases: {releases}, records: {archive.records_written}")
+    print(f"Archive: {archived_bytes / 1024:.0f} KiB "
+          f"(compression ratio {raw_bytes / archived_bytes:.1f}x)")
+    print(f"Replayed {len(cleaned_sales)} sales in {replay_seconds:.2f}s "
+          f"({len(cleaned_sales) / replay_seconds:.0f} sales/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sales", type=int, default=5000, help="number of sales in the day")
+    parser.add_argument("--releases", type=int, default=800,
+                        help="number of albums in the catalogue")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the generated day")
+    args = parser.parse_args()
+
+    run_benchmark(args.sales, args.releases, args.seed)
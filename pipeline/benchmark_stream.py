@@ -0,0 +1,102 @@
+'''Benchmark of the batch pipeline against the streaming pipeline.
+
+Serves the fixture pages from a local server with a simulated network latency and
+loads into a stand-in database that takes a fixed time per inserted sale. Each mode
+runs in a fresh process, reporting the end-to-end latency from the start of the run
+to the commit of each sale, the wall time and the growth in peak RSS over the run.
+
+Run with: python3 benchmark_stream.py --sales 500 --latency 0.05 --insert 0.002
+'''
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import time
+
+from aiohttp import web
+
+import http_client
+from benchmark_page_fetch import create_fixture_app
+from extract import extract_list_of_items, stream_list_of_items
+from stream import get_peak_rss_mb, stream_sales, summarise_latencies
+from transform import transform_sales_data
+
+
+def create_sale_events(base_url: str, sales: int) -> list[dict]:
+    '''Creates sale events for album and track pages served by the fixture server'''
+    events = []
+    for index in range(sales):
+        item = {"utc_date": time.time() - 60, "artist_name": "Artist",
+                "item_description": f"Release {index}", "amount_paid_usd": 1.0,
+                "country": "United Kingdom"}
+        if index % 2:
+            item.update(item_type="a", album_title=None,
+                        url=f"{base_url}/album/album.html?sale={index}")
+        else:
+            item.update(item_type="t", album_title="PT002 - Foam EP",
+                        url=f"{base_url}/track/track_with_album.html?sale={index}")
+        events.append({"event_type": "sale", "items": [item]})
+    return events
+
+
+def run_mode(mode: str, sales: int, latency: float, insert_seconds: float,
+             batch_size: int) -> dict:
+    '''Runs one mode of the pipeline against the fixture server, in this process'''
+    def load_batch(batch: list[dict]) -> bool:
+        time.sleep(insert_seconds * len(batch))
+        return True
+
+    runner = web.AppRunner(create_fixture_app(latency, {"requests": 0}))
+    http_client.run(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    http_client.run(site.start())
+    port = site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+    events = create_sale_events(f"http://127.0.0.1:{port}", sales)
+    rss_before = get_peak_rss_mb()
+
+    start = time.monotonic()
+    if mode == "batch":
+        items = http_client.run(extract_list_of_items(events))
+        cleaned_sales = transform_sales_data(items)
+        load_batch(cleaned_sales)
+        latencies = [time.monotonic() - start] * len(cleaned_sales)
+    else:
+        latencies = http_client.run(stream_sales(
+            stream_list_of_items(events), load_batch, start, batch_size=batch_size))
+    wall_time = time.monotonic() - start
+
+    http_client.run(runner.cleanup())
+    http_client.close()
+    return {**summarise_latencies(latencies), "wall_time": wall_time,
+            "rss_growth_mb": get_peak_rss_mb() - rss_before}
+
+
+def run_benchmark(sales: int, latency: float, insert_seconds: float, batch_size: int) -> None:
+    '''Runs both modes in fresh processes and prints a comparison'''
+    context = multiprocessing.get_context("spawn")
+
+    print(f"Sales: {sales}, page latency: {latency * 1000:.0f}ms, "
+          f"insert time per sale: {insert_seconds * 1000:.1f}ms, batch size: {batch_size}")
+    print(f"{'mode':<8}{'loaded':>8}{'p50 (s)':>9}{'p95 (s)':>9}{'max (s)':>9}"
+          f"{'wall (s)':>10}{'rss growth (mb)':>17}")
+    for mode in ("batch", "stream"):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_mode, mode, sales, latency, insert_seconds,
+                                     batch_size).result()
+        print(f"{mode:<8}{result['count']:>8}{result['p50']:>9.2f}{result['p95']:>9.2f}"
+              f"{result['max']:>9.2f}{result['wall_time']:>10.2f}"
+              f"{result['rss_growth_mb']:>17.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sales", type=int, default=500, help="number of sales to run")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="seconds of latency added to every page request")
+    parser.add_argument("--insert", type=float, default=0.002,
+                        help="seconds the stand-in database takes to insert each sale")
+    parser.add_argument("--batch-size", type=int, default=50,
+                        help="number of sales committed together in stream mode")
+    args = parser.parse_args()
+
+    run_benchmark(args.sales, args.latency, args.insert, args.batch_size)
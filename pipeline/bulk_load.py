@@ -0,0 +1,304 @@
+"""Script for loading a whole batch of sales with a fixed number of statements.
+
+The batch is copied into temporary staging tables, every dimension is inserted
+and resolved with one set-based statement per table, and all of the purchases
+are inserted with a single statement, instead of a round trip per row."""
+
+import io
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from psycopg2.extensions import connection as DBConnection, cursor as DBCursor
+
+from load import (
+    DEFER_SALE,
+    flush_sales_rollups,
+    get_connection,
+    get_deferred_sale_params,
+    get_missing_fields,
+    get_purchase_key,
+    load_sales_batch,
+    prepare_sales_rollups,
+    REQUIRED_FIELDS_ALBUM,
+    REQUIRED_FIELDS_SINGLE,
+    REQUIRED_FIELDS_TRACK,
+)
+
+REQUIRED_FIELDS = {
+    "album": REQUIRED_FIELDS_ALBUM,
+    "track": REQUIRED_FIELDS_TRACK,
+    "single": REQUIRED_FIELDS_SINGLE,
+}
+
+SALE_COLUMNS = [
+    "sale_index", "kind", "country", "artist_name", "artist_url", "album_title",
+    "album_url", "track_title", "track_url", "utc_date", "amount_usd", "purchase_key",
+]
+TAG_COLUMNS = ["sale_index", "tag"]
+
+CREATE_STAGING_TABLES = """
+    CREATE TEMPORARY TABLE staging_sale (
+        sale_index INT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        country TEXT NOT NULL,
+        artist_name TEXT NOT NULL,
+        artist_url TEXT NOT NULL,
+        album_title TEXT,
+        album_url TEXT,
+        track_title TEXT,
+        track_url TEXT,
+        utc_date TIMESTAMP(0) NOT NULL,
+        amount_usd DECIMAL(6,2) NOT NULL,
+        purchase_key CHAR(64) NOT NULL,
+        country_id SMALLINT,
+        artist_id INT,
+        album_id INT,
+        track_id INT
+    ) ON COMMIT DROP;
+    CREATE TEMPORARY TABLE staging_tag (
+        sale_index INT NOT NULL,
+        tag TEXT NOT NULL
+    ) ON COMMIT DROP;
+"""
+
+RESOLVE_DIMENSIONS = [
+    """
+    INSERT INTO country(name)
+    SELECT DISTINCT country FROM staging_sale
+    ON CONFLICT (name) DO NOTHING
+    """,
+    """
+    UPDATE staging_sale SET country_id = country.country_id
+    FROM country WHERE country.name = staging_sale.country
+    """,
+    """
+    INSERT INTO artist(name, url)
+    SELECT DISTINCT artist_name, artist_url FROM staging_sale
+    ON CONFLICT (name, url) DO NOTHING
+    """,
+    """
+    UPDATE staging_sale SET artist_id = artist.artist_id
+    FROM artist
+    WHERE artist.name = staging_sale.artist_name AND artist.url = staging_sale.artist_url
+    """,
+    """
+    INSERT INTO album(title, artist_id, url)
+    SELECT DISTINCT ON (album_url) album_title, artist_id, album_url FROM staging_sale
+    WHERE album_url IS NOT NULL
+    ORDER BY album_url, sale_index
+    ON CONFLICT (url) DO NOTHING
+    """,
+    """
+    UPDATE staging_sale SET album_id = album.album_id
+    FROM album WHERE album.url = staging_sale.album_url
+    """,
+    """
+    INSERT INTO track(title, album_id, artist_id, url)
+    SELECT DISTINCT ON (track_url) track_title, album_id, artist_id, track_url
+    FROM staging_sale
+    WHERE track_url IS NOT NULL
+    ORDER BY track_url, album_id NULLS LAST, sale_index
+    ON CONFLICT (url) DO UPDATE SET album_id = EXCLUDED.album_id
+    WHERE track.album_id IS NULL AND EXCLUDED.album_id IS NOT NULL
+    """,
+    """
+    UPDATE staging_sale SET track_id = track.track_id
+    FROM track WHERE track.url = staging_sale.track_url
+    """,
+    """
+    INSERT INTO tag(name)
+    SELECT DISTINCT tag FROM staging_tag
+    ON CONFLICT (name) DO NOTHING
+    """,
+    """
+    WITH inserted AS (
+        INSERT INTO album_tag_assignment(tag_id, album_id)
+        SELECT DISTINCT tag.tag_id, staging_sale.album_id
+        FROM staging_tag
+        JOIN staging_sale USING (sale_index)
+        JOIN tag ON tag.name = staging_tag.tag
+        WHERE staging_sale.kind = 'album'
+        ON CONFLICT (album_id, tag_id) DO NOTHING
+        RETURNING tag_id, album_id
+    )
+    INSERT INTO pending_tag_assignment(tag_id, album_id)
+    SELECT tag_id, album_id FROM inserted
+    """,
+    """
+    WITH inserted AS (
+        INSERT INTO track_tag_assignment(tag_id, track_id)
+        SELECT DISTINCT tag.tag_id, staging_sale.track_id
+        FROM staging_tag
+        JOIN staging_sale USING (sale_index)
+        JOIN tag ON tag.name = staging_tag.tag
+        WHERE staging_sale.kind <> 'album'
+        ON CONFLICT (track_id, tag_id) DO NOTHING
+        RETURNING tag_id, track_id
+    )
+    INSERT INTO pending_tag_assignment(tag_id, track_id)
+    SELECT tag_id, track_id FROM inserted
+    """,
+]
+
+INSERT_PURCHASES = """
+    WITH album_purchases AS (
+        INSERT INTO album_purchase(album_id, timestamp, amount_usd, country_id, purchase_key)
+        SELECT album_id, utc_date, amount_usd, country_id, purchase_key FROM staging_sale
+        WHERE kind = 'album'
+        ON CONFLICT (purchase_key, timestamp) DO NOTHING
+        RETURNING album_id, timestamp, amount_usd, country_id, purchase_key
+    ), track_purchases AS (
+        INSERT INTO track_purchase(track_id, timestamp, amount_usd, country_id, purchase_key)
+        SELECT track_id, utc_date, amount_usd, country_id, purchase_key FROM staging_sale
+        WHERE kind <> 'album'
+        ON CONFLICT (purchase_key, timestamp) DO NOTHING
+        RETURNING track_id, timestamp, amount_usd, country_id, purchase_key
+    ), pending_purchases AS (
+        INSERT INTO pending_sales_rollup(album_id, track_id, timestamp, amount_usd, country_id,
+                                         purchase_key)
+        SELECT album_id, NULL, timestamp, amount_usd, country_id, purchase_key
+        FROM album_purchases
+        UNION ALL
+        SELECT NULL, track_id, timestamp, amount_usd, country_id, purchase_key
+        FROM track_purchases
+    )
+    SELECT (SELECT COUNT(*) FROM album_purchases), (SELECT COUNT(*) FROM track_purchases)
+"""
+
+
+def get_sale_kind(sale: Dict[str, Any]) -> Optional[str]:
+    """Returns whether a sale is of an album, a track on an album or a single,
+    or None for a track sale without an album title, which is not loaded."""
+
+    if sale["item_type"] == "a":
+        return "album"
+    if sale["item_type"] == "t":
+        return "track" if sale.get("album_title") else None
+    return "single"
+
+
+def get_staging_rows(
+    sales_data: List[Dict[str, Any]]
+) -> Tuple[List[tuple], List[tuple], List[tuple]]:
+    """Turns a batch of sales into rows for the staging tables, along with the
+    parameters of DEFER_SALE for any missing a required field, which are
+    deferred to the retry queue as insert_sale does."""
+
+    sale_rows = []
+    tag_rows = []
+    deferred_rows = []
+    for sale_index, sale in enumerate(sales_data):
+        kind = get_sale_kind(sale)
+        if kind is None:
+            continue
+        missing_fields = get_missing_fields(sale, REQUIRED_FIELDS[kind])
+        if missing_fields:
+            deferred_rows.append(get_deferred_sale_params(sale, missing_fields))
+            continue
+
+        if kind == "album":
+            album = (sale["item_description"], sale["url"])
+            track = (None, None)
+            tags = sale["album_tags"]
+        elif kind == "track":
+            album = (sale["album_title"], sale["album_url"])
+            track = (sale["item_description"], sale["url"])
+            tags = sale["track_tags"]
+        else:
+            album = (None, None)
+            track = (sale["item_description"], sale["url"])
+            tags = sale["track_tags"]
+
+        sale_rows.append((sale_index, kind, sale["country"], sale["artist_name"],
+                          sale["artist_url"], *album, *track, sale["utc_date"],
+                          sale["amount_paid_usd"], get_purchase_key(sale)))
+        tag_rows.extend((sale_index, tag) for tag in dict.fromkeys(tags) if tag)
+
+    return sale_rows, tag_rows, deferred_rows
+
+
+def escape_copy_value(value: Any) -> str:
+    """Formats a value for COPY's text format, where NULL is \\N."""
+
+    if value is None:
+        return "\\N"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def get_copy_buffer(rows: List[tuple]) -> io.StringIO:
+    """Writes rows into a buffer in COPY's text format."""
+
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(escape_copy_value(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    return buffer
+
+
+def copy_rows(cursor: DBCursor, table: str, columns: List[str], rows: List[tuple]) -> None:
+    """Copies rows into a table in a single COPY."""
+
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN",
+                       get_copy_buffer(rows))
+
+
+def insert_sales_in_bulk(cursor: DBCursor, sales_data: List[Dict[str, Any]]) -> int:
+    """Stages a batch of sales and inserts them with set-based statements,
+    returning the number of purchases inserted. Purchases already loaded, or
+    repeated within the batch, are dropped by their purchase key, and those
+    inserted are added to the hourly sales rollups. Runs inside the caller's
+    transaction, which drops the staging tables when it ends."""
+
+    sale_rows, tag_rows, deferred_rows = get_staging_rows(sales_data)
+    if deferred_rows:
+        cursor.executemany(DEFER_SALE, deferred_rows)
+        logging.info("Deferred %s sales to the retry queue", len(deferred_rows))
+    if not sale_rows:
+        return 0
+
+    cursor.execute(CREATE_STAGING_TABLES)
+    prepare_sales_rollups(cursor)
+    copy_rows(cursor, "staging_sale", SALE_COLUMNS, sale_rows)
+    copy_rows(cursor, "staging_tag", TAG_COLUMNS, tag_rows)
+    cursor.execute("ANALYZE staging_sale; ANALYZE staging_tag;")
+
+    for statement in RESOLVE_DIMENSIONS:
+        cursor.execute(statement)
+    cursor.execute(INSERT_PURCHASES)
+    album_purchases, track_purchases = cursor.fetchone()
+    flush_sales_rollups(cursor)
+
+    logging.info("Bulk loaded %s album and %s track purchases, dropped %s duplicates",
+                 album_purchases, track_purchases,
+                 len(sale_rows) - album_purchases - track_purchases)
+    return album_purchases + track_purchases
+
+
+def bulk_load_sales_batch(connection: DBConnection, sales_data: List[Dict[str, Any]]) -> bool:
+    """Bulk loads a batch of sales in one transaction on an open connection,
+    returning whether it was committed. If the bulk load fails, the batch is
+    loaded again sale by sale with load_sales_batch, so the sales that failed
+    are rejected without losing the rest."""
+
+    try:
+        with connection.cursor() as cursor:
+            insert_sales_in_bulk(cursor, sales_data)
+        connection.commit()
+        return True
+    except Exception as e:
+        logging.warning("Loading %s sales sale by sale after an error: %s",
+                        len(sales_data), e)
+        connection.rollback()
+        return load_sales_batch(connection, sales_data)
+
+
+def bulk_load_sales_data(sales_data: List[Dict[str, Any]]) -> bool:
+    """Bulk loads sales data into the database, returning whether it was committed."""
+
+    connection = get_connection()
+    try:
+        return bulk_load_sales_batch(connection, sales_data)
+    finally:
+        connection.close()
@@ -0,0 +1,72 @@
+"""Fixtures and mock database connections shared by the pipeline's tests."""
+
+from itertools import count
+from unittest.mock import AsyncMock, MagicMock
+import pytest
+from load import (
+    INSERT_ALBUM_PURCHASE,
+    INSERT_TRACK_PURCHASE,
+    clear_dimension_caches,
+    log_purchase_stats,
+    rollback_purchase_counts,
+)
+
+PURCHASES = (INSERT_ALBUM_PURCHASE, INSERT_TRACK_PURCHASE)
+
+
+@pytest.fixture(autouse=True)
+def empty_dimension_caches():
+    """Starts and ends each test with empty dimension caches and purchase counts."""
+    clear_dimension_caches()
+    yield
+    clear_dimension_caches()
+    rollback_purchase_counts()
+    log_purchase_stats()
+
+
+def get_mock_cursor(connection: MagicMock) -> MagicMock:
+    """Returns the cursor a mock connection opens with connection.cursor()."""
+    return connection.cursor.return_value.__enter__.return_value
+
+
+def get_mock_connection(fetchone: list = None, fetchall: list = None) -> MagicMock:
+    """Returns a mock connection whose cursor returns fetchone and fetchall,
+    and reports one row changed by each statement."""
+    connection = MagicMock()
+    cursor = get_mock_cursor(connection)
+    if fetchone is not None:
+        cursor.fetchone.return_value = fetchone
+    if fetchall is not None:
+        cursor.fetchall.return_value = fetchall
+    cursor.rowcount = 1
+    return connection
+
+
+def get_statements(connection: MagicMock) -> list[tuple]:
+    """Returns the statements executed on a mock connection, with their params."""
+    return [call.args for call in get_mock_cursor(connection).execute.call_args_list]
+
+
+def get_mock_async_connection(failing_amount: float = None) -> MagicMock:
+    """Returns a mock async connection whose upserts return new ids, and whose
+    purchase inserts fail for a sale of failing_amount."""
+    connection = MagicMock()
+    connection.commit = AsyncMock()
+    connection.rollback = AsyncMock()
+    row_ids = count(1)
+
+    async def execute(query, params=None):
+        if query in PURCHASES and params[2] == failing_amount:
+            raise ValueError("numeric field overflow")
+        cursor = MagicMock()
+        cursor.fetchone = AsyncMock(return_value=[next(row_ids)])
+        cursor.rowcount = 1
+        return cursor
+
+    connection.execute = AsyncMock(side_effect=execute)
+    return connection
+
+
+def get_async_statements(connection: MagicMock) -> list[str]:
+    """Returns the statements executed on a mock async connection."""
+    return [call.args[0] for call in connection.execute.call_args_list]
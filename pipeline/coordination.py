@@ -0,0 +1,254 @@
+"""Script for coordinating pipeline runs that overlap, and scraper workers that
+share one feed window.
+
+A run can hold a Postgres advisory lock for as long as it is connected, so a
+run that starts while the previous one is still going can skip itself. Or the
+feed window can be shared out as work: the items of the feed are queued in the
+feed_work_item table, and each worker repeatedly leases a chunk of the items
+no one else holds with FOR UPDATE SKIP LOCKED, scrapes and loads them, and
+marks them done in the same transaction as their purchases. A worker that dies
+leaves its lease to expire, after which another worker takes the items over.
+Items whose lease has run out MAX_WORK_ATTEMPTS times are marked dead and left
+in the queue for inspection, so an item that keeps failing is not leased
+forever."""
+
+import hashlib
+import json
+import logging
+import os
+import socket
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from psycopg2.extensions import connection as DBConnection
+
+from archive import FeedArchive, open_archive
+from bulk_load import bulk_load_sales_batch
+from extract import (
+    get_latest_event_date,
+    get_new_feed_events,
+    get_parse_executor,
+    get_sale_items,
+    scrape_sale_items,
+)
+import http_client
+from load import (
+    FEED_CURSOR_NAME,
+    SAVE_FEED_CURSOR,
+    get_connection,
+    get_feed_cursor,
+    load_sales_batch,
+    log_dimension_cache_stats,
+    log_purchase_stats,
+)
+from scrape_cache import SCRAPE_CACHE_PATH, ScrapeCache
+from transform import transform_sales_data
+
+RUN_LOCK_ID = 4_170_001
+FEED_LOCK_ID = 4_170_002
+LEASE_SIZE = 50
+LEASE_SECONDS = 600
+MAX_WORK_ATTEMPTS = 5
+COMPLETED_WORK_RETENTION_DAYS = 3
+
+ENQUEUE_WORK_ITEM = """
+    INSERT INTO feed_work_item(item_key, item) VALUES (%s, %s)
+    ON CONFLICT (item_key) DO NOTHING
+"""
+DELETE_COMPLETED_WORK = """
+    DELETE FROM feed_work_item
+    WHERE completed_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 day'
+"""
+MARK_DEAD_WORK_ITEMS = """
+    UPDATE feed_work_item SET dead_at = CURRENT_TIMESTAMP
+    WHERE completed_at IS NULL AND dead_at IS NULL
+    AND attempts >= %(max_attempts)s AND lease_expires_at < CURRENT_TIMESTAMP
+"""
+LEASE_WORK_ITEMS = """
+    UPDATE feed_work_item
+    SET leased_by = %(worker_id)s,
+        lease_expires_at = CURRENT_TIMESTAMP + %(lease_seconds)s * INTERVAL '1 second',
+        attempts = attempts + 1
+    WHERE work_item_id IN (
+        SELECT work_item_id FROM feed_work_item
+        WHERE completed_at IS NULL AND dead_at IS NULL
+        AND (lease_expires_at IS NULL OR lease_expires_at < CURRENT_TIMESTAMP)
+        ORDER BY work_item_id
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING work_item_id, item
+"""
+COMPLETE_WORK_ITEMS = """
+    UPDATE feed_work_item SET completed_at = CURRENT_TIMESTAMP
+    WHERE work_item_id = ANY(%s) AND leased_by = %s
+"""
+
+
+def get_worker_id() -> str:
+    """Returns a name for this worker that is unique across machines."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def get_work_item_key(item: Dict[str, Any]) -> str:
+    """Returns the identity of a feed item: a sha256 of the item as sorted
+    JSON, so an item seen again by an overlapping run is queued only once."""
+    return hashlib.sha256(json.dumps(item, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def try_advisory_lock(connection: DBConnection, lock_id: int) -> bool:
+    """Takes a session advisory lock without waiting, returning whether it was
+    taken. It is held until released, or until the connection closes."""
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", (lock_id,))
+        acquired = cursor.fetchone()[0]
+    connection.commit()
+    return acquired
+
+
+def release_advisory_lock(connection: DBConnection, lock_id: int) -> None:
+    """Releases a session advisory lock taken by try_advisory_lock."""
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (lock_id,))
+    connection.commit()
+
+
+def run_exclusively(run: Callable[[], Any]) -> bool:
+    """Calls run while holding the pipeline's run lock on a connection of its
+    own, or skips it if an earlier run still holds the lock. Returns whether
+    run was called."""
+
+    connection = get_connection()
+    try:
+        if not try_advisory_lock(connection, RUN_LOCK_ID):
+            logging.warning("The previous pipeline run is still going, skipping this run")
+            return False
+        try:
+            run()
+        finally:
+            release_advisory_lock(connection, RUN_LOCK_ID)
+        return True
+    finally:
+        connection.close()
+
+
+def enqueue_feed_items(connection: DBConnection, items: List[Dict[str, Any]],
+                       last_event_date: Optional[float] = None) -> int:
+    """Queues the sale items of a feed window as work, skipping any already
+    queued by an overlapping run, and clears out work completed long ago. If
+    last_event_date is given, the feed cursor is moved on to it in the same
+    transaction, so the window is either queued and passed or fetched again.
+    Returns the number of items queued."""
+
+    with connection.cursor() as cursor:
+        cursor.execute(DELETE_COMPLETED_WORK, (COMPLETED_WORK_RETENTION_DAYS,))
+        queued = 0
+        for item in items:
+            cursor.execute(ENQUEUE_WORK_ITEM, (get_work_item_key(item), json.dumps(item)))
+            queued += cursor.rowcount
+        if last_event_date is not None:
+            cursor.execute(SAVE_FEED_CURSOR, (FEED_CURSOR_NAME, last_event_date))
+    connection.commit()
+    logging.info("Queued %s of %s feed items as work", queued, len(items))
+    return queued
+
+
+def lease_work_items(connection: DBConnection, worker_id: str, limit: int = LEASE_SIZE,
+                     lease_seconds: int = LEASE_SECONDS) -> List[Tuple[int, Dict[str, Any]]]:
+    """Leases up to limit queued items that no worker holds, skipping rows
+    another worker is leasing at the same moment, and returns them with their
+    ids. Items whose last lease ran out after MAX_WORK_ATTEMPTS are marked dead
+    first, rather than leased again. The lease is committed at once, so it
+    outlives this transaction."""
+
+    with connection.cursor() as cursor:
+        cursor.execute(MARK_DEAD_WORK_ITEMS, {"max_attempts": MAX_WORK_ATTEMPTS})
+        if cursor.rowcount:
+            logging.warning("Gave up on %s feed items after %s attempts",
+                            cursor.rowcount, MAX_WORK_ATTEMPTS)
+        cursor.execute(LEASE_WORK_ITEMS, {"worker_id": worker_id, "limit": limit,
+                                          "lease_seconds": lease_seconds})
+        leased = cursor.fetchall()
+    connection.commit()
+    return leased
+
+
+def fetch_feed_window(connection: DBConnection, incremental: bool,
+                      archive: FeedArchive = None) -> Optional[int]:
+    """Fetches the feed and queues its items, unless another worker is doing
+    so already, writing the feed to the archive if one is given. Returns the
+    number of items queued, or None if it was skipped."""
+
+    if not try_advisory_lock(connection, FEED_LOCK_ID):
+        logging.info("Another worker is fetching the feed, only taking queued work")
+        return None
+    try:
+        last_event_date = get_feed_cursor() if incremental else None
+        event_list = get_new_feed_events(last_event_date, archive=archive)
+        if not event_list:
+            return 0
+        return enqueue_feed_items(
+            connection, get_sale_items(event_list),
+            get_latest_event_date(event_list, last_event_date) if incremental else None)
+    finally:
+        release_advisory_lock(connection, FEED_LOCK_ID)
+
+
+def load_leased_items(connection: DBConnection, worker_id: str,
+                      leased: List[Tuple[int, Dict[str, Any]]], items: List[Dict[str, Any]],
+                      bulk_load: bool = False) -> bool:
+    """Loads scraped leased items, marking them done in the same transaction,
+    so they are either loaded and done or left to be leased again. Returns
+    whether they were committed."""
+
+    with connection.cursor() as cursor:
+        cursor.execute(COMPLETE_WORK_ITEMS, ([work_item_id for work_item_id, _ in leased],
+                                             worker_id))
+    load_batch = bulk_load_sales_batch if bulk_load else load_sales_batch
+    return load_batch(connection, transform_sales_data(items))
+
+
+def run_leased_pipeline(incremental: bool = False,
+                        cache_path: str = SCRAPE_CACHE_PATH,
+                        parse_workers: int = 0,
+                        lease_size: int = LEASE_SIZE,
+                        lease_seconds: int = LEASE_SECONDS,
+                        bulk_load: bool = False,
+                        archive_path: str = None) -> int:
+    """Runs the pipeline as one of any number of workers sharing the feed:
+    queues the new feed window unless another worker is fetching it, then
+    leases, scrapes and loads chunks of lease_size queued items until none
+    are left unleased. The feed and pages this worker fetches are archived
+    at archive_path, if one is given. Returns the number of items this
+    worker loaded."""
+
+    worker_id = get_worker_id()
+    connection = get_connection()
+    cache = ScrapeCache(cache_path) if cache_path is not None else None
+    parse_executor = get_parse_executor(parse_workers)
+    archive = open_archive(archive_path)
+    loaded = 0
+    try:
+        fetch_feed_window(connection, incremental, archive)
+        while leased := lease_work_items(connection, worker_id, lease_size, lease_seconds):
+            items = http_client.run(scrape_sale_items(
+                [dict(item) for _, item in leased], cache=cache,
+                parse_executor=parse_executor, archive=archive))
+            if load_leased_items(connection, worker_id, leased, items, bulk_load):
+                loaded += len(leased)
+    finally:
+        connection.close()
+        if cache is not None:
+            cache.log_stats()
+            cache.close()
+        if parse_executor is not None:
+            parse_executor.shutdown()
+        if archive is not None:
+            archive.close()
+
+    logging.info("Worker %s loaded %s leased items", worker_id, loaded)
+    if not bulk_load:
+        log_dimension_cache_stats()
+        log_purchase_stats()
+    return loaded
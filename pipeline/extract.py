@@ -2,42 +2,125 @@
 
 
 import asyncio
+from collections.abc import AsyncIterator, Awaitable, Callable
+from concurrent.futures import Executor, ProcessPoolExecutor
+from html.parser import HTMLParser
 import json
 import logging
+import os
+from os import environ as ENV
 
 import aiohttp
 from bs4 import BeautifulSoup
-import requests as req
+
+try:
+    from lxml import html as lxml_html
+except ImportError:
+    lxml_html = None
+
+from archive import (ARCHIVE_PATH, FEED_LAG_SECONDS, FeedArchive, ReplaySession,
+                     get_day_range, open_archive)
+import http_client
+from limiter import AdaptiveLimiter, is_throttling_status, parse_retry_after
+from scrape_cache import ScrapeCache, SCRAPE_CACHE_PATH, normalize_url
 
 
 BANDCAMP_SALES_URL = "https://bandcamp.com/api/salesfeed/1/get_initial"
+BANDCAMP_SALES_NEXT_URL = "https://bandcamp.com/api/salesfeed/1/get"
+MAX_FEED_PAGES = 30
 MAX_TIMEOUT_SECONDS = 100
-DELAY_BETWEEN_REQUESTS = 0.1
-MAX_CONCURRENT_REQUESTS = 3
 EXPONENTIAL_RETRY_DELAY = 2
 MAXIMUM_FETCH_ATTEMPTS = 3
+DEFAULT_HTML_EXTRACTOR = "lxml"
+TOKENIZER_CHUNK_SIZE = 16384
+TAG_XPATH = '//a[contains(concat(" ", normalize-space(@class), " "), " tag ")]'
+ALBUM_LINK_XPATH = '//a[@id="buyAlbumLink"]'
+TRACK_LINK_XPATH = ('//table[@id="track_table"]'
+                    '//div[contains(concat(" ", normalize-space(@class), " "), " title ")]//a')
+STREAM_BUFFER_SIZE = 64
 
 
-def get_sale_data_from_api(site_url: str = BANDCAMP_SALES_URL,
-                           max_timeout: int = MAX_TIMEOUT_SECONDS) -> dict:
-    '''Get content from the specified api endpoint. Sleep was included to avoid a 429 error'''
-    try:
-        response = req.get(site_url, timeout=max_timeout)
-
-        if response.status_code == 200:
-            response_contents = response.json()
+class PageNotFoundError(Exception):
+    '''Raised when a scraped bandcamp page no longer exists'''
 
-            return response_contents
-        logging.error("Failed to retrieve sale data from API. HTTP Status code: %s",
-                      response.status_code)
 
-    except req.exceptions.RequestException as e:
+def get_sale_data_from_api(site_url: str = BANDCAMP_SALES_URL,
+                           max_timeout: int = MAX_TIMEOUT_SECONDS,
+                           params: dict = None,
+                           archive: FeedArchive = None) -> dict:
+    '''Get content from the specified api endpoint, through the shared http client.
+    The response is written to the archive, if one is given'''
+    try:
+        response_contents = http_client.run(
+            http_client.get_json(site_url, max_timeout, params))
+        if archive is not None and response_contents is not None:
+            archive.write_feed(site_url, params, response_contents)
+        return response_contents
+    except aiohttp.ClientError as e:
         logging.error("A request error has occurred: %s", e)
-    except TimeoutError as e:
+    except asyncio.TimeoutError as e:
         logging.error("A timeout error has occurred: %s", e)
+    except ValueError as e:
+        logging.error("The API returned an invalid response: %s", e)
     return None
 
 
+def get_feed_events_since(last_event_date: float,
+                          next_url: str = BANDCAMP_SALES_NEXT_URL,
+                          max_timeout: int = MAX_TIMEOUT_SECONDS,
+                          max_pages: int = MAX_FEED_PAGES,
+                          archive: FeedArchive = None) -> list[dict]:
+    '''Pages forward through the sales feed from the given timestamp,
+    returning only the events that happened after it. Pages may overlap at
+    their boundaries, so events are only kept past the highest date seen'''
+    events = []
+    start_date = last_event_date
+    high_water_mark = last_event_date
+
+    for _ in range(max_pages):
+        page = get_sale_data_from_api(next_url, max_timeout,
+                                      params={"start_date": int(start_date)},
+                                      archive=archive)
+        if page is None:
+            break
+
+        feed_data = page.get("feed_data", page)
+        page_events = feed_data.get("events", [])
+        events.extend(event for event in page_events
+                      if event["utc_date"] > high_water_mark)
+        high_water_mark = get_latest_event_date(page_events, high_water_mark)
+
+        end_date = feed_data.get("end_date")
+        if not page_events or end_date is None or end_date <= start_date:
+            break
+        start_date = end_date
+
+    return events
+
+
+def get_new_feed_events(last_event_date: float = None,
+                        archive: FeedArchive = None,
+                        api_url: str = None) -> list[dict]:
+    '''Gets the sales events that have not been processed yet. Without a
+    previous cursor this falls back to the initial feed window. The feed is
+    read from bandcamp unless the url of another salesfeed API is given'''
+    initial_url = f"{api_url}/get_initial" if api_url else BANDCAMP_SALES_URL
+    next_url = f"{api_url}/get" if api_url else BANDCAMP_SALES_NEXT_URL
+
+    if last_event_date is None:
+        sales_data = get_sale_data_from_api(initial_url, archive=archive)
+        if sales_data is None:
+            return None
+        return sales_data['feed_data']['events']
+
+    return get_feed_events_since(last_event_date, next_url, archive=archive)
+
+
+def get_latest_event_date(event_list: list[dict], default: float = None) -> float:
+    '''Returns the most recent event timestamp in a list of events'''
+    return max((event["utc_date"] for event in event_list), default=default)
+
+
 def save_to_json(sales_data: list, filename: str) -> None:
     '''Saves list of dictionary to json'''
     with open(filename, 'w', encoding='utf-8') as file:
@@ -59,82 +142,274 @@ def get_stem_url(url_string: str) -> str:
     return "/".join(parts)
 
 
+def get_track_url(album_url: str, track_href: str) -> str:
+    '''Turns a track link on an album page into a full url'''
+    if track_href.startswith(("http://", "https://", "//")):
+        return insert_protocol_url(track_href)
+    return get_stem_url(album_url) + track_href
+
+
+def get_sale_items(event_list: list[dict]) -> list[dict]:
+    '''Returns the album and track items of every sale event'''
+    items = []
+    for event in event_list:
+        if event['event_type'] != 'sale':
+            continue
+        if len(event['items']) < 1:
+            continue
+
+        for item in event['items']:
+            if not (item["item_type"] == "a" or item["item_type"] == "t"):
+                continue
+            items.append(item)
+    return items
+
+
 async def extract_list_of_items(event_list: list[dict],
-                                timeout: int = MAX_TIMEOUT_SECONDS) -> list[dict]:
-    '''Extract all items from event list, where each element is an item'''
+                                timeout: int = MAX_TIMEOUT_SECONDS,
+                                cache: ScrapeCache = None,
+                                parse_executor: Executor = None,
+                                session: aiohttp.ClientSession = None,
+                                archive: FeedArchive = None) -> list[dict]:
+    '''Extract all items from event list, where each element is an item.
+    Pages are fetched through the shared http client unless a session is given,
+    and written to the archive if one is given'''
+    return await scrape_sale_items(get_sale_items(event_list), timeout, cache=cache,
+                                   parse_executor=parse_executor, session=session,
+                                   archive=archive)
+
+
+async def scrape_sale_items(items: list[dict],
+                            timeout: int = MAX_TIMEOUT_SECONDS,
+                            cache: ScrapeCache = None,
+                            parse_executor: Executor = None,
+                            session: aiohttp.ClientSession = None,
+                            archive: FeedArchive = None) -> list[dict]:
+    '''Scrapes the pages of sale items taken from the feed, as
+    extract_list_of_items does for every item of an event list'''
     item_list = []
-    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for event in event_list:
-            if event['event_type'] != 'sale':
-                continue
-            if len(event['items']) < 1:
-                continue
+    limiter = AdaptiveLimiter()
+    single_flight = SingleFlight()
+    if session is None:
+        session = await http_client.get_session()
+    if archive is not None:
+        session = archive.recording(session)
 
-            for item in event['items']:
-                if not (item["item_type"] == "a" or item["item_type"] == "t"):
-                    continue
-                tasks.append(extract_and_scrape_item(
-                    semaphore, session, item, timeout))
+    tasks = [extract_and_scrape_item(limiter, session, item, timeout, cache=cache,
+                                     single_flight=single_flight,
+                                     parse_executor=parse_executor)
+             for item in items]
+
+    item_list = await asyncio.gather(*tasks)
 
-        item_list = await asyncio.gather(*tasks)
+    logging.info("Fetches saved by de-duplicating pages: %s",
+                 single_flight.saved_fetches)
+    limiter.log_stats()
 
     return item_list
 
 
-async def extract_and_scrape_item(semaphore: asyncio.Semaphore,
+async def stream_list_of_items(event_list: list[dict],
+                               timeout: int = MAX_TIMEOUT_SECONDS,
+                               cache: ScrapeCache = None,
+                               parse_executor: Executor = None,
+                               session: aiohttp.ClientSession = None,
+                               buffer_size: int = STREAM_BUFFER_SIZE,
+                               archive: FeedArchive = None) -> AsyncIterator[dict]:
+    '''Yields each item as soon as it has been scraped, in the order they finish.
+    No more than buffer_size items are scraped ahead of the consumer, so a slow
+    consumer holds back the scrape instead of piling up items in memory'''
+    limiter = AdaptiveLimiter()
+    single_flight = SingleFlight()
+    if session is None:
+        session = await http_client.get_session()
+    if archive is not None:
+        session = archive.recording(session)
+
+    buffer_slots = asyncio.Semaphore(buffer_size)
+
+    async def scrape(item: dict) -> dict:
+        await buffer_slots.acquire()
+        return await extract_and_scrape_item(
+            limiter, session, item, timeout, cache=cache,
+            single_flight=single_flight, parse_executor=parse_executor)
+
+    tasks = [asyncio.ensure_future(scrape(item)) for item in get_sale_items(event_list)]
+    try:
+        for next_item in asyncio.as_completed(tasks):
+            item = await next_item
+            yield item
+            buffer_slots.release()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    logging.info("Fetches saved by de-duplicating pages: %s",
+                 single_flight.saved_fetches)
+    limiter.log_stats()
+
+
+class SingleFlight:
+    '''Shares one in-flight scrape between every item in a batch that needs the
+    same page, so that repeated purchases of a release are only fetched once'''
+
+    def __init__(self):
+        self.in_flight = {}
+        self.saved_fetches = 0
+
+    async def run(self, key: tuple, scrape: Callable[[], Awaitable[dict]]) -> dict:
+        '''Waits on the scrape already running for a key, otherwise starts it'''
+        if key in self.in_flight:
+            self.saved_fetches += 1
+        else:
+            self.in_flight[key] = asyncio.ensure_future(scrape())
+        return await asyncio.shield(self.in_flight[key])
+
+
+def get_tags_key(purchase_dict: dict) -> str:
+    '''Returns the key that the scraped tags of an item are stored under'''
+    return "track_tags" if purchase_dict["item_type"] == "t" else "album_tags"
+
+
+def needs_album_url(purchase_dict: dict) -> bool:
+    '''Checks if an item is a track belonging to an album'''
+    return purchase_dict["item_type"] == "t" and purchase_dict["album_title"] is not None
+
+
+def is_usable_cache_entry(cached_item: dict, with_album_url: bool) -> bool:
+    '''Checks if a cache entry holds everything an item needs'''
+    if cached_item is None:
+        return False
+    return cached_item["not_found"] or not with_album_url or cached_item["album_url"] is not None
+
+
+def apply_scraped_fields(purchase_dict: dict, fields: dict) -> dict:
+    '''Fills in an item with the fields scraped from its page'''
+    tags = fields["tags"]
+    purchase_dict[get_tags_key(purchase_dict)] = list(
+        tags) if tags is not None else None
+
+    if needs_album_url(purchase_dict) and fields["album_url"] is not None:
+        purchase_dict["album_url"] = fields["album_url"]
+    return purchase_dict
+
+
+def cache_scraped_fields(cache: ScrapeCache, item_url: str,
+                         fields: dict, with_album_url: bool) -> None:
+    '''Stores the fields scraped from a page, as long as nothing failed to scrape.
+    The tracks listed on an album page are recorded against the album'''
+    if fields["not_found"]:
+        cache.set_not_found(item_url)
+    elif fields["tags"] is not None and (not with_album_url or fields["album_url"] is not None):
+        cache.set(item_url, fields["tags"], fields["album_url"])
+        if fields.get("track_urls"):
+            cache.set_album_tracks(item_url, fields["track_urls"], fields["tags"])
+
+
+async def extract_and_scrape_item(limiter: AdaptiveLimiter,
                                   session: aiohttp.ClientSession,
                                   purchase_dict: dict,
                                   timeout: int,
-                                  delay: float = DELAY_BETWEEN_REQUESTS) -> dict:
+                                  cache: ScrapeCache = None,
+                                  single_flight: SingleFlight = None,
+                                  parse_executor: Executor = None) -> dict:
     '''Scrape and extract information for an item, giving
     more complete information for the item'''
 
-    async with semaphore:
-        await asyncio.sleep(delay)
-
-        if purchase_dict["item_type"] == "t":
-            purchase_dict["track_tags"] = await scrape_tags(session,
-                                                            insert_protocol_url(
-                                                                purchase_dict["url"]),
-                                                            timeout)
-        if purchase_dict["item_type"] == "a":
-            purchase_dict["album_tags"] = await scrape_tags(session,
-                                                            insert_protocol_url(
-                                                                purchase_dict["url"]),
-                                                            timeout)
-        if purchase_dict["item_type"] == "t" and purchase_dict["album_title"] is not None:
-            await asyncio.sleep(delay)
-            stem_url = get_stem_url(insert_protocol_url(purchase_dict["url"]))
-            album_url = await scrape_album_url(session,
-                                               insert_protocol_url(
-                                                   purchase_dict["url"]),
-                                               timeout)
-
-            if stem_url is not None and album_url is not None:
-                purchase_dict["album_url"] = stem_url + album_url
-
-        logging.info("Item gathered!")
-        return purchase_dict
-
-
-async def fetch_webpage(session: aiohttp.ClientSession, specified_url: str, timeout: int):
-    '''Get text/html content from a specified url'''
+    item_url = insert_protocol_url(purchase_dict["url"])
+    with_album_url = needs_album_url(purchase_dict)
+
+    if cache is not None:
+        cached_item = cache.get(item_url)
+        if is_usable_cache_entry(cached_item, with_album_url):
+            logging.debug("Item gathered from cache!")
+            return apply_scraped_fields(purchase_dict, cached_item)
+        album_track = cache.get_album_track(item_url) if with_album_url else None
+        if album_track is not None:
+            logging.debug("Item gathered from its album page!")
+            return apply_scraped_fields(purchase_dict, album_track)
+
+    async def scrape() -> dict:
+        async with limiter:
+            fields = await scrape_item(session, item_url, with_album_url, timeout,
+                                       parse_executor, limiter)
+
+        if cache is not None:
+            cache_scraped_fields(cache, item_url, fields, with_album_url)
+        return fields
+
+    if single_flight is None:
+        fields = await scrape()
+    else:
+        fields = await single_flight.run((normalize_url(item_url), with_album_url), scrape)
+
+    logging.debug("Item gathered!")
+    return apply_scraped_fields(purchase_dict, fields)
+
+
+async def scrape_item(session: aiohttp.ClientSession,
+                      item_url: str,
+                      with_album_url: bool,
+                      timeout: int,
+                      parse_executor: Executor = None,
+                      limiter: AdaptiveLimiter = None) -> dict:
+    '''Scrapes the tags, and album url if it has one, of an item page, along
+    with the urls of the tracks listed on it if it is an album page'''
+    fields = {"tags": None, "album_url": None, "not_found": False, "track_urls": None}
+
+    try:
+        page = await scrape_page(session, item_url, timeout, parse_executor, limiter)
+    except PageNotFoundError:
+        logging.error("Item page no longer exists: %s", item_url)
+        fields["not_found"] = True
+        return fields
+
+    if page is None:
+        return fields
+
+    fields["tags"] = page["tags"]
+    if with_album_url and page["album_href"] is not None:
+        fields["album_url"] = get_stem_url(item_url) + page["album_href"]
+    if page["track_hrefs"] is not None:
+        fields["track_urls"] = [get_track_url(item_url, href) for href in page["track_hrefs"]]
+
+    return fields
+
+
+async def fetch_webpage(session: aiohttp.ClientSession, specified_url: str, timeout: int,
+                        as_bytes: bool = False, limiter: AdaptiveLimiter = None):
+    '''Get text/html content from a specified url, or its raw bytes if as_bytes is set.
+    Throttled and successful responses are reported to the limiter, which sets
+    how long to back off when bandcamp is throttling. The throttled response's
+    connection and the caller's permit are given back while backing off'''
     for attempt in range(MAXIMUM_FETCH_ATTEMPTS):
         try:
             async with session.get(specified_url, timeout=timeout) as response:
+                if is_throttling_status(response.status):
+                    logging.debug("Fetched too many pages. Retrying again...")
+                    retry_after = parse_retry_after(
+                        response.headers.get("Retry-After"))
+                    response.release()
+                    if limiter is not None:
+                        limiter.record_throttle(retry_after)
+                        await limiter.backoff(limiter.backoff_delay(attempt, retry_after))
+                    else:
+                        await asyncio.sleep(max(EXPONENTIAL_RETRY_DELAY ** attempt,
+                                                retry_after or 0))
+                    continue
+
+                if limiter is not None and 200 <= response.status < 300:
+                    limiter.record_success()
                 if response.status == 200:
-                    return await response.text()
-                if response.status == 429:
-                    logging.info("Fetched too many pages. Retrying again...")
-                    await asyncio.sleep(EXPONENTIAL_RETRY_DELAY ** attempt)
-                else:
-                    logging.error("Failed to fetch data. HTTP Status code: %s",
-                                  response.status)
-                    logging.error(
-                        "The error specified url is: %s", specified_url)
-                    return None
+                    return await response.read() if as_bytes else await response.text()
+                if response.status == 404:
+                    raise PageNotFoundError(specified_url)
+
+                logging.error("Failed to fetch data. HTTP Status code: %s",
+                              response.status)
+                logging.error(
+                    "The error specified url is: %s", specified_url)
+                return None
         except aiohttp.ClientError as e:
             logging.error("A fetch request error has occurred: %s", e)
         except asyncio.TimeoutError as e:
@@ -144,33 +419,195 @@ async def fetch_webpage(session: aiohttp.ClientSession, specified_url: str, time
     return None
 
 
-async def scrape_album_url(session: aiohttp.ClientSession, webpage_url: str, timeout: int) -> str:
-    '''Scrapes album url of a specified webpage url'''
-    html = await fetch_webpage(session, webpage_url, timeout)
+def get_unique_hrefs(hrefs: list[str]) -> list[str]:
+    '''Removes empty and repeated links, keeping the order they appear in, or
+    returns None if there are none'''
+    unique_hrefs = list(dict.fromkeys(href for href in hrefs if href))
+    return unique_hrefs if len(unique_hrefs) > 0 else None
 
-    if html is None:
-        return None
 
+def extract_page_fields_soup(html: str) -> dict:
+    '''Pulls every field kept from an item page out of a single BeautifulSoup
+    parse: its tags, the relative link to the album a track belongs to and,
+    on an album page, the relative links to each of its tracks'''
     soup = BeautifulSoup(html, features="html.parser")
+
+    tags = [tag.text for tag in soup.find_all("a", class_="tag")]
     link = soup.find("a", id="buyAlbumLink")
+    track_links = soup.select("table#track_table div.title a")
+
+    return {
+        "tags": tags if len(tags) > 0 else None,
+        "album_href": (link.get("href") or None) if link else None,
+        "track_hrefs": get_unique_hrefs(link.get("href") for link in track_links),
+    }
+
+
+def extract_page_fields_lxml(html: str) -> dict:
+    '''Pulls the same fields as extract_page_fields_soup using lxml and XPath'''
+    if not html.strip():
+        return {"tags": None, "album_href": None, "track_hrefs": None}
+    document = lxml_html.fromstring(html)
+
+    tags = [tag.text_content() for tag in document.xpath(TAG_XPATH)]
+    links = document.xpath(ALBUM_LINK_XPATH)
+    track_links = document.xpath(TRACK_LINK_XPATH)
+
+    return {
+        "tags": tags if len(tags) > 0 else None,
+        "album_href": (links[0].get("href") or None) if links else None,
+        "track_hrefs": get_unique_hrefs(link.get("href") for link in track_links),
+    }
+
+
+class PageFieldParser(HTMLParser):
+    '''Streaming parser that collects the tag links, the buy album link and the
+    track list links of an item page. Bandcamp renders the buy album link and the
+    track list above the tags section, so the parser is done as soon as it leaves
+    the tags section'''
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.tags = []
+        self.album_href = None
+        self.track_hrefs = []
+        self.done = False
+        self._album_link_seen = False
+        self._tag_text = None
+        self._tags_section_depth = 0
+        self._track_table_depth = 0
+        self._track_title_depth = 0
+
+    def handle_starttag(self, tag: str, attrs: list[tuple]) -> None:
+        attributes = dict(attrs)
+        classes = (attributes.get("class") or "").split()
+
+        if tag == "a":
+            if "tag" in classes:
+                self._tag_text = []
+            if attributes.get("id") == "buyAlbumLink" and not self._album_link_seen:
+                self._album_link_seen = True
+                self.album_href = attributes.get("href") or None
+            if self._track_title_depth > 0:
+                self.track_hrefs.append(attributes.get("href"))
+        elif tag == "div":
+            if self._tags_section_depth > 0:
+                self._tags_section_depth += 1
+            elif "tralbum-tags" in classes:
+                self._tags_section_depth = 1
+            if self._track_title_depth > 0:
+                self._track_title_depth += 1
+            elif self._track_table_depth > 0 and "title" in classes:
+                self._track_title_depth = 1
+        elif tag == "table":
+            if self._track_table_depth > 0:
+                self._track_table_depth += 1
+            elif attributes.get("id") == "track_table":
+                self._track_table_depth = 1
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag == "a" and self._tag_text is not None:
+            self.tags.append("".join(self._tag_text))
+            self._tag_text = None
+        elif tag == "div":
+            if self._track_title_depth > 0:
+                self._track_title_depth -= 1
+            if self._tags_section_depth > 0:
+                self._tags_section_depth -= 1
+                self.done = self._tags_section_depth == 0
+        elif tag == "table" and self._track_table_depth > 0:
+            self._track_table_depth -= 1
+
+    def handle_data(self, data: str) -> None:
+        if self._tag_text is not None:
+            self._tag_text.append(data)
+
+
+def extract_page_fields_tokenizer(html: str) -> dict:
+    '''Pulls the same fields as extract_page_fields_soup by tokenizing the page,
+    without building a tree, and stopping once the tags section has been read'''
+    parser = PageFieldParser()
+
+    for start in range(0, len(html), TOKENIZER_CHUNK_SIZE):
+        parser.feed(html[start:start + TOKENIZER_CHUNK_SIZE])
+        if parser.done:
+            break
+
+    return {
+        "tags": parser.tags if len(parser.tags) > 0 else None,
+        "album_href": parser.album_href,
+        "track_hrefs": get_unique_hrefs(parser.track_hrefs),
+    }
+
+
+PAGE_EXTRACTORS = {
+    "soup": extract_page_fields_soup,
+    "tokenizer": extract_page_fields_tokenizer,
+}
+if lxml_html is not None:
+    PAGE_EXTRACTORS["lxml"] = extract_page_fields_lxml
+
+
+def get_page_extractor(backend: str = None) -> Callable[[str], dict]:
+    '''Returns the page extractor for a backend, defaulting to the one set by
+    HTML_EXTRACTOR. Falls back to the tokenizer if the backend is unavailable,
+    e.g. when lxml is not installed'''
+    backend = backend or ENV.get("HTML_EXTRACTOR", DEFAULT_HTML_EXTRACTOR)
+    if backend not in PAGE_EXTRACTORS:
+        logging.warning("HTML extractor %s is unavailable, using the tokenizer", backend)
+        backend = "tokenizer"
+    return PAGE_EXTRACTORS[backend]
+
+
+def extract_page_fields(html: str, backend: str = None) -> dict:
+    '''Pulls every field kept from an item page: its tags, the relative link
+    to the album a track belongs to and the relative links to an album's tracks'''
+    return get_page_extractor(backend)(html)
+
+
+def extract_page_fields_from_bytes(body: bytes) -> dict:
+    '''Decodes a raw item page and extracts its fields. Used by the parse
+    executor, so that only bytes and the extracted fields cross processes.
+    Bandcamp serves its pages as utf-8'''
+    return extract_page_fields(body.decode("utf-8", errors="replace"))
+
+
+def get_parse_executor(workers: int) -> ProcessPoolExecutor:
+    '''Creates a process pool for parsing pages off the event loop, sized to the
+    available cores if workers is negative. Returns None if workers is 0'''
+    if workers == 0:
+        return None
+    return ProcessPoolExecutor(max_workers=os.cpu_count() if workers < 0 else workers)
 
-    if link:
-        href = link.get("href")
-        if href:
-            return href
 
-    return None
+async def scrape_page(session: aiohttp.ClientSession, webpage_url: str, timeout: int,
+                      parse_executor: Executor = None,
+                      limiter: AdaptiveLimiter = None) -> dict:
+    '''Fetches an item page once and extracts all of its fields. With a parse
+    executor the page is parsed there, leaving the event loop free for requests'''
+    if parse_executor is None:
+        html = await fetch_webpage(session, webpage_url, timeout, limiter=limiter)
+        return extract_page_fields(html) if html is not None else None
+
+    body = await fetch_webpage(session, webpage_url, timeout, as_bytes=True,
+                               limiter=limiter)
+    if body is None:
+        return None
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(parse_executor, extract_page_fields_from_bytes, body)
+
+
+async def scrape_album_url(session: aiohttp.ClientSession, webpage_url: str, timeout: int) -> str:
+    '''Scrapes album url of a specified webpage url'''
+    page = await scrape_page(session, webpage_url, timeout)
+    return page["album_href"] if page is not None else None
 
 
 async def scrape_tags(session: aiohttp.ClientSession, webpage_url: str, timeout: int) -> list[str]:
     '''Scrapes tags of a specified webpage url'''
-    html = await fetch_webpage(session, webpage_url, timeout)
-    if html is None:
-        return None
-
-    soup = BeautifulSoup(html, 'html.parser')
-    tags = soup.find_all("a", class_="tag")
-    return [tag.text for tag in tags] if len(tags) > 0 else None
+    page = await scrape_page(session, webpage_url, timeout)
+    return page["tags"] if page is not None else None
 
 
 def configure_log() -> None:
@@ -181,26 +618,93 @@ def configure_log() -> None:
     )
 
 
-def get_sales_data() -> list[dict]:
-    '''Get the latest sales data from bandcamp'''
+def replay_sales_data(replay_day: str,
+                      archive_path: str = ARCHIVE_PATH,
+                      parse_workers: int = 0) -> list[dict]:
+    '''Runs a UTC day (YYYY-MM-DD) of archived sales through the scrape again,
+    serving the feed and every page from the archive instead of the network.
+    Sales near midnight may have been fetched the day before or after, so feed
+    responses either side of the day are read too. A fresh in-memory scrape
+    cache stands in for the one used at the time'''
+    logging.info("Replaying %s from %s", replay_day, archive_path)
+
+    archive = FeedArchive(archive_path)
+    start, end = get_day_range(replay_day)
+    event_list = [event for event in archive.get_feed_events(start - FEED_LAG_SECONDS,
+                                                              end + FEED_LAG_SECONDS)
+                  if start <= event["utc_date"] < end]
+    logging.info("Sales List Length: %s", len(event_list))
+
+    session = ReplaySession(archive, before=end + FEED_LAG_SECONDS)
+    cache = ScrapeCache(":memory:")
+    parse_executor = get_parse_executor(parse_workers)
+    try:
+        list_of_albums_tracks = http_client.run(
+            extract_list_of_items(event_list, cache=cache,
+                                  parse_executor=parse_executor, session=session))
+    finally:
+        cache.close()
+        archive.close()
+        if parse_executor is not None:
+            parse_executor.shutdown()
+    logging.info("Replay finished, %s pages were missing from the archive",
+                 session.misses)
+
+    return list_of_albums_tracks
+
+
+def get_sales_data(last_event_date: float = None,
+                   cache_path: str = SCRAPE_CACHE_PATH,
+                   parse_workers: int = 0,
+                   archive_path: str = None,
+                   replay_day: str = None,
+                   api_url: str = None) -> tuple[list[dict], float]:
+    '''Get the latest sales data from bandcamp, along with the timestamp of the
+    latest feed event fetched. Given the last_event_date of a previous run, only
+    events after it are scraped. The caller saves the returned timestamp as the
+    feed cursor once the sales are loaded, so a failed load is fetched again.
+    If the feed cannot be fetched, there are no sales and the timestamp is unchanged.
+    Scraped pages are cached at cache_path, unless it is None, and parsed in a
+    pool of parse_workers processes if it is not 0. The raw feed and pages are
+    archived at archive_path, if one is given. Given a replay_day, that day
+    is replayed from the archive instead, with no timestamp returned. The feed
+    can be read from another salesfeed API, such as the local simulator, by
+    giving its api_url'''
+    if replay_day is not None:
+        return replay_sales_data(replay_day, archive_path or ARCHIVE_PATH, parse_workers), None
 
     logging.info("Extraction started")
 
-    sales_data = get_sale_data_from_api()
-    logging.info("Sales data gathered")
-    if sales_data is not None:
+    archive = open_archive(archive_path)
+    try:
+        event_list = get_new_feed_events(last_event_date, archive=archive, api_url=api_url)
+        logging.info("Sales data gathered")
+        if event_list is None:
+            logging.info("Scraping did not initiate")
+            return [], last_event_date
+
         logging.info("Scraping begun")
-        logging.info("Sales List Length: %s", len(
-            sales_data['feed_data']['events']))
-        list_of_albums_tracks = asyncio.run(
-            extract_list_of_items(sales_data['feed_data']['events']))
+        logging.info("Sales List Length: %s", len(event_list))
+        cache = ScrapeCache(cache_path) if cache_path is not None else None
+        parse_executor = get_parse_executor(parse_workers)
+        try:
+            list_of_albums_tracks = http_client.run(
+                extract_list_of_items(event_list, cache=cache,
+                                      parse_executor=parse_executor, archive=archive))
+        finally:
+            if cache is not None:
+                cache.log_stats()
+                cache.close()
+            if parse_executor is not None:
+                parse_executor.shutdown()
         logging.info("Scraping ended")
-    else:
-        logging.info("Scraping did not initiate")
-        return
+    finally:
+        if archive is not None:
+            archive.close()
+
     logging.info("Extract finished")
 
-    return list_of_albums_tracks
+    return list_of_albums_tracks, get_latest_event_date(event_list, last_event_date)
 
 
 if __name__ == "__main__":
@@ -213,7 +717,7 @@ if __name__ == "__main__":
     if data is not None:
         logging.info("Scraping begun")
         logging.info("Length of list:", len(data['feed_data']['events']))
-        list_of_items = asyncio.run(
+        list_of_items = http_client.run(
             extract_list_of_items(data['feed_data']['events']))
         save_to_json(list_of_items, "Checking_again.json")
         logging.info("Scraping ended")
@@ -0,0 +1,108 @@
+'''Shared aiohttp client for every request made to bandcamp. The event loop and
+pooled session live at module level, so a warm Lambda invocation reuses the open
+connections, TLS sessions and resolved hosts of the previous one.'''
+
+import asyncio
+from collections.abc import Coroutine
+from importlib.util import find_spec
+import logging
+
+import aiohttp
+
+
+MAX_CONNECTIONS = 100
+MAX_CONNECTIONS_PER_HOST = 32
+KEEPALIVE_SECONDS = 60
+DNS_CACHE_SECONDS = 300
+BROTLI_AVAILABLE = any(find_spec(module) is not None for module in ("brotli", "brotlicffi"))
+ACCEPT_ENCODING = "gzip, deflate, br" if BROTLI_AVAILABLE else "gzip, deflate"
+
+_loop = None
+_session = None
+_session_loop = None
+
+
+def create_connector(ssl_context=None) -> aiohttp.TCPConnector:
+    '''Creates a connection pool that keeps connections and resolved hosts alive between requests'''
+    return aiohttp.TCPConnector(limit=MAX_CONNECTIONS,
+                                limit_per_host=MAX_CONNECTIONS_PER_HOST,
+                                keepalive_timeout=KEEPALIVE_SECONDS,
+                                ttl_dns_cache=DNS_CACHE_SECONDS,
+                                ssl=ssl_context if ssl_context is not None else True)
+
+
+def create_session(ssl_context=None, trace_configs: list = None) -> aiohttp.ClientSession:
+    '''Creates a session on the tuned connection pool, asking for compressed responses'''
+    return aiohttp.ClientSession(connector=create_connector(ssl_context),
+                                 headers={"Accept-Encoding": ACCEPT_ENCODING},
+                                 trace_configs=trace_configs)
+
+
+def discard_session(session: aiohttp.ClientSession, loop: asyncio.AbstractEventLoop) -> None:
+    '''Gives up a session created on another event loop. It is closed on that
+    loop the next time it runs, or only detached from its connections if the
+    loop has already been closed, as they cannot be closed without it'''
+    if session.closed:
+        return
+    if loop.is_closed():
+        session.detach()
+    else:
+        loop.create_task(session.close())
+
+
+async def get_session() -> aiohttp.ClientSession:
+    '''Returns the shared session, creating it on first use or when the running
+    loop has changed since it was created, when the previous one is discarded'''
+    global _session, _session_loop  # pylint: disable=global-statement
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        if _session is not None:
+            discard_session(_session, _session_loop)
+        _session = create_session()
+        _session_loop = loop
+        logging.info("Created shared HTTP session")
+    return _session
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    '''Returns the event loop kept open between invocations'''
+    global _loop  # pylint: disable=global-statement
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+    return _loop
+
+
+def run(coroutine: Coroutine):
+    '''Runs a coroutine to completion on the long lived event loop. Unlike
+    asyncio.run this leaves the loop, and so the shared session, open'''
+    return get_event_loop().run_until_complete(coroutine)
+
+
+async def close_session() -> None:
+    '''Closes the shared session and its pooled connections'''
+    global _session, _session_loop  # pylint: disable=global-statement
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session, _session_loop = None, None
+
+
+def close() -> None:
+    '''Closes the shared session and the event loop it runs on'''
+    global _loop  # pylint: disable=global-statement
+    if _loop is not None and not _loop.is_closed():
+        if _session_loop is _loop:
+            _loop.run_until_complete(close_session())
+        _loop.close()
+    _loop = None
+
+
+async def get_json(url: str, timeout: int, params: dict = None) -> dict:
+    '''Gets a JSON document through the shared session, or None if the response was not a 200'''
+    session = await get_session()
+    async with session.get(url, params=params,
+                           timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+        if response.status != 200:
+            logging.error("Failed to retrieve %s. HTTP Status code: %s",
+                          url, response.status)
+            return None
+        return await response.json(content_type=None)
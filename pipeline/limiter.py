@@ -0,0 +1,142 @@
+'''Adaptive concurrency limiter, so scraping speeds up while bandcamp is responsive
+and backs off as soon as it starts throttling.'''
+
+import asyncio
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import logging
+import random
+import time
+
+
+INITIAL_CONCURRENCY = 3
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 32
+ADDITIVE_INCREASE = 1
+MULTIPLICATIVE_DECREASE = 0.5
+DECREASE_COOLDOWN_SECONDS = 1
+BASE_BACKOFF_SECONDS = 1
+MAX_BACKOFF_SECONDS = 60
+
+
+def parse_retry_after(header_value: str) -> float:
+    '''Converts a Retry-After header, given in seconds or as a date, into seconds to wait'''
+    if not header_value:
+        return None
+    try:
+        return max(float(header_value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(header_value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+def is_throttling_status(status: int) -> bool:
+    '''Checks if a response status means the server is overloaded'''
+    return status == 429 or 500 <= status < 600
+
+
+class AdaptiveLimiter:
+    '''Limits the number of requests in flight using additive increase and
+    multiplicative decrease: every successful response raises the limit by
+    ADDITIVE_INCREASE per window of requests, while a 429 or 5xx cuts it by
+    MULTIPLICATIVE_DECREASE and honours any Retry-After by pausing new requests.'''
+
+    def __init__(self, initial: int = INITIAL_CONCURRENCY,
+                 minimum: int = MIN_CONCURRENCY,
+                 maximum: int = MAX_CONCURRENCY,
+                 increase: float = ADDITIVE_INCREASE,
+                 decrease: float = MULTIPLICATIVE_DECREASE):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.paused_until = 0.0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    @property
+    def concurrency(self) -> int:
+        '''The number of requests currently allowed in flight'''
+        return int(self.limit)
+
+    @property
+    def throttle_rate(self) -> float:
+        '''The fraction of responses that were throttled'''
+        return self.throttled / self.requests if self.requests else 0
+
+    async def acquire(self) -> None:
+        '''Waits for a free permit, and for any Retry-After pause to pass'''
+        async with self._condition:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause <= 0 and self.in_flight < self.concurrency:
+                    break
+                try:
+                    await asyncio.wait_for(self._condition.wait(),
+                                           timeout=pause if pause > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+            self.in_flight += 1
+
+    async def release(self) -> None:
+        '''Returns a permit and wakes up any waiting requests'''
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    async def __aenter__(self) -> "AdaptiveLimiter":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.release()
+
+    async def backoff(self, delay: float) -> None:
+        '''Sleeps for a backoff delay with the caller's permit given back, so
+        other requests can use it meanwhile, then waits for a permit again'''
+        await self.release()
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            await self.acquire()
+
+    def record_success(self) -> None:
+        '''Additively raises the limit after a successful response'''
+        self.requests += 1
+        self.limit = min(self.limit + self.increase / self.limit, self.maximum)
+
+    def record_throttle(self, retry_after: float = None) -> None:
+        '''Multiplicatively cuts the limit after a 429 or 5xx response. Responses
+        throttled together only cut the limit once per cooldown'''
+        self.requests += 1
+        self.throttled += 1
+
+        now = time.monotonic()
+        if now - self._last_decrease >= DECREASE_COOLDOWN_SECONDS:
+            self.limit = max(self.limit * self.decrease, self.minimum)
+            self._last_decrease = now
+        if retry_after is not None:
+            self.paused_until = max(self.paused_until, now + retry_after)
+
+    def backoff_delay(self, attempt: int, retry_after: float = None) -> float:
+        '''Returns how long to wait before retrying: an exponential backoff with
+        jitter, but never less than the server asked for'''
+        backoff = min(BASE_BACKOFF_SECONDS * 2 ** attempt, MAX_BACKOFF_SECONDS)
+        delay = random.uniform(backoff / 2, backoff)
+        return max(delay, retry_after or 0)
+
+    def log_stats(self) -> None:
+        '''Logs the current concurrency and how often requests were throttled'''
+        logging.info("Scrape concurrency: %s, requests: %s, throttled: %s (%.1f%%)",
+                     self.concurrency, self.requests, self.throttled,
+                     self.throttle_rate * 100)
@@ -1,8 +1,12 @@
 """Script containing functions for loading sales data into the Database."""
 
+from collections import OrderedDict
+from decimal import Decimal, ROUND_HALF_UP
+import hashlib
+import json
 from os import environ as ENV
 import logging
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Hashable, List, Optional
 import psycopg2
 import psycopg2.extras
 from psycopg2.extensions import connection as DBConnection, cursor as DBCursor
@@ -15,6 +19,324 @@ REQUIRED_FIELDS_TRACK = ["album_url", "track_tags"]
 REQUIRED_FIELDS_SINGLE = ["track_tags"]
 REQUIRED_FIELDS_ALBUM = ["album_tags"]
 
+COUNTRY_CACHE_SIZE = 512
+TAG_CACHE_SIZE = 8192
+ARTIST_CACHE_SIZE = 20000
+ALBUM_CACHE_SIZE = 20000
+TRACK_CACHE_SIZE = 50000
+ASSIGNMENT_CACHE_SIZE = 100000
+COMMIT_CHUNK_SIZE = 500
+RETRY_DELAY_SECONDS = 900
+FEED_CURSOR_NAME = "salesfeed"
+
+UPSERT_COUNTRY = """
+    WITH inserted AS (
+        INSERT INTO country(name) VALUES (%(name)s)
+        ON CONFLICT (name) DO NOTHING
+        RETURNING country_id
+    )
+    SELECT country_id FROM inserted
+    UNION ALL
+    SELECT country_id FROM country WHERE name = %(name)s
+    LIMIT 1
+"""
+UPSERT_ARTIST = """
+    WITH inserted AS (
+        INSERT INTO artist(name, url) VALUES (%(name)s, %(url)s)
+        ON CONFLICT (name, url) DO NOTHING
+        RETURNING artist_id
+    )
+    SELECT artist_id FROM inserted
+    UNION ALL
+    SELECT artist_id FROM artist WHERE name = %(name)s AND url = %(url)s
+    LIMIT 1
+"""
+UPSERT_ALBUM = """
+    WITH inserted AS (
+        INSERT INTO album(title, artist_id, url) VALUES (%(title)s, %(artist_id)s, %(url)s)
+        ON CONFLICT (url) DO NOTHING
+        RETURNING album_id
+    )
+    SELECT album_id FROM inserted
+    UNION ALL
+    SELECT album_id FROM album WHERE url = %(url)s
+    LIMIT 1
+"""
+UPSERT_TRACK = """
+    WITH upserted AS (
+        INSERT INTO track(title, album_id, artist_id, url)
+        VALUES (%(title)s, %(album_id)s, %(artist_id)s, %(url)s)
+        ON CONFLICT (url) DO UPDATE SET album_id = EXCLUDED.album_id
+        WHERE track.album_id IS NULL AND EXCLUDED.album_id IS NOT NULL
+        RETURNING track_id
+    )
+    SELECT track_id FROM upserted
+    UNION ALL
+    SELECT track_id FROM track WHERE url = %(url)s
+    LIMIT 1
+"""
+UPSERT_TAG = """
+    WITH inserted AS (
+        INSERT INTO tag(name) VALUES (%(name)s)
+        ON CONFLICT (name) DO NOTHING
+        RETURNING tag_id
+    )
+    SELECT tag_id FROM inserted
+    UNION ALL
+    SELECT tag_id FROM tag WHERE name = %(name)s
+    LIMIT 1
+"""
+INSERT_ALBUM_PURCHASE = """
+    WITH inserted AS (
+        INSERT INTO album_purchase(album_id, timestamp, amount_usd, country_id, purchase_key)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (purchase_key, timestamp) DO NOTHING
+        RETURNING album_id, timestamp, amount_usd, country_id, purchase_key
+    )
+    INSERT INTO pending_sales_rollup(album_id, timestamp, amount_usd, country_id, purchase_key)
+    SELECT album_id, timestamp, amount_usd, country_id, purchase_key FROM inserted
+"""
+INSERT_TRACK_PURCHASE = """
+    WITH inserted AS (
+        INSERT INTO track_purchase(track_id, timestamp, amount_usd, country_id, purchase_key)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (purchase_key, timestamp) DO NOTHING
+        RETURNING track_id, timestamp, amount_usd, country_id, purchase_key
+    )
+    INSERT INTO pending_sales_rollup(track_id, timestamp, amount_usd, country_id, purchase_key)
+    SELECT track_id, timestamp, amount_usd, country_id, purchase_key FROM inserted
+"""
+CREATE_PENDING_SALES_ROLLUP = """
+    CREATE TEMPORARY TABLE IF NOT EXISTS pending_sales_rollup (
+        album_id INT,
+        track_id INT,
+        timestamp TIMESTAMP(0) NOT NULL,
+        amount_usd DECIMAL(6,2) NOT NULL,
+        country_id SMALLINT NOT NULL,
+        purchase_key CHAR(64) NOT NULL
+    ) ON COMMIT DELETE ROWS;
+    CREATE TEMPORARY TABLE IF NOT EXISTS pending_tag_assignment (
+        tag_id INT NOT NULL,
+        album_id INT,
+        track_id INT
+    ) ON COMMIT DELETE ROWS
+"""
+# The tags of each of {purchases}, through every tag assignment of its album or track.
+TAGGED_PURCHASES = """
+        SELECT COALESCE(album_tag.tag_id, track_tag.tag_id) AS tag_id,
+               purchase.album_id, purchase.track_id, purchase.timestamp, purchase.amount_usd
+        FROM {purchases} AS purchase
+        LEFT JOIN album_tag_assignment AS album_tag ON album_tag.album_id = purchase.album_id
+        LEFT JOIN track_tag_assignment AS track_tag ON track_tag.track_id = purchase.track_id
+        WHERE COALESCE(album_tag.tag_id, track_tag.tag_id) IS NOT NULL"""
+# The purchases committed before the transaction of each album or track it
+# assigned a new tag to, so they are counted against that tag too.
+REATTRIBUTED_PURCHASES = """
+        SELECT assigned.tag_id, purchase.album_id, NULL::INT, purchase.timestamp,
+               purchase.amount_usd
+        FROM pending_tag_assignment AS assigned
+        JOIN album_purchase AS purchase ON purchase.album_id = assigned.album_id
+        WHERE NOT EXISTS (SELECT FROM pending_sales_rollup AS pending
+                          WHERE pending.purchase_key = purchase.purchase_key)
+        UNION ALL
+        SELECT assigned.tag_id, NULL::INT, purchase.track_id, purchase.timestamp,
+               purchase.amount_usd
+        FROM pending_tag_assignment AS assigned
+        JOIN track_purchase AS purchase ON purchase.track_id = assigned.track_id
+        WHERE NOT EXISTS (SELECT FROM pending_sales_rollup AS pending
+                          WHERE pending.purchase_key = purchase.purchase_key)"""
+# Each rollup upsert adds the purchases of {purchases}, or for tags those of
+# {tagged_purchases}, to an hourly rollup table, in the order of its primary
+# key, so that transactions adding to the same rows lock them in the same
+# order and cannot deadlock.
+UPSERT_ARTIST_HOURLY_SALES = """
+    INSERT INTO artist_hourly_sales AS rollup
+        (artist_id, hour, album_sales, track_sales, album_usd, track_usd)
+    SELECT COALESCE(album.artist_id, track.artist_id) AS artist_id,
+           date_trunc('hour', purchase.timestamp) AS hour,
+           COUNT(purchase.album_id), COUNT(purchase.track_id),
+           COALESCE(SUM(purchase.amount_usd) FILTER (WHERE purchase.album_id IS NOT NULL), 0),
+           COALESCE(SUM(purchase.amount_usd) FILTER (WHERE purchase.track_id IS NOT NULL), 0)
+    FROM {purchases} AS purchase
+    LEFT JOIN album ON album.album_id = purchase.album_id
+    LEFT JOIN track ON track.track_id = purchase.track_id
+    GROUP BY 1, 2
+    ORDER BY 1, 2
+    ON CONFLICT (artist_id, hour) DO UPDATE SET
+        album_sales = rollup.album_sales + EXCLUDED.album_sales,
+        track_sales = rollup.track_sales + EXCLUDED.track_sales,
+        album_usd = rollup.album_usd + EXCLUDED.album_usd,
+        track_usd = rollup.track_usd + EXCLUDED.track_usd
+"""
+UPSERT_TAG_HOURLY_SALES = """
+    INSERT INTO tag_hourly_sales AS rollup
+        (tag_id, hour, album_sales, track_sales, album_usd, track_usd)
+    SELECT purchase.tag_id, date_trunc('hour', purchase.timestamp) AS hour,
+           COUNT(purchase.album_id), COUNT(purchase.track_id),
+           COALESCE(SUM(purchase.amount_usd) FILTER (WHERE purchase.album_id IS NOT NULL), 0),
+           COALESCE(SUM(purchase.amount_usd) FILTER (WHERE purchase.track_id IS NOT NULL), 0)
+    FROM ({tagged_purchases}
+    ) AS purchase
+    GROUP BY 1, 2
+    ORDER BY 1, 2
+    ON CONFLICT (tag_id, hour) DO UPDATE SET
+        album_sales = rollup.album_sales + EXCLUDED.album_sales,
+        track_sales = rollup.track_sales + EXCLUDED.track_sales,
+        album_usd = rollup.album_usd + EXCLUDED.album_usd,
+        track_usd = rollup.track_usd + EXCLUDED.track_usd
+"""
+UPSERT_COUNTRY_HOURLY_SALES = """
+    INSERT INTO country_hourly_sales AS rollup
+        (country_id, hour, album_sales, track_sales, album_usd, track_usd)
+    SELECT purchase.country_id, date_trunc('hour', purchase.timestamp) AS hour,
+           COUNT(purchase.album_id), COUNT(purchase.track_id),
+           COALESCE(SUM(purchase.amount_usd) FILTER (WHERE purchase.album_id IS NOT NULL), 0),
+           COALESCE(SUM(purchase.amount_usd) FILTER (WHERE purchase.track_id IS NOT NULL), 0)
+    FROM {purchases} AS purchase
+    GROUP BY 1, 2
+    ORDER BY 1, 2
+    ON CONFLICT (country_id, hour) DO UPDATE SET
+        album_sales = rollup.album_sales + EXCLUDED.album_sales,
+        track_sales = rollup.track_sales + EXCLUDED.track_sales,
+        album_usd = rollup.album_usd + EXCLUDED.album_usd,
+        track_usd = rollup.track_usd + EXCLUDED.track_usd
+"""
+SALES_ROLLUP_UPSERTS = [
+    UPSERT_ARTIST_HOURLY_SALES,
+    UPSERT_TAG_HOURLY_SALES,
+    UPSERT_COUNTRY_HOURLY_SALES,
+]
+FLUSH_SALES_ROLLUPS = ";".join(query.format(
+    purchases="pending_sales_rollup",
+    tagged_purchases=TAGGED_PURCHASES.format(purchases="pending_sales_rollup")
+    + "\n        UNION ALL" + REATTRIBUTED_PURCHASES) for query in SALES_ROLLUP_UPSERTS)
+INSERT_ALBUM_TAG_ASSIGNMENT = """
+    WITH inserted AS (
+        INSERT INTO album_tag_assignment(tag_id, album_id) VALUES (%s, %s)
+        ON CONFLICT (album_id, tag_id) DO NOTHING
+        RETURNING tag_id, album_id
+    )
+    INSERT INTO pending_tag_assignment(tag_id, album_id)
+    SELECT tag_id, album_id FROM inserted
+"""
+INSERT_TRACK_TAG_ASSIGNMENT = """
+    WITH inserted AS (
+        INSERT INTO track_tag_assignment(tag_id, track_id) VALUES (%s, %s)
+        ON CONFLICT (track_id, tag_id) DO NOTHING
+        RETURNING tag_id, track_id
+    )
+    INSERT INTO pending_tag_assignment(tag_id, track_id)
+    SELECT tag_id, track_id FROM inserted
+"""
+INSERT_REJECTED_SALE = """
+    INSERT INTO rejected_sale(item_url, sale, error) VALUES (%s, %s, %s)
+"""
+DEFER_SALE = """
+    INSERT INTO sale_retry_queue(purchase_key, item_url, sale, reason, next_attempt_at)
+    VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP + %s * INTERVAL '1 second')
+    ON CONFLICT (purchase_key) DO NOTHING
+"""
+GET_FEED_CURSOR = """
+    SELECT last_event_date FROM feed_cursor WHERE feed_name = %s
+"""
+SAVE_FEED_CURSOR = """
+    INSERT INTO feed_cursor(feed_name, last_event_date) VALUES (%s, %s)
+    ON CONFLICT (feed_name) DO UPDATE
+    SET last_event_date = GREATEST(feed_cursor.last_event_date, EXCLUDED.last_event_date),
+        updated_at = CURRENT_TIMESTAMP
+"""
+WARM_CACHE_QUERIES = (
+    ("country", "SELECT name, country_id FROM country ORDER BY country_id DESC LIMIT %s"),
+    ("tag", "SELECT name, tag_id FROM tag ORDER BY tag_id DESC LIMIT %s"),
+)
+
+
+class DimensionCache:
+    """Bounded LRU map from the natural key of a dimension row to its id.
+    Entries added during a transaction are pending until it commits, and are
+    dropped if it rolls back, since the rows they point to no longer exist.
+    Entries added since the last savepoint are likewise dropped if the
+    transaction rolls back to it."""
+
+    def __init__(self, name: str, max_entries: int):
+        self.name = name
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.pending = set()
+        self.unreleased = set()
+        self.warmed = False
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[int]:
+        """Returns the id cached for a key, or None if it is not cached."""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: Hashable, value: int) -> None:
+        """Caches the id of a key, evicting the least recently used entry when full."""
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self.pending.add(key)
+        self.unreleased.add(key)
+        if len(self.entries) > self.max_entries:
+            evicted, _ = self.entries.popitem(last=False)
+            self.pending.discard(evicted)
+            self.unreleased.discard(evicted)
+
+    def release_savepoint(self) -> None:
+        """Keeps the entries added since the savepoint, pending the transaction."""
+        self.unreleased.clear()
+
+    def rollback_to_savepoint(self) -> None:
+        """Drops the entries added since the savepoint that was rolled back to."""
+        for key in self.unreleased:
+            self.entries.pop(key, None)
+            self.pending.discard(key)
+        self.unreleased.clear()
+
+    def commit(self) -> None:
+        """Keeps the entries added during the committed transaction."""
+        self.pending.clear()
+        self.unreleased.clear()
+
+    def rollback(self) -> None:
+        """Drops the entries added during the rolled back transaction."""
+        for key in self.pending:
+            self.entries.pop(key, None)
+        self.pending.clear()
+        self.unreleased.clear()
+
+    def clear(self) -> None:
+        """Empties the cache."""
+        self.entries.clear()
+        self.pending.clear()
+        self.unreleased.clear()
+        self.warmed = False
+
+    def reset_stats(self) -> None:
+        """Resets the hit and miss counts for the next run."""
+        self.hits = 0
+        self.misses = 0
+
+
+PURCHASE_COUNTS = {"inserted": 0, "duplicates": 0, "rejected": 0, "deferred": 0}
+PENDING_PURCHASE_COUNTS = {"inserted": 0, "duplicates": 0, "rejected": 0, "deferred": 0}
+
+DIMENSION_CACHES = {
+    "country": DimensionCache("country", COUNTRY_CACHE_SIZE),
+    "tag": DimensionCache("tag", TAG_CACHE_SIZE),
+    "artist": DimensionCache("artist", ARTIST_CACHE_SIZE),
+    "album": DimensionCache("album", ALBUM_CACHE_SIZE),
+    "track": DimensionCache("track", TRACK_CACHE_SIZE),
+    "album_tag_assignment": DimensionCache("album_tag_assignment", ASSIGNMENT_CACHE_SIZE),
+    "track_tag_assignment": DimensionCache("track_tag_assignment", ASSIGNMENT_CACHE_SIZE),
+}
+
 
 def get_connection() -> DBConnection:
     """Creates a database session and returns a connection object."""
@@ -32,68 +354,157 @@ def get_cursor(connection: DBConnection) -> DBCursor:
     return connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
 
+def get_feed_cursor() -> Optional[float]:
+    """Returns the timestamp of the last salesfeed event whose sales were all
+    loaded, or None if no incremental run has loaded any yet."""
+
+    connection = get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(GET_FEED_CURSOR, (FEED_CURSOR_NAME,))
+            row = cursor.fetchone()
+    finally:
+        connection.close()
+    return row[0] if row is not None else None
+
+
+def advance_feed_cursor(last_event_date: float) -> None:
+    """Moves the feed cursor on to the timestamp of the last salesfeed event,
+    once every sale up to it has been committed, so a failed load is fetched
+    again by the next run. The cursor never moves back, so an overlapping run
+    that finishes after a later one cannot rewind it."""
+
+    connection = get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(SAVE_FEED_CURSOR, (FEED_CURSOR_NAME, last_event_date))
+        connection.commit()
+    finally:
+        connection.close()
+    logging.info("Feed cursor advanced to %s", last_event_date)
+
+
+def commit_dimension_caches() -> None:
+    """Keeps every id cached during the transaction that was just committed."""
+    for cache in DIMENSION_CACHES.values():
+        cache.commit()
+
+
+def rollback_dimension_caches() -> None:
+    """Forgets every id cached during the transaction that was just rolled back."""
+    for cache in DIMENSION_CACHES.values():
+        cache.rollback()
+
+
+def release_dimension_cache_savepoints() -> None:
+    """Keeps every id cached since the savepoint that was just released."""
+    for cache in DIMENSION_CACHES.values():
+        cache.release_savepoint()
+
+
+def rollback_dimension_caches_to_savepoints() -> None:
+    """Forgets every id cached since the savepoint that was just rolled back to."""
+    for cache in DIMENSION_CACHES.values():
+        cache.rollback_to_savepoint()
+
+
+def clear_dimension_caches() -> None:
+    """Empties every dimension cache."""
+    for cache in DIMENSION_CACHES.values():
+        cache.clear()
+
+
+def warm_dimension_caches(connection: DBConnection) -> None:
+    """Fills the caches of the small country and tag dimensions from the
+    database, unless they have already been filled by an earlier invocation."""
+
+    with connection.cursor() as cursor:
+        for name, query in WARM_CACHE_QUERIES:
+            cache = DIMENSION_CACHES[name]
+            if cache.warmed:
+                continue
+            cursor.execute(query, (cache.max_entries,))
+            for key, value in cursor.fetchall():
+                cache.put(key, value)
+            cache.commit()
+            cache.warmed = True
+            logging.info("Warmed the %s cache with %s entries", name, len(cache.entries))
+
+
+def log_dimension_cache_stats() -> None:
+    """Logs the hit rate of each dimension cache and the round trips it saved
+    this run, then resets the counts for the next run."""
+
+    saved_round_trips = 0
+    for cache in DIMENSION_CACHES.values():
+        lookups = cache.hits + cache.misses
+        if lookups:
+            logging.info("Dimension cache %s: %s hits, %s misses (%.1f%%), %s entries",
+                         cache.name, cache.hits, cache.misses,
+                         cache.hits / lookups * 100, len(cache.entries))
+        saved_round_trips += cache.hits
+        cache.reset_stats()
+    logging.info("Dimension caches saved %s round trips", saved_round_trips)
+
+
+def upsert_returning_id(cursor: DBCursor, query: str, params: Dict[str, Any]) -> int:
+    """Runs an upsert that returns the id of the inserted or existing row.
+    If an overlapping run inserted the same row after this statement's snapshot
+    was taken, the row is not visible to it, so it is run once more."""
+
+    cursor.execute(query, params)
+    row = cursor.fetchone()
+    if row is None:
+        cursor.execute(query, params)
+        row = cursor.fetchone()
+    return row[0]
+
+
 def get_or_insert_artist(cursor: DBCursor, artist_name: str, artist_url: str) -> int:
     """Adds the artist to the artist table and returns the artist_id if not present,
     otherwise gets the artist_id from the table"""
 
-    cursor.execute(
-        "SELECT artist_id FROM artist WHERE artist.name = %s AND artist.url = %s",
-        (
-            artist_name,
-            artist_url,
-        ),
-    )
-    artist_id = cursor.fetchone()
-
-    if artist_id:
-        return artist_id[0]
+    cache = DIMENSION_CACHES["artist"]
+    artist_id = cache.get((artist_name, artist_url))
+    if artist_id is not None:
+        return artist_id
 
-    cursor.execute(
-        "INSERT INTO artist(name, url) VALUES (%s, %s) RETURNING artist_id",
-        (artist_name, artist_url),
-    )
-    return cursor.fetchone()[0]
+    artist_id = upsert_returning_id(
+        cursor, UPSERT_ARTIST, {"name": artist_name, "url": artist_url})
+    cache.put((artist_name, artist_url), artist_id)
+    return artist_id
 
 
 def get_or_insert_country(cursor: DBCursor, country_name: str) -> int:
     """Adds the country to the country table and returns the country_id if not present,
     otherwise gets the country_id from the table."""
 
-    cursor.execute(
-        "SELECT country_id FROM country WHERE country.name = %s", (
-            country_name,)
-    )
-    country_id = cursor.fetchone()
-
-    if country_id:
-        return country_id[0]
+    cache = DIMENSION_CACHES["country"]
+    country_id = cache.get(country_name)
+    if country_id is not None:
+        return country_id
 
-    cursor.execute(
-        "INSERT INTO country(name) VALUES (%s) RETURNING country_id", (country_name,)
-    )
-    return cursor.fetchone()[0]
+    country_id = upsert_returning_id(cursor, UPSERT_COUNTRY, {"name": country_name})
+    cache.put(country_name, country_id)
+    return country_id
 
 
 def get_or_insert_album(
     cursor: DBCursor, album_title: str, artist_id: int, album_url: str
 ) -> int:
     """Adds the album to the album table and returns the album_id if not present,
-    otherwise gets the album_id from the table."""
-
-    cursor.execute(
-        "SELECT album_id FROM album WHERE album.title = %s AND album.url = %s",
-        (album_title, album_url),
-    )
-    album_id = cursor.fetchone()
+    otherwise gets the album_id of the album with that url from the table."""
 
-    if album_id:
-        return album_id[0]
+    cache = DIMENSION_CACHES["album"]
+    album_id = cache.get(album_url)
+    if album_id is not None:
+        return album_id
 
-    cursor.execute(
-        "INSERT INTO album(title, artist_id, url) VALUES (%s, %s, %s) RETURNING album_id",
-        (album_title, artist_id, album_url),
-    )
-    return cursor.fetchone()[0]
+    album_id = upsert_returning_id(
+        cursor, UPSERT_ALBUM,
+        {"title": album_title, "artist_id": artist_id, "url": album_url})
+    cache.put(album_url, album_id)
+    return album_id
 
 
 def get_or_insert_track_or_single(
@@ -104,30 +515,20 @@ def get_or_insert_track_or_single(
     album_id: Optional[int] = None,
 ) -> int:
     """Adds a track or single to the track table, returning the id, if not present,
-    otherwise gets the track_id from the table."""
+    otherwise gets the track_id of the track with that url from the table. A track
+    first seen as a single is linked to its album once it is seen on one."""
 
-    cursor.execute(
-        "SELECT track_id FROM track WHERE track.title = %s\
-            AND track.artist_id = %s AND track.url = %s",
-        (song_title, artist_id, song_url),
-    )
-    track_id = cursor.fetchone()
-
-    if track_id:
-        return track_id[0]
+    cache = DIMENSION_CACHES["track"]
+    track_id = cache.get((song_url, album_id))
+    if track_id is not None:
+        return track_id
 
-    if album_id is not None:
-        cursor.execute(
-            "INSERT INTO track(title, album_id, artist_id, url)\
-                VALUES (%s, %s, %s, %s) RETURNING track_id",
-            (song_title, album_id, artist_id, song_url),
-        )
-    else:
-        cursor.execute(
-            "INSERT INTO track(title, artist_id, url) VALUES (%s, %s, %s) RETURNING track_id",
-            (song_title, artist_id, song_url),
-        )
-    return cursor.fetchone()[0]
+    track_id = upsert_returning_id(
+        cursor, UPSERT_TRACK,
+        {"title": song_title, "album_id": album_id, "artist_id": artist_id,
+         "url": song_url})
+    cache.put((song_url, album_id), track_id)
+    return track_id
 
 
 def get_or_insert_tags_and_assignments(
@@ -137,45 +538,39 @@ def get_or_insert_tags_and_assignments(
     track_id: Optional[int] = None,
 ) -> None:
     """
-    Adds a tag to the tag table and returns the tag_id if it doesn't already exist,
-    otherwise simply returns tag_id from table.
-    Then checks if the album-tag or track-tag assignment exists in the database,
-    inserts it otherwise.
+    Adds a tag to the tag table if it doesn't already exist, getting its tag_id,
+    then adds the album-tag or track-tag assignment unless it already exists.
     """
 
-    cursor.execute("SELECT tag_id FROM tag WHERE name = %s", (tag_name,))
-    tag_id = cursor.fetchone()
-    if not tag_id:
-        cursor.execute(
-            "INSERT INTO tag(name) VALUES (%s) RETURNING tag_id", (tag_name,)
-        )
-        tag_id = cursor.fetchone()[0]
-    else:
-        tag_id = tag_id[0]
+    tag_cache = DIMENSION_CACHES["tag"]
+    tag_id = tag_cache.get(tag_name)
+    if tag_id is None:
+        tag_id = upsert_returning_id(cursor, UPSERT_TAG, {"name": tag_name})
+        tag_cache.put(tag_name, tag_id)
 
     if album_id:
-
-        cursor.execute(
-            "SELECT album_genre_assignment_id from album_tag_assignment WHERE album_id = %s and tag_id = %s",
-            (album_id, tag_id),
-        )
-        ata_id = cursor.fetchone()
-        if not ata_id:
-            cursor.execute(
-                "INSERT INTO album_tag_assignment(tag_id, album_id) VALUES (%s, %s)",
-                (tag_id, album_id),
-            )
+        assignment_cache = DIMENSION_CACHES["album_tag_assignment"]
+        if assignment_cache.get((album_id, tag_id)) is None:
+            cursor.execute(INSERT_ALBUM_TAG_ASSIGNMENT, (tag_id, album_id))
+            assignment_cache.put((album_id, tag_id), True)
     if track_id:
-        cursor.execute(
-            "SELECT track_tag_assignment_id from track_tag_assignment WHERE track_id = %s and tag_id = %s",
-            (track_id, tag_id),
-        )
-        tta_id = cursor.fetchone()
-        if not tta_id:
-            cursor.execute(
-                "INSERT INTO track_tag_assignment(tag_id, track_id) VALUES (%s, %s)",
-                (tag_id, track_id),
-            )
+        assignment_cache = DIMENSION_CACHES["track_tag_assignment"]
+        if assignment_cache.get((track_id, tag_id)) is None:
+            cursor.execute(INSERT_TRACK_TAG_ASSIGNMENT, (tag_id, track_id))
+            assignment_cache.put((track_id, tag_id), True)
+
+
+def get_purchase_key(sale: Dict[str, Any]) -> str:
+    """Returns the identity of a sale: a sha256 of its item url, time, amount
+    and country, so the same sale seen twice gets the same key. The amount is
+    rounded as the amount_usd column rounds it, and the fields are joined as
+    migration 002 joins them to backfill keys for existing purchases."""
+
+    amount = Decimal(str(sale["amount_paid_usd"])).quantize(
+        Decimal("0.01"), rounding=ROUND_HALF_UP)
+    identity = "\x1f".join(
+        [sale["url"], str(sale["utc_date"]), str(amount), sale["country"]])
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()
 
 
 def insert_album_or_track_purchase(
@@ -185,32 +580,108 @@ def insert_album_or_track_purchase(
     country_id: int,
     album_id: Optional[int] = None,
     track_id: Optional[int] = None,
-) -> None:
-    """Inserts an album or track purchase in the (album/track)_purchase table."""
+    purchase_key: Optional[str] = None,
+) -> bool:
+    """Inserts an album or track purchase in the (album/track)_purchase table,
+    unless a purchase with the same key is already there. Returns whether it
+    was inserted, counting it as inserted or as a duplicate for the run."""
 
     if album_id:
         cursor.execute(
-            "INSERT INTO album_purchase(album_id, timestamp, amount_usd, country_id)\
-                VALUES (%s, %s, %s, %s)",
-            (album_id, timestamp, amount_usd, country_id),
+            INSERT_ALBUM_PURCHASE,
+            (album_id, timestamp, amount_usd, country_id, purchase_key),
         )
     elif track_id:
         cursor.execute(
-            "INSERT INTO track_purchase(track_id, timestamp, amount_usd, country_id)\
-                VALUES (%s, %s, %s, %s)",
-            (track_id, timestamp, amount_usd, country_id),
+            INSERT_TRACK_PURCHASE,
+            (track_id, timestamp, amount_usd, country_id, purchase_key),
         )
+    else:
+        return False
+
+    inserted = cursor.rowcount == 1
+    PENDING_PURCHASE_COUNTS["inserted" if inserted else "duplicates"] += 1
+    return inserted
+
+
+def prepare_sales_rollups(cursor: DBCursor) -> None:
+    """Creates this session's pending_sales_rollup and pending_tag_assignment
+    tables if they do not exist. Every purchase and tag assignment inserted is
+    also added to them, and their rows are deleted when the transaction ends,
+    so they hold the transaction's purchases and new tag assignments."""
+    cursor.execute(CREATE_PENDING_SALES_ROLLUP)
+
+
+def flush_sales_rollups(cursor: DBCursor) -> None:
+    """Adds the purchases inserted during the transaction to the hourly
+    artist, tag and country rollups, in one round trip just before it
+    commits, so the rollups always match the purchases committed with them.
+    Purchases loaded earlier are added to the tags newly assigned to their
+    album or track."""
+    cursor.execute(FLUSH_SALES_ROLLUPS)
+
+
+def commit_purchase_counts() -> None:
+    """Adds the purchases of the transaction that was just committed to the run's counts."""
+    for key, count in PENDING_PURCHASE_COUNTS.items():
+        PURCHASE_COUNTS[key] += count
+        PENDING_PURCHASE_COUNTS[key] = 0
+
+
+def rollback_purchase_counts() -> None:
+    """Discards the purchases of the transaction that was just rolled back."""
+    for key in PENDING_PURCHASE_COUNTS:
+        PENDING_PURCHASE_COUNTS[key] = 0
+
+
+def log_purchase_stats() -> None:
+    """Logs how many purchases the run inserted, how many it dropped as
+    duplicates of purchases already loaded, how many sales it rejected and
+    how many it deferred to the retry queue, then resets the counts."""
+
+    logging.info("Inserted %s purchases, dropped %s duplicates, rejected %s sales, "
+                 "deferred %s sales", PURCHASE_COUNTS["inserted"],
+                 PURCHASE_COUNTS["duplicates"], PURCHASE_COUNTS["rejected"],
+                 PURCHASE_COUNTS["deferred"])
+    for key in PURCHASE_COUNTS:
+        PURCHASE_COUNTS[key] = 0
+
+
+def get_missing_fields(sale: Dict[str, Any], required_fields: List[str]) -> List[str]:
+    """Returns the required fields of a sale that are missing or empty."""
+    return [field for field in required_fields if not sale.get(field)]
+
+
+def get_deferred_sale_params(sale: Dict[str, Any], missing_fields: List[str]) -> tuple:
+    """Returns the parameters of DEFER_SALE for a sale whose page could not be
+    fully scraped, with the fields it is missing as the reason. The item is queued
+    as the feed gave it, and is first retried after RETRY_DELAY_SECONDS, to give
+    a throttled scrape time to recover."""
+
+    logging.warning("Deferring sale %s, missing %s", sale["url"], ", ".join(missing_fields))
+    return (
+        get_purchase_key(sale),
+        sale["url"],
+        json.dumps(sale["feed_item"], default=str),
+        f"missing {', '.join(missing_fields)}",
+        RETRY_DELAY_SECONDS,
+    )
+
+
+def defer_sale(cursor: DBCursor, sale: Dict[str, Any], missing_fields: List[str]) -> None:
+    """Adds a sale missing scraped fields to the retry queue, to be scraped
+    again and loaded by a later run, unless it is queued already."""
+
+    cursor.execute(DEFER_SALE, get_deferred_sale_params(sale, missing_fields))
+    PENDING_PURCHASE_COUNTS["deferred"] += 1
 
 
 def insert_album_sale(cursor: DBCursor, album_sale: Dict[str, Any]) -> None:
     """Inserts data relating to an album sale."""
 
-    if not all(
-        field in album_sale and album_sale[field] for field in REQUIRED_FIELDS_ALBUM
-    ):
-        logging.warning(
-            "Skipping album sale due to missing required fields: %s", album_sale
-        )
+    missing_fields = get_missing_fields(album_sale, REQUIRED_FIELDS_ALBUM)
+    if missing_fields:
+        defer_sale(cursor, album_sale, missing_fields)
         return
 
     country_id = get_or_insert_country(cursor, album_sale["country"])
@@ -230,18 +701,16 @@ def insert_album_sale(cursor: DBCursor, album_sale: Dict[str, Any]) -> None:
         album_sale["amount_paid_usd"],
         country_id,
         album_id=album_id,
+        purchase_key=get_purchase_key(album_sale),
     )
 
 
 def insert_track_sale(cursor: DBCursor, track_sale: Dict[str, Any]) -> None:
     """Inserts data relating to a track (belonging to an album) sale."""
 
-    if not all(
-        field in track_sale and track_sale[field] for field in REQUIRED_FIELDS_TRACK
-    ):
-        logging.warning(
-            "Skipping track sale due to missing required fields: %s", track_sale
-        )
+    missing_fields = get_missing_fields(track_sale, REQUIRED_FIELDS_TRACK)
+    if missing_fields:
+        defer_sale(cursor, track_sale, missing_fields)
         return
 
     country_id = get_or_insert_country(cursor, track_sale["country"])
@@ -266,18 +735,16 @@ def insert_track_sale(cursor: DBCursor, track_sale: Dict[str, Any]) -> None:
         track_sale["amount_paid_usd"],
         country_id,
         track_id=track_id,
+        purchase_key=get_purchase_key(track_sale),
     )
 
 
 def insert_single_sale(cursor: DBCursor, single_sale: Dict[str, Any]) -> None:
     """Inserts data relating to a single sale."""
 
-    if not all(
-        field in single_sale and single_sale[field] for field in REQUIRED_FIELDS_SINGLE
-    ):
-        logging.warning(
-            "Skipping single sale due to missing required fields: %s, single_sale"
-        )
+    missing_fields = get_missing_fields(single_sale, REQUIRED_FIELDS_SINGLE)
+    if missing_fields:
+        defer_sale(cursor, single_sale, missing_fields)
         return
 
     country_id = get_or_insert_country(cursor, single_sale["country"])
@@ -298,38 +765,117 @@ def insert_single_sale(cursor: DBCursor, single_sale: Dict[str, Any]) -> None:
         single_sale["amount_paid_usd"],
         country_id,
         track_id=track_id,
+        purchase_key=get_purchase_key(single_sale),
+    )
+
+
+def insert_sale(cursor: DBCursor, sale: Dict[str, Any]) -> None:
+    """Inserts a sale of any item type."""
+
+    logging.debug("Processing sale: %s", sale)
+    if sale["item_type"] == "a":
+        logging.debug("Inserting album sale")
+        insert_album_sale(cursor, sale)
+    elif sale["item_type"] == "t":
+        if sale.get("album_title"):
+            logging.debug("Inserting track sale")
+            insert_track_sale(cursor, sale)
+    else:
+        logging.debug("Inserting single sale")
+        insert_single_sale(cursor, sale)
+
+
+def get_rejected_sale_params(sale: Dict[str, Any], error: Exception) -> tuple:
+    """Returns the parameters of INSERT_REJECTED_SALE for a sale, counting it
+    as rejected for the run."""
+
+    logging.warning("Rejecting sale %s: %s", sale.get("url"), error)
+    PENDING_PURCHASE_COUNTS["rejected"] += 1
+    return (
+        sale.get("url"),
+        json.dumps(sale, default=str),
+        f"{type(error).__name__}: {error}",
     )
 
 
-def load_sales_data(sales_data: List[Dict[str, Any]]) -> None:
-    """Loads sales data into the database."""
+def reject_sale(cursor: DBCursor, sale: Dict[str, Any], error: Exception) -> None:
+    """Records a sale that could not be loaded, and why, in the rejected_sale table."""
+    cursor.execute(INSERT_REJECTED_SALE, get_rejected_sale_params(sale, error))
 
+
+def insert_sale_in_savepoint(cursor: DBCursor, sale: Dict[str, Any]) -> bool:
+    """Inserts a sale inside a savepoint, so a sale that fails is rolled back
+    on its own and rejected, leaving the rest of the transaction intact.
+    Returns whether the sale was inserted."""
+
+    pending_counts = dict(PENDING_PURCHASE_COUNTS)
+    cursor.execute("SAVEPOINT sale")
     try:
-        connection = get_connection()
-        with connection.cursor() as cursor:
-            for sale in sales_data:
-                logging.info("Processing sale: %s", sale)
-                if sale["item_type"] == "a":
-                    logging.info("Inserting album sale")
-                    insert_album_sale(cursor, sale)
-                elif sale["item_type"] == "t":
-                    if sale.get("album_title"):
-                        logging.info("Inserting track sale")
-                        insert_track_sale(cursor, sale)
-                else:
-                    logging.info("Inserting single sale")
-                    insert_single_sale(cursor, sale)
-        connection.commit()
+        insert_sale(cursor, sale)
+    except Exception as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT sale")
+        rollback_dimension_caches_to_savepoints()
+        PENDING_PURCHASE_COUNTS.update(pending_counts)
+        reject_sale(cursor, sale, e)
+        return False
+    cursor.execute("RELEASE SAVEPOINT sale")
+    release_dimension_cache_savepoints()
+    return True
+
+
+def load_sales_data(sales_data: List[Dict[str, Any]], warm_caches: bool = False,
+                    chunk_size: int = COMMIT_CHUNK_SIZE) -> bool:
+    """Loads sales data into the database, committing every chunk_size sales,
+    first warming the dimension caches if warm_caches is set. Returns whether
+    every chunk was committed."""
+
+    committed = False
+    connection = get_connection()
+    try:
+        if warm_caches:
+            warm_dimension_caches(connection)
+        committed = True
+        for start in range(0, len(sales_data), chunk_size):
+            committed &= load_sales_batch(connection, sales_data[start:start + chunk_size])
     except Exception as e:
         logging.error("An error occurred: %s", e)
+        committed = False
     finally:
         connection.close()
+    log_dimension_cache_stats()
+    log_purchase_stats()
+    return committed
+
+
+def load_sales_batch(connection: DBConnection, sales_data: List[Dict[str, Any]]) -> bool:
+    """Inserts a chunk of sales in one transaction on an open connection,
+    returning whether it was committed. Each sale is inserted in its own
+    savepoint, so a bad sale is rejected without losing the rest, and the
+    hourly sales rollups are updated with its purchases before it commits."""
+
+    try:
+        with connection.cursor() as cursor:
+            prepare_sales_rollups(cursor)
+            for sale in sales_data:
+                insert_sale_in_savepoint(cursor, sale)
+            flush_sales_rollups(cursor)
+        connection.commit()
+        commit_dimension_caches()
+        commit_purchase_counts()
+        return True
+    except Exception as e:
+        logging.error("An error occurred, rolling back %s sales: %s",
+                      len(sales_data), e)
+        connection.rollback()
+        rollback_dimension_caches()
+        rollback_purchase_counts()
+        return False
 
 
 if __name__ == "__main__":
 
     load_dotenv()
 
-    list_of_items = get_sales_data()
+    list_of_items, _ = get_sales_data()
     cleaned_data = transform_sales_data(list_of_items)
     load_sales_data(cleaned_data)
@@ -0,0 +1,163 @@
+"""Script for maintaining the monthly partitions of the purchase tables.
+
+album_purchase and track_purchase are partitioned by month on timestamp, with
+a default partition for purchases outside every month. Each run makes sure the
+current month and the next few have partitions before they are needed, moving
+any of their purchases that had landed in the default partition across. Months
+older than the retention period are detached and moved to an archive schema,
+where they can still be queried, dumped or dropped, without the purchase
+tables or their queries ever reading them again. Their sales stay in the
+hourly rollups, which rollups.py rebuilds from the archive schema too."""
+
+from datetime import date
+import logging
+import re
+from typing import List
+
+from dotenv import load_dotenv
+from psycopg2 import sql
+from psycopg2.extensions import connection as DBConnection, cursor as DBCursor
+
+from load import get_connection
+
+PURCHASE_TABLES = ["album_purchase", "track_purchase"]
+PARTITION_MONTHS_AHEAD = 3
+ARCHIVE_SCHEMA = "purchase_archive"
+PARTITION_NAME_PATTERN = re.compile(r"_(\d{4})_(\d{2})$")
+
+CREATE_PARTITION_TABLE = """
+    CREATE TABLE {partition} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+"""
+MOVE_FROM_DEFAULT_PARTITION = """
+    WITH moved AS (
+        DELETE FROM {default} WHERE timestamp >= %s AND timestamp < %s
+        RETURNING *
+    )
+    INSERT INTO {partition} SELECT * FROM moved
+"""
+ATTACH_PARTITION = """
+    ALTER TABLE {table} ATTACH PARTITION {partition} FOR VALUES FROM (%s) TO (%s)
+"""
+GET_PARTITIONS = """
+    SELECT child.relname FROM pg_inherits
+    JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+    WHERE pg_inherits.inhparent = %s::regclass
+"""
+CREATE_ARCHIVE_SCHEMA = "CREATE SCHEMA IF NOT EXISTS {schema}"
+DETACH_PARTITION = "ALTER TABLE {table} DETACH PARTITION {partition}"
+ARCHIVE_PARTITION = "ALTER TABLE {partition} SET SCHEMA {schema}"
+
+
+def add_months(month: date, months: int) -> date:
+    """Returns the first day of the month months after the month of a date."""
+    month_index = month.year * 12 + month.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def get_partition_name(table: str, month: date) -> str:
+    """Returns the name of the partition of a purchase table for a month."""
+    return f"{table}_{month:%Y_%m}"
+
+
+def get_partition_month(partition: str) -> date:
+    """Returns the month a partition holds, or None for the default partition."""
+    match = PARTITION_NAME_PATTERN.search(partition)
+    return date(int(match[1]), int(match[2]), 1) if match else None
+
+
+def get_partitions(cursor: DBCursor, table: str) -> List[str]:
+    """Returns the names of the partitions of a purchase table."""
+    cursor.execute(GET_PARTITIONS, (table,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def create_partition(cursor: DBCursor, table: str, month: date) -> None:
+    """Creates the partition of a purchase table for a month, moving any of
+    the month's purchases out of the default partition, which would otherwise
+    keep the partition from being attached."""
+
+    identifiers = {"table": sql.Identifier(table),
+                   "partition": sql.Identifier(get_partition_name(table, month)),
+                   "default": sql.Identifier(f"{table}_default")}
+    bounds = (month, add_months(month, 1))
+    cursor.execute(sql.SQL(CREATE_PARTITION_TABLE).format(**identifiers))
+    cursor.execute(sql.SQL(MOVE_FROM_DEFAULT_PARTITION).format(**identifiers), bounds)
+    cursor.execute(sql.SQL(ATTACH_PARTITION).format(**identifiers), bounds)
+
+
+def create_future_partitions(connection: DBConnection, today: date,
+                             months_ahead: int = PARTITION_MONTHS_AHEAD) -> List[str]:
+    """Creates the partitions of both purchase tables from the current month
+    to months_ahead months ahead that do not exist yet, each in a transaction
+    of its own. Returns the names of the partitions created."""
+
+    created = []
+    for table in PURCHASE_TABLES:
+        with connection.cursor() as cursor:
+            existing = set(get_partitions(cursor, table))
+        for months in range(months_ahead + 1):
+            month = add_months(today, months)
+            if get_partition_name(table, month) in existing:
+                continue
+            with connection.cursor() as cursor:
+                create_partition(cursor, table, month)
+            connection.commit()
+            created.append(get_partition_name(table, month))
+    if created:
+        logging.info("Created purchase partitions %s", ", ".join(created))
+    return created
+
+
+def archive_old_partitions(connection: DBConnection, today: date,
+                           retention_months: int) -> List[str]:
+    """Detaches the partitions of both purchase tables for months more than
+    retention_months before the current month, and moves them to the archive
+    schema. Returns the names of the partitions archived."""
+
+    cutoff = add_months(today, -retention_months)
+    archived = []
+    with connection.cursor() as cursor:
+        cursor.execute(sql.SQL(CREATE_ARCHIVE_SCHEMA).format(
+            schema=sql.Identifier(ARCHIVE_SCHEMA)))
+        for table in PURCHASE_TABLES:
+            for partition in sorted(get_partitions(cursor, table)):
+                month = get_partition_month(partition)
+                if month is None or month >= cutoff:
+                    continue
+                identifiers = {"table": sql.Identifier(table),
+                               "partition": sql.Identifier(partition),
+                               "schema": sql.Identifier(ARCHIVE_SCHEMA)}
+                cursor.execute(sql.SQL(DETACH_PARTITION).format(**identifiers))
+                cursor.execute(sql.SQL(ARCHIVE_PARTITION).format(**identifiers))
+                archived.append(partition)
+    connection.commit()
+    if archived:
+        logging.info("Archived purchase partitions %s to %s",
+                     ", ".join(archived), ARCHIVE_SCHEMA)
+    return archived
+
+
+def maintain_purchase_partitions(months_ahead: int = PARTITION_MONTHS_AHEAD,
+                                 retention_months: int = 0,
+                                 today: date = None) -> None:
+    """Creates the purchase partitions for the months ahead and, if
+    retention_months is not 0, archives those older than it."""
+
+    today = today or date.today()
+    connection = get_connection()
+    try:
+        create_future_partitions(connection, today, months_ahead)
+        if retention_months > 0:
+            archive_old_partitions(connection, today, retention_months)
+    except Exception as e:
+        logging.error("An error occurred maintaining the purchase partitions: %s", e)
+        connection.rollback()
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+
+    load_dotenv()
+
+    maintain_purchase_partitions()
@@ -1,33 +1,101 @@
 """Main script for running the ETL Pipeline."""
 
+from os import environ as ENV
 import logging
+import time
 from dotenv import load_dotenv
 from extract import get_sales_data
+from scrape_cache import SCRAPE_CACHE_PATH
 from transform import transform_sales_data
-from load import load_sales_data
+from load import COMMIT_CHUNK_SIZE, advance_feed_cursor, get_feed_cursor, load_sales_data
+from async_load import async_load_sales_data
+from bulk_load import bulk_load_sales_data
+from stream import STREAM_BATCH_SIZE, log_run_duration, run_streaming_pipeline
+from retry_queue import DRAIN_BATCH_SIZE, DRAIN_MAX_CONCURRENCY, run_retry_drain
+from coordination import LEASE_SECONDS, LEASE_SIZE, run_exclusively, run_leased_pipeline
+from partitions import PARTITION_MONTHS_AHEAD, maintain_purchase_partitions
 
 
 def main(event, context):  # pylint: disable=unused-argument
     """
-    Main function to execute the ETL (Extract, Transform, Load) pipeline.
-
-    - Configures logging with a warning level and a specific format.
-    - Loads environment variables from a .env file using dotenv.
-    - Fetches sales data using get_sales_data().
-    - Transforms the fetched data using transform_sales_data().
-    - Loads the transformed data into a database using load_sales_data().
+    Main function to execute the ETL (Extract, Transform, Load) pipeline, in the
+    mode and with the options set by the environment variables in the README.
     """
 
     logging.basicConfig(
-        level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s"
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
     )
+    logging.getLogger().setLevel(logging.INFO)
 
     try:
         load_dotenv()
 
-        list_of_sales = get_sales_data()
-        cleaned_sales = transform_sales_data(list_of_sales)
-        load_sales_data(cleaned_sales)
+        incremental = ENV.get("INCREMENTAL_FEED", "false").lower() == "true"
+        options = {
+            "cache_path": ENV.get("SCRAPE_CACHE_PATH", SCRAPE_CACHE_PATH) or None,
+            "parse_workers": int(ENV.get("PARSE_WORKERS", "0")),
+            "archive_path": ENV.get("ARCHIVE_PATH") or None,
+        }
+
+        load_method = ENV.get("LOAD_METHOD", "row").lower()
+        bulk_load = load_method == "bulk"
+        async_load = load_method == "async"
+        chunk_size = int(ENV.get("LOAD_CHUNK_SIZE", COMMIT_CHUNK_SIZE))
+        warm_caches = ENV.get("WARM_DIMENSION_CACHES", "false").lower() == "true"
+
+        mode = ENV.get("PIPELINE_MODE", "batch").lower()
+        replay_day = ENV.get("REPLAY_DAY") or None
+        retry_limit = int(ENV.get("RETRY_DRAIN_LIMIT", DRAIN_BATCH_SIZE))
+        retry_concurrency = int(ENV.get("RETRY_DRAIN_CONCURRENCY", DRAIN_MAX_CONCURRENCY))
+
+        coordination = ENV.get("RUN_COORDINATION", "none").lower()
+
+        def run() -> None:
+            if mode == "drain":
+                run_retry_drain(retry_limit, retry_concurrency)
+                return
+
+            maintain_purchase_partitions(
+                months_ahead=int(ENV.get("PARTITION_MONTHS_AHEAD", PARTITION_MONTHS_AHEAD)),
+                retention_months=int(ENV.get("PURCHASE_RETENTION_MONTHS", "0")))
+
+            if coordination == "lease" and replay_day is None:
+                run_leased_pipeline(
+                    incremental=incremental,
+                    lease_size=int(ENV.get("LEASE_CLAIM_SIZE", LEASE_SIZE)),
+                    lease_seconds=int(ENV.get("LEASE_SECONDS", LEASE_SECONDS)),
+                    bulk_load=bulk_load, **options)
+            elif mode == "stream" and replay_day is None:
+                run_streaming_pipeline(
+                    batch_size=int(ENV.get("STREAM_BATCH_SIZE", STREAM_BATCH_SIZE)),
+                    incremental=incremental, bulk_load=bulk_load, warm_caches=warm_caches,
+                    async_load=async_load, **options)
+            else:
+                start = time.monotonic()
+                incremental_run = incremental and replay_day is None
+                last_event_date = get_feed_cursor() if incremental_run else None
+                list_of_sales, high_water_mark = get_sales_data(
+                    last_event_date, replay_day=replay_day, **options)
+                cleaned_sales = transform_sales_data(list_of_sales)
+                if bulk_load:
+                    committed = bulk_load_sales_data(cleaned_sales)
+                elif async_load:
+                    committed = async_load_sales_data(cleaned_sales, warm_caches=warm_caches,
+                                                      chunk_size=chunk_size)
+                else:
+                    committed = load_sales_data(cleaned_sales, warm_caches=warm_caches,
+                                                chunk_size=chunk_size)
+                if incremental_run and committed and high_water_mark != last_event_date:
+                    advance_feed_cursor(high_water_mark)
+                log_run_duration("batch", len(cleaned_sales), time.monotonic() - start)
+
+            if replay_day is None:
+                run_retry_drain(retry_limit, retry_concurrency)
+
+        if coordination == "skip":
+            run_exclusively(run)
+        else:
+            run()
 
     except Exception as e:
         logging.error("An error occurred during ETL pipeline execution: %s", e)
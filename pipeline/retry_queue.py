@@ -0,0 +1,253 @@
+"""Script for draining the queue of sales whose item page could not be fully
+scraped when they were loaded.
+
+The loaders defer such sales to the sale_retry_queue table, as the feed gave
+them, instead of dropping them. A drain claims the sales that are due by
+leasing them for DRAIN_LEASE_SECONDS and commits, then scrapes their pages
+again with no transaction open, with a limiter of its own so it cannot eat
+into the main scrape's budget. It then transforms them again and, in a second
+short transaction, loads those that now have every field. The rest are retried
+later with an exponential backoff, until they run out of attempts and are left
+dead in the queue for inspection. A drain that dies mid-way leaves its sales
+to be claimed again once their lease runs out. Each drain reports the size and
+age of the queue as CloudWatch metrics."""
+
+import asyncio
+from datetime import datetime, timezone
+import json
+import logging
+from typing import Any, Dict, List
+
+from psycopg2.extensions import connection as DBConnection, cursor as DBCursor
+
+from bulk_load import REQUIRED_FIELDS, get_sale_kind
+from extract import MAX_TIMEOUT_SECONDS, extract_and_scrape_item
+import http_client
+from limiter import AdaptiveLimiter
+from load import (
+    RETRY_DELAY_SECONDS,
+    commit_dimension_caches,
+    commit_purchase_counts,
+    flush_sales_rollups,
+    get_connection,
+    get_missing_fields,
+    insert_sale_in_savepoint,
+    log_dimension_cache_stats,
+    log_purchase_stats,
+    prepare_sales_rollups,
+    rollback_dimension_caches,
+    rollback_purchase_counts,
+)
+from transform import transform_sale
+
+DRAIN_BATCH_SIZE = 100
+DRAIN_LEASE_SECONDS = 600
+DRAIN_MAX_CONCURRENCY = 4
+MAX_RETRY_ATTEMPTS = 6
+MAX_RETRY_DELAY_SECONDS = 86400
+METRICS_NAMESPACE = "BandcampTracker"
+
+CLAIM_DUE_SALES = """
+    UPDATE sale_retry_queue
+    SET attempts = attempts + 1,
+        last_attempt_at = CURRENT_TIMESTAMP,
+        next_attempt_at = CASE WHEN attempts + 1 < %(max_attempts)s
+                               THEN CURRENT_TIMESTAMP + %(lease_seconds)s * INTERVAL '1 second'
+                          END
+    WHERE sale_retry_id IN (
+        SELECT sale_retry_id FROM sale_retry_queue
+        WHERE next_attempt_at <= CURRENT_TIMESTAMP
+        ORDER BY next_attempt_at
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING sale_retry_id, sale, attempts
+"""
+DELETE_RETRIED_SALE = """
+    DELETE FROM sale_retry_queue WHERE sale_retry_id = %s
+"""
+RESCHEDULE_SALE = """
+    UPDATE sale_retry_queue
+    SET reason = %(reason)s,
+        next_attempt_at = CURRENT_TIMESTAMP + %(delay)s * INTERVAL '1 second'
+    WHERE sale_retry_id = %(sale_retry_id)s
+"""
+GET_RETRY_QUEUE_STATS = """
+    SELECT
+        COUNT(*) FILTER (WHERE next_attempt_at IS NOT NULL),
+        COUNT(*) FILTER (WHERE next_attempt_at <= CURRENT_TIMESTAMP),
+        COUNT(*) FILTER (WHERE next_attempt_at IS NULL),
+        COALESCE(EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - MIN(first_failed_at)
+                         FILTER (WHERE next_attempt_at IS NOT NULL)), 0)
+    FROM sale_retry_queue
+"""
+
+
+def get_retry_delay(attempts: int) -> int:
+    """Returns the seconds to wait before the next attempt at a sale that has
+    been attempted attempts times, or None once it has used up its attempts."""
+
+    if attempts >= MAX_RETRY_ATTEMPTS:
+        return None
+    return min(RETRY_DELAY_SECONDS * 2 ** attempts, MAX_RETRY_DELAY_SECONDS)
+
+
+def claim_due_sales(connection: DBConnection, limit: int = DRAIN_BATCH_SIZE,
+                    lease_seconds: int = DRAIN_LEASE_SECONDS) -> List[tuple]:
+    """Leases up to limit due sales from the retry queue for lease_seconds,
+    counting the attempt, and commits, so no lock is held while they are
+    scraped. Sales claimed by an overlapping drain are skipped, and a sale on
+    its last attempt is left dead unless it loads. Returns the id, feed item
+    and attempts of each sale claimed."""
+
+    with connection.cursor() as cursor:
+        cursor.execute(CLAIM_DUE_SALES, {"limit": limit, "lease_seconds": lease_seconds,
+                                         "max_attempts": MAX_RETRY_ATTEMPTS})
+        claimed = cursor.fetchall()
+    connection.commit()
+    return claimed
+
+
+async def rescrape_sales(items: List[Dict[str, Any]],
+                         max_concurrency: int = DRAIN_MAX_CONCURRENCY,
+                         timeout: int = MAX_TIMEOUT_SECONDS) -> List[Dict[str, Any]]:
+    """Scrapes the pages of queued feed items again, no more than
+    max_concurrency at a time, filling in their tags and album urls."""
+
+    limiter = AdaptiveLimiter(initial=1, maximum=max_concurrency)
+    session = await http_client.get_session()
+    scraped = await asyncio.gather(*(extract_and_scrape_item(limiter, session, item, timeout)
+                                     for item in items))
+    limiter.log_stats()
+    return scraped
+
+
+def reschedule_sale(cursor: DBCursor, sale_retry_id: int, attempts: int, reason: str) -> str:
+    """Schedules the next attempt at a sale, or leaves it dead if it has used up
+    its attempts. Returns which of the two it did."""
+
+    delay = get_retry_delay(attempts)
+    cursor.execute(RESCHEDULE_SALE, {"sale_retry_id": sale_retry_id, "delay": delay,
+                                     "reason": reason})
+    return "rescheduled" if delay is not None else "dead"
+
+
+def load_retried_sales(connection: DBConnection, claimed: List[tuple],
+                       items: List[Dict[str, Any]]) -> Dict[str, int]:
+    """Transforms the re-scraped items of claimed sales and, in one transaction,
+    loads those that are now complete and removes them from the queue,
+    rescheduling the rest. A sale the database rejects is recorded in
+    rejected_sale by the loader and removed too. Returns how many sales were
+    loaded, rejected, rescheduled and given up on."""
+
+    counts = {"loaded": 0, "rejected": 0, "rescheduled": 0, "dead": 0}
+    with connection.cursor() as cursor:
+        prepare_sales_rollups(cursor)
+        for (sale_retry_id, _, attempts), item in zip(claimed, items):
+            try:
+                sale = transform_sale(item)
+            except (KeyError, TypeError, ValueError) as e:
+                counts[reschedule_sale(cursor, sale_retry_id, attempts,
+                                       f"transform failed: {e}")] += 1
+                continue
+
+            missing_fields = get_missing_fields(sale, REQUIRED_FIELDS[get_sale_kind(sale)])
+            if missing_fields:
+                counts[reschedule_sale(cursor, sale_retry_id, attempts,
+                                       f"missing {', '.join(missing_fields)}")] += 1
+                continue
+
+            inserted = insert_sale_in_savepoint(cursor, sale)
+            cursor.execute(DELETE_RETRIED_SALE, (sale_retry_id,))
+            counts["loaded" if inserted else "rejected"] += 1
+        flush_sales_rollups(cursor)
+    connection.commit()
+    return counts
+
+
+def drain_retry_queue(connection: DBConnection, limit: int = DRAIN_BATCH_SIZE,
+                      max_concurrency: int = DRAIN_MAX_CONCURRENCY) -> Dict[str, int]:
+    """Claims up to limit due sales from the retry queue, scrapes them again
+    with no transaction open, then loads those that are now complete and
+    reschedules the rest. If the load fails, the claimed sales are retried
+    once their lease runs out. Returns how many sales were loaded, rejected,
+    rescheduled and given up on."""
+
+    counts = {"loaded": 0, "rejected": 0, "rescheduled": 0, "dead": 0}
+    try:
+        claimed = claim_due_sales(connection, limit)
+        if not claimed:
+            return counts
+        items = http_client.run(rescrape_sales([item for _, item, _ in claimed],
+                                               max_concurrency))
+        counts = load_retried_sales(connection, claimed, items)
+        commit_dimension_caches()
+        commit_purchase_counts()
+    except Exception as e:
+        logging.error("An error occurred draining the retry queue: %s", e)
+        connection.rollback()
+        rollback_dimension_caches()
+        rollback_purchase_counts()
+        return {"loaded": 0, "rejected": 0, "rescheduled": 0, "dead": 0}
+
+    logging.info("Retry queue drain loaded %s sales, rejected %s, rescheduled %s "
+                 "and gave up on %s", counts["loaded"], counts["rejected"],
+                 counts["rescheduled"], counts["dead"])
+    return counts
+
+
+def get_retry_queue_stats(connection: DBConnection) -> Dict[str, float]:
+    """Returns how many sales are waiting in the retry queue, how many of
+    them are due, how many are dead, and the age in seconds of the oldest
+    one still waiting."""
+
+    with connection.cursor() as cursor:
+        cursor.execute(GET_RETRY_QUEUE_STATS)
+        pending, due, dead, oldest_age = cursor.fetchone()
+    connection.commit()
+    return {"pending": pending, "due": due, "dead": dead, "oldest_age": float(oldest_age)}
+
+
+def log_retry_queue_stats(stats: Dict[str, float]) -> None:
+    """Logs the state of the retry queue, and prints it in CloudWatch's
+    embedded metric format, so the Lambda's log group records it as metrics."""
+
+    logging.info("Retry queue holds %s sales (%s due, oldest %.0fs) and %s dead sales",
+                 stats["pending"], stats["due"], stats["oldest_age"], stats["dead"])
+    print(json.dumps({
+        "_aws": {
+            "Timestamp": int(datetime.now(timezone.utc).timestamp() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [[]],
+                "Metrics": [
+                    {"Name": "RetryQueueDepth", "Unit": "Count"},
+                    {"Name": "RetryQueueDue", "Unit": "Count"},
+                    {"Name": "RetryQueueDead", "Unit": "Count"},
+                    {"Name": "RetryQueueOldestAge", "Unit": "Seconds"},
+                ],
+            }],
+        },
+        "RetryQueueDepth": stats["pending"],
+        "RetryQueueDue": stats["due"],
+        "RetryQueueDead": stats["dead"],
+        "RetryQueueOldestAge": stats["oldest_age"],
+    }))
+
+
+def run_retry_drain(limit: int = DRAIN_BATCH_SIZE,
+                    max_concurrency: int = DRAIN_MAX_CONCURRENCY) -> Dict[str, int]:
+    """Drains up to limit due sales from the retry queue, if limit is not 0,
+    then reports the state of the queue. Returns the counts of the drain."""
+
+    connection = get_connection()
+    try:
+        counts = {"loaded": 0, "rejected": 0, "rescheduled": 0, "dead": 0}
+        if limit > 0:
+            counts = drain_retry_queue(connection, limit, max_concurrency)
+            log_dimension_cache_stats()
+            log_purchase_stats()
+        log_retry_queue_stats(get_retry_queue_stats(connection))
+    finally:
+        connection.close()
+    return counts
@@ -0,0 +1,96 @@
+"""Script for rebuilding the hourly sales rollups from the purchase tables.
+
+artist_hourly_sales, tag_hourly_sales and country_hourly_sales hold the
+number of album and track sales of every hour, and what they came to in USD,
+for each artist, tag and country. The loaders add each transaction's
+purchases to them just before it commits, along with the purchases already
+loaded of any album or track it assigned a new tag to. They need rebuilding
+when purchases or tag assignments change outside the loaders, such as after a
+manual fix or a restore, and now and then to count a purchase that committed
+while another loader was assigning a new tag to its release. A rebuild
+empties the rollups and adds every purchase back in one transaction, using the
+same statements as the loaders. Loaders that commit during it wait for it to
+finish, so none of their purchases are missed or counted twice.
+
+The rollups are the record of every sale ever loaded. Archiving a month of
+purchases out of the purchase tables leaves its rollups alone, and a rebuild
+reads the partitions in the archive schema as well as the purchase tables, so
+only dropping an archived partition takes its sales out of the rollups."""
+
+import logging
+from typing import Dict, List
+
+from dotenv import load_dotenv
+from psycopg2.extensions import connection as DBConnection
+
+from load import SALES_ROLLUP_UPSERTS, TAGGED_PURCHASES, get_connection
+from partitions import ARCHIVE_SCHEMA, PARTITION_NAME_PATTERN, PURCHASE_TABLES
+
+ROLLUP_TABLES = ["artist_hourly_sales", "tag_hourly_sales", "country_hourly_sales"]
+
+PURCHASE_SELECTS = {
+    "album_purchase": """SELECT album_id, NULL::INT AS track_id, timestamp, amount_usd, country_id
+        FROM {table}""",
+    "track_purchase": """SELECT NULL::INT, track_id, timestamp, amount_usd, country_id
+        FROM {table}""",
+}
+GET_ARCHIVED_PARTITIONS = """
+    SELECT tablename FROM pg_tables
+    WHERE schemaname = %s AND tablename ~ '^(album|track)_purchase_[0-9]{4}_[0-9]{2}$'
+    ORDER BY tablename
+"""
+TRUNCATE_ROLLUPS = f"TRUNCATE {', '.join(ROLLUP_TABLES)}"
+
+
+def get_all_purchases(archived_partitions: List[str]) -> str:
+    """Returns a subquery of every purchase, in the purchase tables and in
+    the archived partitions, which must be named as partitions.py names them."""
+
+    selects = [PURCHASE_SELECTS[table].format(table=table) for table in PURCHASE_TABLES]
+    for partition in archived_partitions:
+        table = PARTITION_NAME_PATTERN.sub("", partition)
+        selects.append(PURCHASE_SELECTS[table].format(table=f"{ARCHIVE_SCHEMA}.{partition}"))
+    return "(\n        " + "\n        UNION ALL\n        ".join(selects) + "\n    )"
+
+
+def get_rebuild_queries(archived_partitions: List[str]) -> List[str]:
+    """Returns the upserts adding every purchase to each rollup table, including
+    those of the archived partitions."""
+
+    purchases = get_all_purchases(archived_partitions)
+    return [query.format(purchases=purchases,
+                         tagged_purchases=TAGGED_PURCHASES.format(purchases=purchases))
+            for query in SALES_ROLLUP_UPSERTS]
+
+
+def rebuild_sales_rollups(connection: DBConnection) -> Dict[str, int]:
+    """Empties the hourly sales rollups and fills them again from every
+    purchase, archived or not, in one transaction. Returns the number of rows
+    of each."""
+
+    rows = {}
+    with connection.cursor() as cursor:
+        cursor.execute(GET_ARCHIVED_PARTITIONS, (ARCHIVE_SCHEMA,))
+        archived_partitions = [row[0] for row in cursor.fetchall()]
+        cursor.execute(TRUNCATE_ROLLUPS)
+        for table, query in zip(ROLLUP_TABLES, get_rebuild_queries(archived_partitions)):
+            cursor.execute(query)
+            rows[table] = cursor.rowcount
+    connection.commit()
+    logging.info("Rebuilt the hourly sales rollups: %s",
+                 ", ".join(f"{count} rows of {table}" for table, count in rows.items()))
+    return rows
+
+
+if __name__ == "__main__":
+
+    load_dotenv()
+
+    db_connection = get_connection()
+    try:
+        rebuild_sales_rollups(db_connection)
+    except Exception as e:
+        logging.error("An error occurred rebuilding the hourly sales rollups: %s", e)
+        db_connection.rollback()
+    finally:
+        db_connection.close()
@@ -0,0 +1,176 @@
+'''Persistent cache of scraped item pages, so popular releases are only scraped once.
+Album pages also fill in a lookup of the album and tags of each of their tracks, so
+that later sales of those tracks need no fetch at all.'''
+
+import json
+import logging
+import sqlite3
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+
+SCRAPE_CACHE_PATH = "/tmp/scrape_cache.sqlite3"
+CACHE_TTL_SECONDS = 24 * 60 * 60
+NOT_FOUND_TTL_SECONDS = 6 * 60 * 60
+MAX_CACHE_ENTRIES = 20000
+
+
+def normalize_url(url_string: str) -> str:
+    '''Normalizes an item url so that every form of it maps to the same cache key'''
+    if "//" not in url_string:
+        url_string = "//" + url_string
+    parts = urlsplit(url_string)
+    return urlunsplit(("https", parts.netloc.lower(), parts.path.rstrip("/"), "", ""))
+
+
+class ScrapeCache:
+    '''Sqlite backed cache of the tags and album url scraped from each item page.
+    Entries expire after a ttl, the least recently used entries are evicted once
+    the cache is full, and pages that returned a 404 are remembered as not found.'''
+
+    def __init__(self, path: str = SCRAPE_CACHE_PATH,
+                 ttl: float = CACHE_TTL_SECONDS,
+                 not_found_ttl: float = NOT_FOUND_TTL_SECONDS,
+                 max_entries: int = MAX_CACHE_ENTRIES):
+        self.ttl = ttl
+        self.not_found_ttl = not_found_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.album_track_hits = 0
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS scraped_item (
+                url TEXT PRIMARY KEY,
+                tags TEXT,
+                album_url TEXT,
+                not_found INTEGER NOT NULL,
+                scraped_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            )''')
+        self.connection.execute('''
+            CREATE INDEX IF NOT EXISTS scraped_item_last_used_at
+            ON scraped_item(last_used_at)''')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS album_track (
+                track_url TEXT PRIMARY KEY,
+                album_url TEXT NOT NULL,
+                tags TEXT NOT NULL,
+                scraped_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            )''')
+        self.connection.execute('''
+            CREATE INDEX IF NOT EXISTS album_track_last_used_at
+            ON album_track(last_used_at)''')
+
+    def get(self, url_string: str) -> dict:
+        '''Returns the cached fields for an item url, or None if it is missing or expired'''
+        key = normalize_url(url_string)
+        now = time.time()
+        row = self.connection.execute(
+            "SELECT tags, album_url, not_found, scraped_at FROM scraped_item WHERE url = ?",
+            (key,)).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        tags, album_url, not_found, scraped_at = row
+        ttl = self.not_found_ttl if not_found else self.ttl
+        if now - scraped_at > ttl:
+            self.misses += 1
+            return None
+
+        self.connection.execute(
+            "UPDATE scraped_item SET last_used_at = ? WHERE url = ?", (now, key))
+        self.hits += 1
+        return {
+            "tags": json.loads(tags) if tags is not None else None,
+            "album_url": album_url,
+            "not_found": bool(not_found),
+        }
+
+    def set(self, url_string: str, tags: list[str], album_url: str = None) -> None:
+        '''Stores the scraped fields of an item page'''
+        self._store(url_string, json.dumps(tags), album_url, False)
+
+    def set_not_found(self, url_string: str) -> None:
+        '''Remembers that an item page no longer exists'''
+        self._store(url_string, None, None, True)
+
+    def _store(self, url_string: str, tags: str, album_url: str, not_found: bool) -> None:
+        '''Inserts or replaces the cache entry for an item url'''
+        now = time.time()
+        self.connection.execute(
+            '''INSERT OR REPLACE INTO scraped_item
+               (url, tags, album_url, not_found, scraped_at, last_used_at)
+               VALUES (?, ?, ?, ?, ?, ?)''',
+            (normalize_url(url_string), tags, album_url, int(not_found), now, now))
+
+    def get_album_track(self, url_string: str) -> dict:
+        '''Returns the album url and album tags recorded for a track url from its
+        album page, or None if the track has not been seen on an album page'''
+        key = normalize_url(url_string)
+        now = time.time()
+        row = self.connection.execute(
+            "SELECT album_url, tags, scraped_at FROM album_track WHERE track_url = ?",
+            (key,)).fetchone()
+
+        if row is None or now - row[2] > self.ttl:
+            return None
+
+        self.connection.execute(
+            "UPDATE album_track SET last_used_at = ? WHERE track_url = ?", (now, key))
+        self.album_track_hits += 1
+        return {"tags": json.loads(row[1]), "album_url": row[0], "not_found": False}
+
+    def set_album_tracks(self, album_url: str, track_urls: list[str], tags: list[str]) -> None:
+        '''Records the album url and tags of every track listed on an album page.
+        Bandcamp shows an album's tags on the pages of its tracks, so these stand
+        in for scraping each track page'''
+        now = time.time()
+        self.connection.executemany(
+            '''INSERT OR REPLACE INTO album_track
+               (track_url, album_url, tags, scraped_at, last_used_at)
+               VALUES (?, ?, ?, ?, ?)''',
+            [(normalize_url(track_url), album_url, json.dumps(tags), now, now)
+             for track_url in track_urls])
+
+    def evict(self) -> int:
+        '''Removes expired entries, then the least recently used entries above
+        the size bound. Returns the number of entries removed'''
+        now = time.time()
+        expired = self.connection.execute(
+            '''DELETE FROM scraped_item
+               WHERE (not_found = 0 AND scraped_at < ?)
+               OR (not_found = 1 AND scraped_at < ?)''',
+            (now - self.ttl, now - self.not_found_ttl)).rowcount
+        overflow = self.connection.execute(
+            '''DELETE FROM scraped_item WHERE url IN (
+                   SELECT url FROM scraped_item ORDER BY last_used_at DESC
+                   LIMIT -1 OFFSET ?)''',
+            (self.max_entries,)).rowcount
+        expired += self.connection.execute(
+            "DELETE FROM album_track WHERE scraped_at < ?", (now - self.ttl,)).rowcount
+        overflow += self.connection.execute(
+            '''DELETE FROM album_track WHERE track_url IN (
+                   SELECT track_url FROM album_track ORDER BY last_used_at DESC
+                   LIMIT -1 OFFSET ?)''',
+            (self.max_entries,)).rowcount
+        return expired + overflow
+
+    def log_stats(self) -> None:
+        '''Logs how many lookups were served from the cache'''
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        logging.info("Scrape cache hits: %s, misses: %s, hit rate: %.1f%%",
+                     self.hits, self.misses, hit_rate * 100)
+        logging.info("Track sales resolved from album pages: %s", self.album_track_hits)
+
+    def close(self) -> None:
+        '''Evicts stale entries and writes the cache to disk'''
+        evicted = self.evict()
+        logging.info("Scrape cache evicted %s entries", evicted)
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,169 @@
+'''Local stand-in for bandcamp, so extraction can be measured and tested without it.
+
+Serves the salesfeed API and the album and track pages of a synthetic catalogue.
+Sale events and pages are generated from a seed, so every run sees the same day,
+and the latency, throttling, error rate and size of item pages are configurable.'''
+
+import asyncio
+import random
+import time
+
+from aiohttp import web
+
+
+FEED_PATH = "/api/salesfeed/1"
+FEED_PAGE_SIZE = 50
+ALBUM_SALE_SHARE = 0.35
+POPULARITY_SKEW = 1.1
+TAG_COUNT = 5
+TAG_VOCABULARY = 200
+COUNTRIES = ["United Kingdom", "United States", "Germany", "Japan", "France", "Canada"]
+
+
+class BandcampSimulator:
+    '''Local http server imitating the salesfeed and item pages of bandcamp.
+    Item pages are delayed by latency seconds, answered with a 429 at
+    throttle_rate or a 503 at error_rate, and padded to at least page_bytes'''
+
+    def __init__(self, sales: int = 500, releases: int = 200, latency: float = 0.05,
+                 throttle_rate: float = 0, error_rate: float = 0, page_bytes: int = 40000,
+                 retry_after: float = 0.1, seed: int = 1):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.page_bytes = page_bytes
+        self.retry_after = retry_after
+        self.base_url = None
+        self.stats = {"feed_requests": 0, "page_requests": 0, "throttled": 0, "errors": 0}
+        self.pages_served = set()
+
+        self._rng = random.Random(seed)
+        self._sales = sales
+        self._releases = self.create_catalogue(releases)
+        self._events = None
+        self._runner = None
+
+    def create_catalogue(self, releases: int) -> dict:
+        '''Creates albums of 1 to 12 tracks, each with a few tags'''
+        return {f"artist{index}": {
+            "artist": f"artist{index}",
+            "tracks": self._rng.randint(1, 12),
+            "tags": [f"genre{self._rng.randint(1, TAG_VOCABULARY)}"
+                     for _ in range(TAG_COUNT - 1)] + [self._rng.choice(COUNTRIES)],
+        } for index in range(releases)}
+
+    def create_events(self) -> list[dict]:
+        '''Creates sale events over the two minutes before now, most of them for
+        popular releases, oldest first'''
+        releases = list(self._releases.values())
+        weights = [1 / (rank + 1) ** POPULARITY_SKEW for rank in range(len(releases))]
+        now = time.time()
+        events = []
+        for release in self._rng.choices(releases, weights=weights, k=self._sales):
+            artist_url = f"{self.base_url}/{release['artist']}"
+            utc_date = now - self._rng.uniform(0, 120)
+            item = {
+                "utc_date": utc_date,
+                "artist_name": release["artist"].title(),
+                "item_description": "Record",
+                "amount_paid_usd": round(self._rng.uniform(1, 30), 2),
+                "country": self._rng.choice(COUNTRIES),
+                "currency": "USD",
+                "art_id": self._rng.randint(1, 10 ** 9),
+                "slug_type": "a",
+            }
+            if self._rng.random() < ALBUM_SALE_SHARE:
+                item.update(item_type="a", album_title=None,
+                            url=f"{artist_url}/album/record")
+            else:
+                item.update(item_type="t", album_title="Record",
+                            url=f"{artist_url}/track/t{self._rng.randint(1, release['tracks'])}")
+            events.append({"event_type": "sale", "utc_date": utc_date, "items": [item]})
+        return sorted(events, key=lambda event: event["utc_date"])
+
+    def render_page(self, release: dict, item_type: str) -> str:
+        '''Renders an album page with its track list, or a track page with its
+        buy album link, followed by the tags and padding up to page_bytes'''
+        if item_type == "album":
+            rows = "".join(f'<tr><td><div class="title"><a href="/track/t{number}">'
+                           f'Track {number}</a></div></td></tr>'
+                           for number in range(1, release["tracks"] + 1))
+            body = f'<table id="track_table">{rows}</table>'
+        else:
+            body = '<a id="buyAlbumLink" href="/album/record">Buy Digital Album</a>'
+        links = "".join(f'<a class="tag" href="/tag/{tag}">{tag}</a>'
+                        for tag in release["tags"])
+        html = (f'<html><head><title>{release["artist"]}</title></head><body>{body}'
+                f'<div class="tralbumData tralbum-tags">{links}</div>')
+        padding = max(self.page_bytes - len(html) - len("</body></html>"), 0)
+        return f'{html}<div class="footer">{"x" * padding}</div></body></html>'
+
+    def get_events(self) -> list[dict]:
+        '''Returns the sale events, creating them on first use'''
+        if self._events is None:
+            self._events = self.create_events()
+        return self._events
+
+    async def serve_initial_feed(self, _request: web.Request) -> web.Response:
+        '''Serves the initial window of the salesfeed, holding every sale event'''
+        self.stats["feed_requests"] += 1
+        events = self.get_events()
+        return web.json_response({"feed_data": {
+            "events": events,
+            "end_date": events[-1]["utc_date"] if events else time.time()}})
+
+    async def serve_feed(self, request: web.Request) -> web.Response:
+        '''Serves a page of the salesfeed from its start_date cursor'''
+        self.stats["feed_requests"] += 1
+        start_date = float(request.query.get("start_date", 0))
+        events = [event for event in self.get_events()
+                  if event["utc_date"] >= start_date][:FEED_PAGE_SIZE]
+        return web.json_response({
+            "events": events,
+            "end_date": events[-1]["utc_date"] if events else start_date})
+
+    async def serve_item_page(self, request: web.Request) -> web.Response:
+        '''Serves an album or track page, after the configured faults and latency'''
+        self.stats["page_requests"] += 1
+        self.pages_served.add(request.path)
+        await asyncio.sleep(self.latency)
+
+        if self._rng.random() < self.throttle_rate:
+            self.stats["throttled"] += 1
+            return web.Response(status=429, headers={"Retry-After": str(self.retry_after)})
+        if self._rng.random() < self.error_rate:
+            self.stats["errors"] += 1
+            return web.Response(status=503)
+
+        release = self._releases.get(request.match_info["artist"])
+        if release is None:
+            return web.Response(status=404)
+        return web.Response(text=self.render_page(release, request.match_info["item_type"]),
+                            content_type="text/html")
+
+    @property
+    def retries(self) -> int:
+        '''Number of item page requests beyond the first for each page'''
+        return self.stats["page_requests"] - len(self.pages_served)
+
+    def create_app(self) -> web.Application:
+        '''Creates the web app serving the feed and the item pages'''
+        app = web.Application()
+        app.router.add_get(f"{FEED_PATH}/get_initial", self.serve_initial_feed)
+        app.router.add_get(f"{FEED_PATH}/get", self.serve_feed)
+        app.router.add_get("/{artist}/{item_type:album|track}/{name}", self.serve_item_page)
+        return app
+
+    async def start(self) -> str:
+        '''Starts serving on a free local port and returns the url of the salesfeed API'''
+        self._runner = web.AppRunner(self.create_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+        self.base_url = f"http://127.0.0.1:{port}"
+        return f"{self.base_url}{FEED_PATH}"
+
+    async def stop(self) -> None:
+        '''Stops the server'''
+        await self._runner.cleanup()
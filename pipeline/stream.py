@@ -0,0 +1,216 @@
+"""Streaming mode of the ETL pipeline. Sales are transformed one at a time as
+they are scraped, and loaded in micro-batches while scraping carries on."""
+
+import asyncio
+from collections.abc import AsyncIterator, Callable
+from functools import partial
+import inspect
+import logging
+import resource
+import time
+from typing import Any, Dict, List
+
+from archive import open_archive
+from async_load import get_async_batch_loader
+from bulk_load import bulk_load_sales_batch
+import http_client
+from extract import (
+    get_latest_event_date,
+    get_new_feed_events,
+    get_parse_executor,
+    get_sale_items,
+    stream_list_of_items,
+)
+from load import (
+    advance_feed_cursor,
+    get_connection,
+    get_feed_cursor,
+    load_sales_batch,
+    log_dimension_cache_stats,
+    log_purchase_stats,
+    warm_dimension_caches,
+)
+from scrape_cache import SCRAPE_CACHE_PATH, ScrapeCache
+from transform import transform_sale
+
+STREAM_BATCH_SIZE = 50
+STREAM_BATCH_WAIT_SECONDS = 2
+STREAM_QUEUE_SIZE = 100
+
+
+async def transform_stream(items: AsyncIterator[dict]) -> AsyncIterator[dict]:
+    """Transforms each sale as soon as it has been scraped."""
+    async for item in items:
+        yield transform_sale(item)
+
+
+async def read_batch(queue: asyncio.Queue, batch_size: int,
+                     batch_wait: float) -> tuple[list[dict], bool]:
+    """
+    Takes the next micro-batch of sales off the queue, returning it along with
+    whether the stream has ended. Once the first sale arrives, the batch is
+    returned when it is full or batch_wait seconds have passed.
+    """
+    loop = asyncio.get_running_loop()
+    batch = []
+    sale = await queue.get()
+    deadline = loop.time() + batch_wait
+
+    while sale is not None:
+        batch.append(sale)
+        if len(batch) >= batch_size:
+            return batch, False
+        try:
+            sale = await asyncio.wait_for(queue.get(), max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            return batch, False
+    return batch, True
+
+
+async def stream_sales(items: AsyncIterator[dict],
+                       load_batch: Callable[[List[Dict[str, Any]]], bool],
+                       start: float,
+                       batch_size: int = STREAM_BATCH_SIZE,
+                       batch_wait: float = STREAM_BATCH_WAIT_SECONDS,
+                       queue_size: int = STREAM_QUEUE_SIZE) -> list[float]:
+    """
+    Transforms scraped sales into a bounded queue, while a loader commits them
+    in micro-batches on a worker thread, or on the event loop itself when
+    load_batch is a coroutine function. A full queue holds back the scrape.
+    Returns, for every committed sale, the seconds from start to its commit.
+    """
+    queue = asyncio.Queue(maxsize=queue_size)
+    latencies = []
+    if inspect.iscoroutinefunction(load_batch):
+        run_load = load_batch
+    else:
+        run_load = partial(asyncio.to_thread, load_batch)
+
+    async def produce() -> None:
+        async for sale in transform_stream(items):
+            await queue.put(sale)
+        await queue.put(None)
+
+    async def consume() -> None:
+        finished = False
+        while not finished:
+            batch, finished = await read_batch(queue, batch_size, batch_wait)
+            if batch and await run_load(batch):
+                latencies.extend([time.monotonic() - start] * len(batch))
+
+    async with asyncio.TaskGroup() as group:
+        group.create_task(produce())
+        group.create_task(consume())
+
+    return latencies
+
+
+def summarise_latencies(latencies: list[float]) -> dict:
+    """Returns the count, median, 95th percentile and maximum of the sale latencies."""
+    if not latencies:
+        return {"count": 0, "p50": None, "p95": None, "max": None}
+
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "p50": ordered[(len(ordered) - 1) // 2],
+        "p95": ordered[int((len(ordered) - 1) * 0.95)],
+        "max": ordered[-1],
+    }
+
+
+def get_peak_rss_mb() -> float:
+    """Returns the peak resident memory of this process in megabytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def log_run_stats(mode: str, latencies: list[float]) -> None:
+    """Logs the end-to-end latency of each loaded sale and the peak memory of a run."""
+    summary = summarise_latencies(latencies)
+    if summary["count"]:
+        logging.info("%s run loaded %s sales, latency p50 %.2fs, p95 %.2fs, max %.2fs",
+                     mode, summary["count"], summary["p50"], summary["p95"],
+                     summary["max"])
+    else:
+        logging.info("%s run loaded no sales", mode)
+    logging.info("%s run peak RSS: %.1f MB", mode, get_peak_rss_mb())
+
+
+def log_run_duration(mode: str, sale_count: int, duration: float) -> None:
+    """Logs the duration and peak memory of a run that loads its sales once all are scraped."""
+    logging.info("%s run loaded %s sales in %.2fs", mode, sale_count, duration)
+    logging.info("%s run peak RSS: %.1f MB", mode, get_peak_rss_mb())
+
+
+def run_streaming_pipeline(incremental: bool = False,
+                           cache_path: str = SCRAPE_CACHE_PATH,
+                           parse_workers: int = 0,
+                           archive_path: str = None,
+                           batch_size: int = STREAM_BATCH_SIZE,
+                           bulk_load: bool = False,
+                           warm_caches: bool = False,
+                           async_load: bool = False) -> list[float]:
+    """
+    Runs extract, transform and load as one stream, returning the latency of
+    every committed sale. Takes the same options as get_sales_data, apart from
+    replaying, which is only done in batch mode. With bulk_load each
+    micro-batch is loaded with bulk_load_sales_batch, and with async_load it
+    is loaded with async_load_sales_batch on the event loop that scrapes,
+    overlapping its round trips with the scrape. With warm_caches the
+    loader's dimension caches are filled before the first batch. In
+    incremental mode the feed cursor is only advanced once every sale of the
+    window has been committed.
+    """
+    start = time.monotonic()
+    logging.info("Streaming pipeline started")
+
+    archive = open_archive(archive_path)
+    try:
+        last_event_date = get_feed_cursor() if incremental else None
+        event_list = get_new_feed_events(last_event_date, archive=archive)
+        if event_list is None:
+            logging.info("Scraping did not initiate")
+            return []
+
+        cache = ScrapeCache(cache_path) if cache_path is not None else None
+        parse_executor = get_parse_executor(parse_workers)
+        if async_load:
+            connection, load_batch = http_client.run(get_async_batch_loader(warm_caches))
+        else:
+            connection = get_connection()
+            if warm_caches and not bulk_load:
+                warm_dimension_caches(connection)
+            load_batch = partial(bulk_load_sales_batch if bulk_load else load_sales_batch,
+                                 connection)
+        try:
+            items = stream_list_of_items(event_list, cache=cache,
+                                         parse_executor=parse_executor, archive=archive)
+            latencies = http_client.run(stream_sales(
+                items, load_batch, start, batch_size=batch_size))
+        finally:
+            if async_load:
+                http_client.run(connection.close())
+            else:
+                connection.close()
+            if cache is not None:
+                cache.log_stats()
+                cache.close()
+            if parse_executor is not None:
+                parse_executor.shutdown()
+    finally:
+        if archive is not None:
+            archive.close()
+
+    if incremental and event_list:
+        sale_count = len(get_sale_items(event_list))
+        if len(latencies) == sale_count:
+            advance_feed_cursor(get_latest_event_date(event_list, last_event_date))
+        else:
+            logging.warning("Not advancing the feed cursor, only %s of %s sales were committed",
+                            len(latencies), sale_count)
+    if not bulk_load:
+        log_dimension_cache_stats()
+        log_purchase_stats()
+    log_run_stats("stream", latencies)
+
+    return latencies
@@ -0,0 +1,222 @@
+'''Tests for the raw feed and page archive'''
+
+from contextlib import asynccontextmanager
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+import zstandard
+
+import http_client
+from archive import FeedArchive, ReplaySession, get_day_range, open_archive
+from extract import extract_list_of_items, fetch_webpage, replay_sales_data
+
+
+FIXTURES = Path(__file__).parent / "fixtures"
+DAY = "2024-06-30"
+DAY_START, DAY_END = get_day_range(DAY)
+
+
+@pytest.fixture(autouse=True)
+def close_http_client():
+    '''Closes the shared http client after each test'''
+    yield
+    http_client.close()
+
+
+@pytest.fixture
+def archive(tmp_path):
+    '''Archive stored in a temporary directory'''
+    feed_archive = FeedArchive(tmp_path / "archive", retention_days=0)
+    yield feed_archive
+    feed_archive.close()
+
+
+def make_event(utc_date: float, url: str = "//artist.bandcamp.com/album/a") -> dict:
+    '''Returns a sale event of one album'''
+    return {"event_type": "sale", "utc_date": utc_date,
+            "items": [{"item_type": "a", "url": url, "utc_date": utc_date}]}
+
+
+def test_get_day_range():
+    '''Tests that a day covers 24 hours from midnight UTC'''
+    assert DAY_END - DAY_START == 24 * 60 * 60
+    assert DAY_START == 1719705600
+
+
+def test_feed_events_are_deduplicated(archive):  # pylint: disable=redefined-outer-name
+    '''Tests that overlapping feed responses in a day only give each event once'''
+    archive.write_feed("https://feed/get_initial", None,
+                       {"feed_data": {"events": [make_event(1), make_event(2)]}},
+                       fetched_at=DAY_START + 60)
+    archive.write_feed("https://feed/get_initial", None,
+                       {"feed_data": {"events": [make_event(2), make_event(3)]}},
+                       fetched_at=DAY_START + 180)
+    archive.write_feed("https://feed/get_initial", None,
+                       {"feed_data": {"events": [make_event(4)]}},
+                       fetched_at=DAY_END + 60)
+
+    events = archive.get_feed_events(DAY_START, DAY_END)
+
+    assert [event["utc_date"] for event in events] == [1, 2, 3]
+    assert len(archive.get_feed_records(DAY_START, DAY_END)) == 2
+
+
+def test_get_page_latest_before(archive):  # pylint: disable=redefined-outer-name
+    '''Tests that a page is looked up by any form of its url, as it was before a time'''
+    archive.write_page("https://artist.bandcamp.com/album/a", 200, b"old", fetched_at=100)
+    archive.write_page("https://artist.bandcamp.com/album/a", 200, b"new", fetched_at=200)
+
+    assert archive.get_page("//Artist.bandcamp.com/album/a/")["body"] == "new"
+    assert archive.get_page("https://artist.bandcamp.com/album/a", before=150)["body"] == "old"
+    assert archive.get_page("https://artist.bandcamp.com/album/a", before=50) is None
+
+
+def test_segment_is_plain_zstd_ndjson(archive):  # pylint: disable=redefined-outer-name
+    '''Tests that a whole segment decompresses into one JSON record per line'''
+    for fetched_at in (DAY_START, DAY_START + 1):
+        archive.write_page("https://artist.bandcamp.com/album/a", 200, b"<html>",
+                           fetched_at=fetched_at)
+    segment = next(archive.path.glob("*.ndjson.zst"))
+
+    with open(segment, "rb") as file:
+        reader = zstandard.ZstdDecompressor().stream_reader(file, read_across_frames=True)
+        lines = reader.read().decode("utf-8").splitlines()
+
+    assert segment.name == f"{DAY}-0000.ndjson.zst"
+    assert len(lines) == 2
+
+
+def test_segments_rotate(tmp_path):
+    '''Tests that a new segment is started once the current one is full, and each day'''
+    archive = FeedArchive(tmp_path / "archive", segment_max_bytes=1, retention_days=0)
+    archive.write_page("https://a.bandcamp.com/album/a", 200, b"a", fetched_at=DAY_START)
+    archive.write_page("https://a.bandcamp.com/album/b", 200, b"b", fetched_at=DAY_START)
+    archive.write_page("https://a.bandcamp.com/album/c", 200, b"c", fetched_at=DAY_END)
+    archive.close()
+
+    assert sorted(path.name for path in archive.path.glob("*.ndjson.zst")) == [
+        f"{DAY}-0000.ndjson.zst", f"{DAY}-0001.ndjson.zst", "2024-07-01-0000.ndjson.zst"]
+    assert FeedArchive(archive.path).get_page("https://a.bandcamp.com/album/b")["body"] == "b"
+
+
+class FakeResponse:
+    '''Stand-in for an aiohttp response'''
+
+    def __init__(self, status: int, body: bytes):
+        self.status = status
+        self.headers = {}
+        self.body = body
+
+    async def read(self) -> bytes:
+        '''Returns the raw body'''
+        return self.body
+
+
+class FakeSession:
+    '''Stand-in for an aiohttp session, serving a fixed status and body for each url'''
+
+    def __init__(self, pages: dict):
+        self.pages = pages
+
+    @asynccontextmanager
+    async def get(self, url: str, **_kwargs):
+        '''Serves the page for a url'''
+        yield FakeResponse(*self.pages[url])
+
+
+@pytest.mark.asyncio
+async def test_recording_session_archives_pages(archive):  # pylint: disable=redefined-outer-name
+    '''Tests that found and missing pages are archived, and other responses are not'''
+    session = archive.recording(FakeSession({
+        "https://a.bandcamp.com/album/a": (200, b"<html>a</html>"),
+        "https://a.bandcamp.com/album/gone": (404, b"gone"),
+        "https://a.bandcamp.com/album/busy": (503, b"busy"),
+    }))
+
+    assert await fetch_webpage(session, "https://a.bandcamp.com/album/a", 10) == "<html>a</html>"
+    for url in ("https://a.bandcamp.com/album/gone", "https://a.bandcamp.com/album/busy"):
+        async with session.get(url) as response:
+            await response.read()
+
+    assert archive.records_written == 2
+    assert archive.get_page("https://a.bandcamp.com/album/gone")["status"] == 404
+    assert archive.get_page("https://a.bandcamp.com/album/busy") is None
+
+
+@pytest.mark.asyncio
+async def test_replay_session(archive):  # pylint: disable=redefined-outer-name
+    '''Tests that archived pages are served and missing pages are counted'''
+    archive.write_page("https://a.bandcamp.com/album/a", 200, b"<html>a</html>")
+    session = ReplaySession(archive)
+
+    assert await fetch_webpage(session, "https://a.bandcamp.com/album/a", 10) == "<html>a</html>"
+    assert await fetch_webpage(session, "https://a.bandcamp.com/album/b", 10) is None
+    assert session.misses == 1
+
+
+@pytest.mark.asyncio
+async def test_extract_records_pages(archive):  # pylint: disable=redefined-outer-name
+    '''Tests that the pages scraped by a run are written to the archive'''
+    html = (FIXTURES / "album.html").read_bytes()
+    session = FakeSession({"https://artist.bandcamp.com/album/a": (200, html)})
+
+    items = await extract_list_of_items([make_event(DAY_START)], session=session,
+                                        archive=archive)
+
+    assert items[0]["album_tags"][0] == "ambient"
+    assert archive.get_page("https://artist.bandcamp.com/album/a")["body"] == html.decode()
+
+
+def test_replay_sales_data(tmp_path):
+    '''Tests that a day of archived feed and pages is scraped again without the network'''
+    archive = FeedArchive(tmp_path / "archive", retention_days=0)
+    archive.write_feed("https://feed/get_initial", None, {"feed_data": {"events": [
+        make_event(DAY_START + 10),
+        make_event(DAY_START + 20, "//artist.bandcamp.com/album/unarchived")]}},
+                       fetched_at=DAY_START + 60)
+    archive.write_feed("https://feed/get_initial", None, {"feed_data": {"events": [
+        make_event(DAY_END - 10), make_event(DAY_END + 10)]}}, fetched_at=DAY_END + 60)
+    archive.write_page("https://artist.bandcamp.com/album/a", 200,
+                       (FIXTURES / "album.html").read_bytes(), fetched_at=DAY_START - 60)
+    archive.close()
+
+    items = replay_sales_data(DAY, tmp_path / "archive")
+
+    assert [item["utc_date"] for item in items] == [DAY_START + 10, DAY_START + 20,
+                                                    DAY_END - 10]
+    assert items[0]["album_tags"][-1] == "United Kingdom"
+    assert items[1]["album_tags"] is None
+
+
+def test_write_errors_are_logged_not_raised(archive):  # pylint: disable=redefined-outer-name
+    '''Tests that a record that cannot be written is skipped without failing the run'''
+    with patch("builtins.open", side_effect=OSError("No space left on device")):
+        archive.write_page("https://a.bandcamp.com/album/a", 200, b"a", fetched_at=DAY_START)
+
+    assert archive.write_errors == 1
+    assert archive.records_written == 0
+    assert archive.get_page("https://a.bandcamp.com/album/a") is None
+
+
+def test_prune_deletes_old_segments(tmp_path):
+    '''Tests that segments past the retention period are deleted with their index entries'''
+    archive = FeedArchive(tmp_path / "archive", retention_days=1)
+    archive.write_page("https://a.bandcamp.com/album/a", 200, b"a", fetched_at=DAY_START)
+    archive.write_page("https://a.bandcamp.com/album/b", 200, b"b", fetched_at=DAY_END)
+
+    assert archive.prune(now=DAY_END + 86400) == 1
+    assert archive.get_page("https://a.bandcamp.com/album/a") is None
+    assert archive.get_page("https://a.bandcamp.com/album/b")["body"] == "b"
+    archive.close()
+
+
+def test_open_archive(tmp_path):
+    '''Tests that the archive is off without a path, or if it cannot be opened'''
+    (tmp_path / "file").write_text("not a directory")
+
+    assert open_archive(None) is None
+    assert open_archive(tmp_path / "file" / "archive") is None
+    archive = open_archive(tmp_path / "archive")
+    assert archive is not None
+    archive.close()
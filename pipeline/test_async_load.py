@@ -0,0 +1,112 @@
+"""Tests for the asynchronous pipelined load script."""
+
+import pytest
+from async_load import (
+    async_load_sales_batch,
+    get_loadable_sales,
+    insert_sales_in_pipeline,
+)
+from load import (
+    CREATE_PENDING_SALES_ROLLUP,
+    DEFER_SALE,
+    FLUSH_SALES_ROLLUPS,
+    INSERT_ALBUM_PURCHASE,
+    INSERT_REJECTED_SALE,
+    INSERT_TRACK_PURCHASE,
+    PURCHASE_COUNTS,
+    UPSERT_TAG,
+)
+from conftest import PURCHASES, get_async_statements, get_mock_async_connection
+
+
+@pytest.fixture
+def sales_data():
+    """Pytest fixture of transformed album, track and single sales."""
+    base = {
+        "utc_date": "2024-06-30 12:00:00",
+        "artist_name": "Artist Name",
+        "artist_url": "https://artist.bandcamp.com",
+        "amount_paid_usd": 10.0,
+        "country": "United Kingdom",
+        "feed_item": {"utc_date": 1719748800.0},
+    }
+    return [
+        {**base, "item_type": "a", "item_description": "Album Title",
+         "url": "https://artist.bandcamp.com/album/a", "album_tags": ["rock", ""]},
+        {**base, "item_type": "t", "item_description": "Track Title",
+         "url": "https://artist.bandcamp.com/track/t", "album_title": "Album Title",
+         "album_url": "https://artist.bandcamp.com/album/a", "track_tags": ["rock", "pop"]},
+        {**base, "item_type": "s", "item_description": "Single Title",
+         "url": "https://artist.bandcamp.com/track/s", "track_tags": ["pop"]},
+    ]
+
+
+def test_get_loadable_sales(sales_data):  # pylint: disable=redefined-outer-name
+    """Tests that sales are kept with their kind, sales missing scraped fields
+    deferred, and sales that are never loaded skipped."""
+    untitled_track = {**sales_data[1], "album_title": None}
+    untagged_album = {**sales_data[0], "album_tags": []}
+
+    loadable, deferred = get_loadable_sales(sales_data + [untitled_track, untagged_album])
+
+    assert [kind for kind, _ in loadable] == ["album", "track", "single"]
+    assert [params[3] for params in deferred] == ["missing album_tags"]
+
+
+@pytest.mark.asyncio
+async def test_insert_sales_in_pipeline(sales_data):  # pylint: disable=redefined-outer-name
+    """Tests that a chunk is sent in four pipelined rounds, each dimension
+    upserted once, and that a cached chunk only sends its purchases."""
+    connection = get_mock_async_connection()
+    sales, _ = get_loadable_sales(sales_data)
+
+    await insert_sales_in_pipeline(connection, sales)
+
+    statements = get_async_statements(connection)
+    assert connection.pipeline.call_count == 4
+    assert statements.count(UPSERT_TAG) == 2
+    assert sum(statements.count(query) for query in PURCHASES) == 3
+    assert len(statements) == 14
+
+    connection.execute.reset_mock()
+    connection.pipeline.reset_mock()
+    await insert_sales_in_pipeline(connection, sales)
+
+    assert connection.pipeline.call_count == 1
+    assert get_async_statements(connection) == [INSERT_ALBUM_PURCHASE, INSERT_TRACK_PURCHASE,
+                                                INSERT_TRACK_PURCHASE]
+
+
+@pytest.mark.asyncio
+async def test_async_load_sales_batch_commits(sales_data):  # pylint: disable=redefined-outer-name
+    """Tests that a chunk that loads is committed once, counting its purchases
+    and the sales it deferred."""
+    connection = get_mock_async_connection()
+    untagged_single = {**sales_data[2], "track_tags": []}
+
+    assert await async_load_sales_batch(connection, sales_data + [untagged_single])
+
+    connection.commit.assert_awaited_once()
+    connection.rollback.assert_not_awaited()
+    statements = get_async_statements(connection)
+    assert statements[0] == CREATE_PENDING_SALES_ROLLUP
+    assert statements[-2:] == [DEFER_SALE, FLUSH_SALES_ROLLUPS]
+    assert PURCHASE_COUNTS == {"inserted": 3, "duplicates": 0, "rejected": 0, "deferred": 1}
+
+
+@pytest.mark.asyncio
+async def test_async_load_sales_batch_rejects_failed_sale(sales_data):  # pylint: disable=redefined-outer-name
+    """Tests that a failed chunk is loaded again sale by sale, rejecting the
+    sale that fails and committing the rest."""
+    connection = get_mock_async_connection(failing_amount=99.0)
+    sales_data[1]["amount_paid_usd"] = 99.0
+
+    assert await async_load_sales_batch(connection, sales_data)
+
+    statements = get_async_statements(connection)
+    connection.rollback.assert_awaited_once()
+    assert statements.count("SAVEPOINT sale") == 3
+    assert statements.count("ROLLBACK TO SAVEPOINT sale") == 1
+    assert statements.count(INSERT_REJECTED_SALE) == 1
+    connection.commit.assert_awaited_once()
+    assert PURCHASE_COUNTS == {"inserted": 2, "duplicates": 0, "rejected": 1, "deferred": 0}
@@ -0,0 +1,126 @@
+"""Tests for the bulk load script."""
+
+from unittest.mock import MagicMock, patch
+import pytest
+from load import CREATE_PENDING_SALES_ROLLUP, DEFER_SALE, FLUSH_SALES_ROLLUPS
+from bulk_load import (
+    CREATE_STAGING_TABLES,
+    INSERT_PURCHASES,
+    RESOLVE_DIMENSIONS,
+    bulk_load_sales_batch,
+    escape_copy_value,
+    get_copy_buffer,
+    get_staging_rows,
+    insert_sales_in_bulk,
+)
+
+
+@pytest.fixture
+def sales_data():
+    """Pytest fixture of transformed album, track and single sales."""
+    base = {
+        "utc_date": "2024-06-30 12:00:00",
+        "artist_name": "Artist Name",
+        "artist_url": "https://artist.bandcamp.com",
+        "amount_paid_usd": 10.0,
+        "country": "United Kingdom",
+        "feed_item": {"utc_date": 1719748800.0},
+    }
+    return [
+        {**base, "item_type": "a", "item_description": "Album Title",
+         "url": "https://artist.bandcamp.com/album/a", "album_tags": ["rock", "rock", ""]},
+        {**base, "item_type": "t", "item_description": "Track Title",
+         "url": "https://artist.bandcamp.com/track/t", "album_title": "Album Title",
+         "album_url": "https://artist.bandcamp.com/album/a", "track_tags": ["pop"]},
+        {**base, "item_type": "t", "item_description": "Single Title", "album_title": None,
+         "url": "https://artist.bandcamp.com/track/s", "track_tags": ["pop"]},
+        {**base, "item_type": "s", "item_description": "Single Title",
+         "url": "https://artist.bandcamp.com/track/s", "track_tags": ["jazz"]},
+        {**base, "item_type": "a", "item_description": "Untagged",
+         "url": "https://artist.bandcamp.com/album/u", "album_tags": []},
+    ]
+
+
+def test_get_staging_rows(sales_data):  # pylint: disable=redefined-outer-name
+    """Tests that sales are staged as insert_sale would load them."""
+    sale_rows, tag_rows, deferred_rows = get_staging_rows(sales_data)
+
+    assert [(row[0], row[1]) for row in sale_rows] == [(0, "album"), (1, "track"),
+                                                       (3, "single")]
+    assert sale_rows[0][5:9] == ("Album Title", "https://artist.bandcamp.com/album/a",
+                                 None, None)
+    assert sale_rows[1][5:9] == ("Album Title", "https://artist.bandcamp.com/album/a",
+                                 "Track Title", "https://artist.bandcamp.com/track/t")
+    assert sale_rows[2][5:9] == (None, None, "Single Title",
+                                 "https://artist.bandcamp.com/track/s")
+    assert tag_rows == [(0, "rock"), (1, "pop"), (3, "jazz")]
+    assert [(row[1], row[3]) for row in deferred_rows] == [
+        ("https://artist.bandcamp.com/album/u", "missing album_tags")]
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, "\\N"),
+    (10.5, "10.5"),
+    ("tab\there", "tab\\there"),
+    ("new\nline", "new\\nline"),
+    ("back\\slash", "back\\\\slash"),
+])
+def test_escape_copy_value(value, expected):
+    """Tests that values are escaped for COPY's text format."""
+    assert escape_copy_value(value) == expected
+
+
+def test_get_copy_buffer():
+    """Tests that rows are written one per line with tab separated columns."""
+    assert get_copy_buffer([(1, "a", None), (2, "b", "c")]).read() == \
+        "1\ta\t\\N\n2\tb\tc\n"
+
+
+def test_insert_sales_in_bulk(sales_data):  # pylint: disable=redefined-outer-name
+    """Tests that a batch takes a fixed number of statements, whatever its size."""
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = (1, 2)
+
+    assert insert_sales_in_bulk(mock_cursor, sales_data * 100) == 3
+
+    statements = [call.args[0] for call in mock_cursor.execute.call_args_list]
+    assert statements[0] == CREATE_STAGING_TABLES
+    assert statements[1] == CREATE_PENDING_SALES_ROLLUP
+    assert statements[3:] == RESOLVE_DIMENSIONS + [INSERT_PURCHASES, FLUSH_SALES_ROLLUPS]
+    assert mock_cursor.copy_expert.call_count == 2
+    assert mock_cursor.copy_expert.call_args_list[0].args[0].startswith(
+        "COPY staging_sale (sale_index, kind,")
+    mock_cursor.executemany.assert_called_once()
+    assert mock_cursor.executemany.call_args.args[0] == DEFER_SALE
+
+
+def test_insert_sales_in_bulk_empty():
+    """Tests that nothing is executed when no sale can be loaded."""
+    mock_cursor = MagicMock()
+    assert insert_sales_in_bulk(mock_cursor, []) == 0
+    mock_cursor.execute.assert_not_called()
+
+
+@pytest.mark.parametrize("committed", [True, False])
+def test_bulk_load_falls_back(sales_data, committed):  # pylint: disable=redefined-outer-name
+    """Tests that a failed batch is rolled back and loaded again sale by sale,
+    reporting whether that was committed."""
+    mock_connection = MagicMock()
+    mock_cursor = mock_connection.cursor.return_value.__enter__.return_value
+    mock_cursor.copy_expert.side_effect = Exception("copy failed")
+
+    with patch("bulk_load.load_sales_batch", return_value=committed) as mock_load:
+        assert bulk_load_sales_batch(mock_connection, sales_data) is committed
+    mock_connection.rollback.assert_called_once()
+    mock_connection.commit.assert_not_called()
+    mock_load.assert_called_once_with(mock_connection, sales_data)
+
+
+def test_bulk_load_sales_batch_commits(sales_data):  # pylint: disable=redefined-outer-name
+    """Tests that a successful batch is committed."""
+    mock_connection = MagicMock()
+    mock_cursor = mock_connection.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchone.return_value = (1, 2)
+
+    assert bulk_load_sales_batch(mock_connection, sales_data)
+    mock_connection.commit.assert_called_once()
@@ -0,0 +1,141 @@
+"""Tests for the run coordination script."""
+
+from unittest.mock import MagicMock, patch
+import pytest
+from coordination import (
+    COMPLETE_WORK_ITEMS,
+    ENQUEUE_WORK_ITEM,
+    FEED_LOCK_ID,
+    LEASE_WORK_ITEMS,
+    MARK_DEAD_WORK_ITEMS,
+    MAX_WORK_ATTEMPTS,
+    RUN_LOCK_ID,
+    enqueue_feed_items,
+    fetch_feed_window,
+    get_work_item_key,
+    lease_work_items,
+    load_leased_items,
+    run_exclusively,
+)
+from conftest import get_mock_connection, get_statements
+from load import FEED_CURSOR_NAME, SAVE_FEED_CURSOR
+
+
+@pytest.fixture
+def feed_items():
+    """Pytest fixture of two raw items from the sales feed."""
+    return [{"url": "//artist.bandcamp.com/album/a", "item_type": "a", "utc_date": 1.0},
+            {"url": "//artist.bandcamp.com/track/t", "item_type": "t", "utc_date": 2.0}]
+
+
+def test_get_work_item_key(feed_items):  # pylint: disable=redefined-outer-name
+    """Tests that the same item gets the same key however its keys are ordered."""
+    reordered = dict(reversed(list(feed_items[0].items())))
+
+    assert get_work_item_key(reordered) == get_work_item_key(feed_items[0])
+    assert get_work_item_key(feed_items[0]) != get_work_item_key(feed_items[1])
+
+
+@patch("coordination.get_connection")
+def test_run_exclusively(mock_get_connection):
+    """Tests that a run is called under the run lock, which is then released."""
+    mock_get_connection.return_value = get_mock_connection(fetchone=[True])
+    run = MagicMock()
+
+    assert run_exclusively(run)
+
+    run.assert_called_once()
+    statements = get_statements(mock_get_connection.return_value)
+    assert statements == [("SELECT pg_try_advisory_lock(%s)", (RUN_LOCK_ID,)),
+                          ("SELECT pg_advisory_unlock(%s)", (RUN_LOCK_ID,))]
+    mock_get_connection.return_value.close.assert_called_once()
+
+
+@patch("coordination.get_connection")
+def test_run_exclusively_skips_when_locked(mock_get_connection):
+    """Tests that a run is skipped while another run holds the run lock."""
+    mock_get_connection.return_value = get_mock_connection(fetchone=[False])
+    run = MagicMock()
+
+    assert not run_exclusively(run)
+
+    run.assert_not_called()
+    mock_get_connection.return_value.close.assert_called_once()
+
+
+def test_enqueue_feed_items(feed_items):  # pylint: disable=redefined-outer-name
+    """Tests that every item is queued under its key, and the queue committed."""
+    connection = get_mock_connection(fetchone=[True])
+
+    assert enqueue_feed_items(connection, feed_items) == 2
+
+    statements = get_statements(connection)
+    assert [query for query, _ in statements[1:]] == [ENQUEUE_WORK_ITEM] * 2
+    assert statements[1][1][0] == get_work_item_key(feed_items[0])
+    connection.commit.assert_called_once()
+
+
+def test_enqueue_feed_items_saves_cursor(feed_items):  # pylint: disable=redefined-outer-name
+    """Tests that the feed cursor is saved in the transaction that queues the window."""
+    connection = get_mock_connection(fetchone=[True])
+
+    enqueue_feed_items(connection, feed_items, 5.0)
+
+    assert get_statements(connection)[-1] == (SAVE_FEED_CURSOR, (FEED_CURSOR_NAME, 5.0))
+    connection.commit.assert_called_once()
+
+
+@patch("coordination.get_new_feed_events")
+def test_fetch_feed_window_skips_when_locked(mock_get_new_feed_events):
+    """Tests that a worker leaves the feed to the worker already fetching it."""
+    connection = get_mock_connection(fetchone=[False])
+
+    assert fetch_feed_window(connection, False) is None
+
+    mock_get_new_feed_events.assert_not_called()
+    assert get_statements(connection) == [("SELECT pg_try_advisory_lock(%s)", (FEED_LOCK_ID,))]
+
+
+@patch("coordination.enqueue_feed_items", return_value=1)
+@patch("coordination.get_feed_cursor", return_value=4.0)
+@patch("coordination.get_new_feed_events")
+def test_fetch_feed_window(mock_get_new_feed_events, mock_get_feed_cursor,  # pylint: disable=unused-argument
+                           mock_enqueue_feed_items, feed_items):  # pylint: disable=redefined-outer-name
+    """Tests that the feed is queued with its new cursor under the feed lock."""
+    connection = get_mock_connection(fetchone=[True])
+    mock_get_new_feed_events.return_value = [
+        {"event_type": "sale", "utc_date": 5.0, "items": feed_items}]
+
+    assert fetch_feed_window(connection, True) == 1
+
+    mock_get_new_feed_events.assert_called_once_with(4.0, archive=None)
+    mock_enqueue_feed_items.assert_called_once_with(connection, feed_items, 5.0)
+    assert get_statements(connection)[-1] == ("SELECT pg_advisory_unlock(%s)", (FEED_LOCK_ID,))
+
+
+def test_lease_work_items(feed_items):  # pylint: disable=redefined-outer-name
+    """Tests that leased items are returned and their lease committed at once."""
+    connection = get_mock_connection(fetchall=[(1, feed_items[0])])
+
+    assert lease_work_items(connection, "worker", limit=10) == [(1, feed_items[0])]
+
+    statements = get_statements(connection)
+    assert statements[0] == (MARK_DEAD_WORK_ITEMS, {"max_attempts": MAX_WORK_ATTEMPTS})
+    query, params = statements[1]
+    assert query == LEASE_WORK_ITEMS
+    assert params["limit"] == 10
+    connection.commit.assert_called_once()
+
+
+@patch("coordination.transform_sales_data", side_effect=lambda sales: sales)
+@patch("coordination.load_sales_batch", return_value=True)
+def test_load_leased_items(mock_load_sales_batch, mock_transform_sales_data, feed_items):  # pylint: disable=redefined-outer-name,unused-argument
+    """Tests that leased items are marked done in the transaction that loads them."""
+    connection = get_mock_connection(fetchone=[True])
+    leased = [(1, feed_items[0]), (2, feed_items[1])]
+
+    assert load_leased_items(connection, "worker", leased, feed_items)
+
+    assert get_statements(connection) == [(COMPLETE_WORK_ITEMS, ([1, 2], "worker"))]
+    mock_load_sales_batch.assert_called_once_with(connection, feed_items)
+    connection.commit.assert_not_called()
@@ -1,8 +1,41 @@
 '''File used to test extract'''
 
-from unittest.mock import patch
+import asyncio
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from pathlib import Path
+import threading
+from unittest.mock import AsyncMock, MagicMock, patch
+from urllib.parse import parse_qs, urlparse
 import pytest
-from extract import insert_protocol_url, get_stem_url, extract_list_of_items
+from archive import FeedArchive
+import http_client
+from limiter import AdaptiveLimiter
+from scrape_cache import ScrapeCache
+from extract import (
+    insert_protocol_url,
+    get_stem_url,
+    extract_list_of_items,
+    stream_list_of_items,
+    extract_and_scrape_item,
+    PageNotFoundError,
+    SingleFlight,
+    extract_page_fields,
+    extract_page_fields_soup,
+    get_parse_executor,
+    scrape_page,
+    get_page_extractor,
+    PAGE_EXTRACTORS,
+    get_feed_events_since,
+    get_sales_data,
+)
+
+
+@pytest.fixture(autouse=True)
+def close_http_client():
+    '''Closes the shared http client after each test'''
+    yield
+    http_client.close()
 
 
 @pytest.mark.parametrize("url_string, expected", [
@@ -50,7 +83,8 @@ class TestExtractItems():
     ]
 
     # pylint: disable=unused-argument
-    async def mock_extract_and_scrape_item(self, sempahore, session, item, timeout):
+    async def mock_extract_and_scrape_item(self, sempahore, session, item, timeout,
+                                           **kwargs):
         '''Fake function to use'''
         if item["url"] == "https://example.com/a":
             return {"item_type": "a", "url": item["url"], "tags": ["tag1", "tag2"]}
@@ -61,7 +95,7 @@ class TestExtractItems():
     async def test_extract_list_of_items_base_case(self):
         '''Tests for normal case'''
         with patch('extract.extract_and_scrape_item', new=self.mock_extract_and_scrape_item):
-            items = await extract_list_of_items(self.event_list)
+            items = await extract_list_of_items(self.event_list, session=MagicMock())
             assert items == self.expected_items
 
     @pytest.mark.asyncio
@@ -70,11 +104,347 @@ class TestExtractItems():
         no_sales_data = [{"event_type": "not_a_sale", "items": [
             {"item_type": "a", "url": "https://example.com/a"}]}]
         with patch('extract.extract_and_scrape_item', new=self.mock_extract_and_scrape_item):
-            items = await extract_list_of_items(no_sales_data)
+            items = await extract_list_of_items(no_sales_data, session=MagicMock())
             assert items == []
 
     @pytest.mark.asyncio
     async def test_extract_list_of_items_empty_input(self):
         '''Test for empty input'''
-        items = await extract_list_of_items([])
+        items = await extract_list_of_items([], session=MagicMock())
         assert items == []
+
+    @pytest.mark.asyncio
+    async def test_stream_list_of_items(self):
+        '''Tests that every item is streamed, without scraping more than the
+        buffer size ahead of the consumer'''
+        started = []
+        event_list = [{"event_type": "sale", "items": [
+            {"item_type": "a", "url": f"https://example.com/{i}"}]} for i in range(6)]
+
+        async def fake_scrape(limiter, session, item, timeout, **kwargs):  # pylint: disable=unused-argument
+            started.append(item["url"])
+            return item
+
+        with patch('extract.extract_and_scrape_item', new=fake_scrape):
+            stream = stream_list_of_items(event_list, session=MagicMock(), buffer_size=2)
+            first = await anext(stream)
+            await asyncio.sleep(0.01)
+            assert len(started) == 2
+            items = [first] + [item async for item in stream]
+
+        assert sorted(item["url"] for item in items) == sorted(
+            event["items"][0]["url"] for event in event_list)
+
+
+class FakeSalesFeedHandler(BaseHTTPRequestHandler):
+    '''Local stand-in for the bandcamp salesfeed, paging by start_date'''
+
+    events = [{"event_type": "sale", "utc_date": float(date), "items": []}
+              for date in (100, 150, 200, 250, 300)]
+    page_size = 2
+    requested_start_dates = []
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        '''Serves the initial window or the page after the start_date cursor'''
+        url = urlparse(self.path)
+        if url.path.endswith("get_initial"):
+            body = {"feed_data": {"events": self.events[:2],
+                                  "end_date": 150}}
+        else:
+            start_date = int(parse_qs(url.query)["start_date"][0])
+            self.requested_start_dates.append(start_date)
+            page = [event for event in self.events
+                    if event["utc_date"] >= start_date][:self.page_size]
+            body = {"events": page,
+                    "end_date": page[-1]["utc_date"] if page else start_date}
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode())
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        '''Silences request logging'''
+
+
+@pytest.fixture
+def sales_feed_url():
+    '''Runs the fake sales feed on a local port'''
+    FakeSalesFeedHandler.requested_start_dates = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeSalesFeedHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/api/salesfeed/1"
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_feed_events_since_pages_forward(sales_feed_url):
+    '''Tests that only events after the cursor are returned, across pages'''
+    events = get_feed_events_since(150.0, f"{sales_feed_url}/get")
+
+    assert [event["utc_date"] for event in events] == [200.0, 250.0, 300.0]
+    assert FakeSalesFeedHandler.requested_start_dates == [150, 200, 250, 300]
+
+
+def test_get_feed_events_since_up_to_date(sales_feed_url):
+    '''Tests that nothing is returned when the cursor is at the head of the feed'''
+    assert get_feed_events_since(300.0, f"{sales_feed_url}/get") == []
+
+
+def test_get_sales_data_failed_feed():
+    '''Tests that a feed that cannot be fetched gives no sales and keeps the timestamp'''
+    with patch('extract.get_new_feed_events', return_value=None):
+        assert get_sales_data(100.0, cache_path=None) == ([], 100.0)
+
+
+def test_get_sales_data_incremental(sales_feed_url, tmp_path):
+    '''Tests that consecutive incremental runs, each given the timestamp the
+    last one returned, scrape each event exactly once'''
+    last_event_date = None
+    scraped = []
+
+    async def fake_extract_list_of_items(event_list, **kwargs):  # pylint: disable=unused-argument
+        scraped.extend(event["utc_date"] for event in event_list)
+        return event_list
+
+    with patch('extract.BANDCAMP_SALES_URL', f"{sales_feed_url}/get_initial"), \
+            patch('extract.BANDCAMP_SALES_NEXT_URL', f"{sales_feed_url}/get"), \
+            patch('extract.extract_list_of_items', new=fake_extract_list_of_items):
+        for _ in range(3):
+            _, last_event_date = get_sales_data(last_event_date, cache_path=None,
+                                                archive_path=tmp_path / "archive")
+
+    assert scraped == [100.0, 150.0, 200.0, 250.0, 300.0]
+    assert last_event_date == 300.0
+
+    archive = FeedArchive(tmp_path / "archive", retention_days=0)
+    assert archive.get_feed_events(0, float("inf")) == FakeSalesFeedHandler.events
+
+
+class TestScrapeCacheIntegration():
+    '''Class for scraping items through the scrape cache'''
+
+    @pytest.mark.asyncio
+    async def test_cached_item_skips_scrape(self, tmp_path):
+        '''Tests that a cached track is filled in without fetching its page'''
+        cache = ScrapeCache(tmp_path / "cache.sqlite3")
+        cache.set("https://example.com/track/t", ["tag1"],
+                  "https://example.com/album/a")
+        item = {"item_type": "t", "url": "//example.com/track/t",
+                "album_title": "A"}
+
+        with patch('extract.scrape_item', new=AsyncMock()) as mock_scrape_item:
+            item = await extract_and_scrape_item(None, None, item, 10, cache=cache)
+
+        mock_scrape_item.assert_not_called()
+        assert item["track_tags"] == ["tag1"]
+        assert item["album_url"] == "https://example.com/album/a"
+        assert cache.hits == 1
+
+    @pytest.mark.asyncio
+    async def test_scraped_item_is_cached(self, tmp_path):
+        '''Tests that a freshly scraped album is stored in the cache'''
+        cache = ScrapeCache(tmp_path / "cache.sqlite3")
+        item = {"item_type": "a", "url": "https://example.com/album/a"}
+
+        page = {"tags": ["tag1"], "album_href": None, "track_hrefs": None}
+        with patch('extract.scrape_page', new=AsyncMock(return_value=page)):
+            await extract_and_scrape_item(AdaptiveLimiter(), None, item, 10, cache=cache)
+
+        assert cache.get("https://example.com/album/a")["tags"] == ["tag1"]
+        assert cache.misses == 1
+
+    @pytest.mark.asyncio
+    async def test_album_page_resolves_its_tracks(self, tmp_path):
+        '''Tests that a later sale of a track listed on a scraped album page is
+        filled in from the album, without fetching the track page'''
+        cache = ScrapeCache(tmp_path / "cache.sqlite3")
+        html = (FIXTURES / "album.html").read_text(encoding="utf-8")
+        album = {"item_type": "a", "url": "//final1.bandcamp.com/album/infinite-guitar-2"}
+        track = {"item_type": "t", "album_title": "Infinite Guitar 2",
+                 "url": "https://final1.bandcamp.com/track/infinite-guitar-3"}
+
+        with patch('extract.fetch_webpage', new=AsyncMock(return_value=html)) as mock_fetch:
+            album = await extract_and_scrape_item(AdaptiveLimiter(), None, album, 10,
+                                                  cache=cache)
+            track = await extract_and_scrape_item(AdaptiveLimiter(), None, track, 10,
+                                                  cache=cache)
+
+        assert mock_fetch.await_count == 1
+        assert track["track_tags"] == album["album_tags"]
+        assert track["album_url"] == "https://final1.bandcamp.com/album/infinite-guitar-2"
+        assert cache.album_track_hits == 1
+
+    @pytest.mark.asyncio
+    async def test_missing_page_is_negatively_cached(self, tmp_path):
+        '''Tests that a 404 is remembered, so the page is not fetched again'''
+        cache = ScrapeCache(tmp_path / "cache.sqlite3")
+        item = {"item_type": "a", "url": "https://example.com/album/gone"}
+        mock_scrape_page = AsyncMock(side_effect=PageNotFoundError())
+
+        with patch('extract.scrape_page', new=mock_scrape_page):
+            first = await extract_and_scrape_item(AdaptiveLimiter(), None, dict(item),
+                                                  10, cache=cache)
+            second = await extract_and_scrape_item(AdaptiveLimiter(), None, dict(item),
+                                                   10, cache=cache)
+
+        assert first["album_tags"] is None
+        assert second["album_tags"] is None
+        assert mock_scrape_page.await_count == 1
+
+
+class TestSingleFlight():
+    '''Class for de-duplicating scrapes of the same page'''
+
+    @pytest.mark.asyncio
+    async def test_duplicates_share_one_scrape(self):
+        '''Tests that concurrent purchases of one track fetch its page once'''
+        items = [{"item_type": "t", "url": "//example.com/track/t", "album_title": None}
+                 for _ in range(5)]
+        single_flight = SingleFlight()
+        mock_scrape_page = AsyncMock(return_value={"tags": ["tag1"], "album_href": None, "track_hrefs": None})
+
+        with patch('extract.scrape_page', new=mock_scrape_page):
+            results = await asyncio.gather(*[
+                extract_and_scrape_item(AdaptiveLimiter(), None, item, 10,
+                                        single_flight=single_flight)
+                for item in items])
+
+        assert mock_scrape_page.await_count == 1
+        assert single_flight.saved_fetches == 4
+        assert all(result["track_tags"] == ["tag1"] for result in results)
+        assert results[0]["track_tags"] is not results[1]["track_tags"]
+
+    @pytest.mark.asyncio
+    async def test_different_pages_are_not_shared(self):
+        '''Tests that different urls are scraped separately'''
+        items = [{"item_type": "a", "url": f"https://example.com/album/{name}"}
+                 for name in ("a", "b")]
+        single_flight = SingleFlight()
+        mock_scrape_page = AsyncMock(return_value={"tags": ["tag1"], "album_href": None, "track_hrefs": None})
+
+        with patch('extract.scrape_page', new=mock_scrape_page):
+            await asyncio.gather(*[
+                extract_and_scrape_item(AdaptiveLimiter(), None, item, 10,
+                                        single_flight=single_flight)
+                for item in items])
+
+        assert mock_scrape_page.await_count == 2
+        assert single_flight.saved_fetches == 0
+
+    @pytest.mark.asyncio
+    async def test_duplicates_do_not_take_semaphore(self):
+        '''Tests that a waiting duplicate never acquires a semaphore slot'''
+        semaphore = asyncio.Semaphore(1)
+        single_flight = SingleFlight()
+        release = asyncio.Event()
+        acquisitions = []
+
+        async def slow_scrape():
+            async with semaphore:
+                acquisitions.append(1)
+                await release.wait()
+                return {"tags": ["tag1"], "album_url": None, "not_found": False}
+
+        first = asyncio.ensure_future(single_flight.run(("url", False), slow_scrape))
+        duplicate = asyncio.ensure_future(single_flight.run(("url", False), slow_scrape))
+        await asyncio.sleep(0)
+        release.set()
+
+        assert (await first) == (await duplicate)
+        assert len(acquisitions) == 1
+
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+@pytest.mark.parametrize("fixture, expected", [
+    ("track_with_album.html", {
+        "tags": ["electronic", "street soul", "downtempo", "Sydney"],
+        "album_href": "/album/pt002-foam-ep", "track_hrefs": None}),
+    ("single.html", {
+        "tags": ["alternative", "acoustic punk", "indie", "indie folk",
+                 "singer-songwriter", "Belfast"],
+        "album_href": None, "track_hrefs": None}),
+    ("track_without_tags.html", {"tags": None, "album_href": "/album/sketches",
+                                 "track_hrefs": None}),
+    ("album.html", {
+        "tags": ["ambient", "experimental", "industrial", "noise",
+                 "power electronics", "United Kingdom"],
+        "album_href": None,
+        "track_hrefs": [f"/track/infinite-guitar-{number}" for number in range(1, 9)]}),
+])
+def test_extract_page_fields(fixture, expected):
+    '''Tests that tags, the album link and track links are pulled from one parse of a page'''
+    html = (FIXTURES / fixture).read_text(encoding="utf-8")
+    assert extract_page_fields(html) == expected
+
+
+EDGE_CASE_PAGES = [
+    '<div class="tralbum-tags"><a class="tag">a &amp; b</a><a class="tag big">c</a></div>',
+    '<div class="tralbum-tags"><a class="tag"><span>nested</span> text</a></div>',
+    '<a class="tags">not a tag</a><div class="x tralbum-tags"><div><a class="tag">x</a></div></div>',
+    '<a id="buyAlbumLink" href="">Buy</a><a class="tag">only</a>',
+    '<a id="buyAlbumLink" href="/album/first">Buy</a><a id="buyAlbumLink" href="/album/second">',
+    '<A CLASS="tag" HREF="/x">Upper</A>',
+    '<p>no fields at all</p>',
+    '<table id="track_table"><tr><td><div class="title"><a href="/track/a">A</a>'
+    '<a href="/track/a">again</a></div></td></tr><tr><td><div class="info_link">'
+    '<a href="/track/info">info</a></div><div class="title x"><div><a href="https://y.com/track/b">'
+    '</a></div></div></td></tr></table><div class="title"><a href="/track/outside"></a></div>',
+    '<table id="track_table"><tr><td><table><tr><td></td></tr></table>'
+    '<div class="title"><a href="">empty</a><a href="/track/c">C</a></div></td></tr></table>',
+    '',
+]
+CORPUS = [(FIXTURES / name).read_text(encoding="utf-8")
+          for name in sorted(path.name for path in FIXTURES.glob("*.html"))] + EDGE_CASE_PAGES
+
+
+@pytest.mark.parametrize("backend", sorted(PAGE_EXTRACTORS))
+@pytest.mark.parametrize("html", CORPUS)
+def test_extractor_backends_match_soup(backend, html):
+    '''Tests that every extractor backend gives identical output to BeautifulSoup'''
+    assert PAGE_EXTRACTORS[backend](html) == extract_page_fields_soup(html)
+
+
+def test_get_page_extractor_falls_back():
+    '''Tests that an unavailable backend falls back to the tokenizer'''
+    assert get_page_extractor("missing") is PAGE_EXTRACTORS["tokenizer"]
+
+
+@pytest.mark.asyncio
+async def test_track_with_album_is_fetched_once():
+    '''Tests that a track on an album is filled in from a single page fetch'''
+    html = (FIXTURES / "track_with_album.html").read_text(encoding="utf-8")
+    item = {"item_type": "t", "album_title": "PT002 - Foam EP",
+            "url": "//planettriprecords.bandcamp.com/track/foam-streetside-mix"}
+
+    with patch('extract.fetch_webpage', new=AsyncMock(return_value=html)) as mock_fetch:
+        item = await extract_and_scrape_item(AdaptiveLimiter(), None, item, 10)
+
+    assert mock_fetch.await_count == 1
+    assert item["track_tags"] == ["electronic", "street soul", "downtempo", "Sydney"]
+    assert item["album_url"] == "https://planettriprecords.bandcamp.com/album/pt002-foam-ep"
+
+
+def test_get_parse_executor_disabled():
+    '''Tests that no executor is created when parsing stays on the event loop'''
+    assert get_parse_executor(0) is None
+
+
+@pytest.mark.asyncio
+async def test_scrape_page_in_parse_executor():
+    '''Tests that a page parsed in a worker process gives the same fields'''
+    html = (FIXTURES / "track_with_album.html").read_text(encoding="utf-8")
+    mock_fetch = AsyncMock(return_value=html.encode("utf-8"))
+
+    executor = get_parse_executor(1)
+    try:
+        with patch('extract.fetch_webpage', new=mock_fetch):
+            page = await scrape_page(None, "https://example.com/track/t", 10, executor)
+    finally:
+        executor.shutdown()
+
+    assert mock_fetch.await_args.kwargs["as_bytes"]
+    assert page == extract_page_fields_soup(html)
@@ -0,0 +1,107 @@
+'''Tests for the shared http client'''
+
+import asyncio
+import gzip
+
+from aiohttp import web
+import brotli
+import pytest
+
+import http_client
+
+
+@pytest.fixture(autouse=True)
+def close_http_client():
+    '''Closes the shared http client after each test'''
+    yield
+    http_client.close()
+
+
+@pytest.fixture
+def feed_server():
+    '''Runs a local feed on the shared event loop, recording the client port and
+    Accept-Encoding header of every request'''
+    requests = []
+
+    async def serve_feed(request: web.Request) -> web.Response:
+        requests.append({"port": request.transport.get_extra_info("peername")[1],
+                         "accept_encoding": request.headers.get("Accept-Encoding")})
+        body = b'{"feed_data": {"events": []}}'
+        if request.query.get("encoding") == "br":
+            return web.Response(body=brotli.compress(body),
+                                headers={"Content-Encoding": "br"})
+        if request.query.get("encoding") == "gzip":
+            return web.Response(body=gzip.compress(body),
+                                headers={"Content-Encoding": "gzip"})
+        if request.query.get("status"):
+            return web.Response(status=int(request.query["status"]))
+        return web.Response(body=body)
+
+    app = web.Application()
+    app.router.add_get("/feed", serve_feed)
+    runner = web.AppRunner(app)
+    http_client.run(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    http_client.run(site.start())
+    port = site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+
+    yield f"http://127.0.0.1:{port}/feed", requests
+    http_client.run(runner.cleanup())
+
+
+def test_session_is_reused_across_runs(feed_server):
+    '''Tests that separate invocations share one session and one connection'''
+    url, requests = feed_server
+    session = http_client.run(http_client.get_session())
+
+    for _ in range(3):
+        assert http_client.run(http_client.get_json(url, 10)) == {
+            "feed_data": {"events": []}}
+
+    assert http_client.run(http_client.get_session()) is session
+    assert len({request["port"] for request in requests}) == 1
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "br"])
+def test_compressed_responses_are_decoded(feed_server, encoding):
+    '''Tests that compression is negotiated and compressed bodies are decoded'''
+    url, requests = feed_server
+
+    body = http_client.run(http_client.get_json(url, 10, params={"encoding": encoding}))
+
+    assert body == {"feed_data": {"events": []}}
+    assert encoding in requests[0]["accept_encoding"]
+
+
+def test_get_json_non_200(feed_server):
+    '''Tests that an error status returns None'''
+    url, _ = feed_server
+    assert http_client.run(http_client.get_json(url, 10, params={"status": 503})) is None
+
+
+def test_session_is_replaced_on_a_new_loop():
+    '''Tests that a session is not reused on a different event loop, and that
+    the session it replaces is closed, or detached once its loop is closed'''
+    first = http_client.run(http_client.get_session())
+    second = asyncio.run(http_client.get_session())
+    assert second is not first
+    assert not second.closed
+
+    third = http_client.run(http_client.get_session())
+
+    assert third is not second
+    assert first.closed
+    assert second.closed
+    assert not third.closed
+
+
+def test_close_closes_session_and_loop():
+    '''Tests that closing the client closes the session and its event loop'''
+    loop = http_client.get_event_loop()
+    session = http_client.run(http_client.get_session())
+
+    http_client.close()
+
+    assert session.closed
+    assert loop.is_closed()
+    assert http_client.get_event_loop() is not loop
@@ -0,0 +1,247 @@
+'''Tests for the adaptive concurrency limiter'''
+
+import asyncio
+from unittest.mock import patch
+
+import aiohttp
+from aiohttp import web
+import pytest
+
+from extract import fetch_webpage
+from limiter import AdaptiveLimiter, is_throttling_status, parse_retry_after
+
+
+@pytest.mark.parametrize("header_value, expected", [
+    ("5", 5),
+    ("0.5", 0.5),
+    ("-3", 0),
+    ("Wed, 21 Oct 2015 07:28:00 GMT", 0),
+    ("soon", None),
+    (None, None),
+])
+def test_parse_retry_after(header_value, expected):
+    '''Tests that Retry-After is read in seconds, or as a date in the past'''
+    assert parse_retry_after(header_value) == expected
+
+
+@pytest.mark.parametrize("status, expected", [
+    (200, False), (404, False), (429, True), (500, True), (503, True)])
+def test_is_throttling_status(status, expected):
+    '''Tests which statuses cut the concurrency limit'''
+    assert is_throttling_status(status) == expected
+
+
+def test_additive_increase():
+    '''Tests that a full window of successes raises the limit by one'''
+    limiter = AdaptiveLimiter(initial=4, maximum=10)
+    for _ in range(4):
+        limiter.record_success()
+    assert limiter.concurrency == 4
+    limiter.record_success()
+    assert limiter.concurrency == 5
+
+
+def test_increase_is_capped():
+    '''Tests that the limit never rises above the maximum'''
+    limiter = AdaptiveLimiter(initial=2, maximum=3)
+    for _ in range(50):
+        limiter.record_success()
+    assert limiter.limit == 3
+
+
+def test_multiplicative_decrease_once_per_cooldown():
+    '''Tests that a burst of throttled responses only halves the limit once'''
+    limiter = AdaptiveLimiter(initial=8, minimum=1)
+    for _ in range(5):
+        limiter.record_throttle()
+
+    assert limiter.concurrency == 4
+    assert limiter.throttled == 5
+    assert limiter.throttle_rate == 1
+
+
+def test_decrease_is_floored():
+    '''Tests that the limit never drops below the minimum'''
+    limiter = AdaptiveLimiter(initial=2, minimum=1)
+    with patch("limiter.DECREASE_COOLDOWN_SECONDS", 0):
+        for _ in range(5):
+            limiter.record_throttle()
+    assert limiter.limit == 1
+
+
+def test_backoff_delay_has_jitter_and_honours_retry_after():
+    '''Tests that backoff is jittered and never shorter than Retry-After'''
+    limiter = AdaptiveLimiter()
+    delays = {limiter.backoff_delay(2) for _ in range(20)}
+
+    assert all(2 <= delay <= 4 for delay in delays)
+    assert len(delays) > 1
+    assert limiter.backoff_delay(0, retry_after=30) == 30
+
+
+@pytest.mark.asyncio
+async def test_acquire_waits_for_a_permit():
+    '''Tests that no more requests than the limit are let through at once'''
+    limiter = AdaptiveLimiter(initial=2)
+    await limiter.acquire()
+    await limiter.acquire()
+
+    waiting = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+
+    await limiter.release()
+    await asyncio.wait_for(waiting, 1)
+    assert limiter.in_flight == 2
+
+
+@pytest.mark.asyncio
+async def test_backoff_gives_back_the_permit():
+    '''Tests that a request backing off lets another through, then takes a permit again'''
+    limiter = AdaptiveLimiter(initial=1)
+    await limiter.acquire()
+
+    backing_off = asyncio.ensure_future(limiter.backoff(0.05))
+    await asyncio.sleep(0.01)
+    await asyncio.wait_for(limiter.acquire(), 0.02)
+    await limiter.release()
+
+    await asyncio.wait_for(backing_off, 1)
+    assert limiter.in_flight == 1
+
+
+@pytest.mark.asyncio
+async def test_retry_after_pauses_new_requests():
+    '''Tests that a Retry-After holds back new requests until it has passed'''
+    limiter = AdaptiveLimiter(initial=4)
+    limiter.record_throttle(retry_after=0.1)
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    async with limiter:
+        waited = loop.time() - start
+
+    assert waited >= 0.09
+
+
+def create_throttling_app(capacity: int) -> web.Application:
+    '''Creates a server that answers 429 whenever more than capacity requests are in flight'''
+    state = {"in_flight": 0}
+
+    async def serve_page(_request: web.Request) -> web.Response:
+        state["in_flight"] += 1
+        try:
+            if state["in_flight"] > capacity:
+                return web.Response(status=429, headers={"Retry-After": "0.01"})
+            await asyncio.sleep(0.01)
+            return web.Response(text="<html></html>", content_type="text/html")
+        finally:
+            state["in_flight"] -= 1
+
+    app = web.Application()
+    app.router.add_get("/{name}", serve_page)
+    return app
+
+
+@pytest.mark.asyncio
+async def test_limiter_adapts_to_throttling_server():
+    '''Tests that the limiter converges on the capacity of a throttling server
+    and that every request still gets through'''
+    runner = web.AppRunner(create_throttling_app(capacity=4))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+
+    limiter = AdaptiveLimiter(initial=12, maximum=32)
+
+    async def fetch(session, name):
+        async with limiter:
+            return await fetch_webpage(session, f"http://127.0.0.1:{port}/{name}", 10,
+                                       limiter=limiter)
+
+    try:
+        with patch("limiter.BASE_BACKOFF_SECONDS", 0.01), \
+                patch("limiter.DECREASE_COOLDOWN_SECONDS", 0.02), \
+                patch("extract.MAXIMUM_FETCH_ATTEMPTS", 20):
+            async with aiohttp.ClientSession() as session:
+                pages = await asyncio.gather(*[fetch(session, i) for i in range(200)])
+    finally:
+        await runner.cleanup()
+
+    assert all(page is not None for page in pages)
+    assert limiter.throttled > 0
+    assert limiter.concurrency <= 8
+    assert limiter.throttle_rate < 0.5
+
+
+@pytest.mark.asyncio
+async def test_only_successes_raise_the_limit():
+    '''Tests that pages that are missing or forbidden do not raise the limit'''
+    async def serve_page(request: web.Request) -> web.Response:
+        return web.Response(status=int(request.match_info["status"]), text="<html></html>",
+                            content_type="text/html")
+
+    app = web.Application()
+    app.router.add_get("/{status}", serve_page)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+
+    limiter = AdaptiveLimiter(initial=1, maximum=4)
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with limiter:
+                assert await fetch_webpage(session, f"http://127.0.0.1:{port}/200", 10,
+                                           limiter=limiter) == "<html></html>"
+                assert await fetch_webpage(session, f"http://127.0.0.1:{port}/403", 10,
+                                           limiter=limiter) is None
+    finally:
+        await runner.cleanup()
+
+    assert limiter.requests == 1
+    assert limiter.limit == 2
+
+
+@pytest.mark.asyncio
+async def test_throttled_response_is_released_before_backing_off():
+    '''Tests that a throttled response gives its connection back to the pool
+    before backing off, so other requests are not starved of it meanwhile'''
+    statuses = iter([429])
+
+    async def serve_page(_request: web.Request) -> web.Response:
+        status = next(statuses, 200)
+        # A throttled body too large to be read with its headers keeps its connection
+        text = "<html></html>" if status == 200 else "x" * 2 ** 22
+        return web.Response(status=status, text=text, content_type="text/html")
+
+    app = web.Application()
+    app.router.add_get("/{name}", serve_page)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+
+    limiter = AdaptiveLimiter(initial=1, maximum=4)
+    statuses_while_backing_off = []
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=1)) as session:
+            async def backoff(_delay: float) -> None:
+                async def fetch_other_page() -> int:
+                    async with session.get(f"http://127.0.0.1:{port}/other") as response:
+                        return response.status
+                statuses_while_backing_off.append(
+                    await asyncio.wait_for(fetch_other_page(), 1))
+
+            with patch.object(limiter, "backoff", new=backoff):
+                async with limiter:
+                    assert await fetch_webpage(session, f"http://127.0.0.1:{port}/page", 10,
+                                               limiter=limiter) == "<html></html>"
+    finally:
+        await runner.cleanup()
+
+    assert statuses_while_backing_off == [200]
+    assert limiter.throttled == 1
@@ -1,11 +1,40 @@
 """Tests for the load script."""
 
+from itertools import count
+import json
 from unittest.mock import MagicMock, call, patch
 import os
 import psycopg2
+import pytest
 from load import (
+    CREATE_PENDING_SALES_ROLLUP,
+    DEFER_SALE,
+    DIMENSION_CACHES,
+    FLUSH_SALES_ROLLUPS,
+    PURCHASE_COUNTS,
+    SAVE_FEED_CURSOR,
+    INSERT_ALBUM_PURCHASE,
+    INSERT_ALBUM_TAG_ASSIGNMENT,
+    INSERT_REJECTED_SALE,
+    INSERT_TRACK_PURCHASE,
+    INSERT_TRACK_TAG_ASSIGNMENT,
+    UPSERT_ALBUM,
+    UPSERT_ARTIST,
+    UPSERT_COUNTRY,
+    UPSERT_TAG,
+    UPSERT_TRACK,
+    DimensionCache,
+    advance_feed_cursor,
+    commit_purchase_counts,
+    get_purchase_key,
+    log_purchase_stats,
+    rollback_purchase_counts,
+    load_sales_batch,
+    load_sales_data,
+    warm_dimension_caches,
     get_connection,
     get_cursor,
+    get_feed_cursor,
     get_or_insert_artist,
     get_or_insert_country,
     get_or_insert_album,
@@ -50,235 +79,189 @@ def test_get_cursor(mock_get_connection):
 
 
 @patch("load.get_cursor")
-def test_get_or_insert_artist_existing(mock_get_cursor):
-    """Test case for get_or_insert_artist with existing artist."""
+def test_get_or_insert_artist(mock_get_cursor):
+    """Test case for get_or_insert_artist, in a single upsert."""
     mock_cursor = MagicMock()
     mock_get_cursor.return_value = mock_cursor
     mock_cursor.fetchone.return_value = [1]
     artist_id = get_or_insert_artist(mock_cursor, "artist_name", "artist_url")
     assert artist_id == 1
-    mock_cursor.execute.assert_called_with(
-        "SELECT artist_id FROM artist WHERE artist.name = %s AND artist.url = %s",
-        ("artist_name", "artist_url"),
+    mock_cursor.execute.assert_called_once_with(
+        UPSERT_ARTIST, {"name": "artist_name", "url": "artist_url"}
     )
 
 
 @patch("load.get_cursor")
-def test_get_or_insert_artist_new(mock_get_cursor):
-    """Test case for get_or_insert_artist with new artist."""
+def test_get_or_insert_artist_concurrent_insert(mock_get_cursor):
+    """Test case for get_or_insert_artist when another run inserted the artist
+    after the upsert's snapshot, so it has to be run again."""
     mock_cursor = MagicMock()
     mock_get_cursor.return_value = mock_cursor
     mock_cursor.fetchone.side_effect = [None, [2]]
     artist_id = get_or_insert_artist(
         mock_cursor, "new_artist_name", "new_artist_url")
     assert artist_id == 2
-    mock_cursor.execute.assert_called_with(
-        "INSERT INTO artist(name, url) VALUES (%s, %s) RETURNING artist_id",
-        ("new_artist_name", "new_artist_url"),
-    )
+    assert mock_cursor.execute.call_count == 2
 
 
 @patch("load.get_cursor")
-def test_get_or_insert_country_existing(mock_get_cursor):
-    """Test case for get_or_insert_country with existing country."""
+def test_get_or_insert_country(mock_get_cursor):
+    """Test case for get_or_insert_country, in a single upsert."""
     mock_cursor = MagicMock()
     mock_get_cursor.return_value = mock_cursor
     mock_cursor.fetchone.return_value = [1]
     country_id = get_or_insert_country(mock_cursor, "country_name")
     assert country_id == 1
-    mock_cursor.execute.assert_called_with(
-        "SELECT country_id FROM country WHERE country.name = %s", (
-            "country_name",)
-    )
-
-
-@patch("load.get_cursor")
-def test_get_or_insert_country_new(mock_get_cursor):
-    """Test case for get_or_insert_country with new country."""
-    mock_cursor = MagicMock()
-    mock_get_cursor.return_value = mock_cursor
-    mock_cursor.fetchone.side_effect = [None, [3]]
-    country_id = get_or_insert_country(mock_cursor, "new_country_name")
-    assert country_id == 3
-    mock_cursor.execute.assert_called_with(
-        "INSERT INTO country(name) VALUES (%s) RETURNING country_id",
-        ("new_country_name",),
-    )
+    mock_cursor.execute.assert_called_once_with(
+        UPSERT_COUNTRY, {"name": "country_name"})
 
 
 @patch("load.get_cursor")
-def test_get_or_insert_album_existing(mock_get_cursor):
-    """Test case for get_or_insert_album with existing album."""
+def test_get_or_insert_album(mock_get_cursor):
+    """Test case for get_or_insert_album, in a single upsert."""
     mock_cursor = MagicMock()
     mock_get_cursor.return_value = mock_cursor
     mock_cursor.fetchone.return_value = [1]
     album_id = get_or_insert_album(mock_cursor, "album_title", 1, "album_url")
     assert album_id == 1
-    mock_cursor.execute.assert_called_with(
-        "SELECT album_id FROM album WHERE album.title = %s AND album.url = %s",
-        ("album_title", "album_url"),
-    )
-
-
-@patch("load.get_cursor")
-def test_get_or_insert_album_new(mock_get_cursor):
-    """Test case for get_or_insert_album with new album."""
-    mock_cursor = MagicMock()
-    mock_get_cursor.return_value = mock_cursor
-    mock_cursor.fetchone.side_effect = [None, [2]]
-    album_id = get_or_insert_album(
-        mock_cursor, "new_album_title", 1, "new_album_url")
-    assert album_id == 2
-    mock_cursor.execute.assert_called_with(
-        "INSERT INTO album(title, artist_id, url) VALUES (%s, %s, %s) RETURNING album_id",
-        ("new_album_title", 1, "new_album_url"),
+    mock_cursor.execute.assert_called_once_with(
+        UPSERT_ALBUM, {"title": "album_title", "artist_id": 1, "url": "album_url"}
     )
 
 
 @patch("load.get_cursor")
-def test_get_or_insert_track_or_single_existing(mock_get_cursor):
-    """Test case for get_or_insert_track_or_single with existing track/single."""
+def test_get_or_insert_track_or_single(mock_get_cursor):
+    """Test case for get_or_insert_track_or_single, in a single upsert."""
     mock_cursor = MagicMock()
     mock_get_cursor.return_value = mock_cursor
     mock_cursor.fetchone.return_value = [1]
     track_id = get_or_insert_track_or_single(
         mock_cursor, "song_title", 1, "song_url")
     assert track_id == 1
-    mock_cursor.execute.assert_called_with(
-        "SELECT track_id FROM track WHERE track.title = %s\
-            AND track.artist_id = %s AND track.url = %s",
-        ("song_title", 1, "song_url"),
+    mock_cursor.execute.assert_called_once_with(
+        UPSERT_TRACK,
+        {"title": "song_title", "album_id": None, "artist_id": 1, "url": "song_url"},
     )
 
 
 @patch("load.get_cursor")
-def test_get_or_insert_track_or_single_new(mock_get_cursor):
-    """Test case for get_or_insert_track_or_single with new track/single."""
+def test_get_or_insert_track_single_then_album(mock_get_cursor):
+    """Test case for a track seen as a single, then on its album, which has to
+    reach the database again to be linked to the album."""
     mock_cursor = MagicMock()
     mock_get_cursor.return_value = mock_cursor
-    mock_cursor.fetchone.side_effect = [None, [2]]
-    track_id = get_or_insert_track_or_single(
-        mock_cursor, "new_song_title", 1, "new_song_url"
-    )
-    assert track_id == 2
-    mock_cursor.execute.assert_called_with(
-        "INSERT INTO track(title, artist_id, url) VALUES (%s, %s, %s) RETURNING track_id",
-        ("new_song_title", 1, "new_song_url"),
-    )
+    mock_cursor.fetchone.return_value = [1]
+    get_or_insert_track_or_single(mock_cursor, "song_title", 1, "song_url")
+    get_or_insert_track_or_single(mock_cursor, "song_title", 1, "song_url")
+    get_or_insert_track_or_single(mock_cursor, "song_title", 1, "song_url", album_id=3)
+    assert mock_cursor.execute.call_count == 2
+    assert mock_cursor.execute.call_args.args[1]["album_id"] == 3
 
 
 @patch("load.get_cursor")
-def test_get_or_insert_tags_and_assignments_new_album(mock_get_cursor):
-    """Test case for get_or_insert_tags_and_assignments with new tag and album assignment."""
+def test_get_or_insert_tags_and_assignments_album(mock_get_cursor):
+    """Test case for get_or_insert_tags_and_assignments with an album assignment."""
     mock_cursor = MagicMock()
     mock_get_cursor.return_value = mock_cursor
-    mock_cursor.fetchone.side_effect = [None, [1], None]
-    get_or_insert_tags_and_assignments(mock_cursor, "new_tag", album_id=1)
+    mock_cursor.fetchone.return_value = [1]
+    get_or_insert_tags_and_assignments(mock_cursor, "new_tag", album_id=2)
     calls = [
-        call("SELECT tag_id FROM tag WHERE name = %s", ("new_tag",)),
-        call("INSERT INTO tag(name) VALUES (%s) RETURNING tag_id", ("new_tag",)),
-        call(
-            "SELECT album_genre_assignment_id from album_tag_assignment WHERE album_id = %s and tag_id = %s",
-            (1, 1),
-        ),
-        call(
-            "INSERT INTO album_tag_assignment(tag_id, album_id) VALUES (%s, %s)", (
-                1, 1)
-        ),
+        call(UPSERT_TAG, {"name": "new_tag"}),
+        call(INSERT_ALBUM_TAG_ASSIGNMENT, (1, 2)),
     ]
-    mock_cursor.execute.assert_has_calls(calls)
+    assert mock_cursor.execute.call_args_list == calls
 
 
 @patch("load.get_cursor")
-def test_get_or_insert_tags_and_assignments_existing_album(mock_get_cursor):
-    """Test case for get_or_insert_tags_and_assignments with existing tag and album assignment."""
+def test_get_or_insert_tags_and_assignments_track(mock_get_cursor):
+    """Test case for get_or_insert_tags_and_assignments with a track assignment."""
     mock_cursor = MagicMock()
     mock_get_cursor.return_value = mock_cursor
-    mock_cursor.fetchone.side_effect = [[1], None]
-    get_or_insert_tags_and_assignments(mock_cursor, "existing_tag", album_id=1)
+    mock_cursor.fetchone.return_value = [1]
+    get_or_insert_tags_and_assignments(mock_cursor, "new_tag", track_id=2)
     calls = [
-        call("SELECT tag_id FROM tag WHERE name = %s", ("existing_tag",)),
-        call(
-            "SELECT album_genre_assignment_id from album_tag_assignment WHERE album_id = %s and tag_id = %s",
-            (1, 1),
-        ),
-        call(
-            "INSERT INTO album_tag_assignment(tag_id, album_id) VALUES (%s, %s)", (
-                1, 1)
-        ),
+        call(UPSERT_TAG, {"name": "new_tag"}),
+        call(INSERT_TRACK_TAG_ASSIGNMENT, (1, 2)),
     ]
-    mock_cursor.execute.assert_has_calls(calls)
+    assert mock_cursor.execute.call_args_list == calls
 
 
 @patch("load.get_cursor")
-def test_get_or_insert_tags_and_assignments_new_track(mock_get_cursor):
-    """Test case for get_or_insert_tags_and_assignments with new tag and track assignment."""
+def test_insert_album_or_track_purchase_album(mock_get_cursor):
+    """Test case for insert_album_or_track_purchase with album purchase."""
     mock_cursor = MagicMock()
     mock_get_cursor.return_value = mock_cursor
-    mock_cursor.fetchone.side_effect = [None, [1], None]
-    get_or_insert_tags_and_assignments(mock_cursor, "new_tag", track_id=1)
-    calls = [
-        call("SELECT tag_id FROM tag WHERE name = %s", ("new_tag",)),
-        call("INSERT INTO tag(name) VALUES (%s) RETURNING tag_id", ("new_tag",)),
-        call(
-            "SELECT track_tag_assignment_id from track_tag_assignment WHERE track_id = %s and tag_id = %s",
-            (1, 1),
-        ),
-        call(
-            "INSERT INTO track_tag_assignment(tag_id, track_id) VALUES (%s, %s)", (
-                1, 1)
-        ),
-    ]
-    mock_cursor.execute.assert_has_calls(calls)
+    mock_cursor.rowcount = 1
+    assert insert_album_or_track_purchase(
+        mock_cursor, "timestamp", 10.0, 1, album_id=1, purchase_key="key")
+    mock_cursor.execute.assert_called_with(
+        INSERT_ALBUM_PURCHASE, (1, "timestamp", 10.0, 1, "key"))
 
 
 @patch("load.get_cursor")
-def test_get_or_insert_tags_and_assignments_existing_track(mock_get_cursor):
-    """Test case for get_or_insert_tags_and_assignments with existing tag and track assignment."""
+def test_insert_album_or_track_purchase_track(mock_get_cursor):
+    """Test case for insert_album_or_track_purchase with track purchase."""
     mock_cursor = MagicMock()
     mock_get_cursor.return_value = mock_cursor
-    mock_cursor.fetchone.side_effect = [[1], None]
-    get_or_insert_tags_and_assignments(mock_cursor, "existing_tag", track_id=1)
-    calls = [
-        call("SELECT tag_id FROM tag WHERE name = %s", ("existing_tag",)),
-        call(
-            "SELECT track_tag_assignment_id from track_tag_assignment WHERE track_id = %s and tag_id = %s",
-            (1, 1),
-        ),
-        call(
-            "INSERT INTO track_tag_assignment(tag_id, track_id) VALUES (%s, %s)", (
-                1, 1)
-        ),
-    ]
-    mock_cursor.execute.assert_has_calls(calls)
+    mock_cursor.rowcount = 1
+    assert insert_album_or_track_purchase(
+        mock_cursor, "timestamp", 10.0, 1, track_id=1, purchase_key="key")
+    mock_cursor.execute.assert_called_with(
+        INSERT_TRACK_PURCHASE, (1, "timestamp", 10.0, 1, "key"))
 
 
-@patch("load.get_cursor")
-def test_insert_album_or_track_purchase_album(mock_get_cursor):
-    """Test case for insert_album_or_track_purchase with album purchase."""
+def test_insert_album_or_track_purchase_duplicate():
+    """Tests that a purchase already loaded is counted as a duplicate, and
+    counts only reach the run's totals once their transaction commits."""
     mock_cursor = MagicMock()
-    mock_get_cursor.return_value = mock_cursor
+    mock_cursor.rowcount = 0
+    assert not insert_album_or_track_purchase(
+        mock_cursor, "timestamp", 10.0, 1, album_id=1, purchase_key="key")
+    rollback_purchase_counts()
+    commit_purchase_counts()
+    assert PURCHASE_COUNTS == {"inserted": 0, "duplicates": 0, "rejected": 0, "deferred": 0}
+
     insert_album_or_track_purchase(
-        mock_cursor, "timestamp", 10.0, 1, album_id=1)
-    mock_cursor.execute.assert_called_with(
-        "INSERT INTO album_purchase(album_id, timestamp, amount_usd, country_id)\
-                VALUES (%s, %s, %s, %s)",
-        (1, "timestamp", 10.0, 1),
-    )
+        mock_cursor, "timestamp", 10.0, 1, album_id=1, purchase_key="key")
+    commit_purchase_counts()
+    assert PURCHASE_COUNTS == {"inserted": 0, "duplicates": 1, "rejected": 0, "deferred": 0}
 
+    log_purchase_stats()
+    assert PURCHASE_COUNTS == {"inserted": 0, "duplicates": 0, "rejected": 0, "deferred": 0}
 
-@patch("load.get_cursor")
-def test_insert_album_or_track_purchase_track(mock_get_cursor):
-    """Test case for insert_album_or_track_purchase with track purchase."""
+
+def test_insert_album_sale_defers_missing_tags():
+    """Tests that a sale whose tags could not be scraped is deferred to the
+    retry queue, with its payload and the fields it is missing."""
     mock_cursor = MagicMock()
-    mock_get_cursor.return_value = mock_cursor
-    insert_album_or_track_purchase(
-        mock_cursor, "timestamp", 10.0, 1, track_id=1)
-    mock_cursor.execute.assert_called_with(
-        "INSERT INTO track_purchase(track_id, timestamp, amount_usd, country_id)\
-                VALUES (%s, %s, %s, %s)",
-        (1, "timestamp", 10.0, 1),
-    )
+    sale = {"item_type": "a", "country": "Japan", "artist_name": "Artist",
+            "artist_url": "https://artist.bandcamp.com", "item_description": "Album",
+            "url": "https://artist.bandcamp.com/album/a", "album_tags": [],
+            "utc_date": "2024-06-30 12:00:00", "amount_paid_usd": 1.0,
+            "feed_item": {"url": "//artist.bandcamp.com/album/a", "utc_date": 1719748800.0}}
+
+    insert_album_sale(mock_cursor, sale)
+
+    mock_cursor.execute.assert_called_once()
+    query, (purchase_key, url, payload, reason, _) = mock_cursor.execute.call_args.args
+    assert query == DEFER_SALE
+    assert purchase_key == get_purchase_key(sale)
+    assert url == sale["url"] and json.loads(payload) == sale["feed_item"]
+    assert reason == "missing album_tags"
+    commit_purchase_counts()
+    assert PURCHASE_COUNTS["deferred"] == 1
+
+
+def test_get_purchase_key():
+    """Tests that a sale's key depends on its item, time, rounded amount and country."""
+    sale = {"url": "https://artist.bandcamp.com/album/a", "utc_date": "2024-06-30 12:00:00",
+            "amount_paid_usd": 2.545, "country": "Japan"}
+
+    assert get_purchase_key(sale) == get_purchase_key(dict(sale))
+    assert len(get_purchase_key(sale)) == 64
+    assert get_purchase_key(sale) == get_purchase_key({**sale, "amount_paid_usd": "2.55"})
+    assert get_purchase_key(sale) != get_purchase_key({**sale, "amount_paid_usd": 2.54})
+    assert get_purchase_key(sale) != get_purchase_key({**sale, "country": "Germany"})
 
 
 @patch("load.get_cursor")
@@ -286,6 +269,7 @@ def test_insert_album_sale(mock_get_cursor):
     """Test case for insert_album_sale function."""
     mock_cursor = MagicMock()
     mock_get_cursor.return_value = mock_cursor
+    mock_cursor.fetchone.side_effect = ([row_id] for row_id in count(1))
     album_sale = {
         "utc_date": 1718881844.178138,
         "artist_name": "FINAL",
@@ -313,7 +297,7 @@ def test_insert_album_sale(mock_get_cursor):
     }
     insert_album_sale(mock_cursor, album_sale)
 
-    assert mock_cursor.fetchone.call_count == 15
+    assert mock_cursor.fetchone.call_count == 9
     assert mock_cursor.execute.call_count == 16
 
 
@@ -322,6 +306,7 @@ def test_insert_track_sale(mock_get_cursor):
     """Test case for insert_track_sale function."""
     mock_cursor = MagicMock()
     mock_get_cursor.return_value = mock_cursor
+    mock_cursor.fetchone.side_effect = ([row_id] for row_id in count(1))
 
     track_sale = {
         "utc_date": 1718881757.3350313,
@@ -339,7 +324,7 @@ def test_insert_track_sale(mock_get_cursor):
 
     insert_track_sale(mock_cursor, track_sale)
 
-    assert mock_cursor.fetchone.call_count == 12
+    assert mock_cursor.fetchone.call_count == 8
     assert mock_cursor.execute.call_count == 13
 
 
@@ -348,6 +333,7 @@ def test_insert_single_sale(mock_get_cursor):
     """Test case for insert_single_sale function."""
     mock_cursor = MagicMock()
     mock_get_cursor.return_value = mock_cursor
+    mock_cursor.fetchone.side_effect = ([row_id] for row_id in count(1))
 
     single_sale = {
         "utc_date": 1718881780.3168454,
@@ -374,5 +360,180 @@ def test_insert_single_sale(mock_get_cursor):
 
     insert_single_sale(mock_cursor, single_sale)
 
-    assert mock_cursor.fetchone.call_count == 15
+    assert mock_cursor.fetchone.call_count == 9
     assert mock_cursor.execute.call_count == 16
+
+
+def test_dimension_cache_evicts_least_recently_used():
+    """Tests that the least recently used key is evicted above the size bound."""
+    cache = DimensionCache("test", max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_dimension_cache_rollback_to_savepoint():
+    """Tests that only keys added since the savepoint are dropped when rolling back to it."""
+    cache = DimensionCache("test", max_entries=10)
+    cache.put("a", 1)
+    cache.release_savepoint()
+    cache.put("b", 2)
+    cache.rollback_to_savepoint()
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    cache.rollback()
+    assert cache.get("a") is None
+
+
+def test_dimension_cache_rollback():
+    """Tests that ids cached in a rolled back transaction are forgotten,
+    and those from committed transactions are kept."""
+    cache = DimensionCache("test", max_entries=10)
+    cache.put("committed", 1)
+    cache.commit()
+    cache.put("rolled_back", 2)
+    cache.rollback()
+
+    assert cache.get("committed") == 1
+    assert cache.get("rolled_back") is None
+
+
+def test_get_or_insert_country_cached():
+    """Tests that a country looked up once is not queried again."""
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = [4]
+
+    assert get_or_insert_country(mock_cursor, "Japan") == 4
+    assert get_or_insert_country(mock_cursor, "Japan") == 4
+    assert mock_cursor.execute.call_count == 1
+
+
+def test_get_or_insert_tags_and_assignments_cached():
+    """Tests that a repeated tag assignment is not queried again."""
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = [1]
+
+    get_or_insert_tags_and_assignments(mock_cursor, "rock", album_id=7)
+    get_or_insert_tags_and_assignments(mock_cursor, "rock", album_id=7)
+
+    assert mock_cursor.execute.call_count == 2
+
+
+@pytest.fixture
+def loaded_album_sale():
+    """Pytest fixture of a transformed album sale, as load_sales_batch receives it."""
+    return {"item_type": "a", "country": "Japan", "artist_name": "Artist",
+            "artist_url": "https://artist.bandcamp.com", "item_description": "Album",
+            "url": "https://artist.bandcamp.com/album/a", "album_tags": ["rock"],
+            "utc_date": "2024-06-30 12:00:00", "amount_paid_usd": 1.0}
+
+
+def test_load_sales_batch_rollback_forgets_ids(loaded_album_sale):  # pylint: disable=redefined-outer-name
+    """Tests that ids inserted by a failed batch are not reused by the next."""
+    mock_connection = MagicMock()
+    mock_cursor = mock_connection.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchone.side_effect = ([row_id] for row_id in count(1))
+    mock_connection.commit.side_effect = Exception("commit failed")
+
+    assert not load_sales_batch(mock_connection, [loaded_album_sale])
+    mock_connection.rollback.assert_called_once()
+    assert DIMENSION_CACHES["country"].get("Japan") is None
+
+
+def test_load_sales_batch_rejects_failed_sale(loaded_album_sale):  # pylint: disable=redefined-outer-name
+    """Tests that a failing sale is rolled back to its savepoint and rejected,
+    forgetting the ids it cached, while the sales around it are committed."""
+    mock_connection = MagicMock()
+    mock_cursor = mock_connection.cursor.return_value.__enter__.return_value
+    mock_cursor.rowcount = 1
+    bad_sale = {**loaded_album_sale, "country": "Germany",
+                "url": "https://artist.bandcamp.com/album/b"}
+    # The bad sale inserts its country, then fails inserting its album.
+    mock_cursor.fetchone.side_effect = [[1], [1], [1], [1], [2], Exception("numeric overflow")]
+
+    assert load_sales_batch(mock_connection, [loaded_album_sale, bad_sale])
+
+    statements = [call.args[0] for call in mock_cursor.execute.call_args_list]
+    assert statements.count("SAVEPOINT sale") == 2
+    assert statements.count("RELEASE SAVEPOINT sale") == 1
+    assert statements.count("ROLLBACK TO SAVEPOINT sale") == 1
+    assert statements[0] == CREATE_PENDING_SALES_ROLLUP
+    assert statements[-2:] == [INSERT_REJECTED_SALE, FLUSH_SALES_ROLLUPS]
+    url, sale_json, error = mock_cursor.execute.call_args_list[-2].args[1]
+    assert url == bad_sale["url"] and '"country": "Germany"' in sale_json
+    assert error == "Exception: numeric overflow"
+    mock_connection.commit.assert_called_once()
+    assert DIMENSION_CACHES["country"].get("Japan") == 1
+    assert DIMENSION_CACHES["country"].get("Germany") is None
+    assert PURCHASE_COUNTS == {"inserted": 1, "duplicates": 0, "rejected": 1, "deferred": 0}
+
+
+@patch("load.get_connection")
+def test_load_sales_data_commits_in_chunks(mock_get_connection, loaded_album_sale):  # pylint: disable=redefined-outer-name
+    """Tests that sales are committed every chunk_size sales."""
+    mock_connection = mock_get_connection.return_value
+    mock_cursor = mock_connection.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchone.side_effect = ([row_id] for row_id in count(1))
+
+    assert load_sales_data([loaded_album_sale] * 5, chunk_size=2)
+
+    assert mock_connection.commit.call_count == 3
+    mock_connection.close.assert_called_once()
+
+
+@patch("load.get_connection")
+def test_load_sales_data_reports_failed_chunk(mock_get_connection, loaded_album_sale):  # pylint: disable=redefined-outer-name
+    """Tests that a chunk rolled back is reported, though later chunks are committed."""
+    mock_connection = mock_get_connection.return_value
+    mock_cursor = mock_connection.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchone.side_effect = ([row_id] for row_id in count(1))
+    mock_connection.commit.side_effect = [Exception("commit failed"), None]
+
+    assert not load_sales_data([loaded_album_sale] * 4, chunk_size=2)
+
+    assert mock_connection.commit.call_count == 2
+
+
+@patch("load.get_connection")
+def test_get_feed_cursor(mock_get_connection):
+    """Tests that the stored cursor is read, and reads as None before any is stored."""
+    mock_cursor = mock_get_connection.return_value.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchone.side_effect = [(250.5,), None]
+
+    assert get_feed_cursor() == 250.5
+    assert get_feed_cursor() is None
+    assert mock_get_connection.return_value.close.call_count == 2
+
+
+@patch("load.get_connection")
+def test_advance_feed_cursor(mock_get_connection):
+    """Tests that the cursor is saved and committed."""
+    mock_connection = mock_get_connection.return_value
+    mock_cursor = mock_connection.cursor.return_value.__enter__.return_value
+
+    advance_feed_cursor(300.0)
+
+    mock_cursor.execute.assert_called_once_with(SAVE_FEED_CURSOR, ("salesfeed", 300.0))
+    mock_connection.commit.assert_called_once()
+    mock_connection.close.assert_called_once()
+
+
+def test_warm_dimension_caches():
+    """Tests that countries and tags are loaded once, however often it is called."""
+    mock_connection = MagicMock()
+    mock_cursor = mock_connection.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchall.side_effect = [[("Japan", 1)], [("rock", 2), ("pop", 3)]]
+
+    warm_dimension_caches(mock_connection)
+    warm_dimension_caches(mock_connection)
+
+    assert mock_cursor.execute.call_count == 2
+    assert DIMENSION_CACHES["country"].get("Japan") == 1
+    assert DIMENSION_CACHES["tag"].get("pop") == 3
@@ -0,0 +1,74 @@
+"""Tests for the purchase partition maintenance script."""
+
+from datetime import date
+from unittest.mock import MagicMock
+from psycopg2 import sql
+from partitions import (
+    ARCHIVE_SCHEMA,
+    add_months,
+    archive_old_partitions,
+    create_future_partitions,
+    get_partition_month,
+    get_partition_name,
+)
+from conftest import get_mock_connection, get_mock_cursor, get_statements
+
+
+def get_partitioned_connection(*partitions: list[str]) -> MagicMock:
+    """Returns a mock connection whose album and track purchase tables have the
+    given partitions."""
+    connection = get_mock_connection()
+    get_mock_cursor(connection).fetchall.side_effect = [
+        [(name,) for name in names] for names in partitions]
+    return connection
+
+
+def get_composed_statements(connection: MagicMock) -> list:
+    """Returns the composed statements executed on a mock connection."""
+    return [query for query, *_ in get_statements(connection)
+            if isinstance(query, sql.Composed)]
+
+
+def test_add_months():
+    """Tests that months are added across years, from any day of a month."""
+    assert add_months(date(2024, 11, 17), 0) == date(2024, 11, 1)
+    assert add_months(date(2024, 11, 17), 3) == date(2025, 2, 1)
+    assert add_months(date(2024, 1, 31), -1) == date(2023, 12, 1)
+
+
+def test_partition_names():
+    """Tests that a partition's month is read back from its name."""
+    name = get_partition_name("album_purchase", date(2024, 6, 1))
+
+    assert name == "album_purchase_2024_06"
+    assert get_partition_month(name) == date(2024, 6, 1)
+    assert get_partition_month("album_purchase_default") is None
+
+
+def test_create_future_partitions():
+    """Tests that only the missing months are created, each committed alone."""
+    connection = get_partitioned_connection(["album_purchase_default", "album_purchase_2024_06"],
+                                            ["track_purchase_default", "track_purchase_2024_06"])
+
+    created = create_future_partitions(connection, date(2024, 6, 20), months_ahead=1)
+
+    assert created == ["album_purchase_2024_07", "track_purchase_2024_07"]
+    assert connection.commit.call_count == 2
+    assert len(get_composed_statements(connection)) == 6
+
+
+def test_archive_old_partitions():
+    """Tests that partitions before the retention period are detached and
+    archived, keeping the default partition and the months retained."""
+    connection = get_partitioned_connection(
+        ["album_purchase_default", "album_purchase_2023_12", "album_purchase_2024_01",
+         "album_purchase_2024_06"],
+        ["track_purchase_2023_12", "track_purchase_2024_06"])
+
+    archived = archive_old_partitions(connection, date(2024, 6, 20), retention_months=5)
+
+    assert archived == ["album_purchase_2023_12", "track_purchase_2023_12"]
+    statements = get_composed_statements(connection)
+    assert len(statements) == 5
+    assert sql.Identifier(ARCHIVE_SCHEMA) in statements[0]
+    connection.commit.assert_called_once()
@@ -3,7 +3,23 @@
 from datetime import datetime
 from unittest.mock import patch
 import pytest
+from load import COMMIT_CHUNK_SIZE
 from pipeline import main
+from retry_queue import DRAIN_BATCH_SIZE, DRAIN_MAX_CONCURRENCY
+
+
+@pytest.fixture(autouse=True)
+def mock_maintain_purchase_partitions():
+    """Pytest fixture keeping every run from creating or archiving partitions."""
+    with patch("pipeline.maintain_purchase_partitions") as mock_maintain:
+        yield mock_maintain
+
+
+@pytest.fixture(autouse=True)
+def mock_run_retry_drain():
+    """Pytest fixture keeping every run from draining the retry queue."""
+    with patch("pipeline.run_retry_drain") as mock_drain:
+        yield mock_drain
 
 
 @pytest.fixture
@@ -47,11 +63,218 @@ def test_etl_pipeline(
     mock_sales_data,
 ):
     """Tests that the E,T, and L functions are called once."""
-    mock_get_sales_data.return_value = mock_sales_data
+    mock_get_sales_data.return_value = (mock_sales_data, None)
     mock_transform_sales_data.return_value = mock_sales_data
 
     main("foo", "bar")
 
     mock_get_sales_data.assert_called_once()
     mock_transform_sales_data.assert_called_once_with(mock_sales_data)
-    mock_load_sales_data.assert_called_once_with(mock_sales_data)
+    mock_load_sales_data.assert_called_once_with(
+        mock_sales_data, warm_caches=False, chunk_size=COMMIT_CHUNK_SIZE)
+
+
+@patch.dict("pipeline.ENV", {"INCREMENTAL_FEED": "true"})
+@patch("pipeline.advance_feed_cursor")
+@patch("pipeline.get_feed_cursor", return_value=100.0)
+@patch("pipeline.get_sales_data")
+@patch("pipeline.transform_sales_data")
+@patch("pipeline.load_sales_data", return_value=True)
+def test_etl_pipeline_incremental(
+    mock_load_sales_data,  # pylint: disable=unused-argument
+    mock_transform_sales_data,
+    mock_get_sales_data,
+    mock_get_feed_cursor,  # pylint: disable=unused-argument
+    mock_advance_feed_cursor,
+    mock_sales_data,
+):
+    """Tests that an incremental run fetches from the stored cursor and only
+    advances it once the sales are committed."""
+    mock_get_sales_data.return_value = (mock_sales_data, 300.0)
+    mock_transform_sales_data.return_value = mock_sales_data
+
+    main("foo", "bar")
+
+    assert mock_get_sales_data.call_args.args == (100.0,)
+    mock_advance_feed_cursor.assert_called_once_with(300.0)
+
+
+@patch.dict("pipeline.ENV", {"INCREMENTAL_FEED": "true"})
+@patch("pipeline.advance_feed_cursor")
+@patch("pipeline.get_feed_cursor", return_value=100.0)
+@patch("pipeline.get_sales_data")
+@patch("pipeline.transform_sales_data")
+@patch("pipeline.load_sales_data", return_value=False)
+def test_etl_pipeline_incremental_failed_load(
+    mock_load_sales_data,  # pylint: disable=unused-argument
+    mock_transform_sales_data,
+    mock_get_sales_data,
+    mock_get_feed_cursor,  # pylint: disable=unused-argument
+    mock_advance_feed_cursor,
+    mock_sales_data,
+):
+    """Tests that the cursor stays put when the load is not committed, so the
+    next run fetches the same events again."""
+    mock_get_sales_data.return_value = (mock_sales_data, 300.0)
+    mock_transform_sales_data.return_value = mock_sales_data
+
+    main("foo", "bar")
+
+    mock_advance_feed_cursor.assert_not_called()
+
+
+@patch("pipeline.get_sales_data", return_value=([], None))
+@patch("pipeline.load_sales_data", return_value=True)
+def test_etl_pipeline_drains_after_failed_feed(
+        mock_load_sales_data,
+        mock_get_sales_data,  # pylint: disable=unused-argument
+        mock_run_retry_drain):  # pylint: disable=redefined-outer-name
+    """Tests that a run whose feed could not be fetched still drains the retry queue."""
+    main("foo", "bar")
+
+    mock_load_sales_data.assert_called_once_with(
+        [], warm_caches=False, chunk_size=COMMIT_CHUNK_SIZE)
+    mock_run_retry_drain.assert_called_once_with(DRAIN_BATCH_SIZE, DRAIN_MAX_CONCURRENCY)
+
+
+@patch.dict("pipeline.ENV", {"PIPELINE_MODE": "stream", "STREAM_BATCH_SIZE": "10"})
+@patch("pipeline.run_streaming_pipeline")
+@patch("pipeline.get_sales_data")
+def test_etl_pipeline_stream_mode(mock_get_sales_data, mock_run_streaming_pipeline):
+    """Tests that stream mode runs the streaming pipeline instead of the three phases."""
+    main("foo", "bar")
+
+    mock_get_sales_data.assert_not_called()
+    mock_run_streaming_pipeline.assert_called_once()
+    assert mock_run_streaming_pipeline.call_args.kwargs["batch_size"] == 10
+
+
+@patch.dict("pipeline.ENV", {"LOAD_METHOD": "bulk"})
+@patch("pipeline.get_sales_data")
+@patch("pipeline.transform_sales_data")
+@patch("pipeline.load_sales_data")
+@patch("pipeline.bulk_load_sales_data")
+def test_etl_pipeline_bulk_load(
+    mock_bulk_load_sales_data,
+    mock_load_sales_data,
+    mock_transform_sales_data,
+    mock_get_sales_data,
+    mock_sales_data,
+):
+    """Tests that the bulk loader is used in place of the row loader when set."""
+    mock_get_sales_data.return_value = (mock_sales_data, None)
+    mock_transform_sales_data.return_value = mock_sales_data
+
+    main("foo", "bar")
+
+    mock_bulk_load_sales_data.assert_called_once_with(mock_sales_data)
+    mock_load_sales_data.assert_not_called()
+
+
+@patch.dict("pipeline.ENV", {"LOAD_METHOD": "async", "LOAD_CHUNK_SIZE": "100"})
+@patch("pipeline.get_sales_data")
+@patch("pipeline.transform_sales_data")
+@patch("pipeline.load_sales_data")
+@patch("pipeline.async_load_sales_data")
+def test_etl_pipeline_async_load(
+    mock_async_load_sales_data,
+    mock_load_sales_data,
+    mock_transform_sales_data,
+    mock_get_sales_data,
+    mock_sales_data,
+):
+    """Tests that the async loader is used in place of the row loader when set."""
+    mock_get_sales_data.return_value = (mock_sales_data, None)
+    mock_transform_sales_data.return_value = mock_sales_data
+
+    main("foo", "bar")
+
+    mock_async_load_sales_data.assert_called_once_with(
+        mock_sales_data, warm_caches=False, chunk_size=100)
+    mock_load_sales_data.assert_not_called()
+
+
+@patch.dict("pipeline.ENV", {"PIPELINE_MODE": "drain", "RETRY_DRAIN_LIMIT": "20"})
+@patch("pipeline.get_sales_data")
+def test_etl_pipeline_drain_mode(mock_get_sales_data, mock_run_retry_drain):  # pylint: disable=redefined-outer-name
+    """Tests that drain mode only drains the retry queue."""
+    main("foo", "bar")
+
+    mock_get_sales_data.assert_not_called()
+    mock_run_retry_drain.assert_called_once_with(20, DRAIN_MAX_CONCURRENCY)
+
+
+@patch.dict("pipeline.ENV", {"PIPELINE_MODE": "stream"})
+@patch("pipeline.run_streaming_pipeline")
+def test_etl_pipeline_drains_after_loading(mock_run_streaming_pipeline,
+                                           mock_run_retry_drain):  # pylint: disable=redefined-outer-name
+    """Tests that a run drains the due sales of the retry queue once it has loaded."""
+    main("foo", "bar")
+
+    mock_run_streaming_pipeline.assert_called_once()
+    mock_run_retry_drain.assert_called_once_with(DRAIN_BATCH_SIZE, DRAIN_MAX_CONCURRENCY)
+
+
+@patch.dict("pipeline.ENV", {"PIPELINE_MODE": "stream", "RUN_COORDINATION": "skip"})
+@patch("pipeline.run_streaming_pipeline")
+@patch("pipeline.run_exclusively", return_value=False)
+def test_etl_pipeline_skips_overlapping_run(mock_run_exclusively, mock_run_streaming_pipeline,
+                                            mock_run_retry_drain):  # pylint: disable=redefined-outer-name
+    """Tests that a run is skipped when the previous run still holds the run lock."""
+    main("foo", "bar")
+
+    mock_run_exclusively.assert_called_once()
+    mock_run_streaming_pipeline.assert_not_called()
+    mock_run_retry_drain.assert_not_called()
+
+
+@patch.dict("pipeline.ENV", {"RUN_COORDINATION": "lease", "LEASE_CLAIM_SIZE": "20",
+                             "LEASE_SECONDS": "60"})
+@patch("pipeline.get_sales_data")
+@patch("pipeline.run_leased_pipeline")
+def test_etl_pipeline_lease_mode(mock_run_leased_pipeline, mock_get_sales_data,
+                                 mock_run_retry_drain):  # pylint: disable=redefined-outer-name
+    """Tests that lease mode takes its work from the queue instead of the feed."""
+    main("foo", "bar")
+
+    mock_get_sales_data.assert_not_called()
+    assert mock_run_leased_pipeline.call_args.kwargs["lease_size"] == 20
+    assert mock_run_leased_pipeline.call_args.kwargs["lease_seconds"] == 60
+    mock_run_retry_drain.assert_called_once()
+
+
+@patch.dict("pipeline.ENV", {"RUN_COORDINATION": "lease", "ARCHIVE_PATH": "/mnt/archive"})
+@patch("pipeline.run_leased_pipeline")
+def test_etl_pipeline_lease_mode_archives(mock_run_leased_pipeline):
+    """Tests that lease mode archives what it fetches like the other modes."""
+    main("foo", "bar")
+
+    assert mock_run_leased_pipeline.call_args.kwargs["archive_path"] == "/mnt/archive"
+
+
+@pytest.mark.parametrize("env", [{"RUN_COORDINATION": "lease"}, {"PIPELINE_MODE": "stream"}])
+@patch("pipeline.run_streaming_pipeline")
+@patch("pipeline.run_leased_pipeline")
+@patch("pipeline.get_sales_data", return_value=([], None))
+@patch("pipeline.load_sales_data", return_value=True)
+def test_etl_pipeline_replays_in_batch_mode(mock_load_sales_data,  # pylint: disable=unused-argument
+                                            mock_get_sales_data, mock_run_leased_pipeline,
+                                            mock_run_streaming_pipeline, env):
+    """Tests that a replay runs in batch mode whatever the mode and coordination."""
+    with patch.dict("pipeline.ENV", {**env, "REPLAY_DAY": "2024-06-30"}):
+        main("foo", "bar")
+
+    assert mock_get_sales_data.call_args.kwargs["replay_day"] == "2024-06-30"
+    mock_run_leased_pipeline.assert_not_called()
+    mock_run_streaming_pipeline.assert_not_called()
+
+
+@patch.dict("pipeline.ENV", {"PIPELINE_MODE": "stream", "PURCHASE_RETENTION_MONTHS": "24"})
+@patch("pipeline.run_streaming_pipeline")
+def test_etl_pipeline_maintains_partitions(mock_run_streaming_pipeline,  # pylint: disable=unused-argument
+                                           mock_maintain_purchase_partitions):  # pylint: disable=redefined-outer-name
+    """Tests that a run creates the partitions ahead and archives old ones first."""
+    main("foo", "bar")
+
+    mock_maintain_purchase_partitions.assert_called_once_with(months_ahead=3,
+                                                              retention_months=24)
@@ -0,0 +1,156 @@
+"""Tests for the retry queue script."""
+
+import json
+from unittest.mock import MagicMock, patch
+import pytest
+from load import (
+    FLUSH_SALES_ROLLUPS,
+    PURCHASE_COUNTS,
+    UPSERT_TAG,
+)
+from retry_queue import (
+    CLAIM_DUE_SALES,
+    DELETE_RETRIED_SALE,
+    DRAIN_LEASE_SECONDS,
+    MAX_RETRY_ATTEMPTS,
+    MAX_RETRY_DELAY_SECONDS,
+    RESCHEDULE_SALE,
+    claim_due_sales,
+    drain_retry_queue,
+    get_retry_delay,
+    log_retry_queue_stats,
+)
+from conftest import get_mock_connection, get_mock_cursor, get_statements
+
+
+@pytest.fixture
+def queued_items():
+    """Pytest fixture of two queued feed items, an album and a track on an album."""
+    base = {"utc_date": 1719748800.0, "artist_name": "Artist", "amount_paid_usd": 5.0,
+            "country": "Japan", "slug_type": "a"}
+    return [
+        {**base, "item_type": "a", "item_description": "Album",
+         "url": "//artist.bandcamp.com/album/a"},
+        {**base, "item_type": "t", "item_description": "Track", "album_title": "Album",
+         "url": "//artist.bandcamp.com/track/t"},
+    ]
+
+
+def test_get_retry_delay():
+    """Tests that the delay doubles with each attempt up to a cap, and runs
+    out after the last attempt."""
+    assert get_retry_delay(2) == 2 * get_retry_delay(1)
+    assert get_retry_delay(MAX_RETRY_ATTEMPTS - 1) <= MAX_RETRY_DELAY_SECONDS
+    assert get_retry_delay(MAX_RETRY_ATTEMPTS) is None
+
+
+def test_claim_due_sales(queued_items):  # pylint: disable=redefined-outer-name
+    """Tests that due sales are leased and committed before anything is scraped."""
+    mock_connection = get_mock_connection(fetchone=[1], fetchall=[(1, queued_items[0], 1)])
+
+    assert claim_due_sales(mock_connection, limit=10) == [(1, queued_items[0], 1)]
+    assert get_statements(mock_connection) == [(CLAIM_DUE_SALES, {
+        "limit": 10, "lease_seconds": DRAIN_LEASE_SECONDS,
+        "max_attempts": MAX_RETRY_ATTEMPTS})]
+    mock_connection.commit.assert_called_once()
+
+
+@patch("retry_queue.rescrape_sales", new_callable=MagicMock)
+@patch("retry_queue.http_client.run", side_effect=lambda value: value)
+def test_drain_retry_queue(mock_run, mock_rescrape_sales, queued_items):  # pylint: disable=redefined-outer-name,unused-argument
+    """Tests that a sale complete after re-scraping is transformed, loaded and
+    removed from the queue, while one still incomplete is rescheduled, with the
+    claim and the load committed separately."""
+    mock_connection = get_mock_connection(fetchone=[1], fetchall=[(1, queued_items[0], 1),
+                                                                  (2, queued_items[1], 3)])
+    mock_rescrape_sales.return_value = [{**queued_items[0], "album_tags": ["#Rock "]},
+                                        {**queued_items[1], "track_tags": ["pop"]}]
+
+    counts = drain_retry_queue(mock_connection, limit=10)
+
+    assert counts == {"loaded": 1, "rejected": 0, "rescheduled": 1, "dead": 0}
+    statements = get_statements(mock_connection)
+    assert statements[0][0] == CLAIM_DUE_SALES
+    assert (DELETE_RETRIED_SALE, (1,)) in statements
+    assert (UPSERT_TAG, {"name": "rock"}) in statements
+    assert statements[-2] == (RESCHEDULE_SALE, {"sale_retry_id": 2, "delay": get_retry_delay(3),
+                                                "reason": "missing album_url"})
+    assert statements[-1] == (FLUSH_SALES_ROLLUPS,)
+    assert mock_connection.commit.call_count == 2
+    assert PURCHASE_COUNTS["inserted"] == 1
+
+
+@patch("retry_queue.insert_sale_in_savepoint", return_value=False)
+@patch("retry_queue.rescrape_sales", new_callable=MagicMock)
+@patch("retry_queue.http_client.run", side_effect=lambda value: value)
+def test_drain_retry_queue_counts_rejected(mock_run, mock_rescrape_sales,  # pylint: disable=unused-argument
+                                           mock_insert_sale_in_savepoint, queued_items):  # pylint: disable=redefined-outer-name,unused-argument
+    """Tests that a sale the database rejects is counted apart from those loaded."""
+    mock_connection = get_mock_connection(fetchone=[1], fetchall=[(1, queued_items[0], 1)])
+    mock_rescrape_sales.return_value = [{**queued_items[0], "album_tags": ["rock"]}]
+
+    counts = drain_retry_queue(mock_connection)
+
+    assert counts == {"loaded": 0, "rejected": 1, "rescheduled": 0, "dead": 0}
+    assert (DELETE_RETRIED_SALE, (1,)) in get_statements(mock_connection)
+
+
+@patch("retry_queue.rescrape_sales", new_callable=MagicMock)
+@patch("retry_queue.http_client.run", side_effect=lambda value: value)
+def test_drain_retry_queue_reschedules_failed_transform(mock_run, mock_rescrape_sales,  # pylint: disable=unused-argument
+                                                        queued_items):  # pylint: disable=redefined-outer-name
+    """Tests that a feed item that no longer transforms is rescheduled with the error."""
+    mock_connection = get_mock_connection(fetchone=[1], fetchall=[(1, queued_items[0], 1)])
+    mock_rescrape_sales.return_value = [{**queued_items[0], "utc_date": -1.0,
+                                         "album_tags": ["rock"]}]
+
+    counts = drain_retry_queue(mock_connection)
+
+    assert counts == {"loaded": 0, "rejected": 0, "rescheduled": 1, "dead": 0}
+    assert get_statements(mock_connection)[-2][1]["reason"].startswith("transform failed")
+
+
+@patch("retry_queue.rescrape_sales", new_callable=MagicMock)
+@patch("retry_queue.http_client.run", side_effect=lambda value: value)
+def test_drain_retry_queue_gives_up(mock_run, mock_rescrape_sales, queued_items):  # pylint: disable=redefined-outer-name,unused-argument
+    """Tests that a sale on its last attempt is left dead in the queue."""
+    mock_connection = get_mock_connection(
+        fetchone=[1], fetchall=[(1, queued_items[0], MAX_RETRY_ATTEMPTS)])
+    mock_rescrape_sales.return_value = queued_items[:1]
+
+    counts = drain_retry_queue(mock_connection)
+
+    assert counts == {"loaded": 0, "rejected": 0, "rescheduled": 0, "dead": 1}
+    assert get_statements(mock_connection)[-2][1]["delay"] is None
+
+
+@patch("retry_queue.rescrape_sales", new_callable=MagicMock)
+@patch("retry_queue.http_client.run", side_effect=lambda value: value)
+def test_drain_retry_queue_failed_load(mock_run, mock_rescrape_sales, queued_items):  # pylint: disable=redefined-outer-name,unused-argument
+    """Tests that a load that fails is rolled back, leaving the claimed sales
+    leased until they are due again."""
+    mock_connection = get_mock_connection(fetchone=[1], fetchall=[(1, queued_items[0], 1)])
+    mock_rescrape_sales.return_value = [{**queued_items[0], "album_tags": ["rock"]}]
+    def execute(query, *args):  # pylint: disable=unused-argument
+        if query == FLUSH_SALES_ROLLUPS:
+            raise RuntimeError("lost connection")
+    get_mock_cursor(mock_connection).execute.side_effect = execute
+
+    counts = drain_retry_queue(mock_connection)
+
+    assert counts == {"loaded": 0, "rejected": 0, "rescheduled": 0, "dead": 0}
+    mock_connection.commit.assert_called_once()
+    mock_connection.rollback.assert_called_once()
+    assert PURCHASE_COUNTS["inserted"] == 0
+
+
+def test_log_retry_queue_stats(capsys):
+    """Tests that the queue's state is printed in CloudWatch's embedded metric format."""
+    log_retry_queue_stats({"pending": 3, "due": 1, "dead": 2, "oldest_age": 600.0})
+
+    record = json.loads(capsys.readouterr().out)
+    metrics = record["_aws"]["CloudWatchMetrics"][0]["Metrics"]
+    assert [metric["Name"] for metric in metrics] == [
+        "RetryQueueDepth", "RetryQueueDue", "RetryQueueDead", "RetryQueueOldestAge"]
+    assert record["RetryQueueDepth"] == 3
+    assert record["RetryQueueOldestAge"] == 600.0
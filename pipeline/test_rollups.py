@@ -0,0 +1,53 @@
+"""Tests for the hourly sales rollup rebuild script."""
+
+from unittest.mock import MagicMock
+from load import FLUSH_SALES_ROLLUPS, SALES_ROLLUP_UPSERTS
+from rollups import (
+    GET_ARCHIVED_PARTITIONS,
+    ROLLUP_TABLES,
+    TRUNCATE_ROLLUPS,
+    get_rebuild_queries,
+    rebuild_sales_rollups,
+)
+
+
+def test_rollup_statements():
+    """Tests that the loaders flush the transaction's pending purchases, and
+    the earlier purchases of releases given a new tag, while a rebuild reads
+    every purchase, each with one upsert per rollup table."""
+    assert FLUSH_SALES_ROLLUPS.count("FROM pending_sales_rollup AS purchase") == 3
+    assert FLUSH_SALES_ROLLUPS.count("FROM pending_tag_assignment AS assigned") == 2
+    rebuild_queries = get_rebuild_queries([])
+    assert len(rebuild_queries) == len(SALES_ROLLUP_UPSERTS) == len(ROLLUP_TABLES)
+    for table, query in zip(ROLLUP_TABLES, rebuild_queries):
+        assert f"INSERT INTO {table} AS rollup" in query
+        assert "FROM album_purchase" in query and "FROM track_purchase" in query
+        assert "purchase_archive" not in query
+        assert "pending_sales_rollup" not in query
+        assert "pending_tag_assignment" not in query
+
+
+def test_rebuild_reads_archived_partitions():
+    """Tests that a rebuild also reads the purchases of archived partitions,
+    as album or track purchases by the table they were archived from."""
+    for query in get_rebuild_queries(["album_purchase_2023_12", "track_purchase_2023_12"]):
+        assert ("SELECT album_id, NULL::INT AS track_id, timestamp, amount_usd, country_id\n"
+                "        FROM purchase_archive.album_purchase_2023_12") in query
+        assert ("SELECT NULL::INT, track_id, timestamp, amount_usd, country_id\n"
+                "        FROM purchase_archive.track_purchase_2023_12") in query
+
+
+def test_rebuild_sales_rollups():
+    """Tests that the rollups are emptied and refilled from every purchase,
+    archived or not, in one transaction, returning the rows written to each."""
+    connection = MagicMock()
+    cursor = connection.cursor.return_value.__enter__.return_value
+    cursor.fetchall.return_value = [("album_purchase_2023_12",)]
+    cursor.rowcount = 24
+
+    assert rebuild_sales_rollups(connection) == {table: 24 for table in ROLLUP_TABLES}
+
+    statements = [call.args[0] for call in cursor.execute.call_args_list]
+    assert statements == ([GET_ARCHIVED_PARTITIONS, TRUNCATE_ROLLUPS]
+                          + get_rebuild_queries(["album_purchase_2023_12"]))
+    connection.commit.assert_called_once()
@@ -0,0 +1,113 @@
+'''Tests for the scrape cache'''
+
+from unittest.mock import patch
+import pytest
+from scrape_cache import ScrapeCache, normalize_url
+
+
+@pytest.mark.parametrize("url_string, expected", [
+    ("https://artist.bandcamp.com/track/song", "https://artist.bandcamp.com/track/song"),
+    ("//artist.bandcamp.com/track/song", "https://artist.bandcamp.com/track/song"),
+    ("http://Artist.Bandcamp.com/track/song/", "https://artist.bandcamp.com/track/song"),
+    ("https://artist.bandcamp.com/track/song?from=feed#top",
+     "https://artist.bandcamp.com/track/song"),
+    ("artist.bandcamp.com/album/record", "https://artist.bandcamp.com/album/record"),
+])
+def test_normalize_url(url_string, expected):
+    '''Tests that every form of an item url maps to the same key'''
+    assert normalize_url(url_string) == expected
+
+
+@pytest.fixture
+def cache(tmp_path):
+    '''Scrape cache stored in a temporary file'''
+    return ScrapeCache(tmp_path / "cache.sqlite3", ttl=100, not_found_ttl=10,
+                       max_entries=2)
+
+
+def test_get_missing(cache):  # pylint: disable=redefined-outer-name
+    '''Tests that an unknown url is a miss'''
+    assert cache.get("https://example.com/track/t") is None
+    assert cache.misses == 1
+
+
+def test_set_and_get(cache):  # pylint: disable=redefined-outer-name
+    '''Tests that stored fields are returned for any form of the url'''
+    cache.set("https://example.com/track/t", ["tag1", "tag2"],
+              "https://example.com/album/a")
+
+    assert cache.get("//example.com/track/t/") == {
+        "tags": ["tag1", "tag2"],
+        "album_url": "https://example.com/album/a",
+        "not_found": False,
+    }
+    assert cache.hits == 1
+
+
+def test_not_found(cache):  # pylint: disable=redefined-outer-name
+    '''Tests that missing pages are negatively cached'''
+    cache.set_not_found("https://example.com/track/gone")
+    assert cache.get("https://example.com/track/gone")["not_found"]
+
+
+@patch("scrape_cache.time.time")
+def test_entries_expire(mock_time, cache):  # pylint: disable=redefined-outer-name
+    '''Tests that entries and negative entries expire after their ttl'''
+    mock_time.return_value = 1000
+    cache.set("https://example.com/track/t", ["tag1"])
+    cache.set_not_found("https://example.com/track/gone")
+
+    mock_time.return_value = 1050
+    assert cache.get("https://example.com/track/t") is not None
+    assert cache.get("https://example.com/track/gone") is None
+
+    mock_time.return_value = 1200
+    assert cache.get("https://example.com/track/t") is None
+
+
+@patch("scrape_cache.time.time")
+def test_evict_least_recently_used(mock_time, cache):  # pylint: disable=redefined-outer-name
+    '''Tests that the least recently used entries are evicted above the size bound'''
+    for now, url in enumerate(["https://example.com/1", "https://example.com/2",
+                               "https://example.com/3"]):
+        mock_time.return_value = 1000 + now
+        cache.set(url, ["tag"])
+
+    mock_time.return_value = 1010
+    cache.get("https://example.com/1")
+
+    assert cache.evict() == 1
+    assert cache.get("https://example.com/2") is None
+    assert cache.get("https://example.com/1") is not None
+    assert cache.get("https://example.com/3") is not None
+
+
+def test_close_persists(tmp_path):
+    '''Tests that the cache survives being closed and reopened'''
+    path = tmp_path / "cache.sqlite3"
+    cache = ScrapeCache(path)
+    cache.set("https://example.com/track/t", ["tag1"])
+    cache.close()
+
+    assert ScrapeCache(path).get("https://example.com/track/t")["tags"] == ["tag1"]
+
+
+@patch("scrape_cache.time.time")
+def test_album_tracks(mock_time, cache):  # pylint: disable=redefined-outer-name
+    '''Tests that tracks recorded from an album page resolve to the album until they expire'''
+    mock_time.return_value = 1000
+    cache.set_album_tracks("https://example.com/album/a",
+                           ["https://example.com/track/1", "https://example.com/track/2"],
+                           ["tag1"])
+
+    assert cache.get_album_track("//example.com/track/2") == {
+        "tags": ["tag1"],
+        "album_url": "https://example.com/album/a",
+        "not_found": False,
+    }
+    assert cache.get_album_track("https://example.com/track/3") is None
+    assert cache.album_track_hits == 1
+
+    mock_time.return_value = 1200
+    assert cache.get_album_track("https://example.com/track/1") is None
+    assert cache.evict() == 2
@@ -0,0 +1,87 @@
+'''Tests for the local bandcamp simulator'''
+
+import pytest
+
+import http_client
+from extract import extract_page_fields, get_sales_data
+from simulator import BandcampSimulator
+
+
+@pytest.fixture(autouse=True)
+def close_http_client():
+    '''Closes the shared http client after each test'''
+    yield
+    http_client.close()
+
+
+def start_simulator(**kwargs) -> tuple[BandcampSimulator, str]:
+    '''Starts a simulator without latency, returning it and the url of its feed'''
+    simulator = BandcampSimulator(latency=0, **kwargs)
+    return simulator, http_client.run(simulator.start())
+
+
+def test_feed_pages_forward():
+    '''Tests that the initial window holds every sale and pages start from their cursor'''
+    simulator, api_url = start_simulator(sales=120, releases=10)
+    try:
+        initial = http_client.run(http_client.get_json(f"{api_url}/get_initial", 10))
+        events = initial["feed_data"]["events"]
+        start_date = events[10]["utc_date"]
+        page = http_client.run(http_client.get_json(
+            f"{api_url}/get", 10, params={"start_date": str(start_date)}))
+    finally:
+        http_client.run(simulator.stop())
+
+    assert len(events) == 120
+    assert events == sorted(events, key=lambda event: event["utc_date"])
+    assert page["events"] == events[10:60]
+    assert page["end_date"] == events[59]["utc_date"]
+
+
+def test_pages_have_scrapable_fields():
+    '''Tests that album and track pages carry tags, track lists and album links,
+    padded to the configured size'''
+    simulator = BandcampSimulator(releases=1, page_bytes=5000)
+    release = simulator.create_catalogue(1)["artist0"]
+
+    album = simulator.render_page(release, "album")
+    track = simulator.render_page(release, "track")
+
+    assert len(album) >= 5000 and len(track) >= 5000
+    assert extract_page_fields(album)["tags"] == release["tags"]
+    assert len(extract_page_fields(album)["track_hrefs"]) == release["tracks"]
+    assert extract_page_fields(track)["album_href"] == "/album/record"
+
+
+def test_same_seed_same_day():
+    '''Tests that a seed always generates the same catalogue'''
+    assert BandcampSimulator(seed=3).create_catalogue(20) == \
+        BandcampSimulator(seed=3).create_catalogue(20)
+
+
+def test_get_sales_data_against_simulator():
+    '''Tests that a whole extract runs against the simulator'''
+    simulator, api_url = start_simulator(sales=40, releases=5)
+    try:
+        items, _ = get_sales_data(cache_path=None, archive_path=None, api_url=api_url)
+    finally:
+        http_client.run(simulator.stop())
+
+    assert len(items) == 40
+    assert all(item.get("album_tags") or item.get("track_tags") for item in items)
+    assert simulator.stats["feed_requests"] == 1
+    assert simulator.retries == 0
+
+
+def test_throttling_and_errors_are_retried():
+    '''Tests that injected 429 and 503 responses are counted and retried'''
+    simulator, api_url = start_simulator(sales=20, releases=5, throttle_rate=0.2,
+                                         error_rate=0.2, retry_after=0)
+    try:
+        items, _ = get_sales_data(cache_path=None, archive_path=None, api_url=api_url)
+    finally:
+        http_client.run(simulator.stop())
+
+    assert len(items) == 20
+    assert simulator.stats["throttled"] + simulator.stats["errors"] > 0
+    assert simulator.retries > 0
@@ -0,0 +1,193 @@
+"""Tests for the streaming pipeline."""
+
+import asyncio
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from stream import read_batch, stream_sales, summarise_latencies, run_streaming_pipeline
+
+
+def make_sale(index: int) -> dict:
+    """Returns a scraped album sale."""
+    return {
+        "utc_date": 1718801551.04217,
+        "url": f"//artist.bandcamp.com/album/album-{index}",
+        "item_type": "a",
+        "album_tags": ["#Tag "],
+        "currency": "USD",
+    }
+
+
+async def scrape_sales(count: int, delay: float = 0):
+    """Yields scraped sales, as if each took delay seconds to scrape."""
+    for index in range(count):
+        await asyncio.sleep(delay)
+        yield make_sale(index)
+
+
+@pytest.mark.asyncio
+async def test_read_batch_full():
+    """Tests that a batch is returned as soon as it is full."""
+    queue = asyncio.Queue()
+    for index in range(5):
+        queue.put_nowait(index)
+
+    assert await read_batch(queue, 3, 10) == ([0, 1, 2], False)
+
+
+@pytest.mark.asyncio
+async def test_read_batch_times_out():
+    """Tests that a partial batch is returned once the wait has passed."""
+    queue = asyncio.Queue()
+    queue.put_nowait(0)
+
+    assert await read_batch(queue, 3, 0.01) == ([0], False)
+
+
+@pytest.mark.asyncio
+async def test_read_batch_end_of_stream():
+    """Tests that the end of the stream is reported with the last sales."""
+    queue = asyncio.Queue()
+    for item in (0, 1, None):
+        queue.put_nowait(item)
+
+    assert await read_batch(queue, 3, 10) == ([0, 1], True)
+
+
+@pytest.mark.asyncio
+async def test_stream_sales_loads_in_micro_batches():
+    """Tests that every sale is transformed and loaded, in batches no bigger
+    than the batch size, while the scrape is still running."""
+    batches = []
+    scrape_finished = []
+
+    async def scrape():
+        async for sale in scrape_sales(20, delay=0.005):
+            yield sale
+        scrape_finished.append(len(batches))
+
+    def load_batch(batch):
+        batches.append(batch)
+        return True
+
+    latencies = await stream_sales(scrape(), load_batch, time.monotonic(),
+                                   batch_size=4, batch_wait=10)
+
+    assert [len(batch) for batch in batches] == [4] * 5
+    assert scrape_finished[0] > 0
+    assert batches[0][0]["url"] == "https://artist.bandcamp.com/album/album-0"
+    assert batches[0][0]["album_tags"] == ["tag"]
+    assert "currency" not in batches[0][0]
+    assert len(latencies) == 20
+    assert latencies == sorted(latencies)
+
+
+@pytest.mark.asyncio
+async def test_stream_sales_awaits_async_loader():
+    """Tests that a coroutine loader is awaited on the event loop, not run on a thread."""
+    loaded = []
+
+    async def load_batch(batch):
+        loaded.append(len(batch))
+        return True
+
+    with patch("stream.asyncio.to_thread") as mock_to_thread:
+        latencies = await stream_sales(scrape_sales(5), load_batch, time.monotonic(),
+                                       batch_size=2, batch_wait=10)
+
+    mock_to_thread.assert_not_called()
+    assert loaded == [2, 2, 1]
+    assert len(latencies) == 5
+
+
+@pytest.mark.asyncio
+async def test_stream_sales_skips_failed_batches():
+    """Tests that sales in a rolled back batch are not counted as loaded."""
+    latencies = await stream_sales(scrape_sales(6), lambda batch: len(batch) < 4,
+                                   time.monotonic(), batch_size=4, batch_wait=10)
+
+    assert len(latencies) == 2
+
+
+@pytest.mark.asyncio
+async def test_stream_sales_queue_is_bounded():
+    """Tests that a slow loader holds back the scrape once the queue is full."""
+    scraped = []
+
+    async def scrape():
+        for index in range(10):
+            scraped.append(index)
+            yield make_sale(index)
+
+    def load_batch(_batch):
+        time.sleep(0.05)
+        return True
+
+    task = asyncio.ensure_future(stream_sales(scrape(), load_batch, time.monotonic(),
+                                              batch_size=1, queue_size=2))
+    await asyncio.sleep(0.02)
+    assert len(scraped) <= 5
+    await task
+
+
+def test_summarise_latencies():
+    """Tests the latency percentiles."""
+    summary = summarise_latencies([float(value) for value in range(1, 101)])
+
+    assert summary == {"count": 100, "p50": 50.0, "p95": 95.0, "max": 100.0}
+    assert summarise_latencies([])["count"] == 0
+
+
+def make_sale_event(count: int) -> dict:
+    """Returns a feed event of count album sales."""
+    return {"event_type": "sale", "utc_date": 300.0,
+            "items": [{"item_type": "a", "url": f"//artist.bandcamp.com/album/album-{index}"}
+                      for index in range(count)]}
+
+
+@patch("stream.advance_feed_cursor")
+@patch("stream.get_feed_cursor", return_value=200.0)
+@patch("stream.get_connection")
+@patch("stream.load_sales_batch", return_value=True)
+@patch("stream.stream_list_of_items")
+@patch("stream.get_new_feed_events")
+def test_run_streaming_pipeline(mock_get_new_feed_events, mock_stream_list_of_items,
+                                mock_load_sales_batch, mock_get_connection,
+                                mock_get_feed_cursor, mock_advance_feed_cursor):
+    """Tests that the streaming pipeline loads every sale and then advances the cursor."""
+    mock_get_new_feed_events.return_value = [make_sale_event(3)]
+    mock_stream_list_of_items.side_effect = lambda *args, **kwargs: scrape_sales(3)
+    mock_get_connection.return_value = MagicMock()
+
+    latencies = run_streaming_pipeline(incremental=True, cache_path=None, archive_path=None)
+
+    assert len(latencies) == 3
+    assert sum(len(call.args[1]) for call in mock_load_sales_batch.call_args_list) == 3
+    mock_get_connection.return_value.close.assert_called_once()
+    mock_get_new_feed_events.assert_called_once_with(
+        mock_get_feed_cursor.return_value, archive=None)
+    mock_advance_feed_cursor.assert_called_once_with(300.0)
+
+
+@patch("stream.advance_feed_cursor")
+@patch("stream.get_feed_cursor", return_value=200.0)
+@patch("stream.get_connection")
+@patch("stream.load_sales_batch", side_effect=[True, False])
+@patch("stream.stream_list_of_items")
+@patch("stream.get_new_feed_events")
+def test_run_streaming_pipeline_keeps_cursor_after_failed_batch(
+        mock_get_new_feed_events, mock_stream_list_of_items, mock_load_sales_batch,  # pylint: disable=unused-argument
+        mock_get_connection, mock_get_feed_cursor, mock_advance_feed_cursor):  # pylint: disable=unused-argument
+    """Tests that the cursor stays put when a batch is rolled back, so the
+    next run fetches its sales again."""
+    mock_get_new_feed_events.return_value = [make_sale_event(3)]
+    mock_stream_list_of_items.side_effect = lambda *args, **kwargs: scrape_sales(3)
+    mock_get_connection.return_value = MagicMock()
+
+    latencies = run_streaming_pipeline(incremental=True, cache_path=None, archive_path=None,
+                                       batch_size=2)
+
+    assert len(latencies) == 2
+    mock_advance_feed_cursor.assert_not_called()
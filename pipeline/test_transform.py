@@ -145,6 +145,8 @@ def test_transform_sales_data_valid():
             "artist_url": "https://example_artist.bandcamp.com",
         }
     ]
+    expected_output[0]["feed_item"] = {
+        key: value for key, value in input_data[0].items() if key != "album_tags"}
 
     assert transform_sales_data(input_data) == expected_output
 
@@ -19,6 +19,7 @@ KEYS_TO_REMOVE = [
     "item_slug",
     "country_code",
 ]
+SCRAPED_KEYS = ["album_tags", "track_tags", "album_url"]
 
 
 def convert_unix_to_datetime(unix_timestamp: float) -> str:
@@ -65,23 +66,34 @@ def clean_tags(tags: list[str]) -> list[str]:
     return [tag.lstrip("#").strip().lower() for tag in tags]
 
 
-def transform_sales_data(sales_data: list[dict]) -> list[dict]:
-    """Cleans and formats the sales data, returning it as a list of dictionaries."""
+def get_feed_item(item: dict) -> dict:
+    """Returns a copy of an item as the salesfeed gave it, without its scraped fields."""
 
-    logging.info("Transforming sales data...")
+    return {key: value for key, value in item.items() if key not in SCRAPED_KEYS}
+
+
+def transform_sale(item: dict) -> dict:
+    """Cleans and formats a single sale, returning it as a dictionary. The item
+    as the feed gave it is kept as its feed_item, so that a sale the loader
+    defers can be scraped and transformed again from scratch."""
 
-    cleaned_sales = []
+    feed_item = get_feed_item(item)
+    item["utc_date"] = convert_unix_to_datetime(item["utc_date"])
+    item["url"] = insert_protocol_url(item["url"])
+    item["artist_url"] = get_stem_url(item["url"])
 
-    for item in sales_data:
+    item["album_tags"] = clean_tags(item.get("album_tags"))
+    item["track_tags"] = clean_tags(item.get("track_tags"))
 
-        item["utc_date"] = convert_unix_to_datetime(item["utc_date"])
-        item["url"] = insert_protocol_url(item["url"])
-        item["artist_url"] = get_stem_url(item["url"])
+    return {**clean_data(item), "feed_item": feed_item}
 
-        item["album_tags"] = clean_tags(item.get("album_tags"))
-        item["track_tags"] = clean_tags(item.get("track_tags"))
 
-        cleaned_sales.append(clean_data(item))
+def transform_sales_data(sales_data: list[dict]) -> list[dict]:
+    """Cleans and formats the sales data, returning it as a list of dictionaries."""
+
+    logging.info("Transforming sales data...")
+
+    cleaned_sales = [transform_sale(item) for item in sales_data]
 
     logging.info("Transform complete!")
 
@@ -90,5 +102,5 @@ def transform_sales_data(sales_data: list[dict]) -> list[dict]:
 
 if __name__ == "__main__":
 
-    list_of_items = get_sales_data()
+    list_of_items, _ = get_sales_data()
     cleaned_data = transform_sales_data(list_of_items)
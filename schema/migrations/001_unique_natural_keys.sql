@@ -0,0 +1,55 @@
+-- Declares the natural keys of artist and the tag assignment tables, so the
+-- pipeline can upsert them with ON CONFLICT instead of checking then inserting.
+-- Existing duplicates are merged into the row with the lowest id first.
+-- Safe to run more than once.
+
+BEGIN;
+
+LOCK TABLE artist, album, track, album_tag_assignment, track_tag_assignment
+IN SHARE ROW EXCLUSIVE MODE;
+
+CREATE TEMPORARY TABLE duplicate_artist ON COMMIT DROP AS
+SELECT artist_id, MIN(artist_id) OVER (PARTITION BY name, url) AS kept_artist_id
+FROM artist;
+
+DELETE FROM duplicate_artist WHERE artist_id = kept_artist_id;
+
+UPDATE album SET artist_id = duplicate_artist.kept_artist_id
+FROM duplicate_artist WHERE album.artist_id = duplicate_artist.artist_id;
+
+UPDATE track SET artist_id = duplicate_artist.kept_artist_id
+FROM duplicate_artist WHERE track.artist_id = duplicate_artist.artist_id;
+
+DELETE FROM artist USING duplicate_artist
+WHERE artist.artist_id = duplicate_artist.artist_id;
+
+DELETE FROM album_tag_assignment
+WHERE album_genre_assignment_id NOT IN (
+    SELECT MIN(album_genre_assignment_id) FROM album_tag_assignment
+    GROUP BY album_id, tag_id
+);
+
+DELETE FROM track_tag_assignment
+WHERE track_tag_assignment_id NOT IN (
+    SELECT MIN(track_tag_assignment_id) FROM track_tag_assignment
+    GROUP BY track_id, tag_id
+);
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'artist_name_url_key') THEN
+        ALTER TABLE artist ADD CONSTRAINT artist_name_url_key UNIQUE (name, url);
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                   WHERE conname = 'album_tag_assignment_album_id_tag_id_key') THEN
+        ALTER TABLE album_tag_assignment
+        ADD CONSTRAINT album_tag_assignment_album_id_tag_id_key UNIQUE (album_id, tag_id);
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                   WHERE conname = 'track_tag_assignment_track_id_tag_id_key') THEN
+        ALTER TABLE track_tag_assignment
+        ADD CONSTRAINT track_tag_assignment_track_id_tag_id_key UNIQUE (track_id, tag_id);
+    END IF;
+END $$;
+
+COMMIT;
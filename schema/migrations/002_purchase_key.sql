@@ -0,0 +1,70 @@
+-- Gives every purchase a deterministic identity, so a sale seen by two runs is
+-- only stored once. The key is the sha256 of the item url, time, amount and
+-- country joined by a unit separator, exactly as get_purchase_key in
+-- pipeline/load.py builds it. Existing duplicates are removed, keeping the
+-- first purchase loaded, and the number removed from each table is reported.
+-- Safe to run more than once.
+
+BEGIN;
+
+LOCK TABLE album_purchase, track_purchase IN SHARE ROW EXCLUSIVE MODE;
+
+ALTER TABLE album_purchase ADD COLUMN IF NOT EXISTS purchase_key CHAR(64);
+ALTER TABLE track_purchase ADD COLUMN IF NOT EXISTS purchase_key CHAR(64);
+
+UPDATE album_purchase
+SET purchase_key = encode(sha256(convert_to(concat_ws(E'\x1f',
+    album.url,
+    to_char(album_purchase.timestamp, 'YYYY-MM-DD HH24:MI:SS'),
+    to_char(album_purchase.amount_usd, 'FM9990.00'),
+    country.name), 'UTF8')), 'hex')
+FROM album, country
+WHERE album.album_id = album_purchase.album_id
+AND country.country_id = album_purchase.country_id
+AND album_purchase.purchase_key IS NULL;
+
+UPDATE track_purchase
+SET purchase_key = encode(sha256(convert_to(concat_ws(E'\x1f',
+    track.url,
+    to_char(track_purchase.timestamp, 'YYYY-MM-DD HH24:MI:SS'),
+    to_char(track_purchase.amount_usd, 'FM9990.00'),
+    country.name), 'UTF8')), 'hex')
+FROM track, country
+WHERE track.track_id = track_purchase.track_id
+AND country.country_id = track_purchase.country_id
+AND track_purchase.purchase_key IS NULL;
+
+DO $$
+DECLARE
+    removed INT;
+BEGIN
+    DELETE FROM album_purchase
+    WHERE album_purchase_id NOT IN (
+        SELECT MIN(album_purchase_id) FROM album_purchase GROUP BY purchase_key
+    );
+    GET DIAGNOSTICS removed = ROW_COUNT;
+    RAISE NOTICE 'Removed % duplicate album purchases', removed;
+
+    DELETE FROM track_purchase
+    WHERE track_purchase_id NOT IN (
+        SELECT MIN(track_purchase_id) FROM track_purchase GROUP BY purchase_key
+    );
+    GET DIAGNOSTICS removed = ROW_COUNT;
+    RAISE NOTICE 'Removed % duplicate track purchases', removed;
+
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                   WHERE conname = 'album_purchase_purchase_key_key') THEN
+        ALTER TABLE album_purchase
+        ADD CONSTRAINT album_purchase_purchase_key_key UNIQUE (purchase_key);
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                   WHERE conname = 'track_purchase_purchase_key_key') THEN
+        ALTER TABLE track_purchase
+        ADD CONSTRAINT track_purchase_purchase_key_key UNIQUE (purchase_key);
+    END IF;
+END $$;
+
+ALTER TABLE album_purchase ALTER COLUMN purchase_key SET NOT NULL;
+ALTER TABLE track_purchase ALTER COLUMN purchase_key SET NOT NULL;
+
+COMMIT;
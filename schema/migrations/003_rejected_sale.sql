@@ -0,0 +1,11 @@
+-- Adds the table where the pipeline records sales it could not load, so a bad
+-- sale is kept for inspection instead of failing the rest of its batch.
+-- Safe to run more than once.
+
+CREATE TABLE IF NOT EXISTS rejected_sale (
+    rejected_sale_id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+    rejected_at TIMESTAMP(0) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    item_url TEXT,
+    sale JSONB NOT NULL,
+    error TEXT NOT NULL
+);
@@ -0,0 +1,19 @@
+-- Adds the queue of sales whose item page could not be fully scraped, so they
+-- are scraped again and loaded by a later run instead of being dropped. A
+-- sale whose next_attempt_at is NULL has used up its attempts and is dead.
+-- Safe to run more than once.
+
+CREATE TABLE IF NOT EXISTS sale_retry_queue (
+    sale_retry_id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+    purchase_key CHAR(64) UNIQUE NOT NULL,
+    item_url TEXT NOT NULL,
+    sale JSONB NOT NULL,
+    reason TEXT NOT NULL,
+    attempts SMALLINT NOT NULL DEFAULT 0,
+    first_failed_at TIMESTAMP(0) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_attempt_at TIMESTAMP(0),
+    next_attempt_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS sale_retry_queue_next_attempt_at_idx
+ON sale_retry_queue (next_attempt_at) WHERE next_attempt_at IS NOT NULL;
@@ -0,0 +1,17 @@
+-- Adds the queue of feed items that pipeline workers lease, so runs that
+-- overlap, or workers on several machines, share one feed window without
+-- scraping the same items. Safe to run more than once.
+
+CREATE TABLE IF NOT EXISTS feed_work_item (
+    work_item_id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+    item_key CHAR(64) UNIQUE NOT NULL,
+    item JSONB NOT NULL,
+    leased_by TEXT,
+    lease_expires_at TIMESTAMP(0),
+    attempts SMALLINT NOT NULL DEFAULT 0,
+    queued_at TIMESTAMP(0) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    completed_at TIMESTAMP(0)
+);
+
+CREATE INDEX IF NOT EXISTS feed_work_item_pending_idx
+ON feed_work_item (work_item_id) WHERE completed_at IS NULL;
@@ -0,0 +1,110 @@
+-- Rebuilds album_purchase and track_purchase as tables partitioned by month on
+-- timestamp, so queries over a timeframe only read the months it covers, with a
+-- BRIN index on timestamp within each month. A partition is created for every
+-- month from the first purchase to three months ahead, and a default partition
+-- catches anything outside them; the pipeline creates later months as it runs.
+-- A partitioned table's unique keys must include timestamp, which purchase_key
+-- is already derived from, so the keys stay unique per sale.
+-- The purchases are copied across with their ids, and the old tables dropped.
+-- Safe to run more than once.
+
+BEGIN;
+
+DO $$
+DECLARE
+    purchase_table TEXT;
+    partition_month DATE;
+    last_month DATE := date_trunc('month', CURRENT_DATE + INTERVAL '3 months');
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'album_purchase'::regclass) = 'p' THEN
+        RAISE NOTICE 'Purchase tables are already partitioned';
+        RETURN;
+    END IF;
+
+    LOCK TABLE album_purchase, track_purchase IN ACCESS EXCLUSIVE MODE;
+
+    FOREACH purchase_table IN ARRAY ARRAY['album_purchase', 'track_purchase'] LOOP
+        EXECUTE format('ALTER TABLE %I RENAME TO %I',
+                       purchase_table, purchase_table || '_unpartitioned');
+        EXECUTE format('ALTER INDEX %I RENAME TO %I',
+                       purchase_table || '_pkey', purchase_table || '_unpartitioned_pkey');
+        EXECUTE format('ALTER INDEX %I RENAME TO %I', purchase_table || '_purchase_key_key',
+                       purchase_table || '_unpartitioned_purchase_key_key');
+        EXECUTE format('ALTER SEQUENCE %s RENAME TO %I',
+                       pg_get_serial_sequence(purchase_table || '_unpartitioned',
+                                              purchase_table || '_id'),
+                       purchase_table || '_unpartitioned_id_seq');
+    END LOOP;
+
+    CREATE TABLE album_purchase (
+        album_purchase_id INT GENERATED ALWAYS AS IDENTITY,
+        album_id INT NOT NULL,
+        timestamp TIMESTAMP(0) NOT NULL,
+        amount_usd DECIMAL(6,2) NOT NULL,
+        country_id SMALLINT NOT NULL,
+        purchase_key CHAR(64) NOT NULL,
+        PRIMARY KEY (album_purchase_id, timestamp),
+        CONSTRAINT album_purchase_purchase_key_key UNIQUE (purchase_key, timestamp),
+        FOREIGN KEY (album_id) REFERENCES album(album_id),
+        FOREIGN KEY (country_id) REFERENCES country(country_id)
+    ) PARTITION BY RANGE (timestamp);
+
+    CREATE TABLE track_purchase (
+        track_purchase_id INT GENERATED ALWAYS AS IDENTITY,
+        track_id INT NOT NULL,
+        timestamp TIMESTAMP(0) NOT NULL,
+        amount_usd DECIMAL(6,2) NOT NULL,
+        country_id SMALLINT NOT NULL,
+        purchase_key CHAR(64) NOT NULL,
+        PRIMARY KEY (track_purchase_id, timestamp),
+        CONSTRAINT track_purchase_purchase_key_key UNIQUE (purchase_key, timestamp),
+        FOREIGN KEY (track_id) REFERENCES track(track_id),
+        FOREIGN KEY (country_id) REFERENCES country(country_id)
+    ) PARTITION BY RANGE (timestamp);
+
+    SELECT date_trunc('month', LEAST(MIN(first_timestamp), CURRENT_DATE)) INTO partition_month
+    FROM (SELECT MIN(timestamp) AS first_timestamp FROM album_purchase_unpartitioned
+          UNION ALL
+          SELECT MIN(timestamp) FROM track_purchase_unpartitioned) AS first_purchases;
+
+    WHILE partition_month <= last_month LOOP
+        FOREACH purchase_table IN ARRAY ARRAY['album_purchase', 'track_purchase'] LOOP
+            EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                           purchase_table || to_char(partition_month, '_YYYY_MM'), purchase_table,
+                           partition_month, partition_month + INTERVAL '1 month');
+        END LOOP;
+        partition_month := partition_month + INTERVAL '1 month';
+    END LOOP;
+
+    CREATE TABLE album_purchase_default PARTITION OF album_purchase DEFAULT;
+    CREATE TABLE track_purchase_default PARTITION OF track_purchase DEFAULT;
+
+    INSERT INTO album_purchase
+        (album_purchase_id, album_id, timestamp, amount_usd, country_id, purchase_key)
+    OVERRIDING SYSTEM VALUE
+    SELECT album_purchase_id, album_id, timestamp, amount_usd, country_id, purchase_key
+    FROM album_purchase_unpartitioned
+    ORDER BY timestamp;
+
+    INSERT INTO track_purchase
+        (track_purchase_id, track_id, timestamp, amount_usd, country_id, purchase_key)
+    OVERRIDING SYSTEM VALUE
+    SELECT track_purchase_id, track_id, timestamp, amount_usd, country_id, purchase_key
+    FROM track_purchase_unpartitioned
+    ORDER BY timestamp;
+
+    PERFORM setval(pg_get_serial_sequence('album_purchase', 'album_purchase_id'),
+                   COALESCE(MAX(album_purchase_id), 0) + 1, false)
+    FROM album_purchase;
+    PERFORM setval(pg_get_serial_sequence('track_purchase', 'track_purchase_id'),
+                   COALESCE(MAX(track_purchase_id), 0) + 1, false)
+    FROM track_purchase;
+
+    CREATE INDEX album_purchase_timestamp_idx ON album_purchase USING BRIN (timestamp);
+    CREATE INDEX track_purchase_timestamp_idx ON track_purchase USING BRIN (timestamp);
+
+    DROP TABLE album_purchase_unpartitioned;
+    DROP TABLE track_purchase_unpartitioned;
+END $$;
+
+COMMIT;
@@ -0,0 +1,18 @@
+-- Indexes the columns the dashboard, PDF report and notifications join and
+-- filter on. artist.name needs no index of its own, as the unique key on
+-- artist(name, url) already serves lookups by name, and neither do the
+-- album_id and track_id of the tag assignments, which lead their unique keys.
+-- The indexes on the partitioned purchase tables are created on every
+-- partition, and on each partition the pipeline creates from now on.
+-- Safe to run more than once.
+
+CREATE INDEX IF NOT EXISTS album_artist_id_idx ON album (artist_id);
+CREATE INDEX IF NOT EXISTS track_artist_id_idx ON track (artist_id);
+
+CREATE INDEX IF NOT EXISTS album_tag_assignment_tag_id_idx ON album_tag_assignment (tag_id);
+CREATE INDEX IF NOT EXISTS track_tag_assignment_tag_id_idx ON track_tag_assignment (tag_id);
+
+CREATE INDEX IF NOT EXISTS album_purchase_album_id_idx ON album_purchase (album_id);
+CREATE INDEX IF NOT EXISTS album_purchase_country_id_idx ON album_purchase (country_id);
+CREATE INDEX IF NOT EXISTS track_purchase_track_id_idx ON track_purchase (track_id);
+CREATE INDEX IF NOT EXISTS track_purchase_country_id_idx ON track_purchase (country_id);
@@ -0,0 +1,88 @@
+-- Creates the hourly sales rollups, which hold the number of album and track
+-- sales of every hour, and what they came to in USD, for each artist, tag and
+-- country, and fills them from the purchases already loaded. From then on the
+-- pipeline adds each transaction's purchases to them as it commits, and
+-- `python3 rollups.py` in pipeline/ rebuilds them from the purchases.
+-- Run it before deploying a pipeline that writes to them. A rollup that
+-- already has rows is left as it is, so it is safe to run more than once.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS artist_hourly_sales (
+    artist_id INT NOT NULL,
+    hour TIMESTAMP(0) NOT NULL,
+    album_sales INT NOT NULL,
+    track_sales INT NOT NULL,
+    album_usd DECIMAL(12,2) NOT NULL,
+    track_usd DECIMAL(12,2) NOT NULL,
+    PRIMARY KEY (artist_id, hour),
+    FOREIGN KEY (artist_id) REFERENCES artist(artist_id)
+);
+
+CREATE TABLE IF NOT EXISTS tag_hourly_sales (
+    tag_id SMALLINT NOT NULL,
+    hour TIMESTAMP(0) NOT NULL,
+    album_sales INT NOT NULL,
+    track_sales INT NOT NULL,
+    album_usd DECIMAL(12,2) NOT NULL,
+    track_usd DECIMAL(12,2) NOT NULL,
+    PRIMARY KEY (tag_id, hour),
+    FOREIGN KEY (tag_id) REFERENCES tag(tag_id)
+);
+
+CREATE TABLE IF NOT EXISTS country_hourly_sales (
+    country_id SMALLINT NOT NULL,
+    hour TIMESTAMP(0) NOT NULL,
+    album_sales INT NOT NULL,
+    track_sales INT NOT NULL,
+    album_usd DECIMAL(12,2) NOT NULL,
+    track_usd DECIMAL(12,2) NOT NULL,
+    PRIMARY KEY (country_id, hour),
+    FOREIGN KEY (country_id) REFERENCES country(country_id)
+);
+
+LOCK TABLE artist_hourly_sales, tag_hourly_sales, country_hourly_sales IN EXCLUSIVE MODE;
+
+CREATE TEMPORARY VIEW purchase AS
+SELECT album_id, NULL::INT AS track_id, timestamp, amount_usd, country_id FROM album_purchase
+UNION ALL
+SELECT NULL::INT, track_id, timestamp, amount_usd, country_id FROM track_purchase;
+
+INSERT INTO artist_hourly_sales
+    (artist_id, hour, album_sales, track_sales, album_usd, track_usd)
+SELECT COALESCE(album.artist_id, track.artist_id), date_trunc('hour', purchase.timestamp),
+       COUNT(purchase.album_id), COUNT(purchase.track_id),
+       COALESCE(SUM(purchase.amount_usd) FILTER (WHERE purchase.album_id IS NOT NULL), 0),
+       COALESCE(SUM(purchase.amount_usd) FILTER (WHERE purchase.track_id IS NOT NULL), 0)
+FROM purchase
+LEFT JOIN album ON album.album_id = purchase.album_id
+LEFT JOIN track ON track.track_id = purchase.track_id
+WHERE NOT EXISTS (SELECT 1 FROM artist_hourly_sales)
+GROUP BY 1, 2;
+
+INSERT INTO tag_hourly_sales
+    (tag_id, hour, album_sales, track_sales, album_usd, track_usd)
+SELECT COALESCE(album_tag.tag_id, track_tag.tag_id), date_trunc('hour', purchase.timestamp),
+       COUNT(purchase.album_id), COUNT(purchase.track_id),
+       COALESCE(SUM(purchase.amount_usd) FILTER (WHERE purchase.album_id IS NOT NULL), 0),
+       COALESCE(SUM(purchase.amount_usd) FILTER (WHERE purchase.track_id IS NOT NULL), 0)
+FROM purchase
+LEFT JOIN album_tag_assignment AS album_tag ON album_tag.album_id = purchase.album_id
+LEFT JOIN track_tag_assignment AS track_tag ON track_tag.track_id = purchase.track_id
+WHERE COALESCE(album_tag.tag_id, track_tag.tag_id) IS NOT NULL
+AND NOT EXISTS (SELECT 1 FROM tag_hourly_sales)
+GROUP BY 1, 2;
+
+INSERT INTO country_hourly_sales
+    (country_id, hour, album_sales, track_sales, album_usd, track_usd)
+SELECT purchase.country_id, date_trunc('hour', purchase.timestamp),
+       COUNT(purchase.album_id), COUNT(purchase.track_id),
+       COALESCE(SUM(purchase.amount_usd) FILTER (WHERE purchase.album_id IS NOT NULL), 0),
+       COALESCE(SUM(purchase.amount_usd) FILTER (WHERE purchase.track_id IS NOT NULL), 0)
+FROM purchase
+WHERE NOT EXISTS (SELECT 1 FROM country_hourly_sales)
+GROUP BY 1, 2;
+
+DROP VIEW purchase;
+
+COMMIT;
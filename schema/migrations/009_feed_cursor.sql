@@ -0,0 +1,11 @@
+-- Adds the table holding the timestamp of the last salesfeed event whose
+-- sales were all loaded, which incremental runs page forward from. It was
+-- kept in a file on the machine that ran the pipeline, so a cold start or
+-- another machine started again from the initial feed window. Safe to run
+-- more than once.
+
+CREATE TABLE IF NOT EXISTS feed_cursor (
+    feed_name TEXT PRIMARY KEY,
+    last_event_date DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMP(0) NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
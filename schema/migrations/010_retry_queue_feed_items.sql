@@ -0,0 +1,11 @@
+-- Turns the sales waiting in the retry queue back into the items the salesfeed
+-- gave, as the pipeline now queues them, so a drain transforms them again
+-- rather than loading a transformed sale as it was queued. Their scraped
+-- fields are dropped, to be scraped again, and their time is turned back into
+-- a Unix timestamp. Safe to run more than once.
+
+UPDATE sale_retry_queue
+SET sale = sale - 'album_tags' - 'track_tags' - 'album_url' - 'artist_url'
+    || jsonb_build_object('utc_date', to_jsonb(
+        EXTRACT(EPOCH FROM (sale->>'utc_date')::TIMESTAMP)::NUMERIC(16, 6)))
+WHERE jsonb_typeof(sale->'utc_date') = 'string';
@@ -0,0 +1,9 @@
+-- Lets a feed item that keeps failing be given up on rather than leased
+-- forever: an item whose lease has run out on its last attempt is marked
+-- dead, and left out of the index of pending work. Safe to run more than once.
+
+ALTER TABLE feed_work_item ADD COLUMN IF NOT EXISTS dead_at TIMESTAMP(0);
+
+DROP INDEX IF EXISTS feed_work_item_pending_idx;
+CREATE INDEX feed_work_item_pending_idx
+ON feed_work_item (work_item_id) WHERE completed_at IS NULL AND dead_at IS NULL;
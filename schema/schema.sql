@@ -1,3 +1,10 @@
+DROP TABLE IF EXISTS feed_cursor;
+DROP TABLE IF EXISTS country_hourly_sales;
+DROP TABLE IF EXISTS tag_hourly_sales;
+DROP TABLE IF EXISTS artist_hourly_sales;
+DROP TABLE IF EXISTS feed_work_item;
+DROP TABLE IF EXISTS sale_retry_queue;
+DROP TABLE IF EXISTS rejected_sale;
 DROP TABLE IF EXISTS track_tag_assignment;
 DROP TABLE IF EXISTS album_tag_assignment;
 DROP TABLE IF EXISTS tag;
@@ -19,7 +26,8 @@ CREATE TABLE subscriber (
 CREATE TABLE artist (
     artist_id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
     name TEXT NOT NULL,
-    url TEXT NOT NULL
+    url TEXT NOT NULL,
+    UNIQUE (name, url)
 );
 
 CREATE TABLE album (
@@ -30,6 +38,8 @@ CREATE TABLE album (
     FOREIGN KEY (artist_id) REFERENCES artist(artist_id)
 );
 
+CREATE INDEX album_artist_id_idx ON album (artist_id);
+
 CREATE TABLE track (
     track_id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
     title TEXT NOT NULL,
@@ -39,30 +49,50 @@ CREATE TABLE track (
     FOREIGN KEY (artist_id) REFERENCES artist(artist_id)  
 );
 
+CREATE INDEX track_artist_id_idx ON track (artist_id);
+
 CREATE TABLE country (
     country_id SMALLINT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
     name TEXT UNIQUE NOT NULL
 );
 
 CREATE TABLE album_purchase (
-    album_purchase_id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+    album_purchase_id INT GENERATED ALWAYS AS IDENTITY,
     album_id INT NOT NULL,
     timestamp TIMESTAMP(0) NOT NULL,
     amount_usd DECIMAL(6,2) NOT NULL,
     country_id SMALLINT NOT NULL,
+    purchase_key CHAR(64) NOT NULL,
+    PRIMARY KEY (album_purchase_id, timestamp),
+    CONSTRAINT album_purchase_purchase_key_key UNIQUE (purchase_key, timestamp),
     FOREIGN KEY (album_id) REFERENCES album(album_id),
     FOREIGN KEY (country_id) REFERENCES country(country_id)
-);
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE album_purchase_default PARTITION OF album_purchase DEFAULT;
+
+CREATE INDEX album_purchase_timestamp_idx ON album_purchase USING BRIN (timestamp);
+CREATE INDEX album_purchase_album_id_idx ON album_purchase (album_id);
+CREATE INDEX album_purchase_country_id_idx ON album_purchase (country_id);
 
 CREATE TABLE track_purchase (
-    track_purchase_id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+    track_purchase_id INT GENERATED ALWAYS AS IDENTITY,
     track_id INT NOT NULL,
     timestamp TIMESTAMP(0) NOT NULL,
     amount_usd DECIMAL(6,2) NOT NULL,
     country_id SMALLINT NOT NULL,
+    purchase_key CHAR(64) NOT NULL,
+    PRIMARY KEY (track_purchase_id, timestamp),
+    CONSTRAINT track_purchase_purchase_key_key UNIQUE (purchase_key, timestamp),
     FOREIGN KEY (track_id) REFERENCES track(track_id),
     FOREIGN KEY (country_id) REFERENCES country(country_id)
-);
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE track_purchase_default PARTITION OF track_purchase DEFAULT;
+
+CREATE INDEX track_purchase_timestamp_idx ON track_purchase USING BRIN (timestamp);
+CREATE INDEX track_purchase_track_id_idx ON track_purchase (track_id);
+CREATE INDEX track_purchase_country_id_idx ON track_purchase (country_id);
 
 CREATE TABLE tag (
     tag_id SMALLINT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
@@ -73,14 +103,97 @@ CREATE TABLE album_tag_assignment (
     album_genre_assignment_id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
     tag_id SMALLINT NOT NULL,
     album_id INT NOT NULL,
+    UNIQUE (album_id, tag_id),
     FOREIGN KEY (tag_id) REFERENCES tag(tag_id),
     FOREIGN KEY (album_id) REFERENCES album(album_id)
 );
 
+CREATE INDEX album_tag_assignment_tag_id_idx ON album_tag_assignment (tag_id);
+
 CREATE TABLE track_tag_assignment (
     track_tag_assignment_id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
     tag_id SMALLINT NOT NULL,
     track_id INT NOT NULL,
+    UNIQUE (track_id, tag_id),
     FOREIGN KEY (tag_id) REFERENCES tag(tag_id),
     FOREIGN KEY (track_id) REFERENCES track(track_id)
-);
\ No newline at end of file
+);
+
+CREATE INDEX track_tag_assignment_tag_id_idx ON track_tag_assignment (tag_id);
+
+CREATE TABLE rejected_sale (
+    rejected_sale_id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+    rejected_at TIMESTAMP(0) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    item_url TEXT,
+    sale JSONB NOT NULL,
+    error TEXT NOT NULL
+);
+
+CREATE TABLE sale_retry_queue (
+    sale_retry_id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+    purchase_key CHAR(64) UNIQUE NOT NULL,
+    item_url TEXT NOT NULL,
+    sale JSONB NOT NULL,
+    reason TEXT NOT NULL,
+    attempts SMALLINT NOT NULL DEFAULT 0,
+    first_failed_at TIMESTAMP(0) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_attempt_at TIMESTAMP(0),
+    next_attempt_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX sale_retry_queue_next_attempt_at_idx
+ON sale_retry_queue (next_attempt_at) WHERE next_attempt_at IS NOT NULL;
+
+CREATE TABLE feed_work_item (
+    work_item_id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+    item_key CHAR(64) UNIQUE NOT NULL,
+    item JSONB NOT NULL,
+    leased_by TEXT,
+    lease_expires_at TIMESTAMP(0),
+    attempts SMALLINT NOT NULL DEFAULT 0,
+    queued_at TIMESTAMP(0) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    completed_at TIMESTAMP(0),
+    dead_at TIMESTAMP(0)
+);
+
+CREATE INDEX feed_work_item_pending_idx
+ON feed_work_item (work_item_id) WHERE completed_at IS NULL AND dead_at IS NULL;
+
+CREATE TABLE artist_hourly_sales (
+    artist_id INT NOT NULL,
+    hour TIMESTAMP(0) NOT NULL,
+    album_sales INT NOT NULL,
+    track_sales INT NOT NULL,
+    album_usd DECIMAL(12,2) NOT NULL,
+    track_usd DECIMAL(12,2) NOT NULL,
+    PRIMARY KEY (artist_id, hour),
+    FOREIGN KEY (artist_id) REFERENCES artist(artist_id)
+);
+
+CREATE TABLE tag_hourly_sales (
+    tag_id SMALLINT NOT NULL,
+    hour TIMESTAMP(0) NOT NULL,
+    album_sales INT NOT NULL,
+    track_sales INT NOT NULL,
+    album_usd DECIMAL(12,2) NOT NULL,
+    track_usd DECIMAL(12,2) NOT NULL,
+    PRIMARY KEY (tag_id, hour),
+    FOREIGN KEY (tag_id) REFERENCES tag(tag_id)
+);
+
+CREATE TABLE country_hourly_sales (
+    country_id SMALLINT NOT NULL,
+    hour TIMESTAMP(0) NOT NULL,
+    album_sales INT NOT NULL,
+    track_sales INT NOT NULL,
+    album_usd DECIMAL(12,2) NOT NULL,
+    track_usd DECIMAL(12,2) NOT NULL,
+    PRIMARY KEY (country_id, hour),
+    FOREIGN KEY (country_id) REFERENCES country(country_id)
+);
+
+CREATE TABLE feed_cursor (
+    feed_name TEXT PRIMARY KEY,
+    last_event_date DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMP(0) NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,167 @@
+"""Correctness tests for the dashboard's artist leaderboards against the queries they
+replaced.
+
+Builds schema.sql in a schema of its own on the Postgres at QUERY_PLAN_DB_URL and
+seeds it with a few artists whose album and track sales all differ, one artist with
+no releases, and two artists sharing a name, rolled up by the migration that creates
+the hourly sales rollups. get_popular_artists and get_sales must then return exactly
+what the replaced queries, kept in dashboard/benchmark_leaderboard.py, return on the
+same data. get_popular_artists is also checked on the sales the replaced query got
+wrong: an artist with only track sales, and track sales outside the timeframe.
+Skipped unless QUERY_PLAN_DB_URL is set, and the seeded schema is dropped at the end.
+
+Run with: QUERY_PLAN_DB_URL="host=localhost dbname=postgres" pytest test_leaderboards.py
+"""
+
+from os import environ as ENV
+from pathlib import Path
+import sys
+
+import pytest
+
+psycopg = pytest.importorskip("psycopg")
+pytest.importorskip("streamlit")
+pd = pytest.importorskip("pandas")
+
+# pylint: disable=wrong-import-position
+from psycopg.rows import dict_row
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "dashboard"))
+
+import database
+from benchmark_leaderboard import LEGACY_POPULAR_ARTISTS, LEGACY_SALES
+# pylint: enable=wrong-import-position
+
+SCHEMA_PATH = Path(__file__).parent / "schema.sql"
+ROLLUP_MIGRATION_PATH = Path(__file__).parent / "migrations" / "008_hourly_sales_rollups.sql"
+TEST_SCHEMA = "leaderboard_test"
+TIMEFRAME = "1 day"
+
+SEED_STATEMENTS = [
+    """
+    INSERT INTO artist(name, url)
+    SELECT 'Artist ' || i, 'https://artist' || i || '.bandcamp.com'
+    FROM generate_series(1, 10) AS i
+    """,
+    "INSERT INTO artist(name, url) VALUES ('Artist 1', 'https://another-artist1.bandcamp.com')",
+    """
+    INSERT INTO album(title, artist_id, url)
+    SELECT 'Album ' || i, i, 'https://bandcamp.com/album/a' || i
+    FROM generate_series(1, 9) AS i
+    """,
+    """
+    INSERT INTO album(title, artist_id, url)
+    VALUES ('Album 10', 11, 'https://bandcamp.com/album/a10')
+    """,
+    """
+    INSERT INTO track(title, album_id, artist_id, url)
+    SELECT 'Track ' || i, i, i, 'https://bandcamp.com/track/t' || i
+    FROM generate_series(1, 9) AS i
+    """,
+    "INSERT INTO country(name) VALUES ('Country 1')",
+    """
+    INSERT INTO album_purchase(album_id, timestamp, amount_usd, country_id, purchase_key)
+    SELECT artist, LOCALTIMESTAMP - INTERVAL '1 minute' * n, 5, 1,
+           encode(sha256(('a' || artist || '-' || n)::BYTEA), 'hex')
+    FROM generate_series(1, 7) AS artist, generate_series(1, artist) AS n
+    """,
+    """
+    INSERT INTO track_purchase(track_id, timestamp, amount_usd, country_id, purchase_key)
+    SELECT artist, LOCALTIMESTAMP - INTERVAL '1 minute' * n, 1, 1,
+           encode(sha256(('t' || artist || '-' || n)::BYTEA), 'hex')
+    FROM generate_series(1, 7) AS artist, generate_series(1, 2 * artist) AS n
+    """,
+    """
+    INSERT INTO album_purchase(album_id, timestamp, amount_usd, country_id, purchase_key)
+    SELECT 10, LOCALTIMESTAMP - INTERVAL '1 minute' * n, 5, 1,
+           encode(sha256(('a10-' || n)::BYTEA), 'hex')
+    FROM generate_series(1, 3) AS n
+    """,
+]
+SEED_MISCOUNTED_SALES = [
+    """
+    INSERT INTO track_purchase(track_id, timestamp, amount_usd, country_id, purchase_key)
+    SELECT 8, LOCALTIMESTAMP - INTERVAL '1 minute' * n, 1, 1,
+           encode(sha256(('t8-' || n)::BYTEA), 'hex')
+    FROM generate_series(1, 10) AS n
+    """,
+    """
+    INSERT INTO album_purchase(album_id, timestamp, amount_usd, country_id, purchase_key)
+    SELECT 9, LOCALTIMESTAMP - INTERVAL '1 minute' * n, 5, 1,
+           encode(sha256(('a9-' || n)::BYTEA), 'hex')
+    FROM generate_series(1, 4) AS n
+    """,
+    """
+    INSERT INTO track_purchase(track_id, timestamp, amount_usd, country_id, purchase_key)
+    SELECT 9, LOCALTIMESTAMP - INTERVAL '2 days' - INTERVAL '1 minute' * n, 1, 1,
+           encode(sha256(('t9-' || n)::BYTEA), 'hex')
+    FROM generate_series(1, 20) AS n
+    """,
+]
+
+
+def get_records(data) -> list[dict]:
+    """Returns query results as a list of plain dicts."""
+    return pd.DataFrame(data).to_dict("records")
+
+
+@pytest.fixture(scope="module")
+def seeded_conn():
+    """Pytest fixture of a connection to a freshly seeded schema of its own."""
+    if "QUERY_PLAN_DB_URL" not in ENV:
+        pytest.skip("QUERY_PLAN_DB_URL is not set")
+
+    conn = psycopg.connect(ENV["QUERY_PLAN_DB_URL"], row_factory=dict_row, autocommit=True)
+    conn.execute(f"DROP SCHEMA IF EXISTS {TEST_SCHEMA} CASCADE")
+    conn.execute(f"CREATE SCHEMA {TEST_SCHEMA}")
+    conn.execute(f"SET search_path TO {TEST_SCHEMA}")
+    conn.execute(SCHEMA_PATH.read_text(encoding="utf-8"))
+    for statement in SEED_STATEMENTS:
+        conn.execute(statement)
+    conn.execute(ROLLUP_MIGRATION_PATH.read_text(encoding="utf-8"))
+    conn.autocommit = False
+    yield conn
+    conn.rollback()
+    conn.autocommit = True
+    conn.execute(f"DROP SCHEMA {TEST_SCHEMA} CASCADE")
+    conn.close()
+
+
+def test_popular_artists_matches_legacy(seeded_conn):  # pylint: disable=redefined-outer-name
+    """Tests that the top 5 artists, and their sales, are those the replaced query returns."""
+    legacy = seeded_conn.execute(LEGACY_POPULAR_ARTISTS.format(timeframe=TIMEFRAME)).fetchall()
+    popular = database.get_popular_artists.__wrapped__(seeded_conn, TIMEFRAME)
+    seeded_conn.rollback()
+
+    assert get_records(popular) == get_records(legacy)
+    assert list(popular["name"]) == ["Artist 7", "Artist 6", "Artist 5", "Artist 4", "Artist 3"]
+    assert list(popular["total_sales"]) == [21, 18, 15, 12, 9]
+
+
+def test_popular_artists_counts_each_kind_in_the_timeframe(seeded_conn):  # pylint: disable=redefined-outer-name
+    """Tests that an artist with only track sales is ranked, and that track
+    sales outside the timeframe are not counted, both of which the replaced
+    query got wrong."""
+    for statement in SEED_MISCOUNTED_SALES:
+        seeded_conn.execute(statement)
+    popular = database.get_popular_artists.__wrapped__(seeded_conn, TIMEFRAME)
+    seeded_conn.rollback()
+
+    assert list(popular["name"]) == ["Artist 7", "Artist 6", "Artist 5", "Artist 4", "Artist 8"]
+    assert get_records(popular)[-1] == {
+        "artist_id": 8, "name": "Artist 8", "album_sales": 0, "track_sales": 10,
+        "total_sales": 10, "artist_url": "https://artist8.bandcamp.com"}
+
+
+def test_sales_matches_legacy(seeded_conn):  # pylint: disable=redefined-outer-name
+    """Tests that every artist's album and track sales are those the replaced
+    query returns, including artists with none and artists sharing a name."""
+    legacy = seeded_conn.execute(LEGACY_SALES).fetchall()
+    sales = database.get_sales.__wrapped__(seeded_conn)
+    seeded_conn.rollback()
+
+    assert (sorted(get_records(sales), key=lambda row: row["name"])
+            == sorted(get_records(legacy), key=lambda row: row["name"]))
+    assert len(sales) == 10
+    assert get_records(sales[sales["name"] == "Artist 1"]) == [
+        {"name": "Artist 1", "album_sales": 4, "track_sales": 2}]
@@ -0,0 +1,291 @@
+"""Query plan regression tests for every query of the dashboard, the PDF report and
+the notifications.
+
+Builds schema.sql in a schema of its own on the Postgres at QUERY_PLAN_DB_URL,
+seeds it with synthetic artists, releases, tags and a year of purchases, rolled up
+by the migration that creates the hourly sales rollups, then runs each read path's
+real function on a connection that EXPLAINs every query before running it. Queries
+are planned with the default settings, and a test fails if a query reads every row
+of a table with more than SEQ_SCAN_ROW_THRESHOLD rows, through a sequential scan or
+an index scan with no index condition, counting the partitions of a purchase table
+together. Queries that read every row of a table by design, such as the all-time
+leaderboards, list the tables they may scan.
+Skipped unless QUERY_PLAN_DB_URL is set, and the seeded schema is dropped at the end.
+
+Run with: QUERY_PLAN_DB_URL="host=localhost dbname=postgres" pytest test_query_plans.py
+"""
+
+from importlib import import_module
+from os import environ as ENV
+from pathlib import Path
+import re
+import sys
+from types import ModuleType
+
+import pytest
+
+psycopg = pytest.importorskip("psycopg")
+pytest.importorskip("streamlit")
+pytest.importorskip("pandas")
+pytest.importorskip("boto3")
+
+# pylint: disable=wrong-import-position
+from psycopg.rows import dict_row, tuple_row
+
+# pylint: enable=wrong-import-position
+
+ROOT = Path(__file__).parent.parent
+
+
+def import_from(directory: str, name: str) -> ModuleType:
+    """Imports a module of a directory along with that directory's own time_window,
+    as the dashboard and the notifications each have one."""
+    sys.path.insert(0, str(ROOT / directory))
+    sys.modules.pop("time_window", None)
+    return import_module(name)
+
+
+database = import_from("dashboard", "database")
+queries = import_from("pdf_report", "queries")
+report = import_from("notifications", "report")
+
+SCHEMA_PATH = Path(__file__).parent / "schema.sql"
+ROLLUP_MIGRATION_PATH = Path(__file__).parent / "migrations" / "008_hourly_sales_rollups.sql"
+TEST_SCHEMA = "query_plan_test"
+SEQ_SCAN_ROW_THRESHOLD = 10000
+SEQ_SCAN_NODES = {"Seq Scan", "Parallel Seq Scan"}
+INDEX_SCAN_NODES = {"Index Scan", "Index Only Scan"}
+PURCHASES = ["album_purchase", "track_purchase"]
+
+SEED_STATEMENTS = [
+    """
+    INSERT INTO artist(name, url)
+    SELECT 'Artist ' || i, 'https://artist' || i || '.bandcamp.com'
+    FROM generate_series(1, 30000) AS i
+    """,
+    """
+    INSERT INTO album(title, artist_id, url)
+    SELECT 'Album ' || i, 1 + i % 30000, 'https://bandcamp.com/album/a' || i
+    FROM generate_series(1, 40000) AS i
+    """,
+    """
+    INSERT INTO track(title, album_id, artist_id, url)
+    SELECT 'Track ' || i, 1 + i % 40000, 1 + (i % 40000) % 30000,
+           'https://bandcamp.com/track/t' || i
+    FROM generate_series(1, 100000) AS i
+    """,
+    "INSERT INTO tag(name) SELECT 'genre' || i FROM generate_series(1, 300) AS i",
+    "INSERT INTO country(name) SELECT 'Country ' || i FROM generate_series(1, 100) AS i",
+    """
+    INSERT INTO album_tag_assignment(album_id, tag_id)
+    SELECT DISTINCT album_id, 1 + (album_id * 7 + n * 31) % 300
+    FROM generate_series(1, 40000) AS album_id, generate_series(1, 4) AS n
+    """,
+    """
+    INSERT INTO track_tag_assignment(track_id, tag_id)
+    SELECT DISTINCT track_id, 1 + (track_id * 7 + n * 31) % 300
+    FROM generate_series(1, 100000) AS track_id, generate_series(1, 4) AS n
+    """,
+    """
+    DO $$
+    DECLARE
+        partition_month DATE := date_trunc('month', LOCALTIMESTAMP - INTERVAL '12 months');
+    BEGIN
+        WHILE partition_month <= LOCALTIMESTAMP LOOP
+            EXECUTE format('CREATE TABLE %I PARTITION OF album_purchase '
+                           'FOR VALUES FROM (%L) TO (%L)',
+                           'album_purchase' || to_char(partition_month, '_YYYY_MM'),
+                           partition_month, partition_month + INTERVAL '1 month');
+            EXECUTE format('CREATE TABLE %I PARTITION OF track_purchase '
+                           'FOR VALUES FROM (%L) TO (%L)',
+                           'track_purchase' || to_char(partition_month, '_YYYY_MM'),
+                           partition_month, partition_month + INTERVAL '1 month');
+            partition_month := partition_month + INTERVAL '1 month';
+        END LOOP;
+    END $$
+    """,
+    """
+    INSERT INTO album_purchase(album_id, timestamp, amount_usd, country_id, purchase_key)
+    SELECT 1 + i % 40000, LOCALTIMESTAMP - INTERVAL '12 months' * (1 - i::FLOAT / 100000),
+           1 + i % 30, 1 + i % 100, encode(sha256(('a' || i)::BYTEA), 'hex')
+    FROM generate_series(1, 100000) AS i
+    """,
+    """
+    INSERT INTO track_purchase(track_id, timestamp, amount_usd, country_id, purchase_key)
+    SELECT 1 + i % 100000, LOCALTIMESTAMP - INTERVAL '12 months' * (1 - i::FLOAT / 200000),
+           1 + i % 30, 1 + i % 100, encode(sha256(('t' || i)::BYTEA), 'hex')
+    FROM generate_series(1, 200000) AS i
+    """,
+    ROLLUP_MIGRATION_PATH.read_text(encoding="utf-8"),
+    "ANALYZE",
+]
+GET_SCANNED_TABLE_ROWS = """
+    SELECT COALESCE(parent.relname, child.relname) AS table_name, child.reltuples
+    FROM pg_class AS child
+    JOIN pg_namespace ON pg_namespace.oid = child.relnamespace
+    LEFT JOIN pg_inherits ON pg_inherits.inhrelid = child.oid
+    LEFT JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent
+    WHERE pg_namespace.nspname = %s AND child.relname = ANY(%s)
+"""
+
+READ_PATHS = {
+    "dashboard.get_popular_tracks": (
+        lambda conn: database.get_popular_tracks.__wrapped__(conn, "1 day"), set()),
+    "dashboard.get_popular_albums": (
+        lambda conn: database.get_popular_albums.__wrapped__(conn, "1 day"), set()),
+    "dashboard.get_popular_artists": (
+        lambda conn: database.get_popular_artists.__wrapped__(conn, "1 day"), set()),
+    "dashboard.get_sales_by_tag": (
+        lambda conn: database.get_sales_by_tag.__wrapped__(conn, "1 day"), set()),
+    "dashboard.get_all_artists": (
+        database.get_all_artists.__wrapped__, {"artist"}),
+    "dashboard.get_all_tags": (
+        database.get_all_tags.__wrapped__, set()),
+    "dashboard.get_sales_by_country": (
+        database.get_sales_by_country.__wrapped__, {"country_hourly_sales"}),
+    "dashboard.get_all_album_titles": (
+        database.get_all_album_titles.__wrapped__, {"album"}),
+    "dashboard.get_track_sales_by_artist": (
+        lambda conn: database.get_track_sales_by_artist.__wrapped__(conn, "Artist 7"), set()),
+    "dashboard.get_album_sales_by_artist": (
+        lambda conn: database.get_album_sales_by_artist.__wrapped__(conn, "Artist 7"), set()),
+    "dashboard.get_sales": (
+        database.get_sales.__wrapped__, {"artist", "artist_hourly_sales"}),
+    "dashboard.get_all_tag_names": (
+        database.get_all_tag_names.__wrapped__, set()),
+    "dashboard.get_track_sales_by_tag": (
+        lambda conn: database.get_track_sales_by_tag.__wrapped__(conn, "genre7"), set()),
+    "dashboard.get_album_sales_by_tag": (
+        lambda conn: database.get_album_sales_by_tag.__wrapped__(conn, "genre7"), set()),
+    "pdf_report.get_top_5_artists_world_sales": (
+        lambda conn: queries.get_top_5_artists_world_sales(conn.cursor(row_factory=tuple_row)),
+        {"artist", "album", "track", *PURCHASES}),
+    "pdf_report.get_top_5_tags_world_sales": (
+        lambda conn: queries.get_top_5_tags_world_sales(conn.cursor(row_factory=tuple_row)),
+        {"album_tag_assignment", "track_tag_assignment", *PURCHASES}),
+    "pdf_report.get_top_5_tracks_world_sales": (
+        lambda conn: queries.get_top_5_tracks_world_sales(conn.cursor(row_factory=tuple_row)),
+        {"track", "track_purchase"}),
+    "pdf_report.get_top_5_countries_sales": (
+        lambda conn: queries.get_top_5_countries_sales(conn.cursor(row_factory=tuple_row)),
+        set(PURCHASES)),
+    "pdf_report.get_top_5_artists_volume_specific": (
+        lambda conn: queries.get_top_5_artists_volume_specific(
+            conn.cursor(row_factory=tuple_row), "Country 7"), {"artist"}),
+    "pdf_report.get_top_5_tag_volume_specific": (
+        lambda conn: queries.get_top_5_tag_volume_specific(
+            conn.cursor(row_factory=tuple_row), "Country 7"), set()),
+    "pdf_report.get_top_5_tracks_volume_specific": (
+        lambda conn: queries.get_top_5_tracks_volume_specific(
+            conn.cursor(row_factory=tuple_row), "Country 7"), {"track"}),
+    "notifications.get_sales_data_of_tag(album)": (
+        lambda conn: report.get_sales_data_of_tag(conn, "album", "genre7", 1), set()),
+    "notifications.get_sales_data_of_tag(track)": (
+        lambda conn: report.get_sales_data_of_tag(conn, "track", "genre7", 1), set()),
+}
+
+
+class ExplainingCursor:
+    """A cursor that EXPLAINs every query before running it, keeping the plans."""
+
+    def __init__(self, cursor, plans: list):
+        self.cursor = cursor
+        self.plans = plans
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cursor.close()
+
+    def execute(self, query: str, params=None, prepare=None) -> None:
+        """Plans the query, then runs it."""
+        query = re.sub(r"[\s;]+$", "", query)
+        self.cursor.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+        row = self.cursor.fetchone()
+        self.plans.append((row["QUERY PLAN"] if isinstance(row, dict) else row[0])[0]["Plan"])
+        self.cursor.execute(query, params, prepare=prepare)
+
+    def fetchall(self) -> list:
+        """Returns the rows of the last query."""
+        return self.cursor.fetchall()
+
+
+class ExplainingConnection:
+    """A connection whose cursors EXPLAIN every query they run."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.plans = []
+
+    def cursor(self, row_factory=None) -> ExplainingCursor:
+        """Returns an explaining cursor."""
+        return ExplainingCursor(self.conn.cursor(row_factory=row_factory), self.plans)
+
+    def rollback(self) -> None:
+        """Rolls back the connection."""
+        self.conn.rollback()
+
+
+def is_full_scan(plan: dict) -> bool:
+    """Returns whether a plan node reads every row of its relation, either
+    sequentially or through an index scan with no index condition."""
+    if plan["Node Type"] in SEQ_SCAN_NODES:
+        return True
+    return plan["Node Type"] in INDEX_SCAN_NODES and "Index Cond" not in plan
+
+
+def get_fully_scanned_relations(plan: dict) -> list[str]:
+    """Returns the relations read in full by the scans of a plan."""
+    relations = [plan["Relation Name"]] if is_full_scan(plan) else []
+    for child in plan.get("Plans", []):
+        relations.extend(get_fully_scanned_relations(child))
+    return relations
+
+
+@pytest.fixture(scope="module")
+def seeded_conn():
+    """Pytest fixture of a connection to a freshly seeded schema of its own."""
+    if "QUERY_PLAN_DB_URL" not in ENV:
+        pytest.skip("QUERY_PLAN_DB_URL is not set")
+
+    conn = psycopg.connect(ENV["QUERY_PLAN_DB_URL"], row_factory=dict_row, autocommit=True)
+    conn.execute(f"DROP SCHEMA IF EXISTS {TEST_SCHEMA} CASCADE")
+    conn.execute(f"CREATE SCHEMA {TEST_SCHEMA}")
+    conn.execute(f"SET search_path TO {TEST_SCHEMA}")
+    conn.execute(SCHEMA_PATH.read_text(encoding="utf-8"))
+    for statement in SEED_STATEMENTS:
+        conn.execute(statement)
+    conn.autocommit = False
+    yield conn
+    conn.rollback()
+    conn.autocommit = True
+    conn.execute(f"DROP SCHEMA {TEST_SCHEMA} CASCADE")
+    conn.close()
+
+
+@pytest.mark.parametrize("read_path", list(READ_PATHS))
+def test_no_large_seq_scans(seeded_conn, read_path):  # pylint: disable=redefined-outer-name
+    """Tests that a read path's queries only scan large tables through indexes,
+    apart from the tables it reads in full by design."""
+    run, full_scans = READ_PATHS[read_path]
+    explaining_conn = ExplainingConnection(seeded_conn)
+
+    run(explaining_conn)
+    seeded_conn.commit()
+    assert explaining_conn.plans, f"{read_path} ran no queries"
+
+    scanned = [relation for plan in explaining_conn.plans
+               for relation in get_fully_scanned_relations(plan)]
+    with seeded_conn.cursor() as cur:
+        cur.execute(GET_SCANNED_TABLE_ROWS, (TEST_SCHEMA, scanned))
+        rows = cur.fetchall()
+    seeded_conn.commit()
+
+    table_rows = {}
+    for row in rows:
+        table_rows[row["table_name"]] = (table_rows.get(row["table_name"], 0)
+                                         + max(row["reltuples"], 0))
+    too_large = {table: int(count) for table, count in table_rows.items()
+                 if count > SEQ_SCAN_ROW_THRESHOLD and table not in full_scans}
+    assert not too_large, f"{read_path} reads every row of {too_large}"